@@ -1,40 +1,33 @@
 import os
-import pandas as pd
 import streamlit as st
-from groq import Groq
 from dotenv import load_dotenv
+from llm_client import call_groq_routed, current_session_id
 import logging
 import time
 import smtplib
 import email.mime.text
 import email.mime.multipart
-from textblob import TextBlob
+from risk_rules import assess_risk
 import re
 import streamlit_authenticator as stauth
 import yaml
 from yaml.loader import SafeLoader
+from response_cache import get_response_cache, log_cache_stats
+from model_router import choose_route
+from prompt_builder import build_messages, history_budget
+from kb_passages import rank_kb_sentences
+from conversation_memory import get_session_memory, prior_turns
+from kb_shards import get_sharded_knowledge_base
+from kb_answer_engine import fallback_answer, fast_path_answer
+from risk_classifier import classify_risk
+from message_pipeline import StageGraph
 
 # Load environment variables
 load_dotenv()
 
-# Initialize Groq client
-try:
-    groq_client = Groq(api_key=os.getenv("GROQ_API_KEY"))
-except Exception as e:
-    groq_client = None
-    logging.warning(f"Groq client initialization fails: {e}")
-
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 
-# Crisis keywords for detection
-CRISIS_KEYWORDS = [
-    'suicide', 'kill myself', 'end my life', 'want to die', 'better off dead',
-    'no point living', 'can\'t go on', 'end it all', 'hurt myself', 'self harm',
-    'cutting', 'overdose', 'jump off', 'hang myself', 'worthless', 'hopeless',
-    'can\'t take it anymore', 'nobody cares', 'everyone would be better without me'
-]
-
 # Authentication configuration
 def load_authenticator():
     """Load or create authentication configuration"""
@@ -118,52 +111,16 @@ def analyze_sentiment_and_risk(text):
     Returns: (sentiment_score, risk_score, crisis_level, sentiment_label)
     """
     try:
-        # TextBlob sentiment analysis
-        blob = TextBlob(text.lower())
-        sentiment_score = blob.sentiment.polarity  # -1 to 1
-        
-        # Initialize risk score
-        risk_score = 0
-        
-        # Check for crisis keywords
-        crisis_count = sum(1 for keyword in CRISIS_KEYWORDS if keyword in text.lower())
-        
-        # Calculate risk based on sentiment and crisis keywords
-        if sentiment_score < -0.5:  # Very negative sentiment
-            risk_score += 3
-        elif sentiment_score < -0.2:  # Negative sentiment
-            risk_score += 2
-        elif sentiment_score < 0:  # Slightly negative
-            risk_score += 1
-            
-        # Add risk for crisis keywords
-        risk_score += crisis_count * 2
-        
-        # Additional risk factors
-        if any(word in text.lower() for word in ['depressed', 'anxiety', 'panic', 'scared']):
-            risk_score += 1
-            
-        # Cap risk score at 10
-        risk_score = min(risk_score, 10)
-        
-        # Determine crisis level
-        if risk_score >= 8:
-            crisis_level = "SEVERE"
-        elif risk_score >= 6:
-            crisis_level = "HIGH"
-        elif risk_score >= 4:
-            crisis_level = "MODERATE"
-        else:
-            crisis_level = "LOW"
-            
-        # Sentiment label
-        if sentiment_score > 0.1:
-            sentiment_label = "POSITIVE"
-        elif sentiment_score < -0.1:
-            sentiment_label = "NEGATIVE"
-        else:
-            sentiment_label = "NEUTRAL"
-            
+        # Trained classifier when RISK_CLASSIFIER=1, fitted to the same rule set as below
+        classified = classify_risk(text, "standard")
+        if classified is not None:
+            return classified
+    except Exception as e:
+        logging.error(f"Risk classifier error, using the keyword rules: {e}")
+
+    try:
+        # Keyword groups, polarity buckets and level thresholds from risk_rules.json ("standard" rule set)
+        sentiment_score, risk_score, crisis_level, sentiment_label, _ = assess_risk(text, "standard")
         return sentiment_score, risk_score, crisis_level, sentiment_label
         
     except Exception as e:
@@ -279,29 +236,6 @@ def display_crisis_intervention(risk_score, user_message, user_email, user_name)
             else:
                 st.warning("Please provide consent to proceed.")
 
-# Groq API client function
-def call_groq_api(messages, model="llama-3.3-70b-versatile", max_tokens=800, temperature=0.7):
-    """
-    Call Groq API for chat completions using the official SDK
-    """
-    try:
-        if not groq_client:
-            logging.error("Groq client not initialized")
-            return None
-
-        response = groq_client.chat.completions.create(
-            model=model,
-            messages=messages,
-            max_tokens=max_tokens,
-            temperature=temperature
-        )
-
-        return response.choices[0].message.content
-
-    except Exception as e:
-        logging.error(f"Groq API error: {e}")
-        return None
-
 # Load mental health dataset
 try:
     csv_paths = [
@@ -310,28 +244,11 @@ try:
         "Personalized_Mental_Healthcare-Chatbot-main/AI_Mental_Health.csv"
     ]
 
-    mentalhealth = None
-    csv_path_used = None
-
-    for csv_path in csv_paths:
-        try:
-            mentalhealth = pd.read_csv(csv_path)
-            csv_path_used = csv_path
-            break
-        except FileNotFoundError:
-            continue
-
-    if mentalhealth is not None:
-        knowledge_base = {}
-        for i in range(len(mentalhealth)):
-            question = str(mentalhealth.iloc[i]["Questions"]).lower()
-            answer = str(mentalhealth.iloc[i]["Answers"])
-            if question and answer and question != 'nan' and answer != 'nan':
-                knowledge_base[question] = answer
-
-        st.success(f"✅ Mental health dataset loaded successfully! ({len(knowledge_base)} Q&A pairs from {csv_path_used})")
-    else:
-        raise FileNotFoundError("CSV file not found in any expected location")
+    # AI_Mental_Health.csv is the "general" shard; kb_sources.json adds domain datasets
+    sharded_kb = get_sharded_knowledge_base(csv_paths)
+    knowledge_base = sharded_kb.current()
+    sources = ", ".join(f"{shard['name']}: {shard['entries']}" for shard in sharded_kb.shards())
+    st.success(f"✅ Mental health dataset loaded successfully! ({len(knowledge_base)} Q&A pairs from {sources})")
 
 except FileNotFoundError:
     st.error("❌ Mental health dataset not found.  Please ensure AI_Mental_Health.csv is in the correct location.")
@@ -340,14 +257,65 @@ except Exception as e:
     st.error(f"❌ Error loading mental health dataset: {e}")
     knowledge_base = {}
 
+def generate_authenticated_reply(analysis, direct_matches, input_text, user_name, chat_history, memory, session_id):
+    """
+    Generation stage: answer from the semantic cache or the routed Groq model
+    Runs on the stage pool, so it is handed session state instead of reading st.session_state
+    """
+    sentiment_score, risk_score, crisis_level, sentiment_label = analysis
+    if risk_score >= 6:
+        # Crisis intervention replaces the AI response
+        return None
+
+    # FAQ-style questions the knowledge base answers directly skip the model (low risk only)
+    kb_answer = fast_path_answer(knowledge_base, input_text, risk_score)
+    if kb_answer:
+        return kb_answer['response']
+
+    # Enhanced system prompt based on risk level
+    if risk_score >= 4:
+        system_prompt = f"You are WellBot, a compassionate mental health chatbot. The user {user_name} is showing signs of distress (Risk: {risk_score}/10, Sentiment: {sentiment_label}). Be extra empathetic, validate their feelings, and gently encourage professional help. Provide specific coping strategies and resources. Never diagnose."
+        default_context = "Mental health support for someone in distress"
+    else:
+        system_prompt = f"You are WellBot, a supportive mental health chatbot. The user {user_name} seems to be in a stable state (Risk: {risk_score}/10, Sentiment: {sentiment_label}). Provide helpful, encouraging responses while maintaining professional boundaries. Never diagnose."
+        default_context = "General mental health support"
+
+    # Paraphrases of recent low-risk opening questions are answered from the semantic cache;
+    # follow-ups depend on the conversation so they always go to the model
+    standalone = not prior_turns(chat_history, exclude_text=input_text)
+    response_cache = get_response_cache("authenticated")
+    bot_response = response_cache.lookup(input_text, risk_score, context=sentiment_label, user_name=user_name) if standalone else None
+    if bot_response is None:
+        # Generate response within the routed model's prompt token budget
+        route = choose_route(risk_score, sentiment_label, len(input_text))
+        history = memory.messages(chat_history, history_budget(route), exclude_text=input_text)
+        messages, relevant_context, prompt_tokens = build_messages(
+            system_prompt, input_text, direct_matches, route, default_context=default_context, history=history
+        )
+        bot_response = call_groq_routed(messages, route=route, temperature=0.7, session_id=session_id)
+        if standalone:
+            response_cache.store(input_text, bot_response, risk_score, context=sentiment_label, user_name=user_name)
+    log_cache_stats("authenticated")
+    return bot_response
+
 # Enhanced response generation with sentiment analysis and authentication
 def generate_authenticated_response(input_text, user_email, user_name):
     """
     Generate response with sentiment analysis and crisis detection for authenticated users
+    Sentiment analysis and KB retrieval run in parallel, and generation starts as soon as
+    both are done so the dashboard renders while the model is working
     """
     try:
-        # Analyze sentiment and risk
-        sentiment_score, risk_score, crisis_level, sentiment_label = analyze_sentiment_and_risk(input_text)
+        chat_history = list(st.session_state.get('authenticated_chat_history', []))
+        pipeline = StageGraph()
+        pipeline.add("analysis", analyze_sentiment_and_risk, input_text)
+        pipeline.add("retrieval", rank_kb_sentences, knowledge_base, input_text)
+        pipeline.add("generation", generate_authenticated_reply, input_text, user_name, chat_history,
+                     get_session_memory(st.session_state, 'authenticated_chat_history'), current_session_id(),
+                     deps=("analysis", "retrieval"))
+        pipeline.start()
+
+        sentiment_score, risk_score, crisis_level, sentiment_label = pipeline.result("analysis")
 
         # Display sentiment dashboard
         col1, col2, col3, col4 = st.columns(4)
@@ -364,40 +332,11 @@ def generate_authenticated_response(input_text, user_email, user_name):
         # Crisis intervention if high risk
         if risk_score >= 6:
             display_crisis_intervention(risk_score, input_text, user_email, user_name)
+            pipeline.report()
             return  # Don't generate normal response for crisis situations
 
-        # Search knowledge base
-        relevant_context = ""
-        user_input_lower = input_text.lower()
-        direct_matches = []
-
-        for question, answer in knowledge_base.items():
-            if any(word in question for word in user_input_lower.split()):
-                direct_matches.append((question, answer))
-                relevant_context += f"Q: {question}\nA: {answer}\n\n"
-
-        # Enhanced system prompt based on risk level
-        if risk_score >= 4:
-            system_prompt = f"""You are WellBot, a compassionate mental health chatbot. The user {user_name} is showing signs of distress (Risk: {risk_score}/10, Sentiment: {sentiment_label}). Be extra empathetic, validate their feelings, and gently encourage professional help. Provide specific coping strategies and resources. Never diagnose.
-
-            Context: {relevant_context[:1000] if relevant_context else 'Mental health support for someone in distress'}"""
-        else:
-            system_prompt = f"""You are WellBot, a supportive mental health chatbot. The user {user_name} seems to be in a stable state (Risk: {risk_score}/10, Sentiment: {sentiment_label}). Provide helpful, encouraging responses while maintaining professional boundaries. Never diagnose.
-
-            Context: {relevant_context[:1000] if relevant_context else 'General mental health support'}"""
-
-        # Generate response
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": input_text}
-        ]
-
-        bot_response = call_groq_api(
-            messages=messages,
-            model="llama-3.3-70b-versatile",
-            max_tokens=800,
-            temperature=0.7
-        )
+        bot_response = pipeline.result("generation")
+        pipeline.report()
 
         if bot_response:
             st.success("✅")
@@ -407,7 +346,10 @@ def generate_authenticated_response(input_text, user_email, user_name):
             if risk_score >= 3:
                 st.info("💙 **Additional Resources:** If you're struggling, consider reaching out to a mental health professional or calling 988 for support.")
         else:
-            st.error("❌ Unable to generate response. Please try again.")
+            # Groq is unavailable; answer from the knowledge base instead
+            st.warning("🔄 API temporarily unavailable. Using knowledge base...")
+            fallback_response, _ = fallback_answer(knowledge_base, input_text)
+            st.write("**🤖 WellBot (Knowledge Base):** " + fallback_response)
 
     except Exception as e:
         logging.error(f"Error in authenticated response generation: {e}")
@@ -424,33 +366,34 @@ def get_authenticated_bot_response(input_text, user_name):
         if risk_score >= 6:
             return f"🚨 CRISIS DETECTED (Risk: {risk_score}/10) - Please seek immediate help. Call 988 or emergency services."
 
-        # Search knowledge base
-        relevant_context = ""
-        user_input_lower = input_text.lower()
+        # FAQ-style questions the knowledge base answers directly skip the model (low risk only)
+        kb_answer = fast_path_answer(knowledge_base, input_text, risk_score)
+        if kb_answer:
+            return kb_answer['response']
 
-        for question, answer in knowledge_base.items():
-            if any(word in question for word in user_input_lower.split()):
-                relevant_context += f"Q: {question}\nA: {answer}\n\n"
-                break
+        # Search knowledge base (best match only for the history view)
+        direct_matches = rank_kb_sentences(knowledge_base, input_text, limit=1)
 
         # Enhanced system prompt
-        system_prompt = f"""You are WellBot, a mental health chatbot. User {user_name} sentiment: {sentiment_label} (Risk: {risk_score}/10). Respond appropriately to their emotional state. Be supportive and professional.
-
-        Context: {relevant_context[:800] if relevant_context else 'Mental health support'}"""
-
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": input_text}
-        ]
-
-        bot_response = call_groq_api(
-            messages=messages,
-            model="llama-3.3-70b-versatile",
-            max_tokens=600,
-            temperature=0.7
-        )
-
-        return bot_response if bot_response else f"I'm here to support you, {user_name}. Please try again or contact a professional if you need immediate help."
+        system_prompt = f"You are WellBot, a mental health chatbot. User {user_name} sentiment: {sentiment_label} (Risk: {risk_score}/10). Respond appropriately to their emotional state. Be supportive and professional."
+
+        chat_history = st.session_state.get('authenticated_chat_history', [])
+        standalone = not prior_turns(chat_history, exclude_text=input_text)
+        response_cache = get_response_cache("authenticated_history")
+        bot_response = response_cache.lookup(input_text, risk_score, context=sentiment_label, user_name=user_name) if standalone else None
+        if bot_response is None:
+            route = choose_route(risk_score, sentiment_label, len(input_text), max_tokens=600)
+            memory = get_session_memory(st.session_state, 'authenticated_chat_history')
+            history = memory.messages(chat_history, history_budget(route), exclude_text=input_text)
+            messages, relevant_context, prompt_tokens = build_messages(
+                system_prompt, input_text, direct_matches, route, default_context="Mental health support", history=history
+            )
+            bot_response = call_groq_routed(messages, route=route, temperature=0.7)
+            if standalone:
+                response_cache.store(input_text, bot_response, risk_score, context=sentiment_label, user_name=user_name)
+        log_cache_stats("authenticated_history")
+
+        return bot_response if bot_response else fallback_answer(knowledge_base, input_text)[0]
 
     except Exception as e:
         logging.error(f"Error in get_authenticated_bot_response: {e}")
@@ -1,47 +1,21 @@
-import os
-import pandas as pd
 import streamlit as st
-from groq import Groq
 from dotenv import load_dotenv
+from llm_client import call_groq_routed
+from model_router import choose_route
+from prompt_builder import build_messages, history_budget
+from kb_passages import rank_kb_sentences
+from conversation_memory import get_session_memory
+from kb_shards import get_sharded_knowledge_base
+from kb_answer_engine import KB_FALLBACK_MIN_CONFIDENCE, fallback_answer, fast_path_answer, get_answer_engine
 import logging
 import time
 
 # Load environment variables
 load_dotenv()
 
-# Initialize Groq client
-try:
-    groq_client = Groq(api_key=os.getenv("GROQ_API_KEY"))
-except Exception as e:
-    groq_client = None
-    logging.warning(f"Groq client initialization failed: {e}")
-
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 
-# Groq API client function
-def call_groq_api(messages, model="llama-3.3-70b-versatile", max_tokens=800, temperature=0.7):
-    """
-    Call Groq API for chat completions using the official SDK
-    """
-    try:
-        if not groq_client:
-            logging.error("Groq client not initialized")
-            return None
-
-        response = groq_client.chat.completions.create(
-            model=model,
-            messages=messages,
-            max_tokens=max_tokens,
-            temperature=temperature
-        )
-
-        return response.choices[0].message.content
-
-    except Exception as e:
-        logging.error(f"Groq API error: {e}")
-        return None
-
 # Load mental health dataset
 try:
     # Try different possible locations for the CSV file
@@ -51,29 +25,11 @@ try:
         "Personalized_Mental_Healthcare-Chatbot-main/AI_Mental_Health.csv"  # Full path
     ]
 
-    mentalhealth = None
-    csv_path_used = None
-
-    for csv_path in csv_paths:
-        try:
-            mentalhealth = pd.read_csv(csv_path)
-            csv_path_used = csv_path
-            break
-        except FileNotFoundError:
-            continue
-
-    if mentalhealth is not None:
-        # Create a knowledge base from the dataset
-        knowledge_base = {}
-        for i in range(len(mentalhealth)):
-            question = str(mentalhealth.iloc[i]["Questions"]).lower()
-            answer = str(mentalhealth.iloc[i]["Answers"])
-            if question and answer and question != 'nan' and answer != 'nan':
-                knowledge_base[question] = answer
-
-        st.success(f"✅ Mental health dataset loaded successfully! ({len(knowledge_base)} Q&A pairs from {csv_path_used})")
-    else:
-        raise FileNotFoundError("CSV file not found in any expected location")
+    # AI_Mental_Health.csv is the "general" shard; kb_sources.json adds domain datasets
+    sharded_kb = get_sharded_knowledge_base(csv_paths)
+    knowledge_base = sharded_kb.current()
+    sources = ", ".join(f"{shard['name']}: {shard['entries']}" for shard in sharded_kb.shards())
+    st.success(f"✅ Mental health dataset loaded successfully! ({len(knowledge_base)} Q&A pairs from {sources})")
 
 except FileNotFoundError:
     st.error("❌ Mental health dataset not found. Please ensure AI_Mental_Health.csv is in the correct location.")
@@ -93,49 +49,35 @@ def get_voice_input():
 # Define function for generating responses
 def generate_response(input_text):
     try:
-        # Check if we have a direct match in our knowledge base first
-        relevant_context = ""
-        user_input_lower = input_text.lower()
-
-        # Search for relevant information in knowledge base
-        direct_matches = []
-        for question, answer in knowledge_base.items():
-            if any(word in question for word in user_input_lower.split()):
-                direct_matches.append((question, answer))
-                relevant_context += f"Q: {question}\nA: {answer}\n\n"
-
-        # TEMPORARILY DISABLED FOR GROQ API TESTING
-        # Force all queries to use Groq API instead of knowledge base
-        if False:  # len(direct_matches) >= 1:
+        # Questions the knowledge base answers directly skip Groq; without a risk score only exact question matches qualify
+        kb_answer = fast_path_answer(knowledge_base, input_text)
+
+        if kb_answer:
             st.write("**🤖 Mental Health Assistant:** Based on our mental health knowledge base:")
 
             # Show the most relevant answer
-            best_match = direct_matches[0]
-            st.write(f"**Q:** {best_match[0].title()}")
-            st.write(f"**A:** {best_match[1]}")
+            st.write(f"**Q:** {kb_answer['question'].title()}")
+            st.write(f"**A:** {kb_answer['response']}")
 
             # Add supportive message
             st.write("\n💙 **Additional Support:** Remember that seeking professional help is always a good step when dealing with mental health concerns.")
 
         else:
             # Only use Grok API if no good knowledge base matches
+            # Rank knowledge base matches; the prompt builder packs whole passages into the token budget
+            direct_matches = rank_kb_sentences(knowledge_base, input_text)
+
             # Create a comprehensive mental health focused prompt
-            system_prompt = f"""You are WellBot, a compassionate mental health chatbot. Be empathetic, supportive, and encourage professional help when needed. Never diagnose. Provide complete, helpful responses in 2-3 paragraphs. Always finish your thoughts completely and provide actionable advice.
+            system_prompt = "You are WellBot, a compassionate mental health chatbot. Be empathetic, supportive, and encourage professional help when needed. Never diagnose. Provide complete, helpful responses in 2-3 paragraphs. Always finish your thoughts completely and provide actionable advice."
 
-            Context: {relevant_context[:1000] if relevant_context else 'General mental health support'}"""
+            # No risk scoring in this app, so the router always picks the large model
+            route = choose_route(message_length=len(input_text))
+            memory = get_session_memory(st.session_state, 'chat_history')
+            history = memory.messages(st.session_state.get('chat_history', []), history_budget(route), exclude_text=input_text)
+            messages, relevant_context, prompt_tokens = build_messages(system_prompt, input_text, direct_matches, route, history=history)
 
             # Generate responses using Groq API
-            messages = [
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": input_text}
-            ]
-
-            bot_response = call_groq_api(
-                messages=messages,
-                model="llama-3.3-70b-versatile",
-                max_tokens=800,  # Increased for complete responses
-                temperature=0.7
-            )
+            bot_response = call_groq_routed(messages, route=route, temperature=0.7)
 
             # No character limit - let responses be complete
 
@@ -146,9 +88,7 @@ def generate_response(input_text):
             else:
                 # Fallback to knowledge base if API fails
                 st.warning("🔄 API temporarily unavailable. Using knowledge base...")
-                fallback_response = "I'm here to support you. While I'm having technical difficulties, please know that your feelings are valid and seeking help is always a good step."
-                if relevant_context:
-                    fallback_response += f"\n\n {relevant_context[:200]}..."
+                fallback_response, _ = fallback_answer(knowledge_base, input_text)
                 st.write("**🤖 WellBot (Knowledge Base):** " + fallback_response)
 
         # Show disclaimer
@@ -181,13 +121,11 @@ def generate_response(input_text):
         # Provide fallback response from knowledge base
         if knowledge_base:
             st.info("**Using Knowledge Base Instead:**")
-            # Find any relevant info from knowledge base
-            user_words = input_text.lower().split()
-            for question, answer in list(knowledge_base.items())[:3]:
-                if any(word in question for word in user_words):
-                    st.write(f"**Q:** {question.title()}")
-                    st.write(f"**A:** {answer}")
-                    break
+            # Find the most relevant info from knowledge base
+            kb_answer = get_answer_engine(knowledge_base).answer(input_text)
+            if kb_answer and kb_answer['confidence'] >= KB_FALLBACK_MIN_CONFIDENCE:
+                st.write(f"**Q:** {kb_answer['question'].title()}")
+                st.write(f"**A:** {kb_answer['response']}")
             else:
                 st.write("Please try asking about specific mental health topics like anxiety, depression, or stress management.")
         else:
@@ -198,48 +136,31 @@ def generate_response(input_text):
 def get_bot_response(input_text):
     """Get bot response as string without displaying in Streamlit"""
     try:
-        # Check if we have a direct match in our knowledge base first
-        relevant_context = ""
-        user_input_lower = input_text.lower()
-
-        # Search for relevant information in knowledge base
-        direct_matches = []
-        for question, answer in knowledge_base.items():
-            if any(word in question for word in user_input_lower.split()):
-                direct_matches.append((question, answer))
-                relevant_context += f"Q: {question}\nA: {answer}\n\n"
-
-        # TEMPORARILY DISABLED FOR GROQ API TESTING - Force Groq API
-        if False:  # len(direct_matches) >= 1:
-            best_match = direct_matches[0]
-            return f"Based on our knowledge base:\n\nQ: {best_match[0].title()}\nA: {best_match[1]}\n\n💙 Remember: This is support information. For professional help, please consult a qualified mental health professional."
+        # Questions the knowledge base answers directly skip Groq; without a risk score only exact question matches qualify
+        kb_answer = fast_path_answer(knowledge_base, input_text)
+        if kb_answer:
+            return f"Based on our knowledge base:\n\nQ: {kb_answer['question'].title()}\nA: {kb_answer['response']}\n\n💙 Remember: This is support information. For professional help, please consult a qualified mental health professional."
         else:
             # Use Groq API
-            system_prompt = f"""You are WellBot, a compassionate mental health chatbot. Be empathetic, supportive, and encourage professional help when needed. Never diagnose. Provide complete, helpful responses in 2-3 paragraphs. Always finish your thoughts completely and provide actionable advice.
+            # Rank knowledge base matches; the prompt builder packs whole passages into the token budget
+            direct_matches = rank_kb_sentences(knowledge_base, input_text)
 
-            Context: {relevant_context[:1000] if relevant_context else 'General mental health support'}"""
+            system_prompt = "You are WellBot, a compassionate mental health chatbot. Be empathetic, supportive, and encourage professional help when needed. Never diagnose. Provide complete, helpful responses in 2-3 paragraphs. Always finish your thoughts completely and provide actionable advice."
 
-            messages = [
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": input_text}
-            ]
+            route = choose_route(message_length=len(input_text))
+            memory = get_session_memory(st.session_state, 'chat_history')
+            history = memory.messages(st.session_state.get('chat_history', []), history_budget(route), exclude_text=input_text)
+            messages, relevant_context, prompt_tokens = build_messages(system_prompt, input_text, direct_matches, route, history=history)
 
-            bot_response = call_groq_api(
-                messages=messages,
-                model="llama-3.3-70b-versatile",
-                max_tokens=800,
-                temperature=0.7
-            )
+            bot_response = call_groq_routed(messages, route=route, temperature=0.7)
 
             # No character limit - let responses be complete
 
             if bot_response:
                 return bot_response
             else:
-                # Fallback response
-                fallback_response = "I'm here to support you. While I'm having technical difficulties, please know that your feelings are valid and seeking help is always a good step."
-                if relevant_context:
-                    fallback_response += f"\n\n {relevant_context[:200]}..."
+                # Fallback response from the knowledge base
+                fallback_response, _ = fallback_answer(knowledge_base, input_text)
                 return fallback_response
 
     except Exception as e:
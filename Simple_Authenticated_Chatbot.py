@@ -1,39 +1,30 @@
 import os
-import pandas as pd
 import streamlit as st
-from groq import Groq
 from dotenv import load_dotenv
+from llm_client import call_groq_routed, current_session_id
 import logging
 import time
 import smtplib
 import email.mime.text
 import email.mime.multipart
-from textblob import TextBlob
+from risk_rules import assess_risk
 import hashlib
+from response_cache import get_response_cache, log_cache_stats
+from model_router import choose_route
+from prompt_builder import build_messages, history_budget
+from kb_passages import rank_kb_sentences
+from conversation_memory import get_session_memory, prior_turns
+from kb_shards import get_sharded_knowledge_base
+from kb_answer_engine import fallback_answer, fast_path_answer
+from risk_classifier import classify_risk
+from message_pipeline import StageGraph, enqueue_alert
 
 # Load environment variables
 load_dotenv()
 
-# Initialize Groq client
-try:
-    groq_client = Groq(api_key=os.getenv("GROQ_API_KEY"))
-except Exception as e:
-    groq_client = None
-    logging.warning(f"Groq client initialization failed: {e}")
-
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 
-# Crisis keywords for detection
-CRISIS_KEYWORDS = [
-    'suicide', 'kill myself', 'end my life', 'want to die', 'better off dead',
-    'no point living', 'can\'t go on', 'end it all', 'hurt myself', 'self harm',
-    'cutting', 'cut myself', 'want to cut', 'going to cut', 'overdose', 'jump off',
-    'hang myself', 'worthless', 'hopeless', 'can\'t take it anymore', 'can\'t take this anymore',
-    'nobody cares', 'everyone would be better without me', 'want to kill myself',
-    'going to kill myself', 'self-harm', 'self injury', 'harm myself', 'injure myself', 'bleeding'
-]
-
 # Simple user database (in production, use a proper database)
 USER_DB_FILE = "users.txt"
 
@@ -88,64 +79,20 @@ def analyze_sentiment_and_risk(text):
     Simple sentiment analysis using TextBlob and crisis keyword detection
     """
     try:
-        # Simple TextBlob sentiment analysis (like your example)
-        blob = TextBlob(text)
-        sentiment = blob.sentiment
-        polarity = sentiment.polarity  # -1 (negative) to 1 (positive)
-        subjectivity = sentiment.subjectivity  # 0 (objective) to 1 (subjective)
-
-        # Check for crisis keywords
-        text_lower = text.lower()
-        crisis_keywords_found = []
-        for keyword in CRISIS_KEYWORDS:
-            if keyword in text_lower:
-                crisis_keywords_found.append(keyword)
-
-        # Calculate risk score based on keywords and sentiment
-        risk_score = 0
-
-        # Crisis keywords are the primary indicator
-        if crisis_keywords_found:
-            risk_score += len(crisis_keywords_found) * 4  # Each keyword adds 4 points
-
-        # Sentiment-based risk (secondary factor)
-        if polarity <= -0.5:  # Very negative
-            risk_score += 3
-        elif polarity <= -0.2:  # Negative
-            risk_score += 2
-        elif polarity < 0:  # Slightly negative
-            risk_score += 1
-
-        # Mental health indicators
-        mental_health_words = ['depressed', 'depression', 'anxiety', 'anxious', 'panic', 'scared', 'suicidal', 'desperate', 'overwhelmed']
-        mental_health_count = sum(1 for word in mental_health_words if word in text_lower)
-        if mental_health_count > 0:
-            risk_score += mental_health_count
-
-        # Cap at 10
-        risk_score = min(risk_score, 10)
-
-        # Determine crisis level
-        if risk_score >= 8:
-            crisis_level = "SEVERE"
-        elif risk_score >= 6:
-            crisis_level = "HIGH"
-        elif risk_score >= 4:
-            crisis_level = "MODERATE"
-        else:
-            crisis_level = "LOW"
+        # Trained classifier when RISK_CLASSIFIER=1, fitted to the same rule set as below
+        classified = classify_risk(text, "simple")
+        if classified is not None:
+            return classified
+    except Exception as e:
+        logging.error(f"Risk classifier error, using the keyword rules: {e}")
 
-        # Sentiment label based on polarity
-        if polarity > 0.1:
-            sentiment_label = "POSITIVE"
-        elif polarity < -0.1:
-            sentiment_label = "NEGATIVE"
-        else:
-            sentiment_label = "NEUTRAL"
+    try:
+        # Keyword groups, polarity buckets and level thresholds from risk_rules.json ("simple" rule set)
+        polarity, risk_score, crisis_level, sentiment_label, keywords_found = assess_risk(text, "simple")
 
         # Debug info for crisis detection
-        if crisis_keywords_found:
-            print(f"DEBUG: Crisis keywords found: {crisis_keywords_found}")
+        if keywords_found:
+            print(f"DEBUG: Risk keywords found: {keywords_found}")
             print(f"DEBUG: Polarity: {polarity}, Risk: {risk_score}")
 
         return polarity, risk_score, crisis_level, sentiment_label
@@ -303,29 +250,6 @@ def display_crisis_intervention(risk_score, user_message, user_email, user_name)
     #         else:
     #             st.warning("Please provide consent to proceed.")
 
-# Groq API client function
-def call_groq_api(messages, model="llama-3.3-70b-versatile", max_tokens=800, temperature=0.7):
-    """
-    Call Groq API for chat completions
-    """
-    try:
-        if not groq_client:
-            logging.error("Groq client not initialized")
-            return None
-
-        response = groq_client.chat.completions.create(
-            model=model,
-            messages=messages,
-            max_tokens=max_tokens,
-            temperature=temperature
-        )
-
-        return response.choices[0].message.content
-
-    except Exception as e:
-        logging.error(f"Groq API error: {e}")
-        return None
-
 # Load mental health dataset
 try:
     csv_paths = [
@@ -334,37 +258,61 @@ try:
         "Personalized_Mental_Healthcare-Chatbot-main/AI_Mental_Health.csv"
     ]
 
-    mentalhealth = None
-    csv_path_used = None
-
-    for csv_path in csv_paths:
-        try:
-            mentalhealth = pd.read_csv(csv_path)
-            csv_path_used = csv_path
-            break
-        except FileNotFoundError:
-            continue
-
-    if mentalhealth is not None:
-        knowledge_base = {}
-        for i in range(len(mentalhealth)):
-            question = str(mentalhealth.iloc[i]["Questions"]).lower()
-            answer = str(mentalhealth.iloc[i]["Answers"])
-            if question and answer and question != 'nan' and answer != 'nan':
-                knowledge_base[question] = answer
-    else:
-        knowledge_base = {}
+    # AI_Mental_Health.csv is the "general" shard; kb_sources.json adds domain datasets
+    knowledge_base = get_sharded_knowledge_base(csv_paths).current()
 
 except Exception as e:
     knowledge_base = {}
 
+def generate_reply(analysis, passages, input_text, user_name, chat_history, memory, session_id):
+    """
+    Generation stage: answer from the semantic cache or the routed Groq model
+    Runs on the stage pool, so it is handed session state instead of reading st.session_state
+    """
+    sentiment_score, risk_score, crisis_level, sentiment_label = analysis
+    if risk_score >= 6:
+        # Crisis intervention replaces the AI response
+        return None
+
+    # FAQ-style questions the knowledge base answers directly skip the model (low risk only)
+    kb_answer = fast_path_answer(knowledge_base, input_text, risk_score)
+    if kb_answer:
+        return kb_answer['response']
+
+    system_prompt = f"""You are WellBot, a compassionate mental health chatbot. The user {user_name} has a risk score of {risk_score}/10 and sentiment: {sentiment_label}. Respond appropriately to their emotional state. Be supportive and professional. Never diagnose."""
+
+    # Paraphrases of recent low-risk opening questions are answered from the semantic cache;
+    # follow-ups depend on the conversation so they always go to the model
+    standalone = not prior_turns(chat_history, exclude_text=input_text)
+    response_cache = get_response_cache("simple_authenticated")
+    bot_response = response_cache.lookup(input_text, risk_score, context=sentiment_label, user_name=user_name) if standalone else None
+    if bot_response is None:
+        route = choose_route(risk_score, sentiment_label, len(input_text))
+        history = memory.messages(chat_history, history_budget(route), exclude_text=input_text)
+        messages, _, prompt_tokens = build_messages(system_prompt, input_text, passages, route, default_context=None, history=history)
+        bot_response = call_groq_routed(messages, route=route, session_id=session_id)
+        if standalone:
+            response_cache.store(input_text, bot_response, risk_score, context=sentiment_label, user_name=user_name)
+    log_cache_stats("simple_authenticated")
+    return bot_response
+
 def generate_response(input_text, user_email, user_name, user_phone=None):
     """
     Generate response with sentiment analysis and crisis detection
+    Sentiment analysis and KB retrieval run in parallel; generation starts as soon as both
+    are done, while the dashboard renders and any crisis alert is queued
     """
     try:
-        # Analyze sentiment and risk
-        sentiment_score, risk_score, crisis_level, sentiment_label = analyze_sentiment_and_risk(input_text)
+        chat_history = list(st.session_state.get('chat_history', []))
+        pipeline = StageGraph()
+        pipeline.add("analysis", analyze_sentiment_and_risk, input_text)
+        pipeline.add("retrieval", rank_kb_sentences, knowledge_base, input_text, limit=1)
+        pipeline.add("generation", generate_reply, input_text, user_name, chat_history,
+                     get_session_memory(st.session_state, 'chat_history'), current_session_id(),
+                     deps=("analysis", "retrieval"))
+        pipeline.start()
+
+        sentiment_score, risk_score, crisis_level, sentiment_label = pipeline.result("analysis")
         
         # Display prominent sentiment dashboard
         st.markdown("### 📊 **Sentiment Analysis Results**")
@@ -395,29 +343,19 @@ def generate_response(input_text, user_email, user_name, user_phone=None):
         
         # Automatic email alert for moderate to critical risk
         if risk_score >= 4:
-            # Send automatic email alert for moderate+ risk
+            # Send automatic email alert for moderate+ risk; SMTP runs on the alert queue
             auto_contact_info = f"Automatic alert triggered by sentiment analysis\nRisk Level: {crisis_level}\nPhone: {user_phone if user_phone and user_phone != 'Not provided' else 'Not provided'}"
-            email_sent = send_crisis_alert(user_email, user_name, input_text, risk_score, auto_contact_info)
-
-            # if email_sent:
-            #     st.warning(f"🚨 **Alert Sent**: Risk level {crisis_level} detected. Counselor has been notified automatically.")
-            # else:
-            #     st.error("⚠️ **Alert Failed**: Unable to send automatic alert. Please contact emergency services if needed.")
+            enqueue_alert(send_crisis_alert, user_email, user_name, input_text, risk_score, auto_contact_info)
 
         # Crisis intervention interface for high risk
         if risk_score >= 6:
             display_crisis_intervention(risk_score, input_text, user_email, user_name)
+            pipeline.report()
             return
         
         # Generate AI response
-        system_prompt = f"""You are WellBot, a compassionate mental health chatbot. The user {user_name} has a risk score of {risk_score}/10 and sentiment: {sentiment_label}. Respond appropriately to their emotional state. Be supportive and professional. Never diagnose."""
-        
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": input_text}
-        ]
-        
-        bot_response = call_groq_api(messages=messages)
+        bot_response = pipeline.result("generation")
+        pipeline.report()
         
         if bot_response:
             st.success("✅")
@@ -426,7 +364,10 @@ def generate_response(input_text, user_email, user_name, user_phone=None):
             if risk_score >= 3:
                 st.info("💙 **Additional Resources:** If you're struggling, consider reaching out to a mental health professional or calling 988 for support.")
         else:
-            st.error("❌ Unable to generate response. Please try again.")
+            # Groq is unavailable; answer from the knowledge base instead
+            st.warning("🔄 API temporarily unavailable. Using knowledge base...")
+            fallback_response, _ = fallback_answer(knowledge_base, input_text)
+            st.write("**🤖 WellBot (Knowledge Base):** " + fallback_response)
             
     except Exception as e:
         logging.error(f"Error in response generation: {e}")
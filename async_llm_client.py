@@ -0,0 +1,293 @@
+"""
+Asyncio-based Groq client path
+All completions run on one shared event loop in a background worker thread,
+so hundreds of requests can be in flight without a blocked thread each
+"""
+
+import os
+import asyncio
+import logging
+import threading
+import time
+import concurrent.futures
+import weakref
+from collections import deque
+from groq import AsyncGroq
+from dotenv import load_dotenv
+
+import metrics
+from model_router import LATENCY_MIN_SAMPLES, get_latency_tracker, record_latency
+
+# Load environment variables
+load_dotenv()
+
+MAX_CONCURRENT_COMPLETIONS = int(os.getenv("GROQ_MAX_CONCURRENCY", "256"))
+DEFAULT_TIMEOUT_SECONDS = 30.0
+# Extra time the sync wrapper waits beyond the request timeout before giving up itself
+SYNC_WAIT_GRACE_SECONDS = 5.0
+
+# Hedged requests: opt in with GROQ_HEDGE_REQUESTS=1. A second request is sent when the
+# first has not answered within the model's recent HEDGE_PERCENTILE latency
+HEDGE_REQUESTS = os.getenv("GROQ_HEDGE_REQUESTS", "0") == "1"
+HEDGE_PERCENTILE = 95
+HEDGE_DEFAULT_DELAY_SECONDS = 3.0
+HEDGE_MIN_DELAY_SECONDS = 0.3
+# At most this fraction of requests (plus a small burst) may be hedged
+HEDGE_MAX_RATE = float(os.getenv("GROQ_HEDGE_MAX_RATE", "0.05"))
+HEDGE_BURST = 2.0
+
+# Initialize async Groq client
+try:
+    async_groq_client = AsyncGroq(api_key=os.getenv("GROQ_API_KEY"))
+except Exception as e:
+    async_groq_client = None
+    logging.warning(f"Async Groq client initialization failed: {e}")
+
+class RequestSuperseded(Exception):
+    """The request was cancelled because the same session submitted a newer one"""
+
+_loop = None
+_loop_lock = threading.Lock()
+# asyncio primitives belong to one loop, so each loop that runs completions gets its own limit
+_semaphores = weakref.WeakKeyDictionary()
+_semaphores_lock = threading.Lock()
+
+def get_event_loop():
+    """Return the shared event loop, starting its worker thread on first use"""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            started = threading.Event()
+
+            def run():
+                asyncio.set_event_loop(loop)
+                loop.call_soon(started.set)
+                loop.run_forever()
+
+            threading.Thread(target=run, name="groq-async-loop", daemon=True).start()
+            started.wait()
+            _loop = loop
+        return _loop
+
+def _loop_semaphore():
+    """Concurrency limit of the running event loop, created on its first completion"""
+    loop = asyncio.get_running_loop()
+    with _semaphores_lock:
+        semaphore = _semaphores.get(loop)
+        if semaphore is None:
+            semaphore = _semaphores[loop] = asyncio.Semaphore(MAX_CONCURRENT_COMPLETIONS)
+        return semaphore
+
+async def acomplete(messages, model, max_tokens, temperature, timeout=None):
+    """
+    Async chat completion with bounded concurrency and a timeout
+    Returns (content, usage); content is None on failure or timeout
+    """
+    if not async_groq_client:
+        logging.error("Async Groq client not initialized")
+        return None, None
+
+    timeout = timeout or DEFAULT_TIMEOUT_SECONDS
+    async with _loop_semaphore():
+        metrics.inc_gauge("llm_async_in_flight")
+        start = time.perf_counter()
+        try:
+            response = await asyncio.wait_for(
+                async_groq_client.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    max_tokens=max_tokens,
+                    temperature=temperature
+                ),
+                timeout
+            )
+            record_latency(model, time.perf_counter() - start)
+            return response.choices[0].message.content, getattr(response, 'usage', None)
+
+        except asyncio.TimeoutError:
+            record_latency(model, time.perf_counter() - start)
+            metrics.increment("llm_async_timeouts")
+            logging.error(f"Groq API timeout after {timeout}s ({model})")
+            return None, None
+
+        except asyncio.CancelledError:
+            metrics.increment("llm_async_cancelled")
+            raise
+
+        except Exception as e:
+            record_latency(model, time.perf_counter() - start)
+            logging.error(f"Groq API error: {e}")
+            return None, None
+
+        finally:
+            metrics.dec_gauge("llm_async_in_flight")
+
+# Latest request per session, so a re-submit cancels the request it replaces
+_session_requests = {}
+_session_lock = threading.Lock()
+
+def current_session_id():
+    """Streamlit session id of the calling script thread, or None outside Streamlit"""
+    try:
+        from streamlit.runtime.scriptrunner import get_script_run_ctx
+        ctx = get_script_run_ctx(suppress_warning=True)
+        return ctx.session_id if ctx else None
+    except Exception:
+        return None
+
+def submit(coroutine, session_id=None):
+    """
+    Schedule a coroutine on the shared loop and return a concurrent.futures.Future
+    With a session_id, any earlier unfinished request from that session is cancelled
+    """
+    future = asyncio.run_coroutine_threadsafe(coroutine, get_event_loop())
+    if session_id is not None:
+        with _session_lock:
+            previous = _session_requests.get(session_id)
+            _session_requests[session_id] = future
+        if previous is not None and not previous.done():
+            previous.cancel()
+            metrics.increment("llm_superseded_requests")
+        future.add_done_callback(lambda f: _forget(session_id, f))
+    return future
+
+def _forget(session_id, future):
+    with _session_lock:
+        if _session_requests.get(session_id) is future:
+            del _session_requests[session_id]
+
+def cancel_session(session_id):
+    """Cancel the in-flight request of a session that has gone away"""
+    with _session_lock:
+        future = _session_requests.pop(session_id, None)
+    if future is not None and not future.done():
+        future.cancel()
+        return True
+    return False
+
+class HedgeBudget:
+    """
+    Token bucket capping hedges to a fraction of requests
+    Every request deposits `rate` tokens (up to `burst`); a hedge spends one
+    """
+
+    def __init__(self, rate=HEDGE_MAX_RATE, burst=HEDGE_BURST):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self.tokens = min(self.burst, self.tokens + self.rate)
+
+    def withdraw(self):
+        with self._lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+_hedge_budget = HedgeBudget()
+# Latencies of slow requests the rate cap kept from hedging, used to estimate hedge savings
+_unhedged_stragglers = deque(maxlen=50)
+
+def hedge_delay(model):
+    """Seconds to wait for the first request before hedging, from the model's recent latency"""
+    tracker = get_latency_tracker(model)
+    if len(tracker.recent()) < LATENCY_MIN_SAMPLES:
+        return HEDGE_DEFAULT_DELAY_SECONDS
+    return max(HEDGE_MIN_DELAY_SECONDS, tracker.percentile(HEDGE_PERCENTILE))
+
+async def ahedged_complete(messages, model, max_tokens, temperature, timeout=None, delay=None):
+    """
+    acomplete with a backup request if the first is slow
+    Whichever request answers first wins and the other is cancelled; a failed answer
+    waits for the other request instead. Returns (content, usage)
+    """
+    timeout = timeout or DEFAULT_TIMEOUT_SECONDS
+    delay = hedge_delay(model) if delay is None else delay
+    _hedge_budget.deposit()
+    start = time.perf_counter()
+
+    primary = asyncio.ensure_future(acomplete(messages, model, max_tokens, temperature, timeout))
+    tasks = {primary}
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if done or delay >= timeout or not _hedge_budget.withdraw():
+            if done or delay >= timeout:
+                return await primary
+            metrics.increment("llm_hedges_skipped")
+            result = await primary
+            _unhedged_stragglers.append(time.perf_counter() - start)
+            return result
+
+        metrics.increment("llm_hedges_fired")
+        hedge = asyncio.ensure_future(acomplete(messages, model, max_tokens, temperature, timeout - delay))
+        tasks.add(hedge)
+        result = (None, None)
+        while tasks:
+            done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            winner = next((task for task in done if task.result()[0] is not None), None)
+            if winner is not None:
+                result = winner.result()
+                break
+
+        if winner is hedge:
+            elapsed = time.perf_counter() - start
+            metrics.increment("llm_hedges_won")
+            # The cancelled request's latency is unknown; compare against slow requests that were
+            # not hedged, or the recent tail before any have been seen
+            if _unhedged_stragglers:
+                expected = sum(_unhedged_stragglers) / len(_unhedged_stragglers)
+            else:
+                expected = get_latency_tracker(model).percentile(99) or elapsed
+            metrics.observe("llm_hedge_saved_seconds", max(0.0, expected - elapsed))
+        return result
+    finally:
+        for task in tasks:
+            task.cancel()
+
+def get_hedging_stats():
+    """How often hedging fired, won and was skipped by the rate cap"""
+    data = metrics.snapshot()
+    saved = data['summaries'].get("llm_hedge_saved_seconds", {'sum': 0.0})
+    return {
+        'fired': data['counters'].get("llm_hedges_fired", 0),
+        'won': data['counters'].get("llm_hedges_won", 0),
+        'skipped_by_rate_cap': data['counters'].get("llm_hedges_skipped", 0),
+        'estimated_seconds_saved': saved['sum']
+    }
+
+def complete_sync(messages, model, max_tokens, temperature, timeout=None, session_id=None):
+    """
+    Blocking wrapper over acomplete (or ahedged_complete when hedging is on) for the Streamlit apps
+    Raises RequestSuperseded if a newer request from the same session replaced this one;
+    if the calling thread is interrupted, the upstream request is cancelled too
+    """
+    timeout = timeout or DEFAULT_TIMEOUT_SECONDS
+    complete = ahedged_complete if HEDGE_REQUESTS else acomplete
+    future = submit(complete(messages, model, max_tokens, temperature, timeout), session_id)
+    try:
+        return future.result(timeout + SYNC_WAIT_GRACE_SECONDS)
+    except concurrent.futures.CancelledError:
+        raise RequestSuperseded(f"request for session {session_id} was superseded")
+    except concurrent.futures.TimeoutError:
+        future.cancel()
+        logging.error(f"Groq API request abandoned after {timeout + SYNC_WAIT_GRACE_SECONDS}s")
+        return None, None
+    except BaseException:
+        future.cancel()
+        raise
+
+async def acomplete_many(requests):
+    """
+    Run many completions concurrently on the current loop
+    requests is a list of dicts with messages, model, max_tokens, temperature and optional timeout
+    """
+    return await asyncio.gather(*(acomplete(**request) for request in requests))
+
+def complete_many(requests, timeout=None):
+    """Blocking wrapper over acomplete_many"""
+    return submit(acomplete_many(requests)).result(timeout)
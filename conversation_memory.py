@@ -0,0 +1,196 @@
+"""
+Bounded multi-turn conversation memory
+Keeps the most recent turns of the session chat history verbatim and folds
+older turns into a rolling summary that is updated incrementally in the background
+"""
+
+import logging
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from prompt_builder import count_tokens
+
+MEMORY_MAX_TURNS = 6
+MEMORY_TOKEN_BUDGET = 600
+SUMMARY_TOKEN_BUDGET = 150
+# Tokens for the summary message wrapper and chat format overhead
+SUMMARY_OVERHEAD_TOKENS = 16
+
+SUMMARY_SYSTEM_PROMPT = (
+    "You maintain a running summary of a supportive mental health conversation. "
+    "Merge the new turns into the existing summary. Keep the user's main feelings, concerns, "
+    "life context and any coping strategies already suggested. Write in third person, "
+    f"plain prose, under {SUMMARY_TOKEN_BUDGET * 3 // 4} words."
+)
+
+# Summaries are produced off the request path
+_summary_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="memory-summary")
+
+def _format_turns(turns):
+    """Render chat history turns as plain text for the summarizer"""
+    lines = []
+    for turn in turns:
+        lines.append(f"User: {turn.get('user', '')}")
+        if turn.get('bot'):
+            lines.append(f"WellBot: {turn['bot']}")
+    return "\n".join(lines)
+
+def _trim_to_tokens(text, token_budget):
+    """Keep the most recent whole sentences of text that fit in token_budget"""
+    sentences = re.split(r"(?<=[.!?])\s+", text.strip())
+    kept = []
+    used = 0
+    for sentence in reversed(sentences):
+        cost = count_tokens(sentence) + 1
+        if used + cost > token_budget:
+            break
+        kept.append(sentence)
+        used += cost
+    return " ".join(reversed(kept))
+
+def extractive_summary(previous_summary, turns, token_budget=SUMMARY_TOKEN_BUDGET):
+    """Local summary used when the LLM is unavailable: the user's first sentence per turn"""
+    points = []
+    for turn in turns:
+        first_sentence = re.split(r"(?<=[.!?])\s+", str(turn.get('user', '')).strip())[0]
+        if first_sentence:
+            if first_sentence[-1] not in ".!?":
+                first_sentence += "."
+            points.append(f"The user said: {first_sentence}")
+    combined = " ".join(part for part in [previous_summary] + points if part)
+    return _trim_to_tokens(combined, token_budget)
+
+def llm_summary(previous_summary, turns, token_budget=SUMMARY_TOKEN_BUDGET):
+    """Update the summary with the fast model, falling back to the extractive summary"""
+    from llm_client import call_groq_api
+    from model_router import FAST_MODEL
+
+    messages = [
+        {"role": "system", "content": SUMMARY_SYSTEM_PROMPT},
+        {"role": "user", "content": f"Existing summary:\n{previous_summary or '(none)'}\n\nNew turns:\n{_format_turns(turns)}"}
+    ]
+    summary = call_groq_api(messages, model=FAST_MODEL, max_tokens=token_budget, temperature=0.3, timeout=15.0)
+    if not summary:
+        return extractive_summary(previous_summary, turns, token_budget)
+    return _trim_to_tokens(summary, token_budget)
+
+class ConversationMemory:
+    """
+    Memory for one chat session, driven by that session's chat history list
+    (dicts with 'user' and optionally 'bot', as stored in st.session_state)
+    """
+
+    def __init__(self, max_turns=MEMORY_MAX_TURNS, token_budget=MEMORY_TOKEN_BUDGET,
+                 summary_token_budget=SUMMARY_TOKEN_BUDGET, summarizer=llm_summary):
+        self.max_turns = max_turns
+        self.token_budget = token_budget
+        self.summary_token_budget = summary_token_budget
+        self.summarizer = summarizer
+
+        self.summary = ""
+        self.summarized_turns = 0
+        self._first_turn = None
+        self._generation = 0
+        self._pending = None
+        self._lock = threading.Lock()
+
+    def reset(self):
+        with self._lock:
+            self.summary = ""
+            self.summarized_turns = 0
+            self._first_turn = None
+            self._generation += 1
+
+    def _turn_messages(self, turn):
+        messages = [{"role": "user", "content": str(turn.get('user', ''))}]
+        if turn.get('bot'):
+            messages.append({"role": "assistant", "content": str(turn['bot'])})
+        return messages
+
+    def _verbatim_budget(self, token_budget):
+        """Tokens left for verbatim turns after reserving room for the summary"""
+        return max(0, token_budget - self.summary_token_budget - SUMMARY_OVERHEAD_TOKENS)
+
+    def _verbatim_start(self, chat_history, token_budget):
+        """Index of the oldest turn kept verbatim: at most max_turns, newest first, within budget"""
+        start = len(chat_history)
+        used = 0
+        while start > 0 and len(chat_history) - start < self.max_turns:
+            cost = sum(count_tokens(m['content']) + 4 for m in self._turn_messages(chat_history[start - 1]))
+            if used + cost > token_budget:
+                break
+            used += cost
+            start -= 1
+        return start
+
+    def _summarize(self, turns, end, generation):
+        """Background job: fold turns into the summary"""
+        previous = self.summary
+        try:
+            summary = self.summarizer(previous, turns, self.summary_token_budget)
+        except Exception as e:
+            logging.error(f"Conversation summary failed: {e}")
+            summary = extractive_summary(previous, turns, self.summary_token_budget)
+        with self._lock:
+            # Ignore results that raced with a Clear Chat
+            if generation == self._generation and self.summarized_turns < end:
+                self.summary = summary
+                self.summarized_turns = end
+
+    def update(self, chat_history, token_budget=None):
+        """Schedule summarization of turns that have left the verbatim window"""
+        token_budget = self.token_budget if token_budget is None else token_budget
+        first_turn = (chat_history[0].get('user'), chat_history[0].get('timestamp')) if chat_history else None
+        if first_turn != self._first_turn:
+            # Chat was cleared or replaced
+            self.reset()
+            self._first_turn = first_turn
+
+        start = self._verbatim_start(chat_history, self._verbatim_budget(token_budget))
+        with self._lock:
+            if start <= self.summarized_turns or (self._pending is not None and not self._pending.done()):
+                return
+            turns = list(chat_history[self.summarized_turns:start])
+            self._pending = _summary_executor.submit(self._summarize, turns, start, self._generation)
+
+    def wait(self, timeout=None):
+        """Block until the pending summary update (if any) has finished"""
+        pending = self._pending
+        if pending is not None:
+            pending.result(timeout)
+
+    def messages(self, chat_history, token_budget=None, exclude_text=None):
+        """
+        Chat messages to place between the system prompt and the current message
+        exclude_text drops a trailing turn that is the message being answered
+        """
+        token_budget = self.token_budget if token_budget is None else token_budget
+        history = prior_turns(chat_history, exclude_text)
+
+        self.update(history, token_budget)
+
+        with self._lock:
+            summary = self.summary
+        messages = []
+        if summary:
+            messages.append({"role": "system", "content": f"Summary of the earlier conversation: {summary}"})
+
+        start = self._verbatim_start(history, self._verbatim_budget(token_budget))
+        for turn in history[start:]:
+            messages.extend(self._turn_messages(turn))
+        return messages
+
+def prior_turns(chat_history, exclude_text=None):
+    """Chat history without a trailing turn that is the message currently being answered"""
+    history = list(chat_history or [])
+    if exclude_text is not None and history and history[-1].get('user') == exclude_text:
+        history = history[:-1]
+    return history
+
+def get_session_memory(session_state, history_key):
+    """Return the ConversationMemory stored next to a chat history in Streamlit session state"""
+    memory_key = f"{history_key}_memory"
+    if memory_key not in session_state:
+        session_state[memory_key] = ConversationMemory()
+    return session_state[memory_key]
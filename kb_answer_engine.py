@@ -0,0 +1,408 @@
+"""
+Offline knowledge base answer engine
+Answers from the AI_Mental_Health.csv Q&A pairs without calling Groq: a BM25
+index over questions (and, more weakly, answers) picks the best pair and its
+answer is trimmed into a short, well-formed reply with a confidence score.
+Used as the fallback when Groq is unavailable and as a fast path for
+questions the knowledge base answers directly
+"""
+
+import logging
+import math
+import os
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+from difflib import SequenceMatcher
+
+import metrics
+from kb_cache import KnowledgeBaseCache
+from kb_dense_retriever import EntryEmbeddings
+from kb_fuzzy_index import FuzzyKnowledgeIndex
+from model_router import choose_route, get_latency_tracker
+from text_features import content_tokens, normalize_text
+
+# Answers at or above this match score are served without calling Groq
+KB_FAST_PATH_CONFIDENCE = float(os.getenv("KB_FAST_PATH_CONFIDENCE", "0.9"))
+# Moderate risk and above (4+) always goes to the model; unscored messages are only
+# answered locally when they match a dataset question exactly
+KB_SHORT_CIRCUIT_MAX_RISK = 3
+UNSCORED_SHORT_CIRCUIT_THRESHOLD = 1.0
+# Model latency assumed saved per local answer before real latencies have been recorded
+DEFAULT_MODEL_LATENCY_SECONDS = 2.0
+# Below this confidence the outage fallback doesn't quote the knowledge base
+KB_FALLBACK_MIN_CONFIDENCE = 0.25
+
+# BM25 parameters; answer text counts for a fraction of question text
+BM25_K1 = 1.2
+BM25_B = 0.75
+ANSWER_FIELD_WEIGHT = 0.25
+RERANK_CANDIDATES = 5
+
+MAX_ANSWER_WORDS = 90
+MAX_ANSWER_SENTENCES = 4
+MAX_LIST_ITEMS = 3
+
+FALLBACK_INTRO = ("I'm here to support you. While I'm having technical difficulties, please know that "
+                  "your feelings are valid and seeking help is always a good step.")
+
+_SUFFIXES = ("ness", "ing", "ed", "es", "ly", "s")
+
+def stem(token):
+    """Strip a common English suffix so 'feeling' matches 'feel' and 'illnesses' matches 'illness'"""
+    for suffix in _SUFFIXES:
+        if len(token) > len(suffix) + 3 and token.endswith(suffix):
+            return token[:-len(suffix)]
+    return token
+
+def index_terms(text):
+    """Stemmed content tokens used by the index"""
+    return [stem(token) for token in content_tokens(text)]
+
+class _Field:
+    """
+    BM25 statistics for one text field, updatable in place
+    Searches copy a postings dict before iterating it, so a concurrent update never changes its size mid-loop
+    """
+
+    def __init__(self, documents=()):
+        self.postings = {}
+        self.lengths = {}
+        self._live = 0
+        self._total_length = 0
+        self._max_idf = None
+        grouped = defaultdict(dict)
+        for doc_id, terms in enumerate(documents):
+            self.lengths[doc_id] = len(terms)
+            self._live += 1
+            self._total_length += len(terms)
+            for term, count in Counter(terms).items():
+                grouped[term][doc_id] = count
+        self.postings.update(grouped)
+
+    @property
+    def average_length(self):
+        return self._total_length / self._live if self._live else 0.0
+
+    def add(self, doc_id, terms):
+        self.lengths[doc_id] = len(terms)
+        self._live += 1
+        self._total_length += len(terms)
+        for term, count in Counter(terms).items():
+            self.postings.setdefault(term, {})[doc_id] = count
+        self._max_idf = None
+
+    def remove(self, doc_id, terms):
+        # The length stays behind for searches still holding the old postings
+        self._live -= 1
+        self._total_length -= self.lengths[doc_id]
+        for term in set(terms):
+            docs = self.postings[term]
+            docs.pop(doc_id, None)
+            if not docs:
+                del self.postings[term]
+        self._max_idf = None
+
+    def idf(self, term):
+        """BM25 IDF of a term, or None when no document has it"""
+        docs = self.postings.get(term)
+        if not docs:
+            return None
+        return math.log(1 + (self._live - len(docs) + 0.5) / (len(docs) + 0.5))
+
+    def max_idf(self):
+        """IDF of the rarest indexed term (1.0 for an empty field)"""
+        if self._max_idf is None:
+            rarest = min((len(docs) for docs in list(self.postings.values())), default=None)
+            self._max_idf = 1.0 if rarest is None else math.log(1 + (self._live - rarest + 0.5) / (rarest + 0.5))
+        return self._max_idf
+
+    def score(self, terms, scores, weight=1.0):
+        average_length = self.average_length or 1
+        for term in set(terms):
+            idf = self.idf(term)
+            if idf is None:
+                continue
+            for doc_id, count in list(self.postings.get(term, {}).items()):
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[doc_id] / average_length)
+                scores[doc_id] += weight * idf * count * (BM25_K1 + 1) / (count + norm)
+
+def _split_sentences(text):
+    """Split answer text into sentences and list items, keeping their order"""
+    pieces = []
+    for line in str(text).split("\n"):
+        line = " ".join(line.split())
+        if line:
+            pieces.extend(part for part in re.split(r"(?<=[.!?])\s+", line) if part)
+    return pieces
+
+def summarize_answer(answer, max_words=MAX_ANSWER_WORDS, max_sentences=MAX_ANSWER_SENTENCES):
+    """
+    Leading sentences of an answer, ending on a complete sentence
+    A sentence introducing a list (ending with ':') keeps its first few items as bullets
+    """
+    pieces = _split_sentences(answer)
+    kept = []
+    words = 0
+    for i, piece in enumerate(pieces):
+        piece_words = len(piece.split())
+        if kept and (words + piece_words > max_words or len(kept) >= max_sentences):
+            break
+        if piece.endswith(":"):
+            items = [item.rstrip(".") for item in pieces[i + 1:i + 1 + MAX_LIST_ITEMS]]
+            kept.append(piece + "".join(f"\n- {item}" for item in items))
+            break
+        if piece[-1] not in ".!?":
+            piece += "."
+        kept.append(piece)
+        words += piece_words
+    return " ".join(kept)
+
+class KBAnswerEngine:
+    """
+    Ranked index over knowledge base Q&A pairs
+    upsert() and remove() change single entries in place; removed doc ids are not reused
+    With embeddings, vectors holds entry embeddings by doc id (kb_dense_retriever.EntryEmbeddings);
+    kb_store attaches a kb_passages.PassageIndex as passages. Both are updated with the engine
+    """
+
+    vectors = None
+    embedder_name = None
+    passages = None
+
+    def __init__(self, knowledge_base, embeddings=False):
+        self.questions = list(knowledge_base.keys())
+        self.answers = list(knowledge_base.values())
+        self.question_terms = [index_terms(question) for question in self.questions]
+        self.answer_terms = [index_terms(answer) for answer in self.answers]
+        self._questions = _Field(self.question_terms)
+        self._answers = _Field(self.answer_terms)
+        self._doc_ids = {question: doc_id for doc_id, question in enumerate(self.questions)}
+        # Normalized alias question -> canonical question, for entries kb_dedup collapsed (set by kb_store)
+        self.aliases = {}
+        self._lock = threading.Lock()
+        self.fuzzy = FuzzyKnowledgeIndex(knowledge_base)
+        if embeddings:
+            self.vectors = EntryEmbeddings(knowledge_base)
+            self.embedder_name = self.vectors.embedder_name
+
+    def __len__(self):
+        return len(self._doc_ids)
+
+    def doc_id(self, question):
+        """Doc id of an indexed question, or None"""
+        return self._doc_ids.get(question)
+
+    def canonical_question(self, input_text):
+        """The canonical question a message is a collapsed alias of, or None"""
+        return self.aliases.get(normalize_text(input_text))
+
+    def upsert(self, question, answer):
+        """Add a Q&A pair, or replace the answer of an existing question"""
+        with self._lock:
+            doc_id = self._doc_ids.get(question)
+            if doc_id is not None:
+                if self.answers[doc_id] == answer:
+                    return
+                if self.passages is not None:
+                    self.passages.upsert(doc_id, question, answer)
+                self._answers.remove(doc_id, self.answer_terms[doc_id])
+                self.answers[doc_id] = answer
+                self.answer_terms[doc_id] = index_terms(answer)
+                self._answers.add(doc_id, self.answer_terms[doc_id])
+                self.fuzzy.answers[doc_id] = answer
+                if self.vectors is not None:
+                    self.vectors.upsert(doc_id, question, answer)
+                return
+            doc_id = len(self.questions)
+            # Passages first: a search that returns the question finds its sentences
+            if self.passages is not None:
+                self.passages.upsert(doc_id, question, answer)
+            self.questions.append(question)
+            self.answers.append(answer)
+            self.question_terms.append(index_terms(question))
+            self.answer_terms.append(index_terms(answer))
+            self._questions.add(doc_id, self.question_terms[doc_id])
+            self._answers.add(doc_id, self.answer_terms[doc_id])
+            self.fuzzy.add_question(question, answer)
+            if self.vectors is not None:
+                self.vectors.upsert(doc_id, question, answer)
+            self._doc_ids[question] = doc_id
+
+    def remove(self, question):
+        """Drop a question from the index; returns False when it isn't indexed"""
+        with self._lock:
+            doc_id = self._doc_ids.pop(question, None)
+            if doc_id is None:
+                return False
+            self._questions.remove(doc_id, self.question_terms[doc_id])
+            self._answers.remove(doc_id, self.answer_terms[doc_id])
+            self.fuzzy.remove_question(doc_id)
+            if self.vectors is not None:
+                self.vectors.remove(doc_id)
+            if self.passages is not None:
+                self.passages.remove(doc_id)
+            return True
+
+    def confidence(self, query_terms, doc_id):
+        """
+        How completely the question and the message cover each other, 0..1
+        F1 of the IDF mass of shared terms, so extra words on either side lower it
+        """
+        query = set(query_terms)
+        question = set(self.question_terms[doc_id])
+        if not query or not question:
+            return 0.0
+        field = self._questions
+        shared = sum(field.idf(term) or 0.0 for term in query & question)
+        query_mass = sum(field.idf(term) or field.max_idf() for term in query)
+        question_mass = sum(field.idf(term) or 0.0 for term in question)
+        if shared == 0 or query_mass == 0 or question_mass == 0:
+            return 0.0
+        precision = shared / question_mass
+        recall = shared / query_mass
+        # Rounded so set iteration order can't nudge an exact match below 1.0
+        return round(2 * precision * recall / (precision + recall), 4)
+
+    def search(self, input_text, limit=RERANK_CANDIDATES):
+        """Top Q&A pairs for a message as dicts with doc_id, question, answer, score and confidence"""
+        query_terms = index_terms(self.fuzzy.correct_text(input_text))
+        if not query_terms:
+            return []
+        scores = defaultdict(float)
+        self._questions.score(query_terms, scores)
+        self._answers.score(query_terms, scores, ANSWER_FIELD_WEIGHT)
+        ranked = sorted(scores.items(), key=lambda item: -item[1])[:limit]
+        return [{
+            'doc_id': doc_id,
+            'question': self.questions[doc_id],
+            'answer': self.answers[doc_id],
+            'score': score,
+            'confidence': self.confidence(query_terms, doc_id)
+        } for doc_id, score in ranked]
+
+    def answer(self, input_text):
+        """
+        Best local answer for a message, or None when nothing matches
+        Returns a dict: response, confidence, question, answer, elapsed_ms
+        """
+        start = time.perf_counter()
+        candidates = self.search(input_text)
+        if not candidates:
+            return None
+        canonical = self.canonical_question(input_text)
+        best = max(candidates, key=lambda candidate: (candidate['question'] == canonical, candidate['confidence'],
+                                                      candidate['score']))
+        best['response'] = summarize_answer(best['answer'])
+        best['elapsed_ms'] = (time.perf_counter() - start) * 1000
+        return best
+
+def _build_engine(knowledge_base):
+    start = time.perf_counter()
+    engine = KBAnswerEngine(knowledge_base, embeddings=True)
+    logging.info(f"KB answer engine: indexed {len(engine)} Q&A pairs in "
+                 f"{(time.perf_counter() - start) * 1000:.1f}ms")
+    return engine
+
+_engines = KnowledgeBaseCache(_build_engine)
+
+def get_answer_engine(knowledge_base):
+    """
+    Return the process-wide engine for a knowledge base
+    A knowledge base kept by kb_store carries its own engine, updated in place;
+    engines for plain dicts are cached by kb_cache
+    """
+    live_engine = getattr(knowledge_base, "answer_engine", None)
+    if live_engine is not None:
+        return live_engine
+    return _engines.get(knowledge_base)
+
+def question_match_score(input_text, question):
+    """
+    How exactly a message matches a dataset question, 0..1
+    1.0 for the same words after normalization, otherwise the character similarity of the normalized texts
+    """
+    normalized_input = normalize_text(input_text)
+    normalized_question = normalize_text(question)
+    if not normalized_input or not normalized_question:
+        return 0.0
+    if normalized_input == normalized_question:
+        return 1.0
+    return round(SequenceMatcher(None, normalized_input, normalized_question).ratio(), 4)
+
+def short_circuit_threshold(risk_score, threshold=None):
+    """Match score needed to answer locally at a risk score, or None when the model must answer"""
+    if risk_score is None:
+        return UNSCORED_SHORT_CIRCUIT_THRESHOLD
+    if risk_score > KB_SHORT_CIRCUIT_MAX_RISK:
+        return None
+    return KB_FAST_PATH_CONFIDENCE if threshold is None else threshold
+
+def fast_path_answer(knowledge_base, input_text, risk_score=None, threshold=None):
+    """
+    A local answer for an FAQ-style question, confident enough to skip Groq, or None
+    The match score is the better of the exact/near-exact question match and the index confidence
+    """
+    metrics.increment("kb_short_circuit_checked")
+    required = short_circuit_threshold(risk_score, threshold)
+    if required is None:
+        metrics.increment("kb_short_circuit_blocked_by_risk")
+        return None
+    if not knowledge_base:
+        return None
+
+    start = time.perf_counter()
+    engine = get_answer_engine(knowledge_base)
+    candidates = engine.search(input_text)
+    corrected_text = engine.fuzzy.correct_text(input_text)
+    # A question kb_dedup collapsed into another entry still matches that entry exactly
+    canonical = engine.canonical_question(input_text) or engine.canonical_question(corrected_text)
+    if canonical in knowledge_base and all(candidate['question'] != canonical for candidate in candidates):
+        candidates.append({'doc_id': engine.doc_id(canonical), 'question': canonical,
+                           'answer': knowledge_base[canonical], 'score': 0.0, 'confidence': 0.0})
+    for candidate in candidates:
+        if candidate['question'] == canonical:
+            candidate['match_score'] = 1.0
+        else:
+            candidate['match_score'] = max(candidate['confidence'],
+                                           question_match_score(corrected_text, candidate['question']))
+    best = max(candidates, key=lambda candidate: (candidate['match_score'], candidate['score']), default=None)
+    if best is None or best['match_score'] < required:
+        return None
+
+    best['response'] = summarize_answer(best['answer'])
+    best['elapsed_ms'] = (time.perf_counter() - start) * 1000
+    # Saving is measured against the recent median latency of the model the message would have used
+    model = choose_route(risk_score, message_length=len(input_text))['model']
+    model_latency = get_latency_tracker(model).percentile(50) or DEFAULT_MODEL_LATENCY_SECONDS
+    metrics.increment("kb_short_circuit_served")
+    metrics.observe("kb_short_circuit_saved_seconds", max(0.0, model_latency - best['elapsed_ms'] / 1000))
+    logging.info(f"KB fast path: match {best['match_score']:.2f} (risk {risk_score}) in {best['elapsed_ms']:.2f}ms")
+    return best
+
+def get_short_circuit_stats():
+    """Share of checked messages answered locally and the model latency saved"""
+    data = metrics.snapshot()
+    checked = data['counters'].get("kb_short_circuit_checked", 0)
+    served = data['counters'].get("kb_short_circuit_served", 0)
+    saved = data['summaries'].get("kb_short_circuit_saved_seconds", {'sum': 0.0})
+    return {
+        'checked': checked,
+        'served': served,
+        'blocked_by_risk': data['counters'].get("kb_short_circuit_blocked_by_risk", 0),
+        'served_fraction': served / checked if checked else 0.0,
+        'estimated_seconds_saved': saved['sum']
+    }
+
+def fallback_answer(knowledge_base, input_text):
+    """
+    Reply to use when Groq is unavailable: a supportive message plus the best
+    knowledge base answer when it is relevant enough
+    Returns (response, confidence)
+    """
+    result = get_answer_engine(knowledge_base).answer(input_text) if knowledge_base else None
+    if result is None or result['confidence'] < KB_FALLBACK_MIN_CONFIDENCE:
+        return FALLBACK_INTRO, (result['confidence'] if result else 0.0)
+    logging.info(f"KB fallback: confidence {result['confidence']:.2f} in {result['elapsed_ms']:.2f}ms")
+    return f"{FALLBACK_INTRO}\n\nHere is some information that may help: {result['response']}", result['confidence']
@@ -0,0 +1,52 @@
+"""
+Process-wide indexes per knowledge base version
+A knowledge base from kb_store or kb_shards is an immutable snapshot, so its identity
+is its version: looking it up costs nothing however large it is. A plain dict from a
+loader is found by identity too, and only on a miss by content, so an equal dict that
+a Streamlit rerun rebuilt still reuses the index. Only the most recently used few
+versions are kept, so replaced versions don't stay alive for the life of the process
+"""
+
+import os
+import threading
+
+# Knowledge base versions kept per cache: the current one, plus the previous one for requests still using it
+KB_INDEX_CACHE_VERSIONS = int(os.getenv("KB_INDEX_CACHE_VERSIONS", "2"))
+
+class KnowledgeBaseCache:
+    """LRU of build(knowledge_base) results by knowledge base version"""
+
+    def __init__(self, build, versions=KB_INDEX_CACHE_VERSIONS):
+        self.build = build
+        self.versions = max(1, versions)
+        # [knowledge base, content key or None, value], least recently used first; holding the
+        # knowledge base keeps its id from being reused while the entry is cached
+        self._entries = []
+        self._lock = threading.Lock()
+
+    def _hit(self, position):
+        entry = self._entries.pop(position)
+        self._entries.append(entry)
+        return entry[2]
+
+    def get(self, knowledge_base):
+        with self._lock:
+            for position, (cached, _, _) in enumerate(self._entries):
+                if cached is knowledge_base:
+                    return self._hit(position)
+            content_key = None
+            # Live snapshots are never modified, so a new one is a new version; hash only plain dicts
+            if getattr(knowledge_base, "answer_engine", None) is None:
+                content_key = hash(tuple(knowledge_base.items()))
+                for position, (_, key, _) in enumerate(self._entries):
+                    if key is not None and key == content_key:
+                        self._entries[position][0] = knowledge_base
+                        return self._hit(position)
+            value = self.build(knowledge_base)
+            self._entries.append([knowledge_base, content_key, value])
+            del self._entries[:-self.versions]
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._entries = []
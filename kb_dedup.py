@@ -0,0 +1,288 @@
+"""
+Near-duplicate detection for knowledge base Q&A pairs
+Questions and answers are shingled into character 5-grams and summarized by
+MinHash signatures; locality-sensitive hashing over signature bands finds
+candidate pairs without comparing every entry with every other. Verified pairs
+are grouped into clusters that keep one canonical entry, with the other
+questions recorded as aliases of it.
+Run offline against a knowledge base store:
+    python kb_dedup.py AI_Mental_Health.csv [--dry-run]
+"""
+
+import argparse
+import json
+import logging
+import os
+import time
+import zlib
+from collections import Counter, defaultdict
+
+import numpy as np
+
+from kb_answer_engine import index_terms
+from text_features import content_tokens, tokenize
+
+NUM_PERMUTATIONS = 128
+# 32 bands of 4 rows: pairs above ~0.4 estimated Jaccard become candidates
+LSH_BANDS = 32
+SHINGLE_CHARS = 5
+MINHASH_SEED = 1729
+_PRIME = (1 << 31) - 1
+
+# Two entries are duplicates when their questions are near-identical, when both
+# questions and answers are similar, or when the answers are near-identical and
+# the questions are at least related
+QUESTION_THRESHOLD = 0.8
+PAIR_QUESTION_THRESHOLD = 0.6
+PAIR_ANSWER_THRESHOLD = 0.5
+ANSWER_THRESHOLD = 0.9
+ANSWER_QUESTION_THRESHOLD = 0.2
+# Buckets larger than this only compare their members with the first one
+MAX_BUCKET_PAIRS = 64
+
+def shingles(text, size=SHINGLE_CHARS):
+    """crc32 hashes of the character n-grams of text's content words (all words if it has none)"""
+    normalized = " ".join(content_tokens(text) or tokenize(text))
+    if not normalized:
+        return np.empty(0, dtype=np.uint64)
+    grams = {normalized[i:i + size] for i in range(max(1, len(normalized) - size + 1))}
+    return np.fromiter((zlib.crc32(gram.encode("utf-8")) for gram in grams), dtype=np.uint64, count=len(grams))
+
+class MinHasher:
+    """MinHash signatures under num_permutations universal hash functions (a * x + b) mod p"""
+
+    def __init__(self, num_permutations=NUM_PERMUTATIONS, seed=MINHASH_SEED):
+        rng = np.random.default_rng(seed)
+        self.num_permutations = num_permutations
+        self._a = rng.integers(1, _PRIME, num_permutations, dtype=np.uint64)
+        self._b = rng.integers(0, _PRIME, num_permutations, dtype=np.uint64)
+
+    def signature(self, hashes):
+        """uint32 signature of a set of shingle hashes; an empty set gets the all-ones signature"""
+        if not len(hashes):
+            return np.full(self.num_permutations, _PRIME, dtype=np.uint32)
+        values = (self._a[:, None] * (hashes[None, :] % _PRIME) + self._b[:, None]) % _PRIME
+        return values.min(axis=1).astype(np.uint32)
+
+    def signatures(self, texts):
+        """(len(texts), num_permutations) signatures"""
+        if not len(texts):
+            return np.empty((0, self.num_permutations), dtype=np.uint32)
+        return np.stack([self.signature(shingles(text)) for text in texts])
+
+def similarity(signatures, i, j):
+    """Estimated Jaccard similarity of two rows' shingle sets"""
+    return float(np.mean(signatures[i] == signatures[j]))
+
+def lsh_candidates(signatures, bands=LSH_BANDS):
+    """Pairs (i, j), i < j, whose signatures agree on at least one band"""
+    rows = signatures.shape[1] // bands
+    empty = np.all(signatures == _PRIME, axis=1)
+    ids = np.nonzero(~empty)[0]
+    pairs = set()
+    for band in range(bands):
+        block = signatures[ids, band * rows:(band + 1) * rows]
+        # Rows with equal band values get equal bucket numbers; only shared buckets are visited in Python
+        _, buckets = np.unique(block, axis=0, return_inverse=True)
+        buckets = buckets.ravel()
+        order = np.argsort(buckets, kind="stable")
+        bounds = np.flatnonzero(np.diff(buckets[order])) + 1
+        for group in np.split(order, bounds):
+            if len(group) < 2:
+                continue
+            members = [int(i) for i in ids[group]]
+            if len(members) * (len(members) - 1) // 2 > MAX_BUCKET_PAIRS:
+                pairs.update((members[0], other) for other in members[1:])
+            else:
+                pairs.update((first, second) for k, first in enumerate(members) for second in members[k + 1:])
+    return pairs
+
+class _UnionFind:
+    def __init__(self, size):
+        self.parent = list(range(size))
+
+    def find(self, i):
+        while self.parent[i] != i:
+            self.parent[i] = self.parent[self.parent[i]]
+            i = self.parent[i]
+        return i
+
+    def union(self, i, j):
+        i, j = self.find(i), self.find(j)
+        if i != j:
+            self.parent[max(i, j)] = min(i, j)
+
+def is_duplicate(question_similarity, answer_similarity, question_threshold=QUESTION_THRESHOLD,
+                 pair_question_threshold=PAIR_QUESTION_THRESHOLD, pair_answer_threshold=PAIR_ANSWER_THRESHOLD,
+                 answer_threshold=ANSWER_THRESHOLD, answer_question_threshold=ANSWER_QUESTION_THRESHOLD):
+    return (question_similarity >= question_threshold
+            or (question_similarity >= answer_question_threshold and answer_similarity >= answer_threshold)
+            or (question_similarity >= pair_question_threshold and answer_similarity >= pair_answer_threshold))
+
+def find_clusters(questions, answers, hasher=None, **thresholds):
+    """
+    Clusters of near-duplicate entries as lists of positions, canonical entry first
+    The canonical entry is the one most similar to the rest of its cluster, then the one
+    with the longest answer, then the earliest. Singletons are left out
+    """
+    hasher = hasher or MinHasher()
+    question_signatures = hasher.signatures(questions)
+    answer_signatures = hasher.signatures(answers)
+    pair_similarities = {}
+    union = _UnionFind(len(questions))
+    candidates = np.array(sorted(lsh_candidates(question_signatures) | lsh_candidates(answer_signatures)),
+                          dtype=np.int64).reshape(-1, 2)
+    for first in range(0, len(candidates), 65536):
+        pairs = candidates[first:first + 65536]
+        question_similarities = (question_signatures[pairs[:, 0]] == question_signatures[pairs[:, 1]]).mean(axis=1)
+        answer_similarities = (answer_signatures[pairs[:, 0]] == answer_signatures[pairs[:, 1]]).mean(axis=1)
+        for (i, j), question_similarity, answer_similarity in zip(pairs.tolist(), question_similarities.tolist(),
+                                                                  answer_similarities.tolist()):
+            if is_duplicate(question_similarity, answer_similarity, **thresholds):
+                pair_similarities[(i, j)] = question_similarity + answer_similarity
+                union.union(i, j)
+
+    groups = defaultdict(list)
+    for i in range(len(questions)):
+        groups[union.find(i)].append(i)
+    clusters = []
+    for members in groups.values():
+        if len(members) < 2:
+            continue
+        centrality = Counter()
+        for k, i in enumerate(members):
+            for j in members[k + 1:]:
+                value = pair_similarities.get((i, j)) or (similarity(question_signatures, i, j)
+                                                          + similarity(answer_signatures, i, j))
+                centrality[i] += value
+                centrality[j] += value
+        canonical = min(members, key=lambda i: (-centrality[i], -len(answers[i]), i))
+        clusters.append([canonical] + [i for i in members if i != canonical])
+    clusters.sort(key=lambda cluster: min(cluster))
+    return clusters
+
+def index_size(knowledge_base):
+    """Entries, distinct terms and postings (term, entry) the answer engine would index"""
+    terms = set()
+    postings = 0
+    for question, answer in knowledge_base.items():
+        for field in (question, answer):
+            field_terms = set(index_terms(field))
+            terms.update(field_terms)
+            postings += len(field_terms)
+    return {'entries': len(knowledge_base), 'terms': len(terms), 'postings': postings}
+
+def cluster_stats(clusters, entries):
+    sizes = [len(cluster) for cluster in clusters]
+    return {
+        'clusters': len(clusters),
+        'duplicates': sum(sizes) - len(sizes),
+        'largest_cluster': max(sizes, default=0),
+        'mean_cluster_size': sum(sizes) / len(sizes) if sizes else 0.0,
+        'cluster_sizes': dict(sorted(Counter(sizes).items())),
+        'duplicate_fraction': (sum(sizes) - len(sizes)) / entries if entries else 0.0,
+    }
+
+def deduplicate(knowledge_base, **thresholds):
+    """
+    Collapse near-duplicate Q&A pairs of a knowledge base dict
+    Returns a dict: knowledge_base (canonical entries, in order), aliases (alias question -> canonical
+    question), clusters ([canonical, alias, ...] questions) and stats (cluster sizes, index size before and after)
+    """
+    start = time.perf_counter()
+    questions = list(knowledge_base.keys())
+    answers = list(knowledge_base.values())
+    clusters = find_clusters(questions, answers, **thresholds)
+    aliases = {questions[i]: questions[cluster[0]] for cluster in clusters for i in cluster[1:]}
+    deduplicated = {question: answer for question, answer in knowledge_base.items() if question not in aliases}
+    stats = cluster_stats(clusters, len(questions))
+    stats.update({
+        'index_before': index_size(knowledge_base),
+        'index_after': index_size(deduplicated),
+        'seconds': time.perf_counter() - start,
+    })
+    return {
+        'knowledge_base': deduplicated,
+        'aliases': aliases,
+        'clusters': [[questions[i] for i in cluster] for cluster in clusters],
+        'stats': stats,
+    }
+
+def aliases_path(base_path):
+    return f"{base_path}.aliases.json"
+
+def load_aliases(base_path):
+    """{alias question: canonical Question_ID} recorded by earlier runs"""
+    try:
+        with open(aliases_path(base_path), encoding="utf-8") as aliases:
+            return json.load(aliases)
+    except FileNotFoundError:
+        return {}
+
+def deduplicate_store(store, dry_run=False, **thresholds):
+    """
+    Collapse near-duplicate entries of a KnowledgeBaseStore
+    Aliases are recorded as alias question -> canonical Question_ID next to the base CSV, where
+    kb_store resolves them, then deleted through the delta log, so running apps pick the change up
+    with the aliases already in place. Returns the stats
+    """
+    start = time.perf_counter()
+    records = store.records()
+    ids = list(records)
+    questions = [question for question, _ in records.values()]
+    answers = [answer for _, answer in records.values()]
+    clusters = find_clusters(questions, answers, **thresholds)
+    before = index_size(store.current())
+
+    if not dry_run and clusters:
+        aliases = load_aliases(store.base_path)
+        for cluster in clusters:
+            for i in cluster[1:]:
+                aliases[questions[i]] = ids[cluster[0]]
+        # Aliases of an entry that has since become an alias point at its canonical entry
+        remapped = {ids[i]: ids[cluster[0]] for cluster in clusters for i in cluster[1:]}
+        aliases = {alias: remapped.get(canonical, canonical) for alias, canonical in aliases.items()}
+        temporary = f"{aliases_path(store.base_path)}.{os.getpid()}.tmp"
+        with open(temporary, "w", encoding="utf-8") as output:
+            json.dump(aliases, output, ensure_ascii=False, indent=1)
+        os.replace(temporary, aliases_path(store.base_path))
+        for cluster in clusters:
+            for i in cluster[1:]:
+                store.delete(ids[i])
+
+    stats = cluster_stats(clusters, len(ids))
+    stats.update({
+        'index_before': before,
+        'index_after': before if dry_run else index_size(store.current()),
+        'seconds': time.perf_counter() - start,
+    })
+    logging.info(f"KB dedup: {stats['duplicates']} duplicates in {stats['clusters']} clusters "
+                 f"({len(ids)} -> {len(ids) - stats['duplicates']} entries) in {stats['seconds'] * 1000:.0f}ms")
+    return stats
+
+def main():
+    from kb_store import KnowledgeBaseStore
+
+    parser = argparse.ArgumentParser(description="Collapse near-duplicate knowledge base entries")
+    parser.add_argument("csv_path", help="base CSV of the knowledge base store")
+    parser.add_argument("--dry-run", action="store_true", help="report clusters without changing the store")
+    parser.add_argument("--question-threshold", type=float, default=QUESTION_THRESHOLD)
+    parser.add_argument("--pair-question-threshold", type=float, default=PAIR_QUESTION_THRESHOLD)
+    parser.add_argument("--pair-answer-threshold", type=float, default=PAIR_ANSWER_THRESHOLD)
+    parser.add_argument("--answer-threshold", type=float, default=ANSWER_THRESHOLD)
+    parser.add_argument("--answer-question-threshold", type=float, default=ANSWER_QUESTION_THRESHOLD)
+    args = parser.parse_args()
+
+    store = KnowledgeBaseStore(args.csv_path)
+    stats = deduplicate_store(store, dry_run=args.dry_run, question_threshold=args.question_threshold,
+                              pair_question_threshold=args.pair_question_threshold,
+                              pair_answer_threshold=args.pair_answer_threshold, answer_threshold=args.answer_threshold,
+                              answer_question_threshold=args.answer_question_threshold)
+    print(f"{stats['duplicates']} near-duplicates in {stats['clusters']} clusters "
+          f"(largest {stats['largest_cluster']}, sizes {stats['cluster_sizes']})")
+    for label in ("index_before", "index_after"):
+        size = stats[label]
+        print(f"{label.replace('_', ' ')}: {size['entries']} entries, {size['terms']} terms, {size['postings']} postings")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,327 @@
+"""
+Dense-embedding retrieval over the knowledge base
+Q&A pairs are embedded once into a float32 matrix kept in a memory-mapped file,
+and searched with an exact brute-force index or an approximate IVF index
+(k-means coarse quantizer with inverted lists) for large collections.
+The default embedder is local and deterministic: feature hashing followed by a
+fixed random projection. Heavier embedding models can be registered by name
+"""
+
+import hashlib
+import logging
+import math
+import os
+import threading
+import time
+
+import numpy as np
+
+from kb_cache import KnowledgeBaseCache
+from text_features import content_tokens, hash_vectorize
+
+EMBEDDING_DIM = 256
+HASH_DIM = 4096
+PROJECTION_SEED = 1729
+# Question text counts this many times as much as answer text in an entry's embedding
+QUESTION_WEIGHT = 3.0
+
+EMBEDDINGS_DIR = os.getenv("KB_EMBEDDINGS_DIR", ".kb_embeddings")
+DEFAULT_EMBEDDER = os.getenv("KB_EMBEDDER", "hashing")
+
+# IVF defaults: about sqrt(n) lists, probing a few of them per query
+IVF_MIN_ENTRIES = 1000
+IVF_PROBE_LISTS = 8
+KMEANS_ITERATIONS = 10
+KMEANS_SAMPLE = 50_000
+
+# Embedding files kept per embedder; a live knowledge base writes a new one per version
+EMBEDDING_FILES_KEPT = 4
+
+def kb_fingerprint(knowledge_base):
+    """Stable content hash of a knowledge base (Python's hash() differs between processes)"""
+    digest = hashlib.sha256()
+    for question, answer in knowledge_base.items():
+        digest.update(question.encode("utf-8"))
+        digest.update(b"\0")
+        digest.update(answer.encode("utf-8"))
+        digest.update(b"\1")
+    return digest.hexdigest()[:16]
+
+class HashingEmbedder:
+    """
+    Signed feature hashing of content words, bigrams and character trigrams,
+    randomly projected to `dim`; shared trigrams let "sleep" match "sleeping"
+    """
+
+    def __init__(self, dim=EMBEDDING_DIM, hash_dim=HASH_DIM, seed=PROJECTION_SEED):
+        self.dim = dim
+        self.hash_dim = hash_dim
+        self.name = f"hashing{dim}x{hash_dim}s{seed}"
+        rng = np.random.default_rng(seed)
+        self._projection = (rng.standard_normal((hash_dim, dim)) / math.sqrt(dim)).astype(np.float32)
+
+    def embed(self, texts):
+        """(len(texts), dim) L2-normalized float32 embeddings"""
+        if not len(texts):
+            return np.zeros((0, self.dim), dtype=np.float32)
+        hashed = np.stack([hash_vectorize(" ".join(content_tokens(text)), self.hash_dim) for text in texts])
+        return normalize_rows(hashed @ self._projection)
+
+class SentenceTransformerEmbedder:
+    """Embedder backed by a sentence-transformers model (optional dependency)"""
+
+    def __init__(self, model_name="all-MiniLM-L6-v2"):
+        from sentence_transformers import SentenceTransformer
+        self._model = SentenceTransformer(model_name)
+        self.dim = self._model.get_sentence_embedding_dimension()
+        self.name = f"st-{model_name.replace('/', '_')}"
+
+    def embed(self, texts):
+        return normalize_rows(np.asarray(self._model.encode(list(texts)), dtype=np.float32))
+
+_embedder_factories = {
+    "hashing": HashingEmbedder,
+    "sentence-transformers": SentenceTransformerEmbedder,
+}
+_embedders = {}
+_embedders_lock = threading.Lock()
+
+def register_embedder(name, factory):
+    """Make an embedder available by name; factory() returns an object with name, dim and embed(texts)"""
+    with _embedders_lock:
+        _embedder_factories[name] = factory
+        _embedders.pop(name, None)
+
+def get_embedder(name=None):
+    """Return the process-wide embedder for a name, falling back to hashing if it can't load"""
+    name = name or DEFAULT_EMBEDDER
+    with _embedders_lock:
+        if name not in _embedders:
+            try:
+                if name not in _embedder_factories:
+                    raise ValueError("not registered")
+                _embedders[name] = _embedder_factories[name]()
+            except Exception as e:
+                logging.warning(f"Embedder '{name}' unavailable ({e}); using hashing embedder")
+                _embedders[name] = _embedders.get("hashing") or HashingEmbedder()
+        return _embedders[name]
+
+def normalize_rows(matrix):
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.where(norms > 0, norms, 1)
+
+def top_k(scores, ids, k):
+    """(ids, scores) of the k best scores, best first; ties keep id order"""
+    if len(scores) > k:
+        keep = np.argpartition(-scores, k - 1)[:k]
+        scores, ids = scores[keep], ids[keep]
+    order = np.lexsort((ids, -scores))
+    return ids[order], scores[order]
+
+class ExactIndex:
+    """Brute-force inner-product search over all vectors"""
+
+    name = "exact"
+
+    def __init__(self, vectors):
+        self.vectors = vectors
+        self._ids = np.arange(len(vectors))
+
+    def search(self, query_vector, k):
+        if not len(self.vectors):
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        return top_k(self.vectors @ query_vector, self._ids, k)
+
+class IVFIndex:
+    """
+    Inverted-file index: vectors are assigned to the nearest of n_lists k-means
+    centroids and a query only scores the lists of its n_probe nearest centroids
+    """
+
+    name = "ivf"
+
+    def __init__(self, vectors, n_lists=None, n_probe=IVF_PROBE_LISTS, seed=PROJECTION_SEED):
+        self.vectors = vectors
+        self.n_lists = n_lists or max(1, int(math.sqrt(len(vectors))))
+        self.n_probe = n_probe
+        self.centroids = self._train(seed)
+        assignments = self._assign(vectors)
+        order = np.argsort(assignments, kind="stable")
+        # Inverted lists are contiguous slices of vectors reordered by list
+        self._ids = order
+        self._list_vectors = np.ascontiguousarray(vectors[order])
+        self._offsets = np.searchsorted(assignments[order], np.arange(self.n_lists + 1))
+
+    def _assign(self, vectors, batch=65536):
+        return np.concatenate([np.argmax(vectors[i:i + batch] @ self.centroids.T, axis=1)
+                               for i in range(0, len(vectors), batch)]) if len(vectors) else np.empty(0, dtype=np.int64)
+
+    def _train(self, seed):
+        """Spherical k-means on a sample of the vectors"""
+        rng = np.random.default_rng(seed)
+        sample = self.vectors
+        if len(sample) > KMEANS_SAMPLE:
+            sample = sample[np.sort(rng.choice(len(sample), KMEANS_SAMPLE, replace=False))]
+        sample = np.asarray(sample, dtype=np.float32)
+        centroids = sample[rng.choice(len(sample), self.n_lists, replace=False)].copy()
+        for _ in range(KMEANS_ITERATIONS):
+            assignments = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, sample)
+            empty = np.linalg.norm(sums, axis=1) == 0
+            # Re-seed empty lists with random points
+            sums[empty] = sample[rng.choice(len(sample), int(empty.sum()))]
+            centroids = normalize_rows(sums)
+        return centroids
+
+    def search(self, query_vector, k):
+        probe = np.argsort(-(self.centroids @ query_vector))[:self.n_probe]
+        slices = [slice(self._offsets[i], self._offsets[i + 1]) for i in probe]
+        ids = np.concatenate([self._ids[s] for s in slices])
+        if not len(ids):
+            return ids, np.empty(0, dtype=np.float32)
+        scores = np.concatenate([self._list_vectors[s] @ query_vector for s in slices])
+        return top_k(scores, ids, k)
+
+INDEX_TYPES = {
+    "exact": ExactIndex,
+    "ivf": IVFIndex,
+}
+
+def embed_entries(embedder, questions, answers, batch=1024):
+    """Entry embeddings: question and answer embeddings mixed, question-weighted"""
+    chunks = []
+    for i in range(0, len(questions), batch):
+        question_vectors = embedder.embed(questions[i:i + batch])
+        answer_vectors = embedder.embed(answers[i:i + batch])
+        chunks.append(normalize_rows(QUESTION_WEIGHT * question_vectors + answer_vectors))
+    return np.concatenate(chunks) if chunks else np.zeros((0, embedder.dim), dtype=np.float32)
+
+def load_or_build_embeddings(knowledge_base, embedder, directory=EMBEDDINGS_DIR):
+    """
+    Read-only float32 memmap of entry embeddings, computed and written on first use
+    Files are keyed by knowledge base content and embedder, so every process shares them
+    """
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{embedder.name}-{kb_fingerprint(knowledge_base)}.npy")
+    if not os.path.exists(path):
+        start = time.perf_counter()
+        vectors = embed_entries(embedder, list(knowledge_base.keys()), list(knowledge_base.values()))
+        temporary = f"{path}.{os.getpid()}.tmp"
+        output = np.lib.format.open_memmap(temporary, mode="w+", dtype=np.float32, shape=vectors.shape)
+        output[:] = vectors
+        output.flush()
+        del output
+        os.replace(temporary, path)
+        logging.info(f"KB embeddings: {vectors.shape[0]} x {vectors.shape[1]} written to {path} "
+                     f"in {(time.perf_counter() - start) * 1000:.1f}ms")
+        prune_embeddings(directory, embedder.name)
+    return np.load(path, mmap_mode="r")
+
+def prune_embeddings(directory, embedder_name, keep=EMBEDDING_FILES_KEPT):
+    """Delete all but the newest embedding files of an embedder (open memmaps stay readable on POSIX)"""
+    paths = [os.path.join(directory, name) for name in os.listdir(directory)
+             if name.startswith(f"{embedder_name}-") and name.endswith(".npy")]
+    for path in sorted(paths, key=os.path.getmtime, reverse=True)[keep:]:
+        try:
+            os.remove(path)
+        except OSError as e:
+            logging.warning(f"KB embeddings: could not remove {path}: {e}")
+
+class EntryEmbeddings:
+    """
+    Entry embeddings of a live answer engine, indexed by doc id
+    The base matrix covers the doc ids the engine started with and is built (or read
+    from the embeddings file) on a background thread; until then ready is False.
+    Entries changed later are embedded one at a time, so an update never re-embeds
+    the knowledge base
+    """
+
+    def __init__(self, knowledge_base, embedder=None, directory=EMBEDDINGS_DIR):
+        self.embedder = embedder or get_embedder()
+        self.embedder_name = self.embedder.name
+        self._base = None
+        # Doc id -> embedding of entries added or changed since the engine was built
+        self._changed = {}
+        self._built = threading.Event()
+        entries = dict(knowledge_base)
+        threading.Thread(target=self._build, args=(entries, directory), name="kb-embeddings", daemon=True).start()
+
+    def _build(self, entries, directory):
+        try:
+            self._base = load_or_build_embeddings(entries, self.embedder, directory)
+        except Exception as e:
+            logging.error(f"KB embeddings: build failed, reranking without them: {e}")
+        finally:
+            self._built.set()
+
+    @property
+    def ready(self):
+        return self._base is not None
+
+    def wait(self, timeout=None):
+        """Block until the base matrix is built; returns ready"""
+        self._built.wait(timeout)
+        return self.ready
+
+    def upsert(self, doc_id, question, answer):
+        self._changed[doc_id] = embed_entries(self.embedder, [question], [answer])[0]
+
+    def remove(self, doc_id):
+        self._changed.pop(doc_id, None)
+
+    def __getitem__(self, doc_id):
+        vector = self._changed.get(doc_id)
+        return self._base[doc_id] if vector is None else vector
+
+class DenseRetriever:
+    """Embedding search over knowledge base Q&A pairs, same interface as TfidfRetriever"""
+
+    def __init__(self, knowledge_base, embedder=None, index="exact", directory=EMBEDDINGS_DIR, **index_options):
+        self.questions = list(knowledge_base.keys())
+        self.answers = list(knowledge_base.values())
+        self.rows = {question: row for row, question in enumerate(self.questions)}
+        self.embedder = embedder or get_embedder()
+        self.vectors = load_or_build_embeddings(knowledge_base, self.embedder, directory)
+        self.index = INDEX_TYPES[index](self.vectors, **index_options)
+
+    def __len__(self):
+        return len(self.questions)
+
+    def search_batch(self, queries, k=5):
+        """Top-k Q&A pairs per query as (question, answer, score), best first"""
+        queries = list(queries)
+        query_vectors = self.embedder.embed(queries)
+        results = []
+        for vector in query_vectors:
+            ids, scores = self.index.search(vector, k)
+            results.append([(self.questions[i], self.answers[i], float(score))
+                            for i, score in zip(ids, scores) if score > 0])
+        return results
+
+    def search(self, query, k=5):
+        return self.search_batch([query], k)[0]
+
+# One kb_cache cache per (index type, embedder)
+_retrievers = {}
+_retrievers_lock = threading.Lock()
+
+def get_dense_retriever(knowledge_base, index=None, embedder_name=None):
+    """
+    Return the process-wide dense retriever for a knowledge base
+    The index defaults to exact search, or IVF from IVF_MIN_ENTRIES entries up
+    """
+    index = index or ("ivf" if len(knowledge_base) >= IVF_MIN_ENTRIES else "exact")
+    embedder = get_embedder(embedder_name)
+
+    def build(knowledge_base):
+        start = time.perf_counter()
+        retriever = DenseRetriever(knowledge_base, embedder, index)
+        logging.info(f"KB dense retriever ({index}, {embedder.name}): {len(retriever)} entries "
+                     f"in {(time.perf_counter() - start) * 1000:.1f}ms")
+        return retriever
+
+    with _retrievers_lock:
+        cache = _retrievers.setdefault((index, embedder.name), KnowledgeBaseCache(build))
+    return cache.get(knowledge_base)
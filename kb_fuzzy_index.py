@@ -0,0 +1,219 @@
+"""
+Character-trigram index for typo-tolerant knowledge base lookup
+Similarity is the Jaccard overlap of word trigram sets (as in PostgreSQL's
+pg_trgm), so "anxeity" still finds "anxiety". Candidates come from the postings
+lists of the query's rarest trigrams and are verified against the rest, so a
+lookup never scans the whole collection.
+Message words are corrected against an index of knowledge base words, which grows
+with the vocabulary rather than the number of entries and stays sub-millisecond
+"""
+
+import logging
+import math
+import threading
+import time
+from collections import defaultdict
+
+import numpy as np
+
+from kb_cache import KnowledgeBaseCache
+from text_features import normalize_text, tokenize
+
+DEFAULT_SIMILARITY_THRESHOLD = 0.3
+# Query words are corrected to knowledge base words at or above this similarity
+WORD_CORRECTION_THRESHOLD = 0.25
+WORD_CORRECTION_CANDIDATES = 8
+
+def trigrams(text):
+    """Set of word trigrams, each word padded like pg_trgm ('  w', ' wo', ..., 'rd ')"""
+    grams = set()
+    for word in normalize_text(text).split():
+        padded = f"  {word} "
+        for i in range(len(padded) - 2):
+            grams.add(padded[i:i + 3])
+    return grams
+
+def edit_distance(first, second, limit):
+    """Optimal string alignment distance (adjacent swaps count once), or limit + 1 once it exceeds limit"""
+    if abs(len(first) - len(second)) > limit:
+        return limit + 1
+    previous_row = None
+    row = list(range(len(second) + 1))
+    for i in range(1, len(first) + 1):
+        before, previous_row, row = previous_row, row, [i] + [0] * len(second)
+        for j in range(1, len(second) + 1):
+            cost = first[i - 1] != second[j - 1]
+            row[j] = min(previous_row[j] + 1, row[j - 1] + 1, previous_row[j - 1] + cost)
+            if (i > 1 and j > 1 and first[i - 1] == second[j - 2] and first[i - 2] == second[j - 1]):
+                row[j] = min(row[j], before[j - 2] + 1)
+        if min(row) > limit:
+            return limit + 1
+    return row[-1]
+
+def _append(buffer, length, value):
+    """Store value at buffer[length], doubling the buffer when it's full; returns the buffer holding it"""
+    if length == len(buffer):
+        grown = np.empty(max(4, 2 * length), dtype=buffer.dtype)
+        grown[:length] = buffer
+        buffer = grown
+    buffer[length] = value
+    return buffer
+
+class TrigramIndex:
+    """
+    Trigram postings over a growing list of strings; ids are insertion positions
+    Each postings list is an int32 buffer with spare capacity and a length, so add() is
+    amortized O(trigrams of the string). A buffer is only written past the length readers
+    see, and (buffer, length) pairs are replaced whole, so searches need no lock
+    """
+
+    def __init__(self, texts=()):
+        self.texts = list(texts)
+        lists = defaultdict(list)
+        sizes = []
+        for doc_id, text in enumerate(self.texts):
+            grams = trigrams(text)
+            sizes.append(len(grams))
+            for gram in grams:
+                lists[gram].append(doc_id)
+        self._postings = {gram: (np.asarray(ids, dtype=np.int32), len(ids)) for gram, ids in lists.items()}
+        self._sizes = np.asarray(sizes, dtype=np.int32)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.texts)
+
+    def add(self, text):
+        """Index one more string and return its id"""
+        with self._lock:
+            doc_id = len(self.texts)
+            grams = trigrams(text)
+            # Sizes first: a search that finds the new id in a postings list then finds its size
+            self._sizes = _append(self._sizes, doc_id, len(grams))
+            for gram in grams:
+                # New ids are the largest, so appending keeps the postings sorted
+                buffer, length = self._postings.get(gram, (np.empty(0, dtype=np.int32), 0))
+                self._postings[gram] = (_append(buffer, length, doc_id), length + 1)
+            self.texts.append(text)
+            return doc_id
+
+    def search(self, text, threshold=DEFAULT_SIMILARITY_THRESHOLD, limit=10):
+        """
+        Strings whose trigram similarity to text is at least threshold
+        Returns [(id, similarity)], most similar first
+        """
+        query = trigrams(text)
+        if not query or not self.texts:
+            return []
+        empty = (np.empty(0, dtype=np.int32), 0)
+        lists = sorted((buffer[:length] for buffer, length in (self._postings.get(gram, empty) for gram in query)),
+                       key=len)
+        sizes = self._sizes
+
+        # A match shares at least ceil(threshold * |query|) trigrams with the query,
+        # so it must appear in one of the rarest |query| - that + 1 postings lists
+        min_shared = max(1, math.ceil(threshold * len(query)))
+        probe_count = len(query) - min_shared + 1
+        probe = [ids for ids in lists[:probe_count] if len(ids)]
+        rest = [ids for ids in lists[probe_count:] if len(ids)]
+        if not probe:
+            return []
+        candidates, shared = np.unique(np.concatenate(probe), return_counts=True)
+
+        # Jaccard >= threshold needs shared >= threshold * (|query| + |candidate|) / (1 + threshold);
+        # drop candidates that can't get there even if they contain every remaining trigram
+        candidate_sizes = sizes[candidates]
+        required = threshold * (len(query) + candidate_sizes) / (1 + threshold)
+        viable = shared + len(rest) >= required
+        candidates, shared, candidate_sizes = candidates[viable], shared[viable], candidate_sizes[viable]
+        if not len(candidates):
+            return []
+
+        for ids in rest:
+            positions = np.minimum(np.searchsorted(ids, candidates), len(ids) - 1)
+            shared += ids[positions] == candidates
+
+        similarity = shared / (len(query) + candidate_sizes - shared)
+        keep = np.nonzero(similarity >= threshold)[0]
+        if len(keep) > limit:
+            keep = keep[np.argpartition(-similarity[keep], limit - 1)[:limit]]
+        order = keep[np.lexsort((candidates[keep], -similarity[keep]))]
+        return [(int(candidates[i]), float(similarity[i])) for i in order]
+
+class FuzzyKnowledgeIndex:
+    """Trigram indexes over knowledge base questions and over their vocabulary"""
+
+    def __init__(self, knowledge_base):
+        self.questions = list(knowledge_base.keys())
+        self.answers = list(knowledge_base.values())
+        self.question_index = TrigramIndex(normalize_text(question) for question in self.questions)
+        self.vocabulary = sorted({token for question in self.questions for token in tokenize(question)})
+        self._vocabulary_set = set(self.vocabulary)
+        self.word_index = TrigramIndex(self.vocabulary)
+
+    def add_question(self, question, answer):
+        """Index one more Q&A pair; its words join the correction vocabulary"""
+        self.questions.append(question)
+        self.answers.append(answer)
+        self.question_index.add(normalize_text(question))
+        for token in tokenize(question):
+            if token not in self._vocabulary_set:
+                self._vocabulary_set.add(token)
+                self.vocabulary.append(token)
+                self.word_index.add(token)
+
+    def __contains__(self, word):
+        """Whether a word is in the correction vocabulary"""
+        return word in self._vocabulary_set
+
+    def remove_question(self, doc_id):
+        """Hide a question from similar_questions (its words stay in the vocabulary)"""
+        self.questions[doc_id] = None
+
+    def similar_questions(self, text, threshold=DEFAULT_SIMILARITY_THRESHOLD, limit=10):
+        """[(question, answer, similarity)] for questions similar to text"""
+        return [(self.questions[doc_id], self.answers[doc_id], similarity)
+                for doc_id, similarity in self.question_index.search(text, threshold, limit)
+                if self.questions[doc_id] is not None]
+
+    def correct_word(self, word, threshold=WORD_CORRECTION_THRESHOLD):
+        """
+        The closest knowledge base word to a misspelled word, or the word itself
+        Trigram candidates must also be within one edit (two for words over 5 letters)
+        """
+        if word in self._vocabulary_set or len(word) < 4:
+            return word
+        max_edits = 1 if len(word) <= 5 else 2
+        best = None
+        for word_id, similarity in self.word_index.search(word, threshold, limit=WORD_CORRECTION_CANDIDATES):
+            candidate = self.vocabulary[word_id]
+            distance = edit_distance(word, candidate, max_edits)
+            if distance <= max_edits and (best is None or (distance, -similarity) < best[:2]):
+                best = (distance, -similarity, candidate)
+        return best[2] if best else word
+
+    def correct_tokens(self, tokens, threshold=WORD_CORRECTION_THRESHOLD):
+        return [self.correct_word(token, threshold) for token in tokens]
+
+    def correct_text(self, text, threshold=WORD_CORRECTION_THRESHOLD):
+        """Normalized text with misspelled words replaced by knowledge base words"""
+        return " ".join(self.correct_tokens(tokenize(text), threshold))
+
+def _build_index(knowledge_base):
+    start = time.perf_counter()
+    index = FuzzyKnowledgeIndex(knowledge_base)
+    logging.info(f"KB fuzzy index: {len(index.questions)} questions, {len(index.vocabulary)} words "
+                 f"in {(time.perf_counter() - start) * 1000:.1f}ms")
+    return index
+
+_indexes = KnowledgeBaseCache(_build_index)
+
+def get_fuzzy_index(knowledge_base):
+    """
+    Return the process-wide fuzzy index for a knowledge base
+    A knowledge base carrying a live answer engine uses the engine's own index
+    """
+    engine = getattr(knowledge_base, "answer_engine", None)
+    if engine is not None:
+        return engine.fuzzy
+    return _indexes.get(knowledge_base)
@@ -0,0 +1,141 @@
+"""
+Chunked, streaming ingestion of Q&A datasets into a knowledge base
+CSV and JSONL files are read a chunk at a time, cleaned and deduplicated with
+vectorized column operations and merged into the knowledge base as they arrive,
+so large counseling corpora load without holding the whole file in memory
+"""
+
+import json
+import logging
+import os
+import sys
+import time
+
+import pandas as pd
+
+# Not available on Windows
+try:
+    import resource
+except ImportError:
+    resource = None
+
+QUESTION_COLUMN = "Questions"
+ANSWER_COLUMN = "Answers"
+
+DEFAULT_CHUNK_ROWS = 50_000
+MIN_CHUNK_ROWS = 1_000
+# Ceiling on resident memory while ingesting; 0 disables it
+INGEST_MAX_MEMORY_MB = int(os.getenv("KB_INGEST_MAX_MEMORY_MB", "0"))
+# Share of the ceiling a single chunk may take
+CHUNK_MEMORY_SHARE = 0.1
+
+def current_rss_bytes():
+    """Resident set size of this process, from /proc where available"""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return peak_rss_bytes()
+
+def peak_rss_bytes():
+    """Peak resident set size of this process (ru_maxrss is KiB on Linux, bytes on macOS)"""
+    if resource is None:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+def _jsonl_chunks(path, columns, sizes):
+    with open(path, encoding="utf-8") as lines:
+        while True:
+            records = []
+            for line in lines:
+                if line.strip():
+                    records.append(json.loads(line))
+                    if len(records) >= sizes():
+                        break
+            if not records:
+                return
+            yield pd.DataFrame.from_records(records, columns=columns)
+
+def _csv_chunks(path, columns, sizes):
+    with pd.read_csv(path, usecols=columns, dtype=str, keep_default_na=True, iterator=True) as reader:
+        while True:
+            try:
+                yield reader.get_chunk(sizes())
+            except StopIteration:
+                return
+
+def iter_chunks(path, question_column=QUESTION_COLUMN, answer_column=ANSWER_COLUMN, chunk_rows=DEFAULT_CHUNK_ROWS,
+                extra_columns=()):
+    """
+    DataFrames of the question and answer columns (plus extra_columns) of a CSV or JSONL (.jsonl/.ndjson) file
+    chunk_rows is an int or a callable returning the size of the next chunk
+    """
+    if not os.path.exists(path):
+        raise FileNotFoundError(path)
+    sizes = chunk_rows if callable(chunk_rows) else (lambda: chunk_rows)
+    columns = [question_column, answer_column, *extra_columns]
+    if path.endswith((".jsonl", ".ndjson")):
+        return _jsonl_chunks(path, columns, sizes)
+    return _csv_chunks(path, columns, sizes)
+
+def clean_chunk(frame, question_column=QUESTION_COLUMN, answer_column=ANSWER_COLUMN):
+    """
+    Lowercased questions and their answers, with blank or missing values dropped and
+    duplicate questions collapsed to their last answer (the order of first appearance is kept)
+    Returns a Series of answers indexed by question
+    """
+    questions = frame[question_column].where(frame[question_column].notna(), "").astype(str).str.lower()
+    answers = frame[answer_column].where(frame[answer_column].notna(), "").astype(str)
+    valid = (questions != "") & (questions != "nan") & (answers != "") & (answers != "nan")
+    return answers[valid].groupby(questions[valid].to_numpy(), sort=False).last()
+
+def ingest_knowledge_base(paths, question_column=QUESTION_COLUMN, answer_column=ANSWER_COLUMN,
+                          chunk_rows=DEFAULT_CHUNK_ROWS, max_memory_mb=None, on_chunk=None, knowledge_base=None):
+    """
+    Stream one or more Q&A files into a knowledge base dict (later files win on duplicate questions)
+    With a memory ceiling, chunks are sized from the measured bytes per row and a MemoryError
+    is raised if resident memory goes over it. on_chunk(questions, answers) sees every cleaned
+    chunk, e.g. to add entries to an index incrementally
+    Returns (knowledge_base, stats)
+    """
+    paths = [paths] if isinstance(paths, str) else list(paths)
+    max_memory_mb = INGEST_MAX_MEMORY_MB if max_memory_mb is None else max_memory_mb
+    ceiling = max_memory_mb * 1024 * 1024
+    knowledge_base = {} if knowledge_base is None else knowledge_base
+    initial_entries = len(knowledge_base)
+    # Under a ceiling, the first chunk is small and measures the bytes per row
+    stats = {'rows_read': 0, 'chunks': 0, 'chunk_rows': min(chunk_rows, MIN_CHUNK_ROWS) if ceiling else chunk_rows}
+
+    def next_chunk_rows():
+        return stats['chunk_rows']
+
+    start = time.perf_counter()
+    for path in paths:
+        for frame in iter_chunks(path, question_column, answer_column, next_chunk_rows):
+            if ceiling and stats['chunks'] == 0:
+                row_bytes = frame.memory_usage(deep=True).sum() / max(1, len(frame))
+                stats['chunk_rows'] = max(MIN_CHUNK_ROWS, min(chunk_rows, int(ceiling * CHUNK_MEMORY_SHARE / row_bytes)))
+            cleaned = clean_chunk(frame, question_column, answer_column)
+            knowledge_base.update(zip(cleaned.index, cleaned.array))
+            if on_chunk is not None:
+                on_chunk(list(cleaned.index), list(cleaned.array))
+            stats['rows_read'] += len(frame)
+            stats['chunks'] += 1
+            del frame, cleaned
+            if ceiling and current_rss_bytes() > ceiling:
+                raise MemoryError(f"Ingestion passed the {max_memory_mb}MB memory ceiling after "
+                                  f"{stats['rows_read']} rows of {path}")
+
+    elapsed = time.perf_counter() - start
+    stats.update({
+        'entries': len(knowledge_base),
+        # Blank rows and repeated questions
+        'dropped': stats['rows_read'] - (len(knowledge_base) - initial_entries),
+        'seconds': elapsed,
+        'rows_per_second': stats['rows_read'] / elapsed if elapsed > 0 else 0.0,
+        'peak_rss_mb': peak_rss_bytes() / (1024 * 1024),
+    })
+    logging.info(f"KB ingest: {stats['rows_read']} rows -> {stats['entries']} Q&A pairs in {stats['chunks']} chunks, "
+                 f"{stats['rows_per_second']:,.0f} rows/s, peak RSS {stats['peak_rss_mb']:.0f}MB")
+    return knowledge_base, stats
@@ -0,0 +1,566 @@
+"""
+Shared, memory-mapped knowledge base index for multi-worker deployments
+A knowledge base is compiled once into a directory of flat numpy arrays: UTF-8
+string blobs with offsets, BM25 postings with precomputed term weights, per-entry
+term id sequences, answer sentence passages, entry embeddings and the spelling
+correction vocabulary with its trigram postings. Every app process maps the same
+files read-only, so the page cache holds one copy however many workers run, and
+each process only builds small views over it.
+A source CSV and its kb_store delta log are recompiled, in a child process, when they change;
+the previous version keeps being served until the new one is ready
+"""
+
+import bisect
+import contextlib
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import threading
+import time
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import metrics
+from kb_answer_engine import ANSWER_FIELD_WEIGHT, BM25_B, BM25_K1, RERANK_CANDIDATES, KBAnswerEngine, index_terms
+from kb_dense_retriever import embed_entries, get_embedder, top_k
+from kb_fuzzy_index import FuzzyKnowledgeIndex, TrigramIndex
+from kb_passages import PassageIndex
+
+# Advisory locks are POSIX-only; elsewhere concurrent compiles just race to the same result
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+INDEX_FORMAT = 2
+INDEX_SUFFIX = ".kbindex"
+# Compiled versions kept per source; processes still mapping an older one keep reading it
+INDEX_VERSIONS_KEPT = 2
+# How often a mapped source checks whether its CSV or delta log changed
+MAPPED_CHECK_SECONDS = float(os.getenv("KB_MAPPED_CHECK_SECONDS", "1"))
+
+def _term_hash(text):
+    return int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "little")
+
+def _pack_strings(strings):
+    """UTF-8 blob and int64 offsets of a list of strings"""
+    encoded = [string.encode("utf-8") for string in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(data) for data in encoded], out=offsets[1:])
+    return np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets
+
+def _field_arrays(field, term_ids):
+    """CSR postings of a _Field by term id, with the BM25 term frequency part of each score precomputed"""
+    average_length = field.average_length or 1
+    counts = np.zeros(len(term_ids), dtype=np.int64)
+    idf = np.zeros(len(term_ids), dtype=np.float64)
+    docs, weights = [], []
+    for term_id, term in sorted((term_ids[term], term) for term in field.postings):
+        postings = field.postings[term]
+        counts[term_id] = len(postings)
+        idf[term_id] = field.idf(term)
+        for doc_id, count in sorted(postings.items()):
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * field.lengths[doc_id] / average_length)
+            docs.append(doc_id)
+            weights.append(count * (BM25_K1 + 1) / (count + norm))
+    offsets = np.zeros(len(term_ids) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return {'offsets': offsets, 'docs': np.asarray(docs, dtype=np.int32),
+            'weights': np.asarray(weights, dtype=np.float32), 'idf': idf}
+
+def _trigram_arrays(index):
+    """A TrigramIndex's postings, CSR by trigram in hash order, and its per-string trigram counts"""
+    grams = sorted(index._postings, key=_term_hash)
+    hashes = np.fromiter((_term_hash(gram) for gram in grams), dtype=np.uint64, count=len(grams))
+    if len(hashes) > 1 and not np.all(np.diff(hashes) > 0):
+        raise ValueError("64-bit trigram hash collision; the index can't be compiled")
+    offsets = np.zeros(len(grams) + 1, dtype=np.int64)
+    np.cumsum([index._postings[gram][1] for gram in grams], out=offsets[1:])
+    ids = [buffer[:length] for buffer, length in (index._postings[gram] for gram in grams)]
+    text, text_offsets = _pack_strings(grams)
+    return {'text': text, 'text_offsets': text_offsets, 'hashes': hashes, 'offsets': offsets,
+            'ids': np.concatenate(ids) if ids else np.empty(0, dtype=np.int32), 'sizes': index._sizes}
+
+def _sequence_arrays(sequences, term_ids):
+    offsets = np.zeros(len(sequences) + 1, dtype=np.int64)
+    np.cumsum([len(terms) for terms in sequences], out=offsets[1:])
+    ids = np.fromiter((term_ids[term] for terms in sequences for term in terms), dtype=np.int32, count=int(offsets[-1]))
+    return ids, offsets
+
+def compile_index(knowledge_base, directory, embedder=None, aliases=None):
+    """
+    Write the mapped index of a knowledge base dict to directory (replaced atomically)
+    aliases optionally maps normalized alias questions to their canonical question, as kb_store resolves them
+    """
+    start = time.perf_counter()
+    embedder = embedder or get_embedder()
+    engine = KBAnswerEngine(knowledge_base)
+    passages = PassageIndex(knowledge_base)
+    questions, answers = engine.questions, engine.answers
+
+    # Term ids are positions in hash order, so a lookup is one binary search over the hashes
+    terms = set(engine._questions.postings) | set(engine._answers.postings) | set(passages._field.postings)
+    terms = sorted(terms, key=_term_hash)
+    term_hashes = np.fromiter((_term_hash(term) for term in terms), dtype=np.uint64, count=len(terms))
+    if len(term_hashes) > 1 and not np.all(np.diff(term_hashes) > 0):
+        raise ValueError("64-bit term hash collision; the index can't be compiled")
+    term_ids = {term: term_id for term_id, term in enumerate(terms)}
+    question_hashes = np.fromiter((_term_hash(question) for question in questions), dtype=np.uint64,
+                                  count=len(questions))
+
+    arrays = {}
+    arrays['question_text'], arrays['question_offsets'] = _pack_strings(questions)
+    arrays['answer_text'], arrays['answer_offsets'] = _pack_strings(answers)
+    arrays['term_text'], arrays['term_offsets'] = _pack_strings(terms)
+    arrays['term_hashes'] = term_hashes
+    arrays['question_order'] = np.argsort(question_hashes, kind="stable").astype(np.int32)
+    arrays['question_hashes'] = question_hashes[arrays['question_order']]
+    # Sorted, so a membership test is a binary search; its trigram postings are compiled too
+    vocabulary = sorted(engine.fuzzy.vocabulary)
+    arrays['vocabulary_text'], arrays['vocabulary_offsets'] = _pack_strings(vocabulary)
+    for part, values in _trigram_arrays(TrigramIndex(vocabulary)).items():
+        arrays[f"vocabulary_trigram_{part}"] = values
+    arrays['question_terms'], arrays['question_term_offsets'] = _sequence_arrays(engine.question_terms, term_ids)
+    arrays['answer_terms'], arrays['answer_term_offsets'] = _sequence_arrays(engine.answer_terms, term_ids)
+    for name, field in (("question", engine._questions), ("answer", engine._answers), ("passage", passages._field)):
+        for part, values in _field_arrays(field, term_ids).items():
+            arrays[f"{name}_postings_{part}"] = values
+    spans = np.asarray(passages.passages, dtype=np.int32).reshape(-1, 3)
+    arrays['passage_docs'], arrays['passage_starts'], arrays['passage_ends'] = spans[:, 0], spans[:, 1], spans[:, 2]
+    arrays['doc_passage_offsets'] = np.asarray([0] + [item.stop for item in passages.doc_passages], dtype=np.int64)
+    arrays['vectors'] = embed_entries(embedder, questions, answers)
+
+    meta = {
+        'format': INDEX_FORMAT,
+        'entries': len(questions),
+        'terms': len(terms),
+        'embedder': embedder.name,
+        'question_max_idf': engine._questions.max_idf(),
+        'answer_max_idf': engine._answers.max_idf(),
+        'passage_max_idf': passages._field.max_idf(),
+        'aliases': aliases or {},
+    }
+    temporary = f"{directory}.{os.getpid()}.tmp"
+    shutil.rmtree(temporary, ignore_errors=True)
+    os.makedirs(temporary)
+    for name, values in arrays.items():
+        np.save(os.path.join(temporary, f"{name}.npy"), np.ascontiguousarray(values))
+    with open(os.path.join(temporary, "meta.json"), "w") as output:
+        json.dump(meta, output)
+    shutil.rmtree(directory, ignore_errors=True)
+    os.replace(temporary, directory)
+    size = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+    logging.info(f"KB mapped index: {len(questions)} Q&A pairs, {len(terms)} terms, {size / 1e6:.1f}MB "
+                 f"written to {directory} in {(time.perf_counter() - start) * 1000:.0f}ms")
+    return meta
+
+# Views over the mapped arrays
+
+class _Strings:
+    """Read-only sequence of the strings packed in a blob"""
+
+    def __init__(self, blob, offsets):
+        self._blob = blob
+        self._offsets = offsets
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i):
+        i = range(len(self))[i]
+        return self._blob[self._offsets[i]:self._offsets[i + 1]].tobytes().decode("utf-8")
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+class _TermSequences:
+    """Per-entry term lists, decoded from term ids on access"""
+
+    def __init__(self, ids, offsets, terms):
+        self._ids = ids
+        self._offsets = offsets
+        self._terms = terms
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i):
+        return [self._terms[term_id] for term_id in self._ids[self._offsets[i]:self._offsets[i + 1]].tolist()]
+
+class _Ranges:
+    """Per-entry ranges of ids from CSR offsets"""
+
+    def __init__(self, offsets):
+        self._offsets = offsets
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i):
+        return range(int(self._offsets[i]), int(self._offsets[i + 1]))
+
+class _Passages:
+    """(doc_id, start, end) of each passage"""
+
+    def __init__(self, docs, starts, ends):
+        self._docs = docs
+        self._starts = starts
+        self._ends = ends
+
+    def __len__(self):
+        return len(self._docs)
+
+    def __getitem__(self, i):
+        return int(self._docs[i]), int(self._starts[i]), int(self._ends[i])
+
+class _QuestionIds:
+    """question -> doc id lookups, like the doc_ids dict of the in-memory indexes"""
+
+    def __init__(self, engine):
+        self._engine = engine
+
+    def __getitem__(self, question):
+        doc_id = self._engine.doc_id(question)
+        if doc_id is None:
+            raise KeyError(question)
+        return doc_id
+
+    def __contains__(self, question):
+        return self._engine.doc_id(question) is not None
+
+class _MappedField:
+    """BM25 postings of one field, with the idf() and max_idf() of the in-memory _Field"""
+
+    def __init__(self, term_id, arrays, name, max_idf):
+        self._term_id = term_id
+        self._offsets = arrays[f"{name}_postings_offsets"]
+        self._docs = arrays[f"{name}_postings_docs"]
+        self._weights = arrays[f"{name}_postings_weights"]
+        self._idf = arrays[f"{name}_postings_idf"]
+        self._max_idf = max_idf
+
+    def idf(self, term):
+        """BM25 IDF of a term, or None when no document has it"""
+        term_id = self._term_id(term)
+        if term_id is None or self._offsets[term_id] == self._offsets[term_id + 1]:
+            return None
+        return float(self._idf[term_id])
+
+    def max_idf(self):
+        return self._max_idf
+
+    def contributions(self, terms, weight=1.0):
+        """(doc ids, score contributions) arrays of each query term present in the field"""
+        parts = []
+        for term in set(terms):
+            term_id = self._term_id(term)
+            if term_id is None:
+                continue
+            first, last = self._offsets[term_id], self._offsets[term_id + 1]
+            if first < last:
+                parts.append((self._docs[first:last], self._weights[first:last] * (weight * self._idf[term_id])))
+        return parts
+
+def _accumulate(parts):
+    """(doc ids, summed scores) of score contributions"""
+    if not parts:
+        return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float64)
+    docs = np.concatenate([docs for docs, _ in parts])
+    ids, positions = np.unique(docs, return_inverse=True)
+    scores = np.bincount(positions.ravel(), weights=np.concatenate([values for _, values in parts]), minlength=len(ids))
+    return ids, scores
+
+class _MappedPostings:
+    """trigram -> (ids, length) lookups over mapped CSR postings, as TrigramIndex keeps them"""
+
+    def __init__(self, arrays, prefix):
+        self._grams = _Strings(arrays[f"{prefix}_text"], arrays[f"{prefix}_text_offsets"])
+        self._hashes = arrays[f"{prefix}_hashes"]
+        self._offsets = arrays[f"{prefix}_offsets"]
+        self._ids = arrays[f"{prefix}_ids"]
+
+    def get(self, gram, default=None):
+        position = int(np.searchsorted(self._hashes, np.uint64(_term_hash(gram))))
+        if position == len(self._hashes) or self._grams[position] != gram:
+            return default
+        ids = self._ids[self._offsets[position]:self._offsets[position + 1]]
+        return ids, len(ids)
+
+class _MappedTrigramIndex(TrigramIndex):
+    """Read-only TrigramIndex over compiled postings (add() isn't served)"""
+
+    def __init__(self, texts, arrays, prefix):
+        self.texts = texts
+        self._postings = _MappedPostings(arrays, prefix)
+        self._sizes = arrays[f"{prefix}_sizes"]
+        self._lock = threading.Lock()
+
+class _SortedStrings:
+    """Membership over a sorted _Strings by binary search"""
+
+    def __init__(self, strings):
+        self._strings = strings
+
+    def __contains__(self, text):
+        position = bisect.bisect_left(self._strings, text)
+        return position < len(self._strings) and self._strings[position] == text
+
+class MappedFuzzyIndex(FuzzyKnowledgeIndex):
+    """
+    Spelling correction over the mapped question vocabulary (similar_questions isn't served)
+    The vocabulary and its trigram postings are read from the index, so a worker builds nothing
+    """
+
+    def __init__(self, arrays):
+        self.questions = []
+        self.answers = []
+        self.question_index = TrigramIndex()
+        self.vocabulary = _Strings(arrays['vocabulary_text'], arrays['vocabulary_offsets'])
+        self._vocabulary_set = _SortedStrings(self.vocabulary)
+        self.word_index = _MappedTrigramIndex(self.vocabulary, arrays, "vocabulary_trigram")
+
+class MappedPassageIndex(PassageIndex):
+    """PassageIndex over mapped sentence spans and postings"""
+
+    def __init__(self, engine, arrays, meta):
+        self.questions = engine.questions
+        self.answers = engine.answers
+        self.doc_ids = _QuestionIds(engine)
+        self.passages = _Passages(arrays['passage_docs'], arrays['passage_starts'], arrays['passage_ends'])
+        self.doc_passages = _Ranges(arrays['doc_passage_offsets'])
+        self._field = _MappedField(engine.term_id, arrays, "passage", meta['passage_max_idf'])
+
+    def score(self, query_terms):
+        ids, scores = _accumulate(self._field.contributions(query_terms))
+        return dict(zip(ids.tolist(), scores.tolist()))
+
+class MappedAnswerEngine:
+    """
+    Read-only answer engine over a mapped index, ranking like KBAnswerEngine
+    Also carries the passage index and entry embeddings, so retrieval needs no per-process copies
+    """
+
+    answer = KBAnswerEngine.answer
+    confidence = KBAnswerEngine.confidence
+    canonical_question = KBAnswerEngine.canonical_question
+
+    def __init__(self, arrays, meta):
+        self.questions = _Strings(arrays['question_text'], arrays['question_offsets'])
+        self.answers = _Strings(arrays['answer_text'], arrays['answer_offsets'])
+        self.terms = _Strings(arrays['term_text'], arrays['term_offsets'])
+        self._term_hashes = arrays['term_hashes']
+        self._question_hashes = arrays['question_hashes']
+        self._question_order = arrays['question_order']
+        self.question_terms = _TermSequences(arrays['question_terms'], arrays['question_term_offsets'], self.terms)
+        self.answer_terms = _TermSequences(arrays['answer_terms'], arrays['answer_term_offsets'], self.terms)
+        self._questions = _MappedField(self.term_id, arrays, "question", meta['question_max_idf'])
+        self._answers = _MappedField(self.term_id, arrays, "answer", meta['answer_max_idf'])
+        self.fuzzy = MappedFuzzyIndex(arrays)
+        self.passages = MappedPassageIndex(self, arrays, meta)
+        self.vectors = arrays['vectors']
+        self.embedder_name = meta['embedder']
+        self.aliases = meta.get('aliases', {})
+
+    def __len__(self):
+        return len(self.questions)
+
+    def term_id(self, term):
+        position = int(np.searchsorted(self._term_hashes, np.uint64(_term_hash(term))))
+        if position < len(self._term_hashes) and self.terms[position] == term:
+            return position
+        return None
+
+    def doc_id(self, question):
+        """Doc id of an indexed question, or None"""
+        hashed = np.uint64(_term_hash(question))
+        position = int(np.searchsorted(self._question_hashes, hashed))
+        while position < len(self._question_hashes) and self._question_hashes[position] == hashed:
+            doc_id = int(self._question_order[position])
+            if self.questions[doc_id] == question:
+                return doc_id
+            position += 1
+        return None
+
+    def search(self, input_text, limit=RERANK_CANDIDATES):
+        """Top Q&A pairs for a message as dicts with doc_id, question, answer, score and confidence"""
+        query_terms = index_terms(self.fuzzy.correct_text(input_text))
+        if not query_terms:
+            return []
+        ids, scores = _accumulate(self._questions.contributions(query_terms)
+                                  + self._answers.contributions(query_terms, ANSWER_FIELD_WEIGHT))
+        ids, scores = top_k(scores, ids, limit)
+        return [{
+            'doc_id': doc_id,
+            'question': self.questions[doc_id],
+            'answer': self.answers[doc_id],
+            'score': score,
+            'confidence': self.confidence(query_terms, doc_id)
+        } for doc_id, score in zip(ids.tolist(), scores.tolist())]
+
+class MappedKnowledgeBase(Mapping):
+    """Read-only question -> answer mapping over a compiled index directory, carrying its answer engine"""
+
+    def __init__(self, directory):
+        with open(os.path.join(directory, "meta.json")) as meta_file:
+            meta = json.load(meta_file)
+        if meta['format'] != INDEX_FORMAT:
+            raise ValueError(f"{directory} has index format {meta['format']}, expected {INDEX_FORMAT}")
+        arrays = {name[:-4]: np.load(os.path.join(directory, name), mmap_mode="r")
+                  for name in os.listdir(directory) if name.endswith(".npy")}
+        self.directory = directory
+        self.answer_engine = MappedAnswerEngine(arrays, meta)
+
+    def __getitem__(self, question):
+        doc_id = self.answer_engine.doc_id(question)
+        if doc_id is None:
+            raise KeyError(question)
+        return self.answer_engine.answers[doc_id]
+
+    def __contains__(self, question):
+        return isinstance(question, str) and self.answer_engine.doc_id(question) is not None
+
+    def __iter__(self):
+        return iter(self.answer_engine.questions)
+
+    def __len__(self):
+        return len(self.answer_engine)
+
+# Compiled sources
+
+def _compile_source(path, directory):
+    """Child process side of a compile: load the source's entries through kb_store and write its index"""
+    from kb_store import KnowledgeBaseStore
+    store = KnowledgeBaseStore(path, index=False)
+    return compile_index(dict(store.current()), directory, aliases=store.aliases())
+
+class MappedSource:
+    """
+    A source CSV served from its compiled index
+    A change to the CSV or its delta log triggers a recompile on a background thread; the
+    current version is served until the new one is mapped. Only the first version is compiled on the spot
+    """
+
+    def __init__(self, path):
+        from kb_dedup import aliases_path
+        from kb_store import delta_log_path
+        self.path = path
+        self.log_path = delta_log_path(path)
+        self.aliases_path = aliases_path(path)
+        self.directory = f"{path}{INDEX_SUFFIX}"
+        self._lock = threading.Lock()
+        self._mapped = None
+        self._version = None
+        self._checked = 0.0
+        self._compiling = None
+        self._failed = None
+
+    def version(self):
+        """Name of the compiled version for the current state of the CSV, its log and its dedup aliases"""
+        # The index format too, so a format change recompiles instead of failing to map
+        state = [str(INDEX_FORMAT)]
+        for path in (self.path, self.log_path, self.aliases_path):
+            try:
+                stat = os.stat(path)
+                state.append(f"{stat.st_ino}-{stat.st_size}-{stat.st_mtime_ns}")
+            except FileNotFoundError:
+                if path == self.path:
+                    raise
+                state.append("-")
+        return hashlib.sha256("|".join(state).encode()).hexdigest()[:16]
+
+    @contextlib.contextmanager
+    def _compile_lock(self):
+        os.makedirs(self.directory, exist_ok=True)
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(self.directory, ".lock"), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _prune(self, keep):
+        versions = [os.path.join(self.directory, name) for name in os.listdir(self.directory)
+                    if os.path.isdir(os.path.join(self.directory, name)) and not name.endswith(".tmp")]
+        for directory in sorted(versions, key=os.path.getmtime, reverse=True)[keep:]:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def _map(self, version):
+        directory = os.path.join(self.directory, version)
+        if not os.path.exists(os.path.join(directory, "meta.json")):
+            with self._compile_lock():
+                # Another worker may have compiled it while this one waited
+                if not os.path.exists(os.path.join(directory, "meta.json")):
+                    # In a child process, so this worker never holds the in-memory indexes
+                    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as child:
+                        child.submit(_compile_source, self.path, directory).result()
+                    metrics.increment("kb_mapped_compiles")
+                    self._prune(INDEX_VERSIONS_KEPT)
+        return MappedKnowledgeBase(directory)
+
+    def _remap_in_background(self, version):
+        def run():
+            try:
+                mapped = self._map(version)
+            except Exception as e:
+                mapped = None
+                metrics.increment("kb_mapped_compile_errors")
+                logging.error(f"KB mapped index: recompiling {self.path} failed, serving the previous version: {e}")
+            with self._lock:
+                if mapped is not None:
+                    self._mapped, self._version = mapped, version
+                else:
+                    # Not retried until the source changes again
+                    self._failed = version
+                self._compiling = None
+
+        self._compiling = threading.Thread(target=run, name="kb-mapped-compile", daemon=True)
+        self._compiling.start()
+
+    def current(self):
+        """Mapped knowledge base for the latest compiled version (checked every MAPPED_CHECK_SECONDS)"""
+        with self._lock:
+            now = time.monotonic()
+            if self._mapped is None:
+                # Nothing to serve yet, so the first version is mapped (and compiled if need be) on the spot
+                version = self.version()
+                self._mapped = self._map(version)
+                self._version = version
+                self._checked = now
+            elif self._compiling is None and now - self._checked >= MAPPED_CHECK_SECONDS:
+                self._checked = now
+                version = self.version()
+                if version != self._version and version != self._failed:
+                    self._remap_in_background(version)
+            return self._mapped
+
+    def wait(self, timeout=None):
+        """Wait for a background recompile to be mapped; returns False if it is still running"""
+        with self._lock:
+            compiling = self._compiling
+        if compiling is not None:
+            compiling.join(timeout)
+            return not compiling.is_alive()
+        return True
+
+_sources = {}
+_sources_lock = threading.Lock()
+
+def get_mapped_knowledge_base(path):
+    """
+    Return this process's mapped view of a source CSV, compiling it first if no worker has yet
+    Raises FileNotFoundError when the CSV doesn't exist
+    """
+    key = os.path.abspath(path)
+    with _sources_lock:
+        source = _sources.get(key)
+        if source is None:
+            source = _sources[key] = MappedSource(path)
+    return source.current()
@@ -0,0 +1,167 @@
+"""
+Sentence-level passages of knowledge base answers
+Answers are split into sentences at build time, each indexed with its own terms
+and character offsets into the answer. Context for a prompt keeps only the most
+relevant sentences of each retrieved Q&A pair instead of the whole answer
+"""
+
+import logging
+import re
+import time
+from collections import defaultdict
+
+import metrics
+from kb_cache import KnowledgeBaseCache
+from kb_answer_engine import _Field, get_answer_engine, index_terms
+from kb_reranker import two_stage_search
+from prompt_builder import count_tokens, format_passage
+
+# Sentences kept per retrieved Q&A pair, and how many Q&A pairs are considered
+MAX_SENTENCES_PER_ENTRY = 2
+PASSAGE_CANDIDATES = 8
+# Sentences shorter than this are merged into the next one (list bullets, "Yes.")
+MIN_SENTENCE_CHARS = 25
+
+_LINE_PATTERN = re.compile(r"[^\n]+")
+_SENTENCE_PATTERN = re.compile(r"\S.*?(?:[.!?](?=\s)|$)")
+
+def sentence_spans(text):
+    """(start, end) character offsets of the sentences of text, in order"""
+    spans = []
+    for line in _LINE_PATTERN.finditer(text):
+        for match in _SENTENCE_PATTERN.finditer(line.group()):
+            start = line.start() + match.start()
+            end = line.start() + match.start() + len(match.group().rstrip())
+            if spans and spans[-1][1] - spans[-1][0] < MIN_SENTENCE_CHARS:
+                spans[-1] = (spans[-1][0], end)
+            elif end > start:
+                spans.append((start, end))
+    return spans
+
+class PassageIndex:
+    """
+    BM25 index over answer sentences; passage ids map to (doc_id, start, end)
+    Attached to a live answer engine as engine.passages, it is updated with the engine's
+    doc ids, one entry at a time (under the engine's lock)
+    """
+
+    def __init__(self, knowledge_base):
+        self.questions = list(knowledge_base.keys())
+        self.answers = list(knowledge_base.values())
+        self.doc_ids = {question: doc_id for doc_id, question in enumerate(self.questions)}
+        self.passages = []
+        self.doc_passages = []
+        self._passage_terms = []
+        for doc_id, answer in enumerate(self.answers):
+            self.doc_passages.append(self._split(doc_id, answer))
+        self._field = _Field(self._passage_terms)
+
+    def _split(self, doc_id, answer):
+        first = len(self.passages)
+        for start, end in sentence_spans(answer):
+            self.passages.append((doc_id, start, end))
+            self._passage_terms.append(index_terms(answer[start:end]))
+        return range(first, len(self.passages))
+
+    def upsert(self, doc_id, question, answer):
+        """Index a new entry, or re-split the answer of an existing one; changed sentences get new passage ids"""
+        if doc_id < len(self.answers):
+            self._drop(doc_id)
+            self.questions[doc_id] = question
+        else:
+            self.questions.append(question)
+            self.answers.append(answer)
+            self.doc_passages.append(range(0))
+        passage_ids = self._split(doc_id, answer)
+        for passage_id in passage_ids:
+            self._field.add(passage_id, self._passage_terms[passage_id])
+        self.answers[doc_id] = answer
+        self.doc_passages[doc_id] = passage_ids
+        self.doc_ids[question] = doc_id
+
+    def remove(self, doc_id):
+        """Drop an entry's sentences (its question keeps its doc id for searches already holding it)"""
+        self._drop(doc_id)
+        self.doc_passages[doc_id] = range(0)
+
+    def _drop(self, doc_id):
+        for passage_id in self.doc_passages[doc_id]:
+            self._field.remove(passage_id, self._passage_terms[passage_id])
+
+    def __len__(self):
+        return len(self.passages)
+
+    def text(self, passage_id):
+        doc_id, start, end = self.passages[passage_id]
+        return self.answers[doc_id][start:end]
+
+    def score(self, query_terms):
+        """BM25 score of every sentence sharing a term with the query, by passage id"""
+        scores = defaultdict(float)
+        self._field.score(query_terms, scores)
+        return scores
+
+    def select(self, doc_id, scores, max_sentences=MAX_SENTENCES_PER_ENTRY):
+        """
+        The entry's most relevant sentences by score(), in answer order
+        An entry whose sentences share no terms with the message keeps its opening sentence
+        """
+        passage_ids = self.doc_passages[doc_id]
+        if not passage_ids:
+            return ""
+        ranked = sorted((passage_id for passage_id in passage_ids if scores.get(passage_id, 0) > 0),
+                        key=lambda passage_id: (-scores[passage_id], passage_id))[:max_sentences]
+        sentences = [self.text(passage_id) for passage_id in sorted(ranked or [passage_ids[0]])]
+        # Headings and list items have no closing punctuation of their own
+        return " ".join(sentence if sentence[-1] in ".!?:" else sentence + "." for sentence in sentences)
+
+def _build_index(knowledge_base):
+    start = time.perf_counter()
+    index = PassageIndex(knowledge_base)
+    logging.info(f"KB passages: {len(index)} sentences from {len(index.answers)} answers "
+                 f"in {(time.perf_counter() - start) * 1000:.1f}ms")
+    return index
+
+_indexes = KnowledgeBaseCache(_build_index)
+
+def get_passage_index(knowledge_base):
+    """Return the process-wide passage index for a knowledge base (cached by kb_cache)"""
+    return _indexes.get(knowledge_base)
+
+def rank_kb_sentences(knowledge_base, input_text, limit=None, max_sentences=MAX_SENTENCES_PER_ENTRY):
+    """
+    Ranked (question, relevant sentences) passages for a message (drop-in for rank_kb_context)
+    Records the context tokens saved against pasting the whole answers
+    """
+    ranked = two_stage_search(knowledge_base, input_text, limit=limit or PASSAGE_CANDIDATES)['passages']
+    if not ranked:
+        return []
+    engine = get_answer_engine(knowledge_base)
+    # Live and mapped engines carry their own passages
+    index = getattr(engine, "passages", None)
+    if index is None:
+        index = get_passage_index(knowledge_base)
+    scores = index.score(index_terms(engine.fuzzy.correct_text(input_text)))
+    passages = [(question, index.select(index.doc_ids[question], scores, max_sentences)) for question, _ in ranked]
+
+    full_tokens = sum(count_tokens(format_passage(question, answer)) for question, answer in ranked)
+    passage_tokens = sum(count_tokens(format_passage(question, text)) for question, text in passages)
+    metrics.observe("kb_context_tokens_full", full_tokens)
+    metrics.observe("kb_context_tokens_sent", passage_tokens)
+    logging.info(f"KB passages: {passage_tokens} context tokens instead of {full_tokens} "
+                 f"({len(passages)} Q&A pairs)")
+    return passages
+
+def get_passage_stats():
+    """Context tokens of the selected sentences against whole answers, per request"""
+    data = metrics.snapshot()['summaries']
+    full = data.get("kb_context_tokens_full", {'count': 0, 'sum': 0.0})
+    sent = data.get("kb_context_tokens_sent", {'count': 0, 'sum': 0.0})
+    requests = full['count']
+    return {
+        'requests': requests,
+        'mean_full_tokens': full['sum'] / requests if requests else 0.0,
+        'mean_sent_tokens': sent['sum'] / requests if requests else 0.0,
+        'mean_tokens_saved': (full['sum'] - sent['sum']) / requests if requests else 0.0,
+        'saved_fraction': 1 - sent['sum'] / full['sum'] if full['sum'] else 0.0,
+    }
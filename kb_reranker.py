@@ -0,0 +1,159 @@
+"""
+Two-stage retrieval of knowledge base context
+BM25 over the answer engine's inverted index produces a shortlist, which a
+costlier reranker (phrase overlap, term proximity and embedding similarity)
+reorders under a hard per-request time budget. When the deadline is hit the
+shortlist keeps its first-stage order
+"""
+
+import logging
+import os
+import time
+
+import metrics
+from kb_answer_engine import get_answer_engine, index_terms
+from kb_dense_retriever import get_embedder
+
+FIRST_STAGE_CANDIDATES = 20
+KB_RERANK_BUDGET_MS = float(os.getenv("KB_RERANK_BUDGET_MS", "25"))
+
+# Reranking score weights; the first-stage score is normalized to the best candidate
+FIRST_STAGE_WEIGHT = 0.4
+PHRASE_WEIGHT = 0.25
+PROXIMITY_WEIGHT = 0.15
+EMBEDDING_WEIGHT = 0.2
+
+def _bigrams(terms):
+    return set(zip(terms, terms[1:]))
+
+def phrase_overlap(query_terms, terms):
+    """Share of the query's adjacent term pairs that also appear adjacent in terms"""
+    query_bigrams = _bigrams(query_terms)
+    if not query_bigrams:
+        return 0.0
+    return len(query_bigrams & _bigrams(terms)) / len(query_bigrams)
+
+def proximity(query_terms, terms):
+    """
+    How tightly the query terms cluster in terms, 0..1
+    The smallest window holding every matched query term, compared with the number matched
+    """
+    wanted = set(query_terms) & set(terms)
+    if len(wanted) < 2:
+        return 1.0 if wanted else 0.0
+    counts = {}
+    best = len(terms)
+    left = 0
+    for right, term in enumerate(terms):
+        if term in wanted:
+            counts[term] = counts.get(term, 0) + 1
+        while len(counts) == len(wanted):
+            best = min(best, right - left + 1)
+            dropped = terms[left]
+            if dropped in counts:
+                counts[dropped] -= 1
+                if not counts[dropped]:
+                    del counts[dropped]
+            left += 1
+    return len(wanted) / best
+
+class Reranker:
+    """
+    Scores shortlisted candidates for one message
+    Term lists and entry embeddings come from the answer engine; nothing is embedded
+    here but the message, so the embedding term is left out until the engine's
+    embeddings are built (or when it has none)
+    """
+
+    def __init__(self, knowledge_base, input_text):
+        self.engine = get_answer_engine(knowledge_base)
+        embedder = get_embedder()
+        self.vectors = getattr(self.engine, "vectors", None)
+        if self.vectors is not None and (self.engine.embedder_name != embedder.name
+                                         or not getattr(self.vectors, "ready", True)):
+            self.vectors = None
+            metrics.increment("kb_rerank_without_embeddings")
+        self.query_terms = index_terms(input_text)
+        self.query_vector = embedder.embed([input_text])[0] if self.vectors is not None else None
+
+    def _similarity(self, candidate):
+        if self.vectors is None:
+            return 0.0
+        return float(self.vectors[candidate['doc_id']] @ self.query_vector)
+
+    def score(self, candidate, top_score):
+        doc_id = candidate['doc_id']
+        terms = self.engine.question_terms[doc_id]
+        similarity = self._similarity(candidate)
+        return (FIRST_STAGE_WEIGHT * candidate['score'] / (top_score or 1)
+                + PHRASE_WEIGHT * max(phrase_overlap(self.query_terms, terms),
+                                      phrase_overlap(self.query_terms, self.engine.answer_terms[doc_id]))
+                + PROXIMITY_WEIGHT * proximity(self.query_terms, terms)
+                + EMBEDDING_WEIGHT * max(0.0, similarity))
+
+def two_stage_search(knowledge_base, input_text, limit=None, candidates=FIRST_STAGE_CANDIDATES,
+                     budget_ms=None, reranker=None):
+    """
+    Shortlist with BM25, then rerank within budget_ms (KB_RERANK_BUDGET_MS by default)
+    reranker(knowledge_base, input_text) returns an object whose score(candidate, top_score) is higher for better candidates
+    Returns a dict: passages ([(question, answer)], best first), reranked, timings (candidates_ms, rerank_ms)
+    """
+    budget_ms = KB_RERANK_BUDGET_MS if budget_ms is None else budget_ms
+    start = time.perf_counter()
+    shortlist = get_answer_engine(knowledge_base).search(input_text, limit=candidates) if knowledge_base else []
+    shortlisted = time.perf_counter()
+
+    ordered = shortlist
+    reranked = False
+    if len(shortlist) > 1:
+        deadline = shortlisted + budget_ms / 1000
+        scorer = (reranker or Reranker)(knowledge_base, input_text)
+        top_score = shortlist[0]['score']
+        scores = []
+        for candidate in shortlist:
+            if time.perf_counter() > deadline:
+                break
+            scores.append(scorer.score(candidate, top_score))
+        # The last candidate may finish after the deadline, so check once more
+        if len(scores) == len(shortlist) and time.perf_counter() <= deadline:
+            # Equal rerank scores keep first-stage order
+            order = sorted(range(len(shortlist)), key=lambda i: (-scores[i], i))
+            ordered = [shortlist[i] for i in order]
+            reranked = True
+        else:
+            metrics.increment("kb_rerank_deadline_hits")
+            logging.warning(f"KB rerank: {budget_ms:.0f}ms budget hit after {len(scores)}/{len(shortlist)} "
+                            f"candidates; using first-stage order")
+    finished = time.perf_counter()
+
+    timings = {
+        'candidates_ms': (shortlisted - start) * 1000,
+        'rerank_ms': (finished - shortlisted) * 1000,
+    }
+    metrics.increment("kb_two_stage_requests")
+    metrics.observe("kb_candidates_seconds", shortlisted - start)
+    metrics.observe("kb_rerank_seconds", finished - shortlisted)
+    passages = [(candidate['question'], candidate['answer']) for candidate in ordered]
+    return {
+        'passages': passages[:limit] if limit else passages,
+        'reranked': reranked,
+        'timings': timings,
+    }
+
+def rank_kb_context(knowledge_base, input_text, limit=None):
+    """Ranked (question, answer) passages for a message, best first (drop-in for rank_kb_passages)"""
+    return two_stage_search(knowledge_base, input_text, limit=limit)['passages']
+
+def get_two_stage_stats():
+    """Requests, deadline hits and mean time spent in each retrieval stage"""
+    data = metrics.snapshot()
+    requests = data['counters'].get("kb_two_stage_requests", 0)
+    stats = {
+        'requests': requests,
+        'deadline_hits': data['counters'].get("kb_rerank_deadline_hits", 0),
+    }
+    for stage in ("candidates", "rerank"):
+        summary = data['summaries'].get(f"kb_{stage}_seconds", {'count': 0, 'sum': 0.0, 'max': 0.0})
+        stats[f'{stage}_mean_ms'] = summary['sum'] / summary['count'] * 1000 if summary['count'] else 0.0
+        stats[f'{stage}_max_ms'] = summary['max'] * 1000
+    return stats
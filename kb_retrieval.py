@@ -0,0 +1,30 @@
+"""
+Retriever backends for knowledge base search
+Every backend exposes search(query, k) and search_batch(queries, k), returning
+lists of (question, answer, score), best first
+"""
+
+import os
+
+from kb_dense_retriever import get_dense_retriever
+from kb_tfidf import get_tfidf_retriever
+
+DEFAULT_RETRIEVER = os.getenv("KB_RETRIEVER", "tfidf")
+
+RETRIEVER_BACKENDS = {
+    "tfidf": get_tfidf_retriever,
+    "dense": get_dense_retriever,
+    "dense-exact": lambda knowledge_base: get_dense_retriever(knowledge_base, index="exact"),
+    "dense-ivf": lambda knowledge_base: get_dense_retriever(knowledge_base, index="ivf"),
+}
+
+def register_retriever(name, factory):
+    """Add a backend; factory(knowledge_base) returns a retriever"""
+    RETRIEVER_BACKENDS[name] = factory
+
+def get_retriever(knowledge_base, backend=None):
+    """Return the process-wide retriever of a backend (KB_RETRIEVER by default)"""
+    backend = backend or DEFAULT_RETRIEVER
+    if backend not in RETRIEVER_BACKENDS:
+        raise ValueError(f"Unknown retriever backend '{backend}' (known: {', '.join(RETRIEVER_BACKENDS)})")
+    return RETRIEVER_BACKENDS[backend](knowledge_base)
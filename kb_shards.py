@@ -0,0 +1,404 @@
+"""
+Knowledge base sharded by source
+Each Q&A dataset (general mental health, student wellbeing, workplace stress, ...)
+is its own shard: a kb_store store with its own answer engine, plus metadata.
+Searches fan out to every shard in parallel and the per-shard top results are
+merged. Small shards are searched on a thread pool; large ones get a worker
+process each, so their BM25 scoring runs outside this process's GIL. "mapped"
+shards are served from a compiled index that every worker maps read-only
+(kb_mmap_index) instead of each holding a copy; the apps' general shard is mapped
+unless KB_GENERAL_SHARD_MODE (or KB_SHARD_MODE) says otherwise.
+Shards can be added and removed while the apps run, directly or by editing the
+sources file (KB_SOURCES_FILE), a JSON list such as:
+    [{"name": "students", "path": "data/student_wellbeing.csv", "domain": "student wellbeing"}]
+"""
+
+import json
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+import metrics
+from kb_answer_engine import RERANK_CANDIDATES, KBAnswerEngine
+from kb_mmap_index import get_mapped_knowledge_base
+from kb_store import get_knowledge_base_store
+from text_features import tokenize
+
+KB_SOURCES_FILE = os.getenv("KB_SOURCES_FILE", "kb_sources.json")
+# Mode of shards that don't set one: "thread", "process" or "mapped" (empty picks thread or process by size)
+KB_SHARD_MODE = os.getenv("KB_SHARD_MODE", "")
+# Mode of the general shard of get_sharded_knowledge_base: mapped by default, so the workers of a
+# deployment share one compiled index instead of each building its store, engines and indexes
+KB_GENERAL_SHARD_MODE = os.getenv("KB_GENERAL_SHARD_MODE") or KB_SHARD_MODE or "mapped"
+# Shards with at least this many Q&A pairs are searched in their own worker process
+SHARD_PROCESS_MIN_ENTRIES = int(os.getenv("KB_SHARD_PROCESS_MIN_ENTRIES", "50000"))
+SHARD_QUERY_WORKERS = int(os.getenv("KB_SHARD_QUERY_WORKERS", "4"))
+# A shard that hasn't answered by then is left out of the merged results
+SHARD_QUERY_TIMEOUT_SECONDS = float(os.getenv("KB_SHARD_QUERY_TIMEOUT_SECONDS", "2"))
+
+def _search_in_process(path, input_text, limit):
+    """Worker process side of a shard search (the worker keeps its own store of the shard)"""
+    return get_knowledge_base_store(path).current().answer_engine.search(input_text, limit)
+
+def _load_in_process(path):
+    return len(get_knowledge_base_store(path))
+
+class KnowledgeBaseShard:
+    """One source: its store (or mapped index), its metadata and how it is searched ("thread", "process" or "mapped")"""
+
+    def __init__(self, name, path, mode=None, **metadata):
+        self.name = name
+        self.path = path
+        self.metadata = metadata
+        self.mode = mode or KB_SHARD_MODE or None
+        self.store = None
+        self._process = None
+        if self.mode == "mapped":
+            # Compiled on first use by whichever worker gets there first
+            get_mapped_knowledge_base(path)
+            return
+        self.store = get_knowledge_base_store(path)
+        self.mode = self.mode or ("process" if len(self.store) >= SHARD_PROCESS_MIN_ENTRIES else "thread")
+        if self.mode == "process":
+            # spawn rather than fork: the apps run threads that a forked child would inherit mid-flight
+            self._process = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn"))
+            self._process.submit(_load_in_process, path)
+
+    def __len__(self):
+        return len(self.store) if self.store is not None else len(self.current())
+
+    def current(self):
+        """Latest snapshot of the shard, carrying its answer engine"""
+        if self.store is None:
+            return get_mapped_knowledge_base(self.path)
+        return self.store.current()
+
+    def submit(self, threads, engine, input_text, limit):
+        if self._process is not None:
+            return self._process.submit(_search_in_process, self.path, input_text, limit)
+        return threads.submit(engine.search, input_text, limit)
+
+    def close(self):
+        if self._process is not None:
+            self._process.shutdown(wait=False, cancel_futures=True)
+
+    def describe(self):
+        return {'name': self.name, 'path': self.path, 'mode': self.mode, 'entries': len(self), **self.metadata}
+
+class _ShardTerms:
+    """question_terms / answer_terms of the shard engines, indexed by (shard name, doc id)"""
+
+    def __init__(self, engines, attribute):
+        self._engines = engines
+        self._attribute = attribute
+
+    def __getitem__(self, doc_id):
+        name, local_id = doc_id
+        return getattr(self._engines[name], self._attribute)[local_id]
+
+class _ShardVectors:
+    """Entry embeddings of the shard engines, indexed by (shard name, doc id)"""
+
+    def __init__(self, engines):
+        self._engines = engines
+
+    @property
+    def ready(self):
+        """Whether every shard's embeddings are built (mapped shards always are)"""
+        return all(getattr(engine.vectors, "ready", True) for engine in self._engines.values())
+
+    def __getitem__(self, doc_id):
+        name, local_id = doc_id
+        return self._engines[name].vectors[local_id]
+
+class _ShardedPassageIndex:
+    """Sentence selection through each shard's own passage index"""
+
+    def __init__(self, engines):
+        self._engines = engines
+        self.doc_ids = self
+
+    def __getitem__(self, question):
+        """(shard name, doc id) of a question, from the first shard that has it"""
+        for name, engine in self._engines.items():
+            doc_id = engine.doc_id(question)
+            if doc_id is not None:
+                return name, doc_id
+        raise KeyError(question)
+
+    def score(self, query_terms):
+        return {name: engine.passages.score(query_terms) for name, engine in self._engines.items()}
+
+    def select(self, doc_id, scores, max_sentences):
+        name, local_id = doc_id
+        return self._engines[name].passages.select(local_id, scores[name], max_sentences)
+
+class ShardedFuzzyIndex:
+    """Spelling correction against the vocabularies of every shard"""
+
+    def __init__(self, indexes):
+        self.indexes = indexes
+
+    def correct_word(self, word):
+        # A word one shard knows is never "corrected" into another shard's word
+        if any(word in index for index in self.indexes):
+            return word
+        for index in self.indexes:
+            corrected = index.correct_word(word)
+            if corrected != word:
+                return corrected
+        return word
+
+    def correct_tokens(self, tokens):
+        return [self.correct_word(token) for token in tokens]
+
+    def correct_text(self, text):
+        return " ".join(self.correct_tokens(tokenize(text)))
+
+class ShardedAnswerEngine:
+    """
+    Answer engine interface over a set of shard snapshots
+    Doc ids are (shard name, doc id in the shard's engine). Results from several shards are
+    ordered by confidence, then by BM25 score relative to the shard's best hit
+    """
+
+    answer = KBAnswerEngine.answer
+
+    def __init__(self, shards, snapshots, threads, timeout=SHARD_QUERY_TIMEOUT_SECONDS):
+        self.shards = shards
+        self.engines = {shard.name: snapshot.answer_engine for shard, snapshot in zip(shards, snapshots)}
+        self.question_terms = _ShardTerms(self.engines, "question_terms")
+        self.answer_terms = _ShardTerms(self.engines, "answer_terms")
+        self.fuzzy = ShardedFuzzyIndex([engine.fuzzy for engine in self.engines.values()])
+        # Passages and embeddings come from the shards only when every shard carries them (mapped shards do)
+        engines = list(self.engines.values())
+        self.passages = None
+        if all(getattr(engine, "passages", None) is not None for engine in engines):
+            self.passages = _ShardedPassageIndex(self.engines)
+        self.vectors = None
+        embedders = {getattr(engine, "embedder_name", None) for engine in engines}
+        if all(getattr(engine, "vectors", None) is not None for engine in engines) and len(embedders) == 1:
+            self.vectors = _ShardVectors(self.engines)
+            self.embedder_name = embedders.pop()
+        self._threads = threads
+        self._timeout = timeout
+
+    def __len__(self):
+        return sum(len(engine) for engine in self.engines.values())
+
+    def doc_id(self, question):
+        """(shard name, doc id) of a question in the first shard that has it, or None"""
+        for name, engine in self.engines.items():
+            doc_id = engine.doc_id(question)
+            if doc_id is not None:
+                return name, doc_id
+        return None
+
+    def canonical_question(self, input_text):
+        """The canonical question a message is a collapsed alias of in the first shard that has one, or None"""
+        for engine in self.engines.values():
+            canonical = engine.canonical_question(input_text)
+            if canonical is not None:
+                return canonical
+        return None
+
+    def search(self, input_text, limit=RERANK_CANDIDATES):
+        """Top Q&A pairs across shards, each tagged with its shard"""
+        start = time.perf_counter()
+        if len(self.shards) == 1 and self.shards[0].mode != "process":
+            # Nothing to fan out to
+            shard = self.shards[0]
+            results = [(shard, self.engines[shard.name].search(input_text, limit))]
+        else:
+            results = self._fan_out(input_text, limit)
+
+        merged = {}
+        for shard, hits in results:
+            engine = self.engines[shard.name]
+            # BM25 scores depend on each shard's term statistics, so merged scores are relative to the shard's best
+            top_score = (hits[0]['score'] or 1) if hits and len(results) > 1 else 1
+            for hit in hits:
+                hit['score'] /= top_score
+                # A worker process numbers docs itself; use this process's ids for the same question
+                local_id = hit['doc_id'] if shard.mode != "process" else engine.doc_id(hit['question'])
+                if local_id is None:
+                    continue
+                hit.update(doc_id=(shard.name, local_id), shard=shard.name)
+                previous = merged.get(hit['question'])
+                if previous is None or (hit['confidence'], hit['score']) > (previous['confidence'], previous['score']):
+                    merged[hit['question']] = hit
+        ranked = list(merged.values())
+        if len(results) > 1:
+            ranked = sorted(ranked, key=lambda hit: (-hit['confidence'], -hit['score']))[:limit]
+        metrics.observe("kb_shard_search_seconds", time.perf_counter() - start)
+        return ranked
+
+    def _fan_out(self, input_text, limit):
+        """[(shard, hits)] of the shards that answered within the timeout"""
+        futures = {shard.submit(self._threads, self.engines[shard.name], input_text, limit): shard
+                   for shard in self.shards}
+        done, pending = wait(futures, timeout=self._timeout)
+        for future in pending:
+            future.cancel()
+            metrics.increment("kb_shard_timeouts")
+            logging.warning(f"KB shards: '{futures[future].name}' missed the {self._timeout}s deadline")
+        results = []
+        for future, shard in futures.items():
+            if future not in done:
+                continue
+            try:
+                results.append((shard, future.result()))
+            except Exception as e:
+                metrics.increment("kb_shard_errors")
+                logging.error(f"KB shards: search of '{shard.name}' failed: {e}")
+        return results
+
+class ChainedKnowledgeBase(Mapping):
+    """
+    Read-only question -> answer view over shard snapshots that copies none of them; earlier shards win
+    len() adds up the shards, so a question in two shards counts twice
+    """
+
+    def __init__(self, snapshots, answer_engine):
+        self._snapshots = snapshots
+        self.answer_engine = answer_engine
+
+    def __getitem__(self, question):
+        for snapshot in self._snapshots:
+            if question in snapshot:
+                return snapshot[question]
+        raise KeyError(question)
+
+    def __contains__(self, question):
+        return any(question in snapshot for snapshot in self._snapshots)
+
+    def __iter__(self):
+        for position, snapshot in enumerate(self._snapshots):
+            for question in snapshot:
+                if not any(question in earlier for earlier in self._snapshots[:position]):
+                    yield question
+
+    def __len__(self):
+        return sum(len(snapshot) for snapshot in self._snapshots)
+
+class ShardedKnowledgeBase:
+    """Shards by name, in the order they were added; earlier shards win on duplicate questions"""
+
+    def __init__(self, query_workers=SHARD_QUERY_WORKERS, timeout=SHARD_QUERY_TIMEOUT_SECONDS):
+        self._shards = {}
+        self._lock = threading.RLock()
+        self._threads = ThreadPoolExecutor(max_workers=query_workers, thread_name_prefix="kb-shard")
+        self._timeout = timeout
+        self._view = None
+        self._view_key = None
+        self._configured = {}
+        self._sources_mtime = None
+
+    def add_shard(self, name, path, mode=None, **metadata):
+        """Load a source as a new shard; raises ValueError if the name is taken, FileNotFoundError if path is missing"""
+        with self._lock:
+            if name in self._shards:
+                raise ValueError(f"Shard '{name}' already exists")
+            start = time.perf_counter()
+            shard = KnowledgeBaseShard(name, path, mode, **metadata)
+            self._shards[name] = shard
+            logging.info(f"KB shards: added '{name}' ({len(shard)} Q&A pairs, {shard.mode}) from {path} "
+                         f"in {(time.perf_counter() - start) * 1000:.1f}ms")
+            return shard
+
+    def remove_shard(self, name):
+        """Stop serving a shard; raises KeyError if there is none by that name"""
+        with self._lock:
+            shard = self._shards.pop(name)
+            self._configured.pop(name, None)
+        shard.close()
+        logging.info(f"KB shards: removed '{name}'")
+
+    def shards(self):
+        """Name, path, mode, entry count and metadata of each shard"""
+        with self._lock:
+            return [shard.describe() for shard in self._shards.values()]
+
+    def __len__(self):
+        return len(self._shards)
+
+    def sync_sources(self, path=KB_SOURCES_FILE):
+        """Add, replace or remove the shards listed in a sources file to match it; a no-op while it's unchanged"""
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        with self._lock:
+            if mtime == self._sources_mtime:
+                return
+            self._sources_mtime = mtime
+            sources = {}
+            if mtime is not None:
+                try:
+                    with open(path, encoding="utf-8") as sources_file:
+                        sources = {source['name']: source for source in json.load(sources_file)}
+                except (ValueError, KeyError, TypeError) as e:
+                    logging.error(f"KB shards: ignoring malformed {path}: {e}")
+                    return
+            for name, source in list(self._configured.items()):
+                if sources.get(name) != source:
+                    self.remove_shard(name)
+            for name, source in sources.items():
+                if name in self._configured:
+                    continue
+                if name in self._shards:
+                    logging.warning(f"KB shards: '{name}' from {path} clashes with an existing shard")
+                    continue
+                try:
+                    metadata = {key: value for key, value in source.items() if key not in ("name", "path", "mode")}
+                    self.add_shard(name, source['path'], source.get('mode'), **metadata)
+                    self._configured[name] = source
+                except (FileNotFoundError, KeyError) as e:
+                    logging.error(f"KB shards: can't load source '{name}': {e}")
+
+    def current(self):
+        """
+        Up-to-date knowledge base over every shard (question -> answer), carrying a ShardedAnswerEngine
+        It is a ChainedKnowledgeBase over the shard snapshots, so a change copies nothing; the
+        view is only replaced when a shard changed or shards were added or removed
+        """
+        with self._lock:
+            shards = list(self._shards.values())
+        snapshots = [shard.current() for shard in shards]
+        key = tuple((shard.name, id(snapshot)) for shard, snapshot in zip(shards, snapshots))
+        with self._lock:
+            if key != self._view_key:
+                engine = ShardedAnswerEngine(shards, snapshots, self._threads, self._timeout)
+                self._view = ChainedKnowledgeBase(snapshots, engine)
+                self._view_key = key
+            return self._view
+
+    def search(self, input_text, limit=RERANK_CANDIDATES):
+        return self.current().answer_engine.search(input_text, limit)
+
+_sharded = None
+_sharded_lock = threading.Lock()
+
+def get_sharded_knowledge_base(default_paths=("AI_Mental_Health.csv",), sources_path=KB_SOURCES_FILE):
+    """
+    Return the process-wide sharded knowledge base
+    The first of default_paths that exists becomes the "general" shard; the sources file adds the rest
+    and is re-read whenever it changes. Raises FileNotFoundError when there is no shard at all
+    """
+    global _sharded
+    with _sharded_lock:
+        if _sharded is None:
+            sharded = ShardedKnowledgeBase()
+            for path in default_paths:
+                if os.path.exists(path):
+                    sharded.add_shard("general", path, KB_GENERAL_SHARD_MODE, domain="general mental health")
+                    break
+            _sharded = sharded
+    _sharded.sync_sources(sources_path)
+    if not len(_sharded):
+        raise FileNotFoundError(f"No knowledge base in {', '.join(default_paths)} or {sources_path}")
+    return _sharded
@@ -0,0 +1,432 @@
+"""
+Knowledge base store with incremental updates
+Q&A pairs are added, updated and deleted by Question_ID through an append-only
+delta log next to the base CSV. Each process tails the log and merges new
+deltas into its live answer engine in place, so updates reach running apps
+without a restart or a rebuild. Compaction folds the log back into the base CSV
+(other processes reload once when they see the new base). Questions kb_dedup
+collapsed into a canonical entry are resolved to it through its alias map.
+Processes coordinate through an advisory file lock (fcntl, where available)
+"""
+
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+from collections.abc import Mapping
+
+import pandas as pd
+
+import metrics
+from kb_answer_engine import KBAnswerEngine
+from kb_dedup import aliases_path, load_aliases
+from kb_ingest import ANSWER_COLUMN, QUESTION_COLUMN, iter_chunks
+from kb_passages import PassageIndex
+from text_features import normalize_text
+
+# Advisory locks are POSIX-only; elsewhere only threads of one process are coordinated
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+ID_COLUMN = "Question_ID"
+KB_COMPACT_INTERVAL_SECONDS = float(os.getenv("KB_COMPACT_INTERVAL_SECONDS", "300"))
+# Background compaction waits until the log holds at least this many deltas
+KB_COMPACT_MIN_DELTAS = int(os.getenv("KB_COMPACT_MIN_DELTAS", "100"))
+
+# Overlay value of a question deleted since the base was loaded
+_DELETED = object()
+
+class LiveKnowledgeBase(Mapping):
+    """
+    Snapshot of question -> answer that carries the store's in-place answer engine
+    A read-only view of the shared base entries plus an overlay of the questions changed
+    since the base was loaded, so publishing one costs the size of the overlay, not the KB
+    """
+
+    answer_engine = None
+
+    def __init__(self, base, overlay=None):
+        self._base = base
+        self._overlay = overlay or {}
+        self._length = len(base)
+        for question, answer in self._overlay.items():
+            if question in base:
+                self._length -= answer is _DELETED
+            else:
+                self._length += answer is not _DELETED
+
+    def __getitem__(self, question):
+        answer = self._overlay.get(question, self._base.get(question, _DELETED))
+        if answer is _DELETED:
+            raise KeyError(question)
+        return answer
+
+    def __contains__(self, question):
+        return self._overlay.get(question, self._base.get(question, _DELETED)) is not _DELETED
+
+    def __iter__(self):
+        for question in self._base:
+            if self._overlay.get(question) is not _DELETED:
+                yield question
+        for question, answer in self._overlay.items():
+            if answer is not _DELETED and question not in self._base:
+                yield question
+
+    def __len__(self):
+        return self._length
+
+def delta_log_path(base_path):
+    return f"{base_path}.delta.jsonl"
+
+def _file_id(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_dev, stat.st_ino)
+
+class KnowledgeBaseStore:
+    """
+    Base CSV plus delta log, with a live knowledge base snapshot and answer engine
+    With index=False only the entries are kept (no answer engine), for callers that build their own index
+    """
+
+    def __init__(self, base_path, log_path=None, index=True):
+        self.base_path = base_path
+        self.log_path = log_path or delta_log_path(base_path)
+        self.index = index
+        self._lock = threading.RLock()
+        self._lock_file = None
+        self._log_file = None
+        self._load()
+
+    # Loading and applying deltas
+
+    def _load(self):
+        """Full load: base CSV, then every delta in the log"""
+        start = time.perf_counter()
+        if not os.path.exists(self.base_path):
+            raise FileNotFoundError(self.base_path)
+        self._records = {}
+        self._keys = {}
+        self._base = {}
+        self._overlay = {}
+        self._alias_ids = {}
+        self._alias_keys = {}
+        self._base_id = _file_id(self.base_path)
+        has_ids = ID_COLUMN in pd.read_csv(self.base_path, nrows=0).columns
+        row = 0
+        for frame in iter_chunks(self.base_path, extra_columns=(ID_COLUMN,) if has_ids else ()):
+            ids = frame[ID_COLUMN] if has_ids else pd.Series(range(row, row + len(frame))).astype(str)
+            row += len(frame)
+            for question_id, question, answer in zip(ids, frame[QUESTION_COLUMN], frame[ANSWER_COLUMN]):
+                if all(isinstance(value, str) and value and value.lower() != "nan"
+                       for value in (question_id, question, answer)):
+                    self._set(question_id, question, answer)
+        self._fold()
+        self.engine = None
+        if self.index:
+            self.engine = KBAnswerEngine(self._base, embeddings=True)
+            self.engine.passages = PassageIndex(self._base)
+        self.pending_deltas = 0
+        self._open_log()
+        self._read_log()
+        self._load_aliases()
+        self._publish()
+        logging.info(f"KB store: {len(self._records)} Q&A pairs ({self.pending_deltas} deltas) from "
+                     f"{self.base_path} in {(time.perf_counter() - start) * 1000:.1f}ms")
+
+    def _open_log(self):
+        """(Re)open the log for reading from the start; it's created by the first write"""
+        if self._log_file is not None:
+            self._log_file.close()
+            self._log_file = None
+        self._log_id = _file_id(self.log_path)
+        self._log_offset = 0
+        if self._log_id is not None:
+            self._log_file = open(self.log_path, encoding="utf-8")
+
+    def _fold(self):
+        """Start a new base with the overlay folded in; published snapshots keep the old one"""
+        base = {question: answer for question, answer in self._base.items() if question not in self._overlay}
+        base.update((question, answer) for question, answer in self._overlay.items() if answer is not _DELETED)
+        self._base = base
+        self._overlay = {}
+
+    def _answer(self, key):
+        """Current answer of a knowledge base key, or None"""
+        answer = self._overlay.get(key, self._base.get(key))
+        return None if answer is _DELETED else answer
+
+    def _load_aliases(self):
+        """Resolve the kb_dedup alias map (alias question -> canonical Question_ID) to knowledge base keys"""
+        self._aliases_file_id = _file_id(aliases_path(self.base_path))
+        self._alias_ids = {}
+        self._alias_keys = {}
+        for alias, canonical_id in load_aliases(self.base_path).items():
+            alias = normalize_text(alias)
+            self._alias_ids.setdefault(str(canonical_id), []).append(alias)
+            if str(canonical_id) in self._records:
+                self._alias_keys[alias] = self._key(self._records[str(canonical_id)][0])
+        if self.engine is not None:
+            self.engine.aliases = self._alias_keys
+
+    @staticmethod
+    def _key(question):
+        """Knowledge base key of a question, as the loaders build it"""
+        return question.lower()
+
+    def _set(self, question_id, question, answer):
+        """Apply an upsert to the records and the entries dict; returns the changed keys"""
+        changed = []
+        previous = self._records.get(question_id)
+        if previous is not None:
+            changed += self._unset(question_id)
+        self._records[question_id] = (question, answer)
+        key = self._key(question)
+        self._keys.setdefault(key, []).append(question_id)
+        self._overlay[key] = answer
+        for alias in self._alias_ids.get(question_id, ()):
+            self._alias_keys[alias] = key
+        return changed + [key]
+
+    def _unset(self, question_id):
+        question, _ = self._records.pop(question_id)
+        key = self._key(question)
+        for alias in self._alias_ids.get(question_id, ()):
+            self._alias_keys.pop(alias, None)
+        owners = self._keys[key]
+        owners.remove(question_id)
+        if owners:
+            # Another Question_ID has the same question: the most recent one answers it
+            self._overlay[key] = self._records[owners[-1]][1]
+        else:
+            del self._keys[key]
+            if key in self._base:
+                self._overlay[key] = _DELETED
+            else:
+                self._overlay.pop(key, None)
+        return [key]
+
+    def _apply(self, delta):
+        """Apply one delta to the records; returns the knowledge base keys it touched"""
+        question_id = str(delta['id'])
+        if delta['op'] == "upsert":
+            return self._set(question_id, delta['question'], delta['answer'])
+        if delta['op'] == "delete" and question_id in self._records:
+            return self._unset(question_id)
+        return []
+
+    def _sync_engine(self, keys):
+        if self.engine is None:
+            return
+        for key in dict.fromkeys(keys):
+            answer = self._answer(key)
+            if answer is not None:
+                self.engine.upsert(key, answer)
+            else:
+                self.engine.remove(key)
+
+    def _read_log(self):
+        """Apply complete log lines past the current offset; returns how many were applied"""
+        if self._log_file is None:
+            return 0
+        start = time.perf_counter()
+        self._log_file.seek(self._log_offset)
+        applied = 0
+        touched = []
+        while True:
+            line = self._log_file.readline()
+            if not line.endswith("\n"):
+                # A writer is mid-append; pick the line up on the next refresh
+                break
+            self._log_offset = self._log_file.tell()
+            if line.strip():
+                touched += self._apply(json.loads(line))
+                applied += 1
+        if applied:
+            self._sync_engine(touched)
+            self.pending_deltas += applied
+            metrics.increment("kb_deltas_applied", applied)
+            metrics.observe("kb_delta_apply_seconds", time.perf_counter() - start)
+        return applied
+
+    def _publish(self):
+        # The base is never modified once published; only the overlay is copied
+        snapshot = LiveKnowledgeBase(self._base, dict(self._overlay))
+        snapshot.answer_engine = self.engine
+        self._snapshot = snapshot
+
+    @contextlib.contextmanager
+    def _locked(self, exclusive):
+        """Thread lock plus the shared or exclusive inter-process lock"""
+        with self._lock:
+            if fcntl is None:
+                yield
+                return
+            if self._lock_file is None:
+                self._lock_file = open(f"{self.log_path}.lock", "a")
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def _refresh_locked(self):
+        if _file_id(self.base_path) != self._base_id:
+            # Compacted by another process (or edited by hand): start over from the new base
+            self._load()
+            return self.pending_deltas
+        if _file_id(aliases_path(self.base_path)) != self._aliases_file_id:
+            self._load_aliases()
+        if _file_id(self.log_path) != self._log_id:
+            # Created by a first write, or replaced by a compaction whose base we already loaded
+            self._open_log()
+        applied = self._read_log()
+        if applied:
+            self._publish()
+        return applied
+
+    # Public API
+
+    def refresh(self):
+        """Pick up deltas written by any process since the last refresh; returns how many were applied"""
+        with self._locked(exclusive=False):
+            return self._refresh_locked()
+
+    def current(self):
+        """The up-to-date knowledge base (question -> answer); snapshots are never modified"""
+        self.refresh()
+        return self._snapshot
+
+    def get(self, question_id):
+        """(question, answer) for a Question_ID, or None"""
+        with self._lock:
+            return self._records.get(str(question_id))
+
+    def aliases(self):
+        """Up-to-date copy of normalized alias question -> canonical knowledge base key"""
+        self.refresh()
+        with self._lock:
+            return dict(self._alias_keys)
+
+    def records(self):
+        """Up-to-date copy of Question_ID -> (question, answer)"""
+        self.refresh()
+        with self._lock:
+            return dict(self._records)
+
+    def __len__(self):
+        return len(self._records)
+
+    def _write(self, delta):
+        with self._locked(exclusive=True):
+            self._refresh_locked()
+            self._check(delta)
+            line = json.dumps(delta, ensure_ascii=False) + "\n"
+            # One write() of one line to an O_APPEND file, so concurrent appends never interleave
+            descriptor = os.open(self.log_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(descriptor, line.encode("utf-8"))
+                os.fsync(descriptor)
+            finally:
+                os.close(descriptor)
+            self._refresh_locked()
+
+    def _check(self, delta):
+        exists = delta['id'] in self._records
+        if delta.pop('new', False) and exists:
+            raise ValueError(f"Question_ID {delta['id']} already exists")
+        if delta['op'] == "delete" and not exists:
+            raise KeyError(delta['id'])
+        if delta['op'] == "upsert":
+            if 'question' not in delta or 'answer' not in delta:
+                if not exists:
+                    raise KeyError(delta['id'])
+                question, answer = self._records[delta['id']]
+                delta.setdefault('question', question)
+                delta.setdefault('answer', answer)
+            if not str(delta['question']).strip() or not str(delta['answer']).strip():
+                raise ValueError("Question and answer must not be empty")
+
+    def add(self, question_id, question, answer):
+        """Add a new Q&A pair; raises ValueError if the Question_ID is taken"""
+        self._write({'op': "upsert", 'id': str(question_id), 'question': question, 'answer': answer,
+                     'ts': time.time(), 'new': True})
+
+    def update(self, question_id, question=None, answer=None):
+        """Change the question and/or answer of an existing Question_ID"""
+        delta = {'op': "upsert", 'id': str(question_id), 'ts': time.time()}
+        if question is not None:
+            delta['question'] = question
+        if answer is not None:
+            delta['answer'] = answer
+        # A missing question or answer is filled in from the current record under the write lock
+        self._write(delta)
+
+    def delete(self, question_id):
+        """Remove a Question_ID; raises KeyError if it doesn't exist"""
+        self._write({'op': "delete", 'id': str(question_id), 'ts': time.time()})
+
+    def compact(self):
+        """Rewrite the base CSV with every delta folded in and drop the log; returns False if there was nothing to fold"""
+        with self._locked(exclusive=True):
+            self._refresh_locked()
+            if not self.pending_deltas:
+                return False
+            start = time.perf_counter()
+            frame = pd.DataFrame(
+                [(question_id, question, answer) for question_id, (question, answer) in self._records.items()],
+                columns=[ID_COLUMN, QUESTION_COLUMN, ANSWER_COLUMN])
+            temporary = f"{self.base_path}.{os.getpid()}.tmp"
+            frame.to_csv(temporary, index=False)
+            os.replace(temporary, self.base_path)
+            # Replaying the old log over the new base would be harmless, so a crash here loses nothing
+            os.remove(self.log_path)
+            compacted = self.pending_deltas
+            self._base_id = _file_id(self.base_path)
+            self._open_log()
+            self.pending_deltas = 0
+            self._fold()
+            metrics.increment("kb_compactions")
+            logging.info(f"KB store: compacted {compacted} deltas into {self.base_path} "
+                         f"in {(time.perf_counter() - start) * 1000:.1f}ms")
+            return True
+
+    def start_background_compaction(self, interval=KB_COMPACT_INTERVAL_SECONDS, min_deltas=KB_COMPACT_MIN_DELTAS):
+        """Compact on a daemon thread every interval seconds once enough deltas pile up; returns a stop Event"""
+        stop = threading.Event()
+
+        def run():
+            while not stop.wait(interval):
+                try:
+                    self.refresh()
+                    if self.pending_deltas >= min_deltas:
+                        self.compact()
+                except Exception as e:
+                    logging.error(f"KB store: background compaction failed: {e}")
+
+        threading.Thread(target=run, name="kb-compaction", daemon=True).start()
+        return stop
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+def get_knowledge_base_store(base_path):
+    """
+    Return the process-wide store for a base CSV, with background compaction running
+    Raises FileNotFoundError when the CSV doesn't exist
+    """
+    key = os.path.abspath(base_path)
+    with _stores_lock:
+        store = _stores.get(key)
+        if store is None:
+            store = KnowledgeBaseStore(base_path)
+            if KB_COMPACT_INTERVAL_SECONDS > 0:
+                store.start_background_compaction()
+            _stores[key] = store
+        return store
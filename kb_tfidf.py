@@ -0,0 +1,134 @@
+"""
+Vectorized TF-IDF retrieval over the knowledge base
+Builds one L2-normalized TF-IDF matrix from the questions and answers and scores
+a whole batch of queries with a single matrix product and per-row top-k
+selection, for offline evaluation and bulk processing
+"""
+
+import logging
+import math
+import time
+from collections import Counter
+
+import numpy as np
+
+from kb_answer_engine import index_terms
+from kb_cache import KnowledgeBaseCache
+
+# Optional sparse matrices; without scipy the matrix is a dense float32 array
+try:
+    from scipy import sparse
+except ImportError:
+    sparse = None
+
+# Question terms count this many times as much as answer terms
+QUESTION_WEIGHT = 3
+# Cap on query rows x documents scored at once, to bound the score matrix memory
+MAX_SCORE_CELLS = 16_000_000
+
+class TfidfRetriever:
+    """TF-IDF matrix over knowledge base Q&A pairs with batched search"""
+
+    def __init__(self, knowledge_base, question_weight=QUESTION_WEIGHT):
+        self.questions = list(knowledge_base.keys())
+        self.answers = list(knowledge_base.values())
+
+        documents = []
+        for question, answer in zip(self.questions, self.answers):
+            counts = Counter(index_terms(answer))
+            for term in index_terms(question):
+                counts[term] += question_weight
+            documents.append(counts)
+
+        self.vocabulary = {term: i for i, term in enumerate(sorted({term for counts in documents for term in counts}))}
+        document_frequency = np.zeros(len(self.vocabulary), dtype=np.float32)
+        rows, columns, values = [], [], []
+        for doc_id, counts in enumerate(documents):
+            for term, count in counts.items():
+                column = self.vocabulary[term]
+                document_frequency[column] += 1
+                rows.append(doc_id)
+                columns.append(column)
+                values.append(1 + math.log(count))
+        # Smoothed IDF, as in scikit-learn's TfidfVectorizer
+        self.idf = (np.log((1 + len(documents)) / (1 + document_frequency)) + 1).astype(np.float32)
+
+        values = np.asarray(values, dtype=np.float32) * self.idf[np.asarray(columns, dtype=np.int64)]
+        self.matrix = self._build((np.asarray(rows), np.asarray(columns), values), len(documents))
+
+    def __len__(self):
+        return len(self.questions)
+
+    def _build(self, entries, row_count):
+        """Row-normalized (documents or queries) x terms matrix, sparse when scipy is available"""
+        rows, columns, values = entries
+        norms = np.zeros(row_count, dtype=np.float32)
+        np.add.at(norms, rows, values * values)
+        norms = np.sqrt(norms)
+        values = values / np.where(norms[rows] > 0, norms[rows], 1)
+        shape = (row_count, len(self.vocabulary))
+        if sparse is not None:
+            return sparse.csr_matrix((values, (rows, columns)), shape=shape, dtype=np.float32)
+        matrix = np.zeros(shape, dtype=np.float32)
+        matrix[rows, columns] = values
+        return matrix
+
+    def vectorize(self, texts):
+        """TF-IDF rows for query texts; terms outside the knowledge base vocabulary are ignored"""
+        rows, columns, values = [], [], []
+        for row, text in enumerate(texts):
+            for term, count in Counter(index_terms(text)).items():
+                column = self.vocabulary.get(term)
+                if column is not None:
+                    rows.append(row)
+                    columns.append(column)
+                    values.append((1 + math.log(count)) * self.idf[column])
+        entries = (np.asarray(rows, dtype=np.int64), np.asarray(columns, dtype=np.int64),
+                   np.asarray(values, dtype=np.float32))
+        return self._build(entries, len(texts))
+
+    def score_batch(self, queries):
+        """Cosine similarity of every query to every Q&A pair, as a dense queries x documents array"""
+        scores = self.vectorize(queries) @ self.matrix.T
+        return scores.toarray() if sparse is not None and sparse.issparse(scores) else np.asarray(scores)
+
+    def search_batch(self, queries, k=5):
+        """
+        Top-k Q&A pairs for each query, scored in chunks of one matrix product each
+        Returns one list of (question, answer, score) per query, best first; zero scores are dropped
+        """
+        queries = list(queries)
+        k = min(k, len(self.questions))
+        results = []
+        if k == 0:
+            return [[] for _ in queries]
+        chunk = max(1, MAX_SCORE_CELLS // max(1, len(self.questions)))
+        for start in range(0, len(queries), chunk):
+            scores = self.score_batch(queries[start:start + chunk])
+            top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            top_scores = np.take_along_axis(scores, top, axis=1)
+            # Best first; equal scores keep knowledge base order
+            order = np.lexsort((top, -top_scores), axis=1)
+            top = np.take_along_axis(top, order, axis=1)
+            top_scores = np.take_along_axis(top_scores, order, axis=1)
+            for doc_ids, row_scores in zip(top, top_scores):
+                results.append([(self.questions[doc_id], self.answers[doc_id], float(score))
+                                for doc_id, score in zip(doc_ids, row_scores) if score > 0])
+        return results
+
+    def search(self, query, k=5):
+        """Single-query search through the same matrices"""
+        return self.search_batch([query], k)[0]
+
+def _build_retriever(knowledge_base):
+    start = time.perf_counter()
+    retriever = TfidfRetriever(knowledge_base)
+    logging.info(f"KB TF-IDF: {len(retriever)} Q&A pairs x {len(retriever.vocabulary)} terms "
+                 f"({'sparse' if sparse is not None else 'dense'}) in {(time.perf_counter() - start) * 1000:.1f}ms")
+    return retriever
+
+_retrievers = KnowledgeBaseCache(_build_retriever)
+
+def get_tfidf_retriever(knowledge_base):
+    """Return the process-wide retriever for a knowledge base (cached by kb_cache)"""
+    return _retrievers.get(knowledge_base)
@@ -0,0 +1,161 @@
+"""
+Shared Groq LLM client used by all chatbot apps
+"""
+
+import os
+import json
+import hashlib
+import logging
+import threading
+import time
+from concurrent.futures import Future
+from groq import Groq
+from dotenv import load_dotenv
+
+import metrics
+import async_llm_client
+from async_llm_client import RequestSuperseded, current_session_id
+from model_router import choose_route, record_latency, log_routing_outcome
+
+# Load environment variables
+load_dotenv()
+
+# Completions go through the shared asyncio loop unless GROQ_ASYNC_CLIENT=0
+USE_ASYNC_CLIENT = os.getenv("GROQ_ASYNC_CLIENT", "1") != "0"
+
+# Initialize Groq client
+try:
+    groq_client = Groq(api_key=os.getenv("GROQ_API_KEY"))
+except Exception as e:
+    groq_client = None
+    logging.warning(f"Groq client initialization failed: {e}")
+
+def _complete(messages, model, max_tokens, temperature, timeout=None, session_id=None):
+    """
+    Run one chat completion and record its latency
+    Returns (content, usage); content is None on failure
+    """
+    if USE_ASYNC_CLIENT and async_llm_client.async_groq_client is not None:
+        return async_llm_client.complete_sync(messages, model, max_tokens, temperature, timeout, session_id)
+
+    if not groq_client:
+        logging.error("Groq client not initialized")
+        return None, None
+
+    start = time.perf_counter()
+    try:
+        response = groq_client.chat.completions.create(
+            model=model,
+            messages=messages,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            timeout=timeout
+        )
+        record_latency(model, time.perf_counter() - start)
+        return response.choices[0].message.content, getattr(response, 'usage', None)
+
+    except Exception as e:
+        # Failures count against the model's latency budget too
+        record_latency(model, time.perf_counter() - start)
+        logging.error(f"Groq API error: {e}")
+        return None, None
+
+class LeaderCancelled(Exception):
+    """The caller running a shared completion was interrupted before it finished"""
+
+# Single-flight table: request key -> Future of (content, usage) for the call in progress
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+
+def request_key(messages, model, max_tokens, temperature):
+    """Key identifying completions that would be sent with identical normalized messages and parameters"""
+    normalized = [(m.get('role'), " ".join(str(m.get('content', '')).split())) for m in messages]
+    payload = json.dumps([normalized, model, max_tokens, temperature], sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def _complete_coalesced(messages, model, max_tokens, temperature, timeout=None, session_id=None):
+    """
+    Run a completion, sharing one upstream call between concurrent identical requests
+    Returns (content, usage, shared); shared is True when another caller's result was reused
+    """
+    key = request_key(messages, model, max_tokens, temperature)
+
+    while True:
+        with _in_flight_lock:
+            future = _in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                _in_flight[key] = future
+
+        if not leader:
+            metrics.increment("llm_coalesced_requests")
+            try:
+                content, usage = future.result()
+                return content, usage, True
+            except LeaderCancelled:
+                # The leader's session went away mid-call; take over instead of failing
+                metrics.increment("llm_coalesced_retries")
+                continue
+
+        metrics.increment("llm_upstream_requests")
+        try:
+            result = _complete(messages, model, max_tokens, temperature, timeout, session_id=session_id)
+        except BaseException as e:
+            # e.g. Streamlit stopping this script run or the session re-submitting;
+            # waiting callers retry on their own
+            future.set_exception(LeaderCancelled(str(e)))
+            raise
+        else:
+            future.set_result(result)
+            return result[0], result[1], False
+        finally:
+            with _in_flight_lock:
+                if _in_flight.get(key) is future:
+                    del _in_flight[key]
+
+def get_coalescing_stats():
+    """Upstream vs. coalesced request counts"""
+    return {
+        'upstream_requests': metrics.get_counter("llm_upstream_requests"),
+        'coalesced_requests': metrics.get_counter("llm_coalesced_requests"),
+        'coalesced_retries': metrics.get_counter("llm_coalesced_retries"),
+        'in_flight': len(_in_flight)
+    }
+
+# Groq API client function
+def call_groq_api(messages, model="llama-3.3-70b-versatile", max_tokens=800, temperature=0.7, timeout=None,
+                  session_id=None):
+    """
+    Call Groq API for chat completions using the official SDK
+    """
+    try:
+        content, _, _ = _complete_coalesced(messages, model, max_tokens, temperature, timeout, session_id)
+    except RequestSuperseded as e:
+        logging.info(f"Groq request dropped: {e}")
+        return None
+    return content
+
+def call_groq_routed(messages, input_text=None, risk_score=None, sentiment_label=None, temperature=0.7,
+                     max_tokens=None, route=None, session_id=None):
+    """
+    Call Groq with the model, max_tokens and timeout picked by model_router
+    Pass a route from choose_route when the prompt was already built for it
+    Inside Streamlit, a newer request from the same session cancels this one
+    """
+    if route is None:
+        route = choose_route(risk_score, sentiment_label, len(input_text or ""), max_tokens)
+    if session_id is None:
+        session_id = current_session_id()
+
+    start = time.perf_counter()
+    try:
+        content, usage, shared = _complete_coalesced(messages, route['model'], route['max_tokens'], temperature,
+                                                     route['timeout'], session_id)
+    except RequestSuperseded as e:
+        logging.info(f"Groq request dropped: {e}")
+        return None
+    route['coalesced'] = shared
+    # A shared result was paid for once, by the leader
+    log_routing_outcome(route, time.perf_counter() - start, None if shared else usage, success=content is not None)
+    return content
@@ -0,0 +1,167 @@
+"""
+Per-message stage graph
+Runs the independent stages of handling one chat message (analysis, retrieval,
+generation) concurrently, and sends crisis alerts from a background queue so
+they never sit on the response path
+"""
+
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+
+import metrics
+
+STAGE_WORKERS = 16
+# How long exit waits for queued crisis alerts to be sent
+ALERT_FLUSH_SECONDS = float(os.getenv("ALERT_FLUSH_SECONDS", "30"))
+
+_stage_executor = ThreadPoolExecutor(max_workers=STAGE_WORKERS, thread_name_prefix="message-stage")
+
+class StageGraph:
+    """
+    A small dependency graph of stages for one message
+    Each stage runs on the shared stage pool as soon as its dependencies finish;
+    it is called with the dependency results (in order) followed by its own args.
+    Stage functions must not call Streamlit; render from the script thread with result()
+    """
+
+    def __init__(self, executor=None):
+        self._executor = executor or _stage_executor
+        self._stages = {}
+        self._futures = {}
+        self._lock = threading.Lock()
+        self._started = None
+        self.timings = {}
+
+    def add(self, name, func, *args, deps=(), **kwargs):
+        """Register a stage; deps are names of stages whose results it takes"""
+        for dep in deps:
+            if dep not in self._stages:
+                raise ValueError(f"Stage '{name}' depends on unknown stage '{dep}'")
+        self._stages[name] = (func, tuple(deps), args, kwargs)
+        self._futures[name] = Future()
+        return self
+
+    def start(self):
+        """Launch every stage whose dependencies are met; the rest follow automatically"""
+        self._started = time.perf_counter()
+        for name, (_, deps, _, _) in self._stages.items():
+            if not deps:
+                self._launch(name)
+                continue
+            remaining = {'count': len(deps)}
+            for dep in deps:
+                self._futures[dep].add_done_callback(
+                    lambda _, name=name, remaining=remaining: self._dependency_done(name, remaining)
+                )
+        return self
+
+    def _dependency_done(self, name, remaining):
+        with self._lock:
+            remaining['count'] -= 1
+            ready = remaining['count'] == 0
+        if ready:
+            self._launch(name)
+
+    def _launch(self, name):
+        func, deps, args, kwargs = self._stages[name]
+        future = self._futures[name]
+        for dep in deps:
+            error = self._futures[dep].exception()
+            if error is not None:
+                future.set_exception(error)
+                return
+        dep_results = [self._futures[dep].result() for dep in deps]
+        self._executor.submit(self._run, name, func, dep_results, args, kwargs)
+
+    def _run(self, name, func, dep_results, args, kwargs):
+        future = self._futures[name]
+        start = time.perf_counter()
+        try:
+            result = func(*dep_results, *args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.timings[name] = elapsed
+            metrics.observe(f"stage_{name}_seconds", elapsed)
+
+    def result(self, name, timeout=None):
+        """Block until a stage finishes and return its result (re-raises its error)"""
+        return self._futures[name].result(timeout)
+
+    def as_completed(self, timeout=None):
+        """Yield stage names in the order they finish"""
+        names = {future: name for name, future in self._futures.items()}
+        for future in as_completed(names, timeout=timeout):
+            yield names[future]
+
+    def elapsed(self):
+        """Seconds since start()"""
+        return time.perf_counter() - self._started if self._started else 0.0
+
+    def report(self):
+        """Per-stage timings plus wall-clock time, logged and returned"""
+        wall = self.elapsed()
+        metrics.observe("message_pipeline_seconds", wall)
+        stage_total = sum(self.timings.values())
+        logging.info(f"Message pipeline: {wall:.3f}s wall vs {stage_total:.3f}s summed stages "
+                     + ", ".join(f"{name}={seconds:.3f}s" for name, seconds in self.timings.items()))
+        return {'wall_seconds': wall, 'stage_seconds': dict(self.timings)}
+
+# Crisis alerts are delivered by one background worker, in order
+_alert_queue = queue.Queue()
+_alert_worker = None
+_alert_worker_lock = threading.Lock()
+
+def _deliver_alerts():
+    while True:
+        func, args, kwargs = _alert_queue.get()
+        start = time.perf_counter()
+        try:
+            if func(*args, **kwargs) is False:
+                metrics.increment("alerts_failed")
+            else:
+                metrics.increment("alerts_sent")
+        except Exception as e:
+            metrics.increment("alerts_failed")
+            logging.error(f"Crisis alert delivery error: {e}")
+        finally:
+            metrics.observe("alert_delivery_seconds", time.perf_counter() - start)
+            _alert_queue.task_done()
+
+def enqueue_alert(func, *args, **kwargs):
+    """Queue a crisis alert send (e.g. send_crisis_alert) without waiting for SMTP"""
+    global _alert_worker
+    with _alert_worker_lock:
+        if _alert_worker is None:
+            _alert_worker = threading.Thread(target=_deliver_alerts, name="crisis-alerts", daemon=True)
+            _alert_worker.start()
+            # The worker is a daemon so it never holds the process open on its own; exit drains the queue first
+            atexit.register(_flush_alerts)
+    metrics.increment("alerts_enqueued")
+    _alert_queue.put((func, args, kwargs))
+
+def wait_for_alerts(timeout=None):
+    """Block until queued alerts have been handled (used by tests and shutdown)"""
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while _alert_queue.unfinished_tasks:
+        if deadline is not None and time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+def _flush_alerts():
+    """Send alerts still queued at interpreter exit"""
+    pending = _alert_queue.unfinished_tasks
+    if not pending:
+        return
+    logging.info(f"Sending {pending} queued crisis alert(s) before exit")
+    if not wait_for_alerts(ALERT_FLUSH_SECONDS):
+        logging.error(f"{_alert_queue.unfinished_tasks} crisis alert(s) not sent after {ALERT_FLUSH_SECONDS}s at exit")
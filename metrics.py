@@ -0,0 +1,78 @@
+"""
+Process-wide counters, gauges and value summaries for performance metrics
+Exported as a dict snapshot or in Prometheus text format
+"""
+
+import threading
+
+_counters = {}
+_gauges = {}
+_summaries = {}
+_lock = threading.Lock()
+
+def increment(name, value=1):
+    """Add value to a counter"""
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+def set_gauge(name, value):
+    """Set a gauge, a value that can go up and down, such as requests in flight"""
+    with _lock:
+        _gauges[name] = value
+
+def inc_gauge(name, value=1):
+    """Raise a gauge by value"""
+    with _lock:
+        _gauges[name] = _gauges.get(name, 0) + value
+
+def dec_gauge(name, value=1):
+    """Lower a gauge by value"""
+    inc_gauge(name, -value)
+
+def observe(name, value):
+    """Record one observation (count, sum, max) for a value such as a latency"""
+    with _lock:
+        summary = _summaries.setdefault(name, {'count': 0, 'sum': 0.0, 'max': 0.0})
+        summary['count'] += 1
+        summary['sum'] += value
+        summary['max'] = max(summary['max'], value)
+
+def get_counter(name):
+    with _lock:
+        return _counters.get(name, 0)
+
+def get_gauge(name):
+    with _lock:
+        return _gauges.get(name, 0)
+
+def snapshot():
+    """Copy of all counters, gauges and summaries"""
+    with _lock:
+        return {
+            'counters': dict(_counters),
+            'gauges': dict(_gauges),
+            'summaries': {name: dict(summary) for name, summary in _summaries.items()}
+        }
+
+def reset():
+    """Clear all metrics (used by tests)"""
+    with _lock:
+        _counters.clear()
+        _gauges.clear()
+        _summaries.clear()
+
+def render_prometheus(prefix="wellbot_"):
+    """Render all metrics in the Prometheus text exposition format"""
+    data = snapshot()
+    lines = []
+    for name, value in sorted(data['counters'].items()):
+        lines.append(f"# TYPE {prefix}{name} counter")
+        lines.append(f"{prefix}{name} {value}")
+    for name, value in sorted(data['gauges'].items()):
+        lines.append(f"# TYPE {prefix}{name} gauge")
+        lines.append(f"{prefix}{name} {value}")
+    for name, summary in sorted(data['summaries'].items()):
+        lines.append(f"# TYPE {prefix}{name} summary")
+        lines.append(f"{prefix}{name}_count {summary['count']}")
+        lines.append(f"{prefix}{name}_sum {summary['sum']}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,156 @@
+"""
+Risk-aware model routing between fast and large Groq models
+Picks model, max_tokens and timeout per message and falls back to the fast
+model for low-risk messages when the large model's recent latency is over budget
+"""
+
+import json
+import logging
+import threading
+import time
+from collections import deque
+
+FAST_MODEL = "llama-3.1-8b-instant"
+LARGE_MODEL = "llama-3.3-70b-versatile"
+
+# USD per million tokens (input, output), used for cost estimates in the routing log
+MODEL_PRICING = {
+    LARGE_MODEL: (0.59, 0.79),
+    FAST_MODEL: (0.05, 0.08),
+}
+
+# Low-risk messages fall back to FAST_MODEL when the recent p90 latency of a model exceeds
+# its budget; elevated and unscored messages stay on it with a longer timeout instead
+LATENCY_BUDGET_SECONDS = {
+    LARGE_MODEL: 6.0,
+}
+LATENCY_WINDOW_SECONDS = 300
+LATENCY_MIN_SAMPLES = 5
+OVER_BUDGET_TIMEOUT_SECONDS = 45.0
+
+ROUTING_LOG_FILE = "model_routing.log"
+
+SHORT_MESSAGE_CHARS = 80
+LONG_MESSAGE_CHARS = 400
+
+class LatencyTracker:
+    """Sliding window of recent call latencies for one model"""
+
+    def __init__(self, maxlen=100):
+        self._samples = deque(maxlen=maxlen)
+        self._lock = threading.Lock()
+
+    def record(self, latency):
+        with self._lock:
+            self._samples.append((time.time(), latency))
+
+    def recent(self, window_seconds=LATENCY_WINDOW_SECONDS):
+        """Latencies recorded within the window"""
+        cutoff = time.time() - window_seconds
+        with self._lock:
+            return [latency for timestamp, latency in self._samples if timestamp >= cutoff]
+
+    def percentile(self, q, window_seconds=LATENCY_WINDOW_SECONDS):
+        """q-th percentile (0-100) of recent latencies, or None without data"""
+        samples = sorted(self.recent(window_seconds))
+        if not samples:
+            return None
+        index = min(len(samples) - 1, int(round(q / 100 * (len(samples) - 1))))
+        return samples[index]
+
+_trackers = {}
+_trackers_lock = threading.Lock()
+
+def get_latency_tracker(model):
+    """Return the process-wide latency tracker for a model"""
+    with _trackers_lock:
+        if model not in _trackers:
+            _trackers[model] = LatencyTracker()
+        return _trackers[model]
+
+def record_latency(model, latency):
+    """Record the latency of one completed call"""
+    get_latency_tracker(model).record(latency)
+
+def is_over_budget(model):
+    """True when the model's recent p90 latency exceeds its budget"""
+    budget = LATENCY_BUDGET_SECONDS.get(model)
+    if budget is None:
+        return False
+    tracker = get_latency_tracker(model)
+    if len(tracker.recent()) < LATENCY_MIN_SAMPLES:
+        return False
+    return tracker.percentile(90) > budget
+
+def choose_route(risk_score=None, sentiment_label=None, message_length=0, max_tokens=None):
+    """
+    Pick model, max_tokens and timeout for a message
+    Unknown risk is treated like elevated risk so it always gets the large model,
+    even when that model is over its latency budget
+    max_tokens optionally caps the routed reply length
+    Returns a dict: model, max_tokens, timeout, reason, fallback
+    """
+    if risk_score is None:
+        route = {'model': LARGE_MODEL, 'max_tokens': 800, 'timeout': 30.0, 'reason': "unscored message"}
+    elif risk_score >= 4:
+        route = {'model': LARGE_MODEL, 'max_tokens': 800, 'timeout': 30.0, 'reason': f"elevated risk {risk_score}"}
+    elif sentiment_label == "NEGATIVE" or message_length > LONG_MESSAGE_CHARS:
+        route = {'model': LARGE_MODEL, 'max_tokens': 700, 'timeout': 20.0, 'reason': "negative or long low-risk message"}
+    elif message_length <= SHORT_MESSAGE_CHARS:
+        route = {'model': FAST_MODEL, 'max_tokens': 300, 'timeout': 10.0, 'reason': "short low-risk message"}
+    else:
+        route = {'model': LARGE_MODEL, 'max_tokens': 500, 'timeout': 15.0, 'reason': "low-risk message"}
+
+    route['fallback'] = False
+    if route['model'] != FAST_MODEL and is_over_budget(route['model']):
+        p90 = get_latency_tracker(route['model']).percentile(90)
+        route['reason'] += f"; {route['model']} p90 {p90:.1f}s over budget"
+        if risk_score is None or risk_score >= 4:
+            # Never trade the large model away for speed on elevated or unknown risk
+            route['timeout'] = max(route['timeout'], OVER_BUDGET_TIMEOUT_SECONDS)
+        else:
+            route['model'] = FAST_MODEL
+            route['fallback'] = True
+
+    if max_tokens is not None:
+        route['max_tokens'] = min(route['max_tokens'], max_tokens)
+
+    route['risk_score'] = risk_score
+    route['sentiment_label'] = sentiment_label
+    route['message_length'] = message_length
+    return route
+
+def estimate_cost(model, prompt_tokens, completion_tokens):
+    """Estimated USD cost of one completion"""
+    input_price, output_price = MODEL_PRICING.get(model, (0.0, 0.0))
+    return (prompt_tokens * input_price + completion_tokens * output_price) / 1_000_000
+
+def log_routing_outcome(route, latency, usage=None, success=True):
+    """Append the routing decision and its latency/cost outcome to the routing log"""
+    prompt_tokens = getattr(usage, 'prompt_tokens', 0) or 0
+    completion_tokens = getattr(usage, 'completion_tokens', 0) or 0
+    record = {
+        'timestamp': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'model': route['model'],
+        'reason': route['reason'],
+        'fallback': route['fallback'],
+        'coalesced': route.get('coalesced', False),
+        'risk_score': route.get('risk_score'),
+        'sentiment_label': route.get('sentiment_label'),
+        'message_length': route.get('message_length'),
+        'max_tokens': route['max_tokens'],
+        'estimated_prompt_tokens': route.get('prompt_tokens'),
+        'timeout': route['timeout'],
+        'latency': round(latency, 3),
+        'success': success,
+        'prompt_tokens': prompt_tokens,
+        'completion_tokens': completion_tokens,
+        'cost_usd': round(estimate_cost(route['model'], prompt_tokens, completion_tokens), 8)
+    }
+    logging.info(f"Routing: {record['model']} ({record['reason']}) {record['latency']}s ${record['cost_usd']}")
+    try:
+        with open(ROUTING_LOG_FILE, "a") as f:
+            f.write(json.dumps(record) + "\n")
+    except OSError as e:
+        logging.warning(f"Could not write routing log: {e}")
+    return record
@@ -0,0 +1,323 @@
+"""
+Native polarity/subjectivity scoring that reproduces TextBlob's PatternAnalyzer
+TextBlob(text).sentiment builds a blob, runs pattern's tokenizer, looks words up in
+a lazily loaded dict of per-tag dicts and creates a namedtuple type on every call.
+This module reads the same en-sentiment.xml lexicon once into one flat
+word -> (polarity, subjectivity, intensity, is_modifier) table and runs a port of
+the tokenizer and the assessment rules (intensifiers, negation, "!", emoticons)
+"""
+
+import bisect
+import importlib.util
+import logging
+import os
+import re
+import threading
+import time
+from xml.etree import ElementTree
+
+# Empty: the lexicon shipped with TextBlob
+LEXICON_PATH = os.getenv("SENTIMENT_LEXICON_PATH", "")
+
+NEGATIONS = frozenset(("no", "not", "n't", "never"))
+PUNCTUATION = ".,;:!?()[]{}`''\"@#$^&*+-|=~_"
+EOS = "END-OF-SENTENCE"
+
+# Tokenizer tables, as in pattern's find_tokens
+_LEADING = tuple(PUNCTUATION.replace(".", ""))
+_TRAILING = _LEADING + (".",)
+_BOUNDARY_CHARS = frozenset(PUNCTUATION)
+_CONTRACTIONS = {"'d": " 'd", "'m": " 'm", "'s": " 's", "'ll": " 'll", "'re": " 're", "'ve": " 've", "n't": " n't"}
+_QUOTES = (("“", " “ "), ("”", " ” "), ("‘", " ‘ "), ("’", " ’ "), ("'", " ' "), ('"', ' " '))
+_SENTENCE_ENDS = frozenset(("...", ".", "!", "?", EOS))
+_SENTENCE_TRAILERS = frozenset(("'", '"', "”", "’", "...", ".", "!", "?", ")", EOS))
+ABBREVIATIONS = frozenset((
+    "a.", "adj.", "adv.", "al.", "a.m.", "c.", "cf.", "comp.", "conf.", "def.", "ed.", "e.g.", "esp.", "etc.",
+    "ex.", "f.", "fig.", "gen.", "id.", "i.e.", "int.", "l.", "m.", "Med.", "Mil.", "Mr.", "n.", "n.q.", "orig.",
+    "pl.", "pred.", "pres.", "p.m.", "ref.", "v.", "vs.", "w/",
+))
+_ABBREVIATION_PATTERNS = (
+    re.compile(r"^[A-Za-z]\.$"),
+    re.compile(r"^([A-Za-z]\.)+$"),
+    re.compile("^[A-Z][" + "|".join("bcdfghjklmnpqrstvwxz") + "]+.$"),
+)
+_LINEBREAKS = re.compile(r"\n{2,}")
+
+# (expression, polarity) -> emoticons; a lowercased emoticon takes the first group it appears in
+EMOTICONS = {
+    ("love", +1.00): ("<3", "♥"),
+    ("grin", +1.00): (">:D", ":-D", ":D", "=-D", "=D", "X-D", "x-D", "XD", "xD", "8-D"),
+    ("taunt", +0.75): (">:P", ":-P", ":P", ":-p", ":p", ":-b", ":b", ":c)", ":o)", ":^)"),
+    ("smile", +0.50): (">:)", ":-)", ":)", "=)", "=]", ":]", ":}", ":>", ":3", "8)", "8-)"),
+    ("wink", +0.25): (">;]", ";-)", ";)", ";-]", ";]", ";D", ";^)", "*-)", "*)"),
+    ("gasp", +0.05): (">:o", ":-O", ":O", ":o", ":-o", "o_O", "o.O", "°O°", "°o°"),
+    ("worry", -0.25): (">:/", ":-/", ":/", ":\\", ">:\\", ":-.", ":-s", ":s", ":S", ":-S", ">.>"),
+    ("frown", -0.75): (">:[", ":-(", ":(", "=(", ":-[", ":[", ":{", ":-<", ":c", ":-c", "=/"),
+    ("cry", -1.00): (":'(", ":'''(", ";'("),
+}
+_EMOTICON_POLARITY = {}
+for (_, _polarity), _expressions in EMOTICONS.items():
+    for _expression in _expressions:
+        _EMOTICON_POLARITY.setdefault(_expression.lower(), _polarity)
+_SARCASM = re.compile(r"\( ?\! ?\)")
+_EMOTICON_PATTERN = re.compile(r"(%s)($|\s)" % "|".join(
+    r" ?".join(re.escape(char) for char in expression) for expressions in EMOTICONS.values() for expression in expressions))
+
+def default_lexicon_path():
+    """en-sentiment.xml of the installed TextBlob, found without importing it"""
+    spec = importlib.util.find_spec("textblob")
+    if spec is None or not spec.submodule_search_locations:
+        raise FileNotFoundError("TextBlob is not installed; set SENTIMENT_LEXICON_PATH to an en-sentiment.xml file")
+    return os.path.join(list(spec.submodule_search_locations)[0], "en", "en-sentiment.xml")
+
+def _average(values):
+    return sum(values) / float(len(values) or 1)
+
+def load_lexicon(path=None):
+    """
+    word -> (polarity, subjectivity, intensity, is_modifier), with pattern's averaging over
+    word senses and tags and its derived "-ly" adverbs ("terrible" -> "terribly")
+    """
+    words = {}
+    for element in ElementTree.parse(path or LEXICON_PATH or default_lexicon_path()).getroot().findall("word"):
+        form = element.attrib.get("form")
+        if form:
+            words.setdefault(form, {}).setdefault(element.attrib.get("pos"), []).append((
+                float(element.attrib.get("polarity", 0.0)),
+                float(element.attrib.get("subjectivity", 0.0)),
+                float(element.attrib.get("intensity", 1.0)),
+            ))
+    for form in words:
+        words[form] = {tag: [_average(each) for each in zip(*senses)] for tag, senses in words[form].items()}
+    for form, tags in list(words.items()):
+        tags[None] = [_average(each) for each in zip(*tags.values())]
+    for form, tags in list(words.items()):
+        if "JJ" in tags:
+            if form.endswith("y"):
+                form = form[:-1] + "i"
+            if form.endswith("le"):
+                form = form[:-2]
+            adverb = words.setdefault(form + "ly", {})
+            adverb["RB"] = adverb[None] = tuple(tags["JJ"])
+    return {form: (*tags[None], "RB" in tags) for form, tags in words.items()}
+
+def _is_abbreviation(token):
+    return token in ABBREVIATIONS or any(pattern.match(token) is not None for pattern in _ABBREVIATION_PATTERNS)
+
+def _spaced(text):
+    """Contractions and quotes spaced out, paragraph breaks marked"""
+    for contraction, spaced in _CONTRACTIONS.items():
+        text = text.replace(contraction, spaced)
+    for quote, spaced in _QUOTES:
+        text = text.replace(quote, spaced)
+    text = text.replace("\r\n", "\n")
+    if "\n" in text:
+        text = _LINEBREAKS.sub(f" {EOS} ", text)
+    return text
+
+def _split_token(token, tokens):
+    """Append a whitespace-free token to tokens with its leading and trailing punctuation split off"""
+    tail = []
+    while token.startswith(_LEADING) and token not in _CONTRACTIONS:
+        tokens.append(token[0])
+        token = token[1:]
+    while token.endswith(_TRAILING) and token not in _CONTRACTIONS:
+        if token.endswith(_LEADING):
+            tail.append(token[-1])
+            token = token[:-1]
+        if token.endswith("..."):
+            tail.append("...")
+            token = token[:-3].rstrip(".")
+        if token.endswith("."):
+            if _is_abbreviation(token):
+                break
+            tail.append(token[-1])
+            token = token[:-1]
+    if token != "":
+        tokens.append(token)
+    tokens.extend(reversed(tail))
+
+def _split_tokens(text):
+    """Punctuation split from words, with end-of-sentence markers for paragraph breaks"""
+    tokens = []
+    # Same tokens as collapsing whitespace and matching (\S+)\s
+    for token in _spaced(text).split():
+        # Most tokens are plain words
+        if token[0] not in _BOUNDARY_CHARS and token[-1] not in _BOUNDARY_CHARS:
+            tokens.append(token)
+        else:
+            _split_token(token, tokens)
+    return tokens
+
+def _sentences(tokens):
+    sentences, start, j = [[]], 0, 0
+    while j < len(tokens):
+        if tokens[j] in _SENTENCE_ENDS:
+            # Trailing quotes, parentheses and repeated punctuation stay with the sentence
+            while j < len(tokens) and tokens[j] in _SENTENCE_TRAILERS:
+                if tokens[j] in ("'", '"') and sentences[-1].count(tokens[j]) % 2 == 0:
+                    break
+                j += 1
+            sentences[-1].extend(token for token in tokens[start:j] if token != EOS)
+            sentences.append([])
+            start = j
+        j += 1
+    sentences[-1].extend(tokens[start:j])
+    sentences = [_SARCASM.sub("(!)", " ".join(sentence)) for sentence in sentences if sentence]
+    return [_EMOTICON_PATTERN.sub(lambda match: match.group(1).replace(" ", "") + match.group(2), sentence)
+            for sentence in sentences]
+
+def find_tokens(text):
+    """pattern's find_tokens with its default arguments: sentences of space-separated tokens"""
+    return _sentences(_split_tokens(text))
+
+def find_words(text):
+    """Tokens of all sentences, lowercased, as pattern's Sentiment sees a string"""
+    tokens = _split_tokens(text)
+    joined = " ".join(token for token in tokens if token != EOS)
+    # Sentence boundaries only matter to the sarcasm and emoticon rewrites, and a match in
+    # one sentence is also a match in the joined text
+    if _SARCASM.search(joined) or _EMOTICON_PATTERN.search(joined):
+        joined = " ".join(_sentences(tokens))
+    return joined.lower().split()
+
+# Joins a batch of messages into one text; split() keeps the marker as a token of its own
+_BATCH_MARKER = "\x00"
+_BATCH_SEPARATOR = f" {_BATCH_MARKER} "
+
+def find_words_many(texts):
+    """
+    find_words of each text, tokenizing the batch as one string: the contraction and quote
+    rewrites and the sarcasm and emoticon searches run once, and each distinct token that
+    needs punctuation split off is split once
+    """
+    texts = [str(text) for text in texts]
+    if not texts:
+        return []
+    if any(_BATCH_MARKER in text for text in texts):
+        return [find_words(text) for text in texts]
+    messages, tokens, split_tokens = [], [], {}
+    # None of the rewrites match across the separator, so this equals spacing each text
+    for token in _spaced(_BATCH_SEPARATOR.join(texts)).split():
+        if token == _BATCH_MARKER:
+            messages.append(tokens)
+            tokens = []
+        elif token[0] not in _BOUNDARY_CHARS and token[-1] not in _BOUNDARY_CHARS:
+            tokens.append(token)
+        else:
+            split = split_tokens.get(token)
+            if split is None:
+                split = split_tokens[token] = []
+                _split_token(token, split)
+            tokens.extend(split)
+    messages.append(tokens)
+
+    joined = [" ".join(token for token in tokens if token != EOS) for tokens in messages]
+    starts, offset = [], 0
+    for text in joined:
+        starts.append(offset)
+        offset += len(text) + len(_BATCH_SEPARATOR)
+    batch = _BATCH_SEPARATOR.join(joined)
+    # A message ends in a space here rather than at the end of the string, which the
+    # emoticon pattern's ($|\s) accepts alike
+    rewritten = {bisect.bisect_right(starts, match.start()) - 1
+                 for pattern in (_SARCASM, _EMOTICON_PATTERN) for match in pattern.finditer(batch)}
+    return [(" ".join(_sentences(messages[i])) if i in rewritten else text).lower().split()
+            for i, text in enumerate(joined)]
+
+class PolarityScorer:
+    """TextBlob-compatible (polarity, subjectivity) over a flat lexicon table"""
+
+    def __init__(self, lexicon):
+        self.lexicon = lexicon
+
+    def assessments(self, words):
+        """[polarity, subjectivity, intensity, negated] per assessed chunk, as pattern's Sentiment.assessments"""
+        lexicon = self.lexicon
+        chunks = []
+        modifier = negation = None
+        for word in words:
+            entry = lexicon.get(word)
+            if entry is not None:
+                polarity, subjectivity, intensity, is_modifier = entry
+                if modifier is None:
+                    chunks.append([polarity, subjectivity, intensity, False])
+                else:
+                    # "really good": scaled by the modifier's intensity
+                    last = chunks[-1]
+                    last[0] = max(-1.0, min(polarity * last[2], +1.0))
+                    last[1] = max(-1.0, min(subjectivity * last[2], +1.0))
+                    last[2] = intensity
+                if negation is not None:
+                    chunks[-1][2] = 1.0 / chunks[-1][2]
+                    chunks[-1][3] = True
+                modifier = word if is_modifier else None
+                negation = word if word in NEGATIONS else None
+            else:
+                if word in NEGATIONS:
+                    negation = word
+                # Negation carries across small words ("not a good")
+                elif negation and len(word.strip("'")) > 1:
+                    negation = None
+                # "really not good"
+                if negation is not None and modifier is not None and modifier.endswith("ly"):
+                    chunks[-1][3] = True
+                    negation = None
+                # The modifier carries across small words ("really is a good")
+                elif modifier and len(word) > 2:
+                    modifier = None
+                if word == "!" and chunks:
+                    chunks[-1][0] = max(-1.0, min(chunks[-1][0] * 1.25, +1.0))
+                if word == "(!)":
+                    chunks.append([0.0, 1.0, 1.0, False])
+                if word.isalpha() is False and len(word) <= 5 and word not in PUNCTUATION:
+                    emoticon = _EMOTICON_POLARITY.get(word)
+                    if emoticon is not None:
+                        chunks.append([emoticon, 1.0, 1.0, False])
+        return chunks
+
+    def sentiment(self, text):
+        """(polarity, subjectivity) equal to TextBlob(text).sentiment"""
+        return self._score(self.assessments(find_words(str(text))))
+
+    def sentiments(self, texts):
+        """sentiment of each text, tokenized as one batch"""
+        return [self._score(self.assessments(words)) for words in find_words_many(texts)]
+
+    @staticmethod
+    def _score(chunks):
+        if not chunks:
+            return 0.0, 0.0
+        # "not good" = slightly bad, "not bad" = slightly good
+        polarity = sum(chunk[0] * -0.5 if chunk[3] else chunk[0] for chunk in chunks)
+        subjectivity = sum(chunk[1] for chunk in chunks)
+        return polarity / float(len(chunks)), subjectivity / float(len(chunks))
+
+    def polarity(self, text):
+        return self.sentiment(text)[0]
+
+_scorer = None
+_scorer_lock = threading.Lock()
+
+def get_polarity_scorer():
+    """Process-wide scorer; the lexicon is read on first use"""
+    global _scorer
+    with _scorer_lock:
+        if _scorer is None:
+            start = time.perf_counter()
+            _scorer = PolarityScorer(load_lexicon())
+            logging.info(f"Sentiment lexicon: {len(_scorer.lexicon)} words loaded in "
+                         f"{(time.perf_counter() - start) * 1000:.0f}ms")
+        return _scorer
+
+def text_sentiment(text):
+    """(polarity, subjectivity) of a message, matching TextBlob's default analyzer"""
+    return get_polarity_scorer().sentiment(text)
+
+def sentiment_label(polarity):
+    """Sentiment label for a -1..1 polarity"""
+    if polarity > 0.1:
+        return "POSITIVE"
+    if polarity < -0.1:
+        return "NEGATIVE"
+    return "NEUTRAL"
@@ -0,0 +1,165 @@
+"""
+Token-budgeted prompt assembly
+Counts tokens locally and packs whole, ranked knowledge base passages into a
+per-model prompt budget while reserving room for the reply
+"""
+
+import logging
+import math
+import re
+
+from text_features import content_tokens, normalize_text
+from kb_fuzzy_index import get_fuzzy_index
+from model_router import FAST_MODEL, LARGE_MODEL
+
+# Optional exact tokenizer; cl100k_base is close to the Llama 3 tokenizer for English text
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("cl100k_base")
+except Exception:
+    _encoding = None
+
+# Context window per model and the share of it we are willing to spend on the prompt
+MODEL_CONTEXT_WINDOWS = {
+    LARGE_MODEL: 131072,
+    FAST_MODEL: 131072,
+}
+PROMPT_TOKEN_BUDGETS = {
+    LARGE_MODEL: 1500,
+    FAST_MODEL: 700,
+}
+DEFAULT_PROMPT_TOKEN_BUDGET = 1000
+DEFAULT_CONTEXT_WINDOW = 8192
+
+CONTEXT_HEADER = "\n\nContext: "
+
+# Stop scanning ranked passages once less than this much budget is left
+MIN_PASSAGE_TOKENS = 16
+
+# Share of the prompt budget that conversation memory may use
+HISTORY_BUDGET_SHARE = 0.4
+
+# Chat format overhead per message (role markers, separators)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# Same shape as the BPE pre-tokenizers: contractions, words with a leading space, digit runs, punctuation
+_PIECE_PATTERN = re.compile(r"'(?:s|t|re|ve|m|ll|d)| ?[A-Za-z]+| ?\d{1,3}| ?[^\sA-Za-z\d]+|\s+")
+
+def count_tokens(text):
+    """
+    Count tokens locally
+    Uses tiktoken when installed, otherwise a conservative estimate: one token per
+    common-length word piece, long pieces split every 6 characters, non-ASCII per character
+    """
+    if not text:
+        return 0
+    if _encoding is not None:
+        return len(_encoding.encode(text))
+
+    tokens = 0
+    for piece in _PIECE_PATTERN.findall(text):
+        stripped = piece.lstrip(" ")
+        if not piece.isascii():
+            tokens += len(stripped)
+        elif len(stripped) <= 8:
+            tokens += 1
+        else:
+            tokens += math.ceil(len(stripped) / 6)
+    return tokens
+
+def rank_kb_passages(knowledge_base, input_text, limit=None):
+    """
+    Rank knowledge base Q&A pairs by how many distinct content words of the
+    message appear in the question; pairs with no overlap are dropped
+    Misspelled words are first corrected to knowledge base words
+    """
+    query_tokens = content_tokens(input_text)
+    if knowledge_base:
+        query_tokens = get_fuzzy_index(knowledge_base).correct_tokens(query_tokens)
+    query_tokens = set(query_tokens)
+    if not query_tokens:
+        return []
+
+    scored = []
+    for position, (question, answer) in enumerate(knowledge_base.items()):
+        normalized_question = normalize_text(question)
+        score = sum(1 for token in query_tokens if token in normalized_question)
+        if score:
+            scored.append((-score, position, question, answer))
+
+    scored.sort()
+    ranked = [(question, answer) for _, _, question, answer in scored]
+    return ranked[:limit] if limit else ranked
+
+def format_passage(question, answer):
+    """Render one Q&A pair as a context passage"""
+    return f"Q: {question}\nA: {answer}"
+
+def prompt_budget(model, max_tokens):
+    """Prompt token budget for a model after reserving max_tokens for the reply"""
+    budget = PROMPT_TOKEN_BUDGETS.get(model, DEFAULT_PROMPT_TOKEN_BUDGET)
+    window = MODEL_CONTEXT_WINDOWS.get(model, DEFAULT_CONTEXT_WINDOW)
+    return max(0, min(budget, window - max_tokens))
+
+def history_budget(route):
+    """Token budget for conversation memory messages under this route"""
+    return int(prompt_budget(route['model'], route['max_tokens']) * HISTORY_BUDGET_SHARE)
+
+def pack_passages(passages, token_budget):
+    """
+    Greedily keep whole passages in rank order while they fit the budget
+    Returns (kept passage strings, tokens used)
+    """
+    kept = []
+    used = 0
+    for question, answer in passages:
+        if token_budget - used < MIN_PASSAGE_TOKENS:
+            break
+        passage = format_passage(question, answer)
+        # +1 for the blank-line separator between passages
+        cost = count_tokens(passage) + 1
+        if used + cost > token_budget:
+            continue
+        kept.append(passage)
+        used += cost
+    return kept, used
+
+def build_messages(system_prompt, input_text, passages, route, default_context="General mental health support",
+                   max_passages=None, history=None):
+    """
+    Assemble the chat messages for one request within the route's token budget
+    passages are ranked (question, answer) pairs; route comes from model_router.choose_route
+    history is a list of earlier chat messages (see conversation_memory) placed before the user message
+    With default_context=None and nothing to pack, the Context section is left out
+    Returns (messages, context, prompt_tokens)
+    """
+    history = history or []
+    budget = prompt_budget(route['model'], route['max_tokens'])
+    fixed_tokens = count_tokens(system_prompt) + count_tokens(input_text) + 2 * MESSAGE_OVERHEAD_TOKENS
+    fixed_tokens += sum(count_tokens(message['content']) + MESSAGE_OVERHEAD_TOKENS for message in history)
+    header_tokens = count_tokens(CONTEXT_HEADER)
+
+    if max_passages is not None:
+        passages = passages[:max_passages]
+    kept, context_tokens = pack_passages(passages, max(0, budget - fixed_tokens - header_tokens))
+
+    if kept:
+        context = "\n\n".join(kept)
+    else:
+        context = default_context
+        context_tokens = count_tokens(context) if context else 0
+
+    system_content = system_prompt
+    if context:
+        system_content = system_prompt + CONTEXT_HEADER + context
+        context_tokens += header_tokens
+
+    messages = [{"role": "system", "content": system_content}]
+    messages.extend(history)
+    messages.append({"role": "user", "content": input_text})
+    prompt_tokens = fixed_tokens + context_tokens
+
+    route['prompt_tokens'] = prompt_tokens
+    logging.info(f"Prompt: {prompt_tokens} tokens for {route['model']} "
+                 f"(budget {budget}, {len(kept)}/{len(passages)} passages, {len(history)} history messages)")
+    return messages, (context if kept else ""), prompt_tokens
@@ -0,0 +1,238 @@
+"""
+Semantic near-duplicate response cache for low-risk messages
+Paraphrases of recently answered questions are served from memory instead of calling Groq again
+"""
+
+import logging
+import random
+import re
+import threading
+import time
+from collections import deque
+import numpy as np
+
+import metrics
+from text_features import tokenize, normalize_text, negation_signature, hash_vectorize
+
+# Only messages strictly below MODERATE risk (score 4) are ever cached or served from cache
+CACHE_MAX_RISK_SCORE = 3
+CACHE_SIMILARITY_THRESHOLD = 0.85
+CACHE_CAPACITY = 512
+CACHE_VECTOR_DIM = 1024
+CACHE_TTL_SECONDS = 6 * 60 * 60
+CACHE_AUDIT_RATE = 0.05
+
+# Placeholder used to personalize cached answers for a different user
+NAME_PLACEHOLDER = "{{user_name}}"
+# Names shorter than this are too likely to be words of their own, so answers using them aren't cached
+MIN_NAME_CHARS = 3
+
+class SemanticResponseCache:
+    """
+    Fixed-capacity cache keyed by hashed text vectors
+    Nearest-neighbour lookup is a single matrix-vector product over the
+    preallocated float32 vector matrix; the least recently used slot is evicted
+    """
+
+    def __init__(self, capacity=CACHE_CAPACITY, dim=CACHE_VECTOR_DIM, threshold=CACHE_SIMILARITY_THRESHOLD,
+                 max_risk_score=CACHE_MAX_RISK_SCORE, ttl_seconds=CACHE_TTL_SECONDS, audit_rate=CACHE_AUDIT_RATE):
+        self.capacity = capacity
+        self.dim = dim
+        self.threshold = threshold
+        self.max_risk_score = max_risk_score
+        self.ttl_seconds = ttl_seconds
+        self.audit_rate = audit_rate
+
+        self._vectors = np.zeros((capacity, dim), dtype=np.float32)
+        self._last_used = np.zeros(capacity, dtype=np.float64)
+        self._entries = [None] * capacity
+        self._size = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.evictions = 0
+        self.audit_samples = deque(maxlen=200)
+        # Samples taken so far, and how many of them log_cache_stats has shown
+        self.audits = 0
+        self.audits_reported = 0
+
+    def _nearest(self, vector, context):
+        """Return (slot, similarity) of the best live entry for this context, or (None, 0)"""
+        if self._size == 0:
+            return None, 0.0
+        similarities = self._vectors[:self._size] @ vector
+        now = time.time()
+        for slot in np.argsort(similarities)[::-1]:
+            similarity = float(similarities[slot])
+            if similarity < self.threshold:
+                break
+            entry = self._entries[slot]
+            if entry['context'] != context:
+                continue
+            if now - entry['created'] > self.ttl_seconds:
+                continue
+            return int(slot), similarity
+        return None, 0.0
+
+    def lookup(self, text, risk_score, context=None, user_name=None):
+        """
+        Return a cached answer for a near-duplicate of text, or None
+        Messages above max_risk_score always bypass the cache
+        """
+        if risk_score > self.max_risk_score:
+            with self._lock:
+                self.bypassed += 1
+            metrics.increment("response_cache_bypassed")
+            return None
+
+        tokens = tokenize(text)
+        if not tokens:
+            return None
+        vector = hash_vectorize(text, self.dim)
+
+        with self._lock:
+            slot, similarity = self._nearest(vector, context)
+            # A cached answer to "I feel okay" must never answer "I don't feel okay"
+            if slot is not None and self._entries[slot]['negations'] != negation_signature(tokens):
+                slot = None
+
+            if slot is None:
+                self.misses += 1
+                metrics.increment("response_cache_misses")
+                return None
+
+            entry = self._entries[slot]
+            entry['hits'] += 1
+            self._last_used[slot] = time.time()
+            self.hits += 1
+            metrics.increment("response_cache_hits")
+
+            if random.random() < self.audit_rate:
+                sample = {
+                    'query': normalize_text(text),
+                    'cached_query': entry['key'],
+                    'similarity': round(similarity, 4),
+                    'timestamp': time.strftime('%Y-%m-%d %H:%M:%S')
+                }
+                self.audit_samples.append(sample)
+                self.audits += 1
+
+            response = entry['response']
+
+        if user_name:
+            response = response.replace(NAME_PLACEHOLDER, user_name)
+        return response
+
+    def store(self, text, response, risk_score, context=None, user_name=None):
+        """Cache a generated answer for a low-risk message"""
+        if not response or risk_score > self.max_risk_score:
+            return False
+
+        tokens = tokenize(text)
+        if not tokens:
+            return False
+        vector = hash_vectorize(text, self.dim)
+
+        # Generalize personalized answers so they can be adapted for other users; only the whole
+        # name in its own case is replaced, so "Al" never turns "Also" into placeholder text
+        if user_name:
+            name = user_name.strip()
+            if len(name) < MIN_NAME_CHARS:
+                return False
+            pattern = re.compile(rf"(?<!\w){re.escape(name)}(?!\w)", re.IGNORECASE)
+            # A name that is also a word ("Hope", "Will") can't be told apart from it
+            if any(match.group() != name for match in pattern.finditer(response)):
+                return False
+            response = pattern.sub(NAME_PLACEHOLDER, response)
+
+        with self._lock:
+            slot, _ = self._nearest(vector, context)
+            if slot is None:
+                if self._size < self.capacity:
+                    slot = self._size
+                    self._size += 1
+                else:
+                    slot = int(np.argmin(self._last_used))
+                    self.evictions += 1
+
+            self._vectors[slot] = vector
+            self._last_used[slot] = time.time()
+            self._entries[slot] = {
+                'key': normalize_text(text),
+                'response': response,
+                'context': context,
+                'negations': negation_signature(tokens),
+                'created': time.time(),
+                'hits': 0
+            }
+        return True
+
+    def clear(self):
+        """Drop all cached entries (statistics are kept)"""
+        with self._lock:
+            self._vectors[:] = 0
+            self._last_used[:] = 0
+            self._entries = [None] * self.capacity
+            self._size = 0
+
+    def _memory_bytes(self):
+        text_bytes = sum(len(entry['key']) + len(entry['response']) for entry in self._entries[:self._size])
+        return self._vectors.nbytes + self._last_used.nbytes + text_bytes
+
+    def memory_bytes(self):
+        """Approximate memory held by the cache (vectors plus cached strings)"""
+        with self._lock:
+            return self._memory_bytes()
+
+    def stats(self):
+        """Hit rate, bypass count, audit sample count and memory use"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': self._size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'bypassed': self.bypassed,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'audit_samples': len(self.audit_samples),
+                'memory_bytes': self._memory_bytes()
+            }
+
+    def recent_audit_samples(self, limit=None):
+        """The latest audit samples (query, cached query, similarity), oldest first"""
+        with self._lock:
+            samples = list(self.audit_samples)
+        return samples[-limit:] if limit else samples
+
+    def unreported_audit_samples(self):
+        """Audit samples taken since the last call, for review"""
+        with self._lock:
+            new = min(self.audits - self.audits_reported, len(self.audit_samples))
+            self.audits_reported = self.audits
+            return list(self.audit_samples)[len(self.audit_samples) - new:]
+
+# One cache per app/response style, shared across Streamlit reruns and sessions of this process
+_caches = {}
+_caches_lock = threading.Lock()
+
+def get_response_cache(name="default"):
+    """Return the process-wide cache registered under name"""
+    with _caches_lock:
+        if name not in _caches:
+            _caches[name] = SemanticResponseCache()
+        return _caches[name]
+
+def log_cache_stats(name="default"):
+    """Log cache statistics and the audit samples taken since the last report"""
+    cache = get_response_cache(name)
+    stats = cache.stats()
+    logging.info(f"Response cache [{name}]: hit rate {stats['hit_rate']:.1%} "
+                 f"({stats['hits']} hits, {stats['misses']} misses, {stats['bypassed']} bypassed), "
+                 f"{stats['entries']} entries, {stats['memory_bytes'] / 1024:.1f} KB")
+    for sample in cache.unreported_audit_samples():
+        logging.info(f"Response cache [{name}] audit: {sample['query']!r} served the answer to "
+                     f"{sample['cached_query']!r} (similarity {sample['similarity']})")
+    return stats
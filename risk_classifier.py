@@ -0,0 +1,437 @@
+"""
+Trained linear risk classifier
+A compact alternative to the hand-tuned keyword rules in analyze_sentiment_and_risk:
+messages become hashed word, word-bigram and character n-gram counts, and two
+ridge-regression heads (polarity, then risk) are fitted offline and stored as one NumPy
+weight array per rule set of risk_rules.json.
+The risk head learns the crisis levels of the hand-labeled messages in risk_labels.csv
+(the test_sentiment.py phrases and about 150 more, including idioms, negations and
+crisis language no keyword covers). The generated messages of risk_training.csv have no
+human labels, so they fall back to the scores of the rule set; the polarity head only
+ever learns TextBlob polarity. Beyond the labeled set the model imitates the rules, so
+it stays off until it beats them on held-out human labels (see main's train command).
+Scoring a message is a sparse dot product over the few hundred features it contains,
+with no TextBlob parse
+"""
+
+import argparse
+import logging
+import os
+import random
+import threading
+import time
+import zlib
+from collections import Counter
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+from polarity_scorer import sentiment_label
+from risk_rules import get_rule_set, load_rules
+from text_features import tokenize
+
+# Off by default: the keyword rules stay in charge until the classifier beats them on the
+# held-out human labels reported by `python risk_classifier.py train`
+RISK_CLASSIFIER = os.getenv("RISK_CLASSIFIER", "0") == "1"
+# Weights of each rule set's model: risk_classifier_<rule set>.npz
+RISK_MODEL_DIR = os.getenv("RISK_MODEL_DIR") or os.path.dirname(os.path.abspath(__file__))
+RISK_TRAINING_PATH = "risk_training.csv"
+# Hand-labeled messages: text, crisis_level (LOW, MODERATE, HIGH or SEVERE)
+RISK_LABELS_PATH = "risk_labels.csv"
+# Times each hand-labeled message is repeated in the training frame, so a few hundred of them
+# outweigh thousands of rule-labeled messages on the features they share
+HUMAN_LABEL_WEIGHT = 5
+
+FEATURE_DIM = 1 << 16
+RIDGE_PENALTY = 3.0
+# Refits that stop scores already past 0 or MAX_RISK from being pulled back to the clipped label
+CENSORED_ROUNDS = 5
+# Polarity buckets the risk head gets as extra features, matching the rules' -0.5 / -0.2 / 0 steps
+POLARITY_STEPS = (-0.5, -0.2, 0.0)
+MAX_RISK = 10
+
+def _hash(feature, dim):
+    return zlib.crc32(feature.encode("utf-8")) % dim
+
+# The character trigrams of " w1 w2 ... " are those of each " w " plus one "x y" per adjacent
+# pair (last and first letters), so all hashing is cached per distinct word and word pair
+@lru_cache(maxsize=65536)
+def _token_features(token, dim):
+    padded = f" {token} "
+    return (_hash("w:" + token, dim),) + tuple(
+        _hash("c:" + padded[i:i + 3], dim) for i in range(len(padded) - 2))
+
+@lru_cache(maxsize=65536)
+def _pair_features(first, second, dim):
+    return _hash("b:" + first + " " + second, dim), _hash("c:" + first[-1] + " " + second[0], dim)
+
+def message_features(text, dim=FEATURE_DIM):
+    """
+    Hashed feature counts of a message: (feature ids, counts, token count)
+    Words, word bigrams and character trigrams of the normalized text, hashed with crc32
+    """
+    tokens = tokenize(text)
+    ids = []
+    for token in tokens:
+        ids.extend(_token_features(token, dim))
+    for first, second in zip(tokens, tokens[1:]):
+        ids.extend(_pair_features(first, second, dim))
+    counts = Counter(ids)
+    return (np.fromiter(counts.keys(), dtype=np.int64, count=len(counts)),
+            np.fromiter(counts.values(), dtype=np.float32, count=len(counts)), len(tokens))
+
+def _polarity_buckets(polarity):
+    """One column per polarity step the value is at or below (the rules add 1 point per step)"""
+    polarity = np.asarray(polarity, dtype=np.float32).reshape(-1, 1)
+    return (polarity <= np.asarray(POLARITY_STEPS, dtype=np.float32)).astype(np.float32)
+
+def model_path(rule_set):
+    return os.path.join(RISK_MODEL_DIR, f"risk_classifier_{rule_set}.npz")
+
+def _ridge(features, targets, penalty, intercept=True):
+    """Ridge regression in its dual form (fewer messages than features); returns (weights, bias)"""
+    bias = float(targets.mean()) if intercept else 0.0
+    gram = features @ features.T
+    gram[np.diag_indices_from(gram)] += penalty
+    return features.T @ np.linalg.solve(gram, targets - bias), bias
+
+def _censored_ridge(features, targets, penalty, low, high, rounds=CENSORED_ROUNDS):
+    """
+    Ridge regression for labels clipped to [low, high]: a message labeled at a bound whose
+    fitted score is already beyond it is refitted towards that score instead of the bound
+    """
+    fitted_targets = targets
+    for _ in range(rounds):
+        weights, bias = _ridge(features, fitted_targets, penalty, intercept=False)
+        fitted = features @ weights + bias
+        beyond = ((targets >= high) & (fitted > high)) | ((targets <= low) & (fitted < low))
+        fitted_targets = np.where(beyond, fitted, targets)
+    return _ridge(features, fitted_targets, penalty, intercept=False)
+
+class RiskClassifier:
+    """Linear polarity and risk heads over hashed message features, with the crisis levels of the rule set they learned"""
+
+    def __init__(self, weights, bucket_weights, polarity_bias, risk_bias, max_risk=MAX_RISK, rules="simple"):
+        self.rules = load_rules(rules)
+        if self.rules is None:
+            raise ValueError(f"Unknown rule set {rules!r}")
+        # Column 0: polarity head (counts scaled by 1/sqrt(tokens)); column 1: risk head (raw counts)
+        self.weights = weights
+        self.bucket_weights = bucket_weights
+        self._bucket_weights = [float(weight) for weight in bucket_weights]
+        # The model is linear, so each word's and word pair's share of the dot product is cached
+        self._token_weights = lru_cache(maxsize=65536)(self._feature_weights)
+        self._pair_weights = lru_cache(maxsize=65536)(self._feature_weights)
+        self.polarity_bias = float(polarity_bias)
+        self.risk_bias = float(risk_bias)
+        self.max_risk = int(max_risk)
+
+    @classmethod
+    def train(cls, texts, polarities, risk_scores, penalty=RIDGE_PENALTY, dim=FEATURE_DIM, max_risk=MAX_RISK,
+              rules="simple"):
+        """
+        Fit both heads on labeled messages (see label_messages) for a rule set (a RuleSet or name)
+        The risk head has no intercept, so text with no known features scores 0 as it does
+        under the rules, rather than the average risk of the training messages
+        """
+        rows = [message_features(text, dim) for text in texts]
+        # Only the columns some message uses take part in the solve
+        columns, inverse = np.unique(np.concatenate([ids for ids, _, _ in rows]), return_inverse=True)
+        counts = np.zeros((len(rows), len(columns)), dtype=np.float64)
+        start = 0
+        for row, (ids, values, _) in enumerate(rows):
+            counts[row, inverse[start:start + len(ids)]] = values
+            start += len(ids)
+        scale = np.sqrt(np.maximum([tokens for _, _, tokens in rows], 1))[:, None]
+
+        polarity_weights, polarity_bias = _ridge(counts / scale, np.asarray(polarities, dtype=np.float64), penalty)
+        fitted = (counts / scale) @ polarity_weights + polarity_bias
+        risk_features = np.hstack([counts, _polarity_buckets(fitted)])
+        risk_weights, risk_bias = _censored_ridge(risk_features, np.asarray(risk_scores, dtype=np.float64), penalty,
+                                                  0, max_risk)
+
+        weights = np.zeros((dim, 2), dtype=np.float32)
+        weights[columns, 0] = polarity_weights
+        weights[columns, 1] = risk_weights[:len(columns)]
+        return cls(weights, risk_weights[len(columns):].astype(np.float32), polarity_bias, risk_bias, max_risk, rules)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as arrays:
+            rules = str(arrays['rule_set']) if 'rule_set' in arrays.files else "simple"
+            return cls(arrays['weights'], arrays['bucket_weights'], arrays['polarity_bias'], arrays['risk_bias'],
+                       arrays['max_risk'], rules)
+
+    def save(self, path):
+        # Almost every hashed slot is zero, so the compressed file stays small
+        with open(path, "wb") as output:
+            np.savez_compressed(output, weights=self.weights, bucket_weights=self.bucket_weights,
+                                polarity_bias=self.polarity_bias, risk_bias=self.risk_bias, max_risk=self.max_risk,
+                                rule_set=self.rules.name)
+
+    def _feature_weights(self, *tokens):
+        """Summed (polarity, risk) weights of the features of one word or one word pair"""
+        dim = len(self.weights)
+        ids = _token_features(tokens[0], dim) if len(tokens) == 1 else _pair_features(tokens[0], tokens[1], dim)
+        polarity, risk = self.weights[list(ids)].sum(axis=0, dtype=np.float64).tolist()
+        return polarity, risk
+
+    def scores(self, text):
+        """Raw (polarity, risk) before clipping and rounding"""
+        tokens = tokenize(text)
+        polarity_sum = risk_sum = 0.0
+        for token in tokens:
+            polarity, risk = self._token_weights(token)
+            polarity_sum += polarity
+            risk_sum += risk
+        for first, second in zip(tokens, tokens[1:]):
+            polarity, risk = self._pair_weights(first, second)
+            polarity_sum += polarity
+            risk_sum += risk
+        polarity = polarity_sum / max(len(tokens), 1) ** 0.5 + self.polarity_bias
+        risk = risk_sum + self.risk_bias
+        for step, weight in zip(POLARITY_STEPS, self._bucket_weights):
+            if polarity <= step:
+                risk += weight
+        return polarity, risk
+
+    def analyze(self, text):
+        """Same (polarity, risk_score, crisis_level, sentiment_label) tuple as analyze_sentiment_and_risk"""
+        polarity, risk = self.scores(text)
+        polarity = min(max(polarity, -1.0), 1.0)
+        risk_score = int(min(max(round(risk), 0), self.max_risk))
+        return polarity, risk_score, self.rules.crisis_level(risk_score), sentiment_label(polarity)
+
+# Loaded classifiers by weights path; None for a path with no weights, so it's reported once
+_classifiers = {}
+_classifier_lock = threading.Lock()
+
+def get_risk_classifier(path=None):
+    """
+    Process-wide classifier for a weights file (default: the "simple" rule set's), or None
+    when it doesn't exist or can't be loaded
+    """
+    path = path or model_path("simple")
+    with _classifier_lock:
+        if path not in _classifiers:
+            _classifiers[path] = None
+            if not os.path.exists(path):
+                logging.warning(f"Risk classifier weights not found at {path}; using the keyword rules")
+            else:
+                try:
+                    _classifiers[path] = RiskClassifier.load(path)
+                except Exception as e:
+                    logging.error(f"Risk classifier weights at {path} could not be loaded ({e}); using the keyword rules")
+        return _classifiers[path]
+
+def _crisis_floor(rules, text, polarity, risk_score):
+    """A message matching a phrase of the rule set's "crisis" group never scores below what the rules give it"""
+    lowered = text.lower()
+    if any(rules.phrases[index] in lowered for index in rules.group_phrases.get("crisis", ())):
+        risk_score = max(risk_score, rules.risk_score(polarity, rules.matches(text)))
+    return risk_score
+
+def classify_risk(text, rule_set="simple"):
+    """
+    Classifier result for analyze_sentiment_and_risk under a rule set, or None when
+    RISK_CLASSIFIER is off or that rule set has no trained model. A message matching a
+    phrase of the rule set's "crisis" group never scores below what the rules give it.
+    Only the hand-labeled messages of risk_labels.csv teach the model anything the rules
+    don't already say; elsewhere it imitates the rule set's scores
+    """
+    if not RISK_CLASSIFIER:
+        return None
+    classifier = get_risk_classifier(model_path(rule_set))
+    if classifier is None:
+        return None
+    polarity, risk_score, _, label = classifier.analyze(text)
+    rules = get_rule_set(rule_set)
+    risk_score = _crisis_floor(rules, text, polarity, risk_score)
+    return polarity, risk_score, rules.crisis_level(risk_score), label
+
+# Training data
+
+# The crisis test phrases of test_sentiment.py
+SEED_MESSAGES = [
+    "Hello, how are you today?", "I am feeling sad and depressed", "I feel hopeless and worthless",
+    "I want to kill myself", "I want to cut myself", "I am going to hurt myself", "I feel like cutting",
+]
+_OPENERS = ["I", "Sometimes I", "Lately I", "Honestly I", "Today I", "I think I", "Right now I", "Every night I"]
+_STATES = [
+    "feel sad", "feel hopeless", "want to kill myself", "am going to hurt myself", "feel like cutting",
+    "am so happy", "had a great day", "feel anxious about my exams", "am overwhelmed at work", "feel worthless",
+    "can't take it anymore", "want to die", "am scared", "feel like nobody cares", "am feeling depressed",
+    "have panic attacks", "feel okay", "am doing better", "love my new job", "feel lonely", "am tired",
+    "want to end my life", "think about suicide", "want to cut myself", "feel desperate", "am angry at my friend",
+    "feel calm after my walk", "am excited about the weekend", "feel terrible", "feel awful and useless",
+    "am stressed about money", "feel good today", "can't sleep", "feel empty", "am grateful for my family",
+    "want to harm myself", "think about taking an overdose", "feel like a burden", "am fine", "feel anxious",
+]
+_TAILS = ["", " and I don't know what to do", " because of my exams", " after talking to my friend", " all the time",
+          " but I'm trying", " and it keeps getting worse", " this week", " again", " and nobody understands"]
+
+def seed_messages(count=3000, csv_path="AI_Mental_Health.csv", seed=7):
+    """The test phrases, the dataset's questions and generated one- to three-clause messages, shuffled"""
+    rng = random.Random(seed)
+    messages = set(SEED_MESSAGES)
+    if os.path.exists(csv_path):
+        messages.update(str(question) for question in pd.read_csv(csv_path)["Questions"].dropna())
+    while len(messages) < count:
+        clauses = [f"{rng.choice(_OPENERS)} {rng.choice(_STATES)}{rng.choice(_TAILS)}"
+                   for _ in range(rng.choice((1, 1, 2, 2, 3)))]
+        messages.add(". ".join(clauses) + rng.choice((".", "", "!", "...")))
+    messages = sorted(messages)
+    rng.shuffle(messages)
+    return messages
+
+def load_labels(path=RISK_LABELS_PATH):
+    """Hand-labeled messages (text, crisis_level), or an empty frame when the file doesn't exist"""
+    if not os.path.exists(path):
+        return pd.DataFrame({'text': [], 'crisis_level': []})
+    return pd.read_csv(path)[['text', 'crisis_level']].dropna()
+
+def level_band(rules, level):
+    """(lowest, highest) risk score of a crisis level under a rule set"""
+    thresholds = {name: lowest for lowest, name in rules.crisis_levels}
+    lowest = thresholds.get(level, 0)
+    above = [threshold for threshold, _ in rules.crisis_levels if threshold > lowest]
+    return lowest, min(above) - 1 if above else rules.max_risk
+
+def label_messages(messages, rules="simple", labels=None, weight=HUMAN_LABEL_WEIGHT):
+    """
+    Training frame of messages labeled by a rule set (a RuleSet, name or JSON file, see load_rules)
+    With a frame of hand labels (see load_labels), those messages are added and take their level
+    from it: the rules' score clipped into that level's band, each repeated weight times. The
+    source column tells the two apart ("human" or "rules")
+    """
+    rules = load_rules(rules)
+    levels = {} if labels is None else dict(zip(labels['text'], labels['crisis_level']))
+    texts = [message for message in messages if message not in levels]
+    sources = ["rules"] * len(texts)
+    for text in levels:
+        texts.extend([text] * weight)
+        sources.extend(["human"] * weight)
+    assessed = {text: rules.assess(text) for text in set(texts)}
+    risks = []
+    for text, source in zip(texts, sources):
+        risk = assessed[text][1]
+        if source == "human":
+            lowest, highest = level_band(rules, levels[text])
+            risk = min(max(risk, lowest), highest)
+        risks.append(risk)
+    return pd.DataFrame({'text': texts, 'polarity': [assessed[text][0] for text in texts], 'risk_score': risks,
+                         'source': sources})
+
+def agreement(classifier, frame):
+    """How often the classifier matches the labels of its rule set on a training-format frame"""
+    rules = classifier.rules
+    results = [classifier.analyze(text) for text in frame['text']]
+    levels = [rules.crisis_level(risk) for risk in frame['risk_score']]
+    thresholds = {level: lowest for lowest, level in rules.crisis_levels}
+    high_risk = thresholds.get("HIGH", max(thresholds.values(), default=rules.max_risk))
+    high = [i for i, risk in enumerate(frame['risk_score']) if risk >= high_risk]
+    return {
+        'messages': len(frame),
+        'crisis_level': float(np.mean([result[2] == level for result, level in zip(results, levels)])),
+        'risk_score': float(np.mean([result[1] == risk for result, risk in zip(results, frame['risk_score'])])),
+        'sentiment_label': float(np.mean([result[3] == sentiment_label(polarity)
+                                          for result, polarity in zip(results, frame['polarity'])])),
+        'polarity_error': float(np.mean(np.abs([result[0] - polarity
+                                                for result, polarity in zip(results, frame['polarity'])]))),
+        # Messages the labels put at HIGH or above that the classifier scores lower
+        'missed_high_risk': sum(results[i][1] < high_risk for i in high),
+        'high_risk': len(high),
+    }
+
+def human_agreement(classifier, labels):
+    """
+    How often the classifier (with the crisis floor of classify_risk) and its rule set each give
+    the hand-labeled crisis level, and how many HIGH+ messages each scores lower
+    """
+    rules = classifier.rules
+    floored, assessed = [], []
+    for text in labels['text']:
+        polarity, risk_score, _, _ = classifier.analyze(text)
+        floored.append(rules.crisis_level(_crisis_floor(rules, text, polarity, risk_score)))
+        assessed.append(rules.assess(text)[2])
+    ranks = {"LOW": 0, "MODERATE": 1, "HIGH": 2, "SEVERE": 3}
+    high = [i for i, level in enumerate(labels['crisis_level']) if ranks[level] >= ranks["HIGH"]]
+    return {
+        'messages': len(labels),
+        'classifier': float(np.mean([level == label for level, label in zip(floored, labels['crisis_level'])])),
+        'rules': float(np.mean([level == label for level, label in zip(assessed, labels['crisis_level'])])),
+        'classifier_missed_high_risk': sum(ranks[floored[i]] < ranks["HIGH"] for i in high),
+        'rules_missed_high_risk': sum(ranks[assessed[i]] < ranks["HIGH"] for i in high),
+        'high_risk': len(high),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Train the linear risk classifier")
+    commands = parser.add_subparsers(dest="command", required=True)
+    seed = commands.add_parser("seed", help="write a CSV of training messages")
+    seed.add_argument("--output", default=RISK_TRAINING_PATH)
+    seed.add_argument("--count", type=int, default=3000)
+    train = commands.add_parser("train", help="fit one model per rule set on the hand labels and the messages of a training CSV")
+    train.add_argument("--data", default=RISK_TRAINING_PATH)
+    train.add_argument("--labels", default=RISK_LABELS_PATH, help="CSV of hand-labeled messages (text, crisis_level)")
+    train.add_argument("--rules", nargs="+", default=["simple", "standard"],
+                       help="rule sets (names or JSON files) whose scores the models learn")
+    train.add_argument("--penalty", type=float, default=RIDGE_PENALTY)
+    train.add_argument("--holdout", type=float, default=0.2, help="share of messages held out to report agreement")
+    train.add_argument("--folds", type=int, default=5,
+                       help="cross-validation folds over the hand labels to compare the classifier with the rules")
+    args = parser.parse_args()
+
+    if args.command == "seed":
+        messages = seed_messages(args.count)
+        pd.DataFrame({'text': messages}).to_csv(args.output, index=False)
+        print(f"Wrote {len(messages)} messages to {args.output}")
+        return
+
+    messages = pd.read_csv(args.data)['text']
+    labels = load_labels(args.labels)
+    if labels.empty:
+        print(f"No hand labels at {args.labels}: the models will only imitate the rules")
+    for spec in args.rules:
+        rules = load_rules(spec)
+        frame = label_messages(messages, rules)
+        split = int(len(frame) * (1 - args.holdout))
+        if 0 < split < len(frame):
+            held_out = RiskClassifier.train(frame['text'][:split], frame['polarity'][:split],
+                                            frame['risk_score'][:split], args.penalty, max_risk=rules.max_risk,
+                                            rules=rules)
+            print(f"[{rules.name}] held-out agreement with the rules: "
+                  f"{agreement(held_out, frame[split:].reset_index(drop=True))}")
+        # Each fold of hand labels is scored by a model trained on all the others
+        folds = [labels[fold::args.folds].reset_index(drop=True) for fold in range(args.folds)] \
+            if len(labels) >= args.folds > 1 else []
+        results = []
+        for fold, test in enumerate(folds):
+            rest = pd.concat([other for i, other in enumerate(folds) if i != fold])
+            train_frame = label_messages(messages, rules, rest)
+            model = RiskClassifier.train(train_frame['text'], train_frame['polarity'], train_frame['risk_score'],
+                                         args.penalty, max_risk=rules.max_risk, rules=rules)
+            results.append(human_agreement(model, test))
+        if results:
+            total = sum(result['messages'] for result in results)
+            accuracy = {name: sum(result[name] * result['messages'] for result in results) / total
+                        for name in ("classifier", "rules")}
+            missed = {name: sum(result[f"{name}_missed_high_risk"] for result in results)
+                      for name in ("classifier", "rules")}
+            high = sum(result['high_risk'] for result in results)
+            print(f"[{rules.name}] hand-labeled levels ({total} messages, {args.folds}-fold): classifier "
+                  f"{accuracy['classifier']:.1%} ({missed['classifier']}/{high} HIGH+ missed), rules "
+                  f"{accuracy['rules']:.1%} ({missed['rules']}/{high} HIGH+ missed)")
+        frame = label_messages(messages, rules, labels)
+        start = time.perf_counter()
+        classifier = RiskClassifier.train(frame['text'], frame['polarity'], frame['risk_score'], args.penalty,
+                                          max_risk=rules.max_risk, rules=rules)
+        output = model_path(rules.name)
+        classifier.save(output)
+        print(f"[{rules.name}] trained on {len(frame)} messages ({(frame['source'] == 'human').sum()} hand-labeled) "
+              f"in {time.perf_counter() - start:.1f}s; weights written to {output} "
+              f"({os.path.getsize(output) / 1e3:.0f}KB)")
+
+if __name__ == "__main__":
+    main()
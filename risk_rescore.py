@@ -0,0 +1,263 @@
+"""
+Offline re-scoring of message archives after the risk rules change
+Messages are streamed from JSONL or CSV files a batch at a time, scored with the new
+and the old rules in a process pool, and appended to a JSONL results file as each
+batch completes. A checkpoint written after every batch lets an interrupted run
+resume where it stopped, and the run ends with a table of crisis-level changes.
+    python risk_rescore.py archive.jsonl chats.csv -o rescored.jsonl --rules rules.json --old-rules simple [--resume]
+A rules JSON file declares one rule set in the risk_rules.json format, e.g. a copy of the
+"standard" keyword groups with a phrase added plus {"base": "standard"} for everything else
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import time
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+import metrics
+from polarity_scorer import get_polarity_scorer
+from risk_rules import load_rules
+from risk_scoring import RISK_BATCH_CHUNK, RISK_BATCH_WORKERS, analyze_many
+
+# Fields tried in order for the message text and its id when none is given
+TEXT_FIELDS = ("text", "message", "user", "content", "body", "Questions")
+ID_FIELDS = ("id", "message_id", "request_id", "Question_ID")
+CRISIS_LEVELS = ("LOW", "MODERATE", "HIGH", "SEVERE")
+CHECKPOINT_VERSION = 1
+
+def checkpoint_path(output_path):
+    return f"{output_path}.checkpoint.json"
+
+def _first_field(fields, candidates):
+    return next((field for field in candidates if field in fields), None)
+
+def _jsonl_batches(path, text_field, batch_size, skip):
+    with open(path, encoding="utf-8") as lines:
+        position, batch = 0, []
+        for line in lines:
+            if not line.strip():
+                continue
+            position += 1
+            if position <= skip:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                record = None
+            if not isinstance(record, dict):
+                batch.append((position - 1, None, None))
+            else:
+                field = text_field or _first_field(record, TEXT_FIELDS)
+                text = record.get(field) if field else None
+                id_field = _first_field(record, ID_FIELDS)
+                batch.append((position - 1, record[id_field] if id_field else None,
+                              text if isinstance(text, str) else None))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+def _csv_batches(path, text_field, batch_size, skip):
+    header = list(pd.read_csv(path, nrows=0).columns)
+    text_field = text_field or _first_field(header, TEXT_FIELDS)
+    if text_field not in header:
+        raise ValueError(f"{path} has no text column (tried {text_field or ', '.join(TEXT_FIELDS)})")
+    id_field = _first_field(header, ID_FIELDS)
+    columns = [text_field] + ([id_field] if id_field else [])
+    position = 0
+    with pd.read_csv(path, usecols=columns, dtype=str, keep_default_na=False, chunksize=batch_size) as reader:
+        for frame in reader:
+            # Rows before the checkpoint are parsed and dropped, a chunk at a time
+            first = position
+            position += len(frame)
+            if position <= skip:
+                continue
+            first = max(first, skip)
+            frame = frame.iloc[first - position:]
+            ids = frame[id_field].tolist() if id_field else [None] * len(frame)
+            yield [(first + offset, record_id, text or None)
+                   for offset, (record_id, text) in enumerate(zip(ids, frame[text_field].tolist()))]
+
+def iter_batches(path, text_field=None, batch_size=RISK_BATCH_CHUNK, skip=0):
+    """
+    Lists of (record, id, text) from a JSONL (.jsonl/.ndjson) or CSV file, skipping its
+    first skip records; text is None for records without a message
+    The text is the text_field of each record, or the first of TEXT_FIELDS it has
+    """
+    if not os.path.exists(path):
+        raise FileNotFoundError(path)
+    if path.endswith((".jsonl", ".ndjson")):
+        return _jsonl_batches(path, text_field, batch_size, skip)
+    return _csv_batches(path, text_field, batch_size, skip)
+
+def _score_batch(texts, rules, old_rules):
+    new = analyze_many(texts, rules, workers=1)
+    old = analyze_many(texts, old_rules, workers=1)
+    return new, old[['risk_score', 'crisis_level']]
+
+def _result_lines(source, batch, scored, changes_only):
+    """JSONL lines for a scored batch and its (old level, new level) pairs"""
+    new, old = scored
+    messages = [item for item in batch if item[2] is not None]
+    lines, transitions = [], []
+    for (record, record_id, _), row, old_risk, old_level in zip(
+            messages, new.itertuples(index=False), old['risk_score'].tolist(), old['crisis_level'].tolist()):
+        transitions.append((old_level, row.crisis_level))
+        if changes_only and old_level == row.crisis_level:
+            continue
+        result = {'source': source, 'record': record, 'id': record_id, 'risk_score': int(row.risk_score),
+                  'crisis_level': row.crisis_level, 'old_risk_score': int(old_risk), 'old_crisis_level': old_level,
+                  'sentiment_label': row.sentiment_label, 'polarity': float(row.polarity),
+                  'crisis_keywords': int(row.crisis_keywords)}
+        lines.append(json.dumps(result, ensure_ascii=False, default=str) + "\n")
+    return lines, transitions
+
+def _read_checkpoint(output_path, config):
+    try:
+        with open(checkpoint_path(output_path), encoding="utf-8") as checkpoint_file:
+            checkpoint = json.load(checkpoint_file)
+    except FileNotFoundError:
+        return None
+    if checkpoint.get('version') != CHECKPOINT_VERSION or checkpoint.get('config') != config:
+        raise ValueError(f"{checkpoint_path(output_path)} was written for other inputs or rules; "
+                         f"remove it or run without resume")
+    return checkpoint
+
+def _write_checkpoint(output_path, checkpoint):
+    temporary = f"{checkpoint_path(output_path)}.{os.getpid()}.tmp"
+    with open(temporary, "w", encoding="utf-8") as checkpoint_file:
+        json.dump(checkpoint, checkpoint_file)
+    os.replace(temporary, checkpoint_path(output_path))
+
+def rescore_archives(paths, output_path, rules="simple", old_rules="simple", text_field=None,
+                     batch_size=RISK_BATCH_CHUNK, workers=None, resume=False, changes_only=False, on_batch=None):
+    """
+    Re-score every message of the input files with rules and old_rules into a JSONL file
+    With resume, a run picks up from the checkpoint of an earlier run with the same
+    inputs and rules. on_batch(stats) is called after each batch is written
+    Returns stats, with 'transitions' counting (old level, new level) pairs
+    """
+    paths = [paths] if isinstance(paths, str) else list(paths)
+    rules, old_rules = load_rules(rules), load_rules(old_rules)
+    workers = workers or RISK_BATCH_WORKERS
+    config = {'inputs': [os.path.abspath(path) for path in paths], 'rules': rules.to_dict(),
+              'old_rules': old_rules.to_dict(), 'text_field': text_field, 'changes_only': changes_only}
+    checkpoint = _read_checkpoint(output_path, config) if resume else None
+    if checkpoint is None:
+        checkpoint = {'version': CHECKPOINT_VERSION, 'config': config, 'file': 0, 'records': 0, 'output_bytes': 0,
+                      'stats': {'records': 0, 'messages': 0, 'skipped': 0, 'written': 0}, 'transitions': {}}
+    stats = dict(checkpoint['stats'])
+    transitions = Counter({tuple(pair.split("->")): count for pair, count in checkpoint['transitions'].items()})
+    resumed_records = stats['records']
+
+    start = time.perf_counter()
+    # Lines written after the last checkpoint belong to batches that will be scored again
+    with open(output_path, "a+b") as output:
+        output.truncate(checkpoint['output_bytes'])
+    pool = None
+    if workers > 1:
+        pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                                   initializer=get_polarity_scorer)
+    try:
+        with open(output_path, "a", encoding="utf-8") as output:
+
+            def write(file_index, batch, scored):
+                lines, pairs = _result_lines(paths[file_index], batch, scored, changes_only)
+                output.writelines(lines)
+                output.flush()
+                os.fsync(output.fileno())
+                transitions.update(pairs)
+                stats['records'] += len(batch)
+                stats['messages'] += len(pairs)
+                stats['skipped'] += len(batch) - len(pairs)
+                stats['written'] += len(lines)
+                checkpoint.update({'file': file_index, 'records': batch[-1][0] + 1, 'output_bytes': os.fstat(output.fileno()).st_size,
+                                   'stats': stats, 'transitions': {"->".join(pair): count
+                                                                   for pair, count in transitions.items()}})
+                _write_checkpoint(output_path, checkpoint)
+                metrics.increment("risk_rescore_records", len(batch))
+                if on_batch is not None:
+                    on_batch(stats)
+
+            # Batches are scored out of order across the pool but written in input order,
+            # with at most two per worker held in memory
+            pending = deque()
+            for file_index in range(checkpoint['file'], len(paths)):
+                skip = checkpoint['records'] if file_index == checkpoint['file'] else 0
+                for batch in iter_batches(paths[file_index], text_field, batch_size, skip):
+                    texts = [text for _, _, text in batch if text is not None]
+                    if pool is None:
+                        write(file_index, batch, _score_batch(texts, rules, old_rules))
+                        continue
+                    pending.append((file_index, batch, pool.submit(_score_batch, texts, rules, old_rules)))
+                    while len(pending) >= 2 * workers:
+                        file_done, batch_done, future = pending.popleft()
+                        write(file_done, batch_done, future.result())
+            while pending:
+                file_done, batch_done, future = pending.popleft()
+                write(file_done, batch_done, future.result())
+            checkpoint.update({'file': len(paths), 'records': 0})
+            _write_checkpoint(output_path, checkpoint)
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+
+    elapsed = time.perf_counter() - start
+    stats = dict(stats, transitions=transitions, seconds=elapsed, resumed_records=resumed_records,
+                 rules=rules.name, old_rules=old_rules.name)
+    logging.info(f"Risk rescore: {stats['records'] - resumed_records} records ({stats['messages']} messages in all) "
+                 f"in {elapsed:.1f}s with {workers} worker(s) -> {output_path}")
+    return stats
+
+def format_diff(stats):
+    """Crisis-level transition table of a rescore_archives run"""
+    transitions = stats['transitions']
+    width = max([9, *(len(f"{count:,}") + 1 for count in transitions.values())])
+    lines = [f"Crisis level changes, {stats['old_rules']} rules (rows) -> {stats['rules']} rules (columns):",
+             "old \\ new".ljust(10) + "".join(level.rjust(width) for level in CRISIS_LEVELS)]
+    for old in CRISIS_LEVELS:
+        lines.append(old.ljust(10) + "".join(f"{transitions.get((old, new), 0):,}".rjust(width)
+                                             for new in CRISIS_LEVELS))
+    order = {level: rank for rank, level in enumerate(CRISIS_LEVELS)}
+    up = sum(count for (old, new), count in transitions.items() if order[new] > order[old])
+    down = sum(count for (old, new), count in transitions.items() if order[new] < order[old])
+    messages = sum(transitions.values())
+    lines.append(f"{up + down:,} of {messages:,} messages changed level ({(up + down) / max(1, messages):.1%}): "
+                 f"{up:,} up, {down:,} down")
+    return "\n".join(lines)
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-score archived messages with new risk rules")
+    parser.add_argument("inputs", nargs="+", help="JSONL (.jsonl/.ndjson) or CSV files of messages")
+    parser.add_argument("-o", "--output", required=True, help="JSONL results file")
+    parser.add_argument("--rules", default="simple", help="new rules: simple, standard or a rules JSON file")
+    parser.add_argument("--old-rules", default="simple", help="rules to compare against")
+    parser.add_argument("--text-field", help=f"message field or column (default: first of {', '.join(TEXT_FIELDS)})")
+    parser.add_argument("--batch-size", type=int, default=RISK_BATCH_CHUNK)
+    parser.add_argument("--workers", type=int, default=RISK_BATCH_WORKERS)
+    parser.add_argument("--resume", action="store_true", help="continue from the output's checkpoint")
+    parser.add_argument("--changes-only", action="store_true", help="only write messages whose crisis level changed")
+    args = parser.parse_args()
+
+    def progress(stats):
+        print(f"\r{stats['records']:,} records, {stats['messages']:,} messages scored", end="", flush=True)
+
+    stats = rescore_archives(args.inputs, args.output, rules=args.rules, old_rules=args.old_rules,
+                             text_field=args.text_field, batch_size=args.batch_size, workers=args.workers,
+                             resume=args.resume, changes_only=args.changes_only, on_batch=progress)
+    print()
+    if stats['resumed_records']:
+        print(f"Resumed after {stats['resumed_records']:,} records")
+    print(f"{stats['records'] - stats['resumed_records']:,} records in {stats['seconds']:.1f}s, "
+          f"{stats['skipped']:,} without a message; {stats['written']:,} results in {args.output}")
+    print(format_diff(stats))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,240 @@
+"""
+Crisis risk rules shared by the apps' analyze_sentiment_and_risk
+Each rule set in risk_rules.json declares keyword groups (phrases and the points a match
+adds), polarity buckets, the risk cap and the crisis level thresholds. A rule set is
+compiled once into one table of distinct phrases across all groups with the points each
+match adds, so a message is evaluated in a single pass over that table. Edits to the
+file are picked up without a restart: the whole file is recompiled and swapped in at
+once, and a file that fails to compile leaves the running rules in place
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+
+import metrics
+from polarity_scorer import sentiment_label, text_sentiment
+
+RISK_RULES_PATH = os.getenv("RISK_RULES_PATH") or os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                               "risk_rules.json")
+# How often the rules file is checked for changes
+RISK_RULES_CHECK_SECONDS = float(os.getenv("RISK_RULES_CHECK_SECONDS", "2"))
+
+# "each": every matched phrase adds the group's points; "any": a match adds them once
+COUNT_MODES = ("each", "any")
+
+class RuleSet:
+    """One compiled rule set; to_dict gives back its declaration"""
+
+    def __init__(self, name, keyword_groups, polarity_buckets, crisis_levels, max_risk=10, lowercase_polarity=False,
+                 description=""):
+        self.name = name
+        self.description = description
+        self.lowercase_polarity = bool(lowercase_polarity)
+        self.max_risk = int(max_risk)
+        self.keyword_groups = []
+        # Distinct phrases in declaration order, and what matching each one adds
+        phrase_index = {}
+        self.phrase_points = []
+        self.once_groups = []
+        self.group_phrases = {}
+        for group in keyword_groups:
+            group = dict(group)
+            unknown = set(group) - {"name", "points", "count", "phrases"}
+            if unknown or group.get("count", "each") not in COUNT_MODES:
+                raise ValueError(f"Risk rules '{name}': bad keyword group {group.get('name')!r}")
+            group.setdefault("count", "each")
+            group['phrases'] = [phrase.lower() for phrase in group['phrases']]
+            self.keyword_groups.append(group)
+            indexes = []
+            for phrase in group['phrases']:
+                if phrase not in phrase_index:
+                    phrase_index[phrase] = len(phrase_index)
+                    self.phrase_points.append(0)
+                indexes.append(phrase_index[phrase])
+            if group['count'] == "each":
+                # A phrase listed twice counts twice, as a loop over the list would
+                for index in indexes:
+                    self.phrase_points[index] += group['points']
+            else:
+                self.once_groups.append((group['points'], tuple(sorted(set(indexes)))))
+            self.group_phrases[group['name']] = tuple(sorted(set(indexes)))
+        self.phrases = tuple(phrase_index)
+
+        # (bound, inclusive, points); the first bucket the polarity falls in applies
+        self.polarity_buckets = []
+        for bucket in polarity_buckets:
+            bounds = [key for key in ("below", "at_most") if key in bucket]
+            if len(bounds) != 1 or set(bucket) - {"below", "at_most", "points"}:
+                raise ValueError(f"Risk rules '{name}': a polarity bucket needs one of below / at_most: {bucket}")
+            self.polarity_buckets.append((float(bucket[bounds[0]]), bounds[0] == "at_most", bucket['points']))
+        # (lowest risk, level), highest first; below all of them is LOW
+        self.crisis_levels = sorted(((int(risk), level) for level, risk in crisis_levels.items()), reverse=True)
+
+        # Per-message lookups: points of a phrase, and the "any" groups it belongs to
+        self._points = dict(zip(self.phrases, self.phrase_points))
+        self._once = {}
+        for group_id, (_, indexes) in enumerate(self.once_groups):
+            for index in indexes:
+                self._once[self.phrases[index]] = self._once.get(self.phrases[index], ()) + (group_id,)
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'description': self.description,
+            'keyword_groups': [dict(group, phrases=list(group['phrases'])) for group in self.keyword_groups],
+            'polarity_buckets': [{("at_most" if inclusive else "below"): bound, 'points': points}
+                                 for bound, inclusive, points in self.polarity_buckets],
+            'crisis_levels': {level: risk for risk, level in self.crisis_levels},
+            'max_risk': self.max_risk,
+            'lowercase_polarity': self.lowercase_polarity,
+        }
+
+    def matches(self, text):
+        """Phrases of any keyword group found in text, in declaration order"""
+        lowered = text.lower()
+        return [phrase for phrase in self.phrases if phrase in lowered]
+
+    def risk_score(self, polarity, matches):
+        risk = 0
+        once = set()
+        for phrase in matches:
+            risk += self._points[phrase]
+            once.update(self._once.get(phrase, ()))
+        for group_id in once:
+            risk += self.once_groups[group_id][0]
+        for bound, inclusive, points in self.polarity_buckets:
+            if polarity <= bound if inclusive else polarity < bound:
+                risk += points
+                break
+        return min(risk, self.max_risk)
+
+    def crisis_level(self, risk_score):
+        for lowest, level in self.crisis_levels:
+            if risk_score >= lowest:
+                return level
+        return "LOW"
+
+    def assess(self, text):
+        """(polarity, risk_score, crisis_level, sentiment_label, matched phrases) of a message"""
+        polarity = text_sentiment(text.lower() if self.lowercase_polarity else text)[0]
+        matches = self.matches(text)
+        risk = self.risk_score(polarity, matches)
+        return polarity, risk, self.crisis_level(risk), sentiment_label(polarity), matches
+
+def compile_rule_sets(declarations, bases=None):
+    """
+    {name: RuleSet} from {name: declaration}; a declaration's "base" names a rule set
+    (declared here or in bases) whose fields it inherits
+    """
+    bases = dict(bases or {})
+    rule_sets = {}
+
+    def build(name, seen=()):
+        if name in rule_sets:
+            return rule_sets[name]
+        if name in seen:
+            raise ValueError(f"Risk rules: '{name}' is its own base")
+        declaration = dict(declarations[name])
+        base = declaration.pop("base", None)
+        if base is None:
+            fields = {}
+        elif base in declarations and base != name:
+            fields = build(base, seen + (name,)).to_dict()
+        elif base in bases:
+            fields = bases[base].to_dict()
+        else:
+            raise ValueError(f"Risk rules '{name}': unknown base '{base}'")
+        fields.update(declaration, name=name)
+        rule_sets[name] = RuleSet(**fields)
+        return rule_sets[name]
+
+    for name in declarations:
+        build(name)
+    return rule_sets
+
+def read_rule_sets(path=RISK_RULES_PATH):
+    with open(path, encoding="utf-8") as rules_file:
+        return compile_rule_sets(json.load(rules_file)['rule_sets'])
+
+class RiskRulesFile:
+    """The rule sets of a rules file, recompiled and swapped in when the file changes"""
+
+    def __init__(self, path=RISK_RULES_PATH, check_seconds=RISK_RULES_CHECK_SECONDS):
+        self.path = path
+        self.check_seconds = check_seconds
+        self._lock = threading.Lock()
+        self._mtime = os.stat(path).st_mtime_ns
+        self._rule_sets = read_rule_sets(path)
+        self._checked = time.monotonic()
+
+    def refresh(self):
+        """Recompile if the file changed; returns whether new rules were swapped in"""
+        with self._lock:
+            self._checked = time.monotonic()
+            try:
+                mtime = os.stat(self.path).st_mtime_ns
+            except FileNotFoundError:
+                return False
+            if mtime == self._mtime:
+                return False
+            # A broken edit is reported once, not on every check
+            self._mtime = mtime
+            start = time.perf_counter()
+            try:
+                rule_sets = read_rule_sets(self.path)
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                logging.error(f"Risk rules: keeping the running rules, {self.path} doesn't compile: {e}")
+                metrics.increment("risk_rules_reload_errors")
+                return False
+            # One assignment: callers see the old rule sets or the new ones, never a mix
+            self._rule_sets = rule_sets
+            metrics.increment("risk_rules_reloads")
+            logging.info(f"Risk rules: reloaded {sorted(rule_sets)} from {self.path} "
+                         f"in {(time.perf_counter() - start) * 1000:.1f}ms")
+            return True
+
+    def get(self, name):
+        if time.monotonic() - self._checked >= self.check_seconds:
+            self.refresh()
+        return self._rule_sets[name]
+
+    def names(self):
+        return list(self._rule_sets)
+
+_rules_file = None
+_rules_file_lock = threading.Lock()
+
+def get_risk_rules():
+    """Process-wide rules from RISK_RULES_PATH"""
+    global _rules_file
+    with _rules_file_lock:
+        if _rules_file is None:
+            _rules_file = RiskRulesFile()
+        return _rules_file
+
+def get_rule_set(name):
+    """The current compiled rule set by that name"""
+    return get_risk_rules().get(name)
+
+def load_rules(spec):
+    """
+    A RuleSet, a rule set name, or a JSON file declaring one rule set; its "base" (a rule
+    set name) supplies the fields it leaves out, e.g. {"base": "standard", "max_risk": 8}
+    """
+    if isinstance(spec, RuleSet):
+        return spec
+    if not spec.endswith(".json"):
+        return get_rule_set(spec)
+    with open(spec, encoding="utf-8") as rules_file:
+        declaration = json.load(rules_file)
+    name = os.path.splitext(os.path.basename(spec))[0]
+    rules = get_risk_rules()
+    bases = {base: rules.get(base) for base in rules.names()}
+    return compile_rule_sets({name: declaration}, bases)[name]
+
+def assess_risk(text, rule_set):
+    """(polarity, risk_score, crisis_level, sentiment_label, matched phrases) under a named rule set"""
+    return get_rule_set(rule_set).assess(text)
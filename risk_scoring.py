@@ -0,0 +1,125 @@
+"""
+Batch sentiment and risk scoring for message archives
+analyze_many applies an app's risk rule set (risk_rules.py) to many messages at
+once: the batch is lowercased and tokenized in one pass, each keyword is searched
+for once across the whole batch, repeated messages are scored once, and the risk arithmetic
+runs as NumPy array operations. Large batches are split across a process pool.
+Results come back as a DataFrame with one row per message
+"""
+
+import logging
+import math
+import multiprocessing
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import metrics
+from polarity_scorer import get_polarity_scorer
+from risk_rules import load_rules
+
+RISK_BATCH_WORKERS = int(os.getenv("RISK_BATCH_WORKERS", "0")) or os.cpu_count() or 1
+# Below this many messages the pool's start-up costs more than it saves
+RISK_BATCH_PARALLEL_MIN = int(os.getenv("RISK_BATCH_PARALLEL_MIN", "20000"))
+RISK_BATCH_CHUNK = int(os.getenv("RISK_BATCH_CHUNK", "10000"))
+
+# Joins the batch into one string for keyword search; no keyword contains it
+_SEPARATOR = "\x00"
+
+def _present(joined, starts, phrases):
+    """(messages, phrases) bool matrix: phrase occurs in message, one search per phrase over the joined batch"""
+    found = np.zeros((len(starts), len(phrases)), dtype=bool)
+    for column, phrase in enumerate(phrases):
+        positions = [match.start() for match in re.finditer(re.escape(phrase), joined)]
+        if positions:
+            found[np.searchsorted(starts, positions, side="right") - 1, column] = True
+    return found
+
+def _lowercase_batch(texts):
+    """Lowercased messages and their joined form with start offsets"""
+    joined = _SEPARATOR.join(texts).lower()
+    lowered = joined.split(_SEPARATOR)
+    if len(lowered) != len(texts):
+        # A message contains the separator itself
+        lowered = [text.lower() for text in texts]
+        joined = _SEPARATOR.join(text.replace(_SEPARATOR, " ") for text in lowered)
+    lengths = np.fromiter((len(text) + 1 for text in lowered), dtype=np.int64, count=len(lowered))
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    return lowered, joined, starts
+
+def _score_chunk(texts, rules):
+    """Columns for one chunk of distinct messages"""
+    scorer = get_polarity_scorer()
+    lowered, joined, starts = _lowercase_batch(texts)
+    sentiments = scorer.sentiments(lowered if rules.lowercase_polarity else texts)
+    polarity = np.fromiter((score[0] for score in sentiments), dtype=np.float64, count=len(texts))
+    subjectivity = np.fromiter((score[1] for score in sentiments), dtype=np.float64, count=len(texts))
+
+    # The rule set's phrase table and the points each matched phrase adds
+    found = _present(joined, starts, rules.phrases)
+    risk = found @ np.asarray(rules.phrase_points, dtype=np.int64)
+    for points, indexes in rules.once_groups:
+        risk += points * found[:, list(indexes)].any(axis=1)
+    if rules.polarity_buckets:
+        risk += np.select([polarity <= bound if inclusive else polarity < bound
+                           for bound, inclusive, _ in rules.polarity_buckets],
+                          [points for _, _, points in rules.polarity_buckets], 0)
+    risk = np.minimum(risk, rules.max_risk)
+    crisis_hits = found[:, list(rules.group_phrases.get("crisis", ()))].sum(axis=1)
+    return {'polarity': polarity, 'subjectivity': subjectivity, 'risk_score': risk.astype(np.int64),
+            'crisis_keywords': crisis_hits.astype(np.int64)}
+
+def _chunks(items, size):
+    return [items[start:start + size] for start in range(0, len(items), size)]
+
+def analyze_many(texts, rules="simple", workers=None, chunk_size=RISK_BATCH_CHUNK):
+    """
+    Score many messages with an app's rules (anything load_rules accepts)
+    Returns a DataFrame aligned with texts: polarity, subjectivity, risk_score, crisis_level,
+    sentiment_label and crisis_keywords (how many phrases of the "crisis" group matched). Missing or
+    non-string messages score like an empty one
+    """
+    start = time.perf_counter()
+    rules = load_rules(rules)
+    index = texts.index if isinstance(texts, pd.Series) else None
+    texts = ["" if text is None or (isinstance(text, float) and math.isnan(text)) else str(text) for text in texts]
+    # Archives repeat themselves ("thanks", "ok"): each distinct message is scored once
+    codes, distinct = pd.factorize(pd.Series(texts, dtype=object), sort=False)
+    distinct = list(distinct)
+
+    workers = workers or RISK_BATCH_WORKERS
+    if workers > 1 and len(distinct) >= RISK_BATCH_PARALLEL_MIN:
+        # Enough chunks for every worker, none larger than chunk_size
+        size = max(1, min(chunk_size, math.ceil(len(distinct) / workers)))
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=get_polarity_scorer) as pool:
+            parts = list(pool.map(_score_chunk, _chunks(distinct, size), [rules] * math.ceil(len(distinct) / size)))
+    else:
+        workers = 1
+        parts = [_score_chunk(chunk, rules) for chunk in _chunks(distinct, chunk_size)]
+    if parts:
+        columns = {name: np.concatenate([part[name] for part in parts])[codes] for name in parts[0]}
+    else:
+        columns = {name: np.zeros(0, dtype=dtype) for name, dtype in
+                   (('polarity', np.float64), ('subjectivity', np.float64), ('risk_score', np.int64),
+                    ('crisis_keywords', np.int64))}
+
+    risk, polarity = columns['risk_score'], columns['polarity']
+    results = pd.DataFrame({
+        'polarity': polarity,
+        'subjectivity': columns['subjectivity'],
+        'risk_score': risk,
+        'crisis_level': np.select([risk >= lowest for lowest, _ in rules.crisis_levels],
+                                  [level for _, level in rules.crisis_levels], "LOW"),
+        'sentiment_label': np.select([polarity > 0.1, polarity < -0.1], ["POSITIVE", "NEGATIVE"], "NEUTRAL"),
+        'crisis_keywords': columns['crisis_keywords'],
+    }, index=index)
+    elapsed = time.perf_counter() - start
+    metrics.observe("risk_batch_messages", len(texts))
+    logging.info(f"Risk batch ({rules.name} rules): {len(texts)} messages ({len(distinct)} distinct) scored "
+                 f"in {elapsed * 1000:.0f}ms with {workers} worker(s)")
+    return results
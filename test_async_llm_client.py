@@ -0,0 +1,237 @@
+"""
+Test the asyncio-based Groq client path
+"""
+
+import asyncio
+import threading
+import time
+import pytest
+import async_llm_client
+from async_llm_client import complete_sync, complete_many, RequestSuperseded
+
+class FakeAsyncGroq:
+    """Stands in for AsyncGroq: each completion sleeps for `delay` seconds"""
+
+    def __init__(self, delay=0.2):
+        self.delay = delay
+        self.active = 0
+        self.peak = 0
+        self.chat = self
+        self.completions = self
+
+    async def create(self, model, messages, max_tokens, temperature):
+        self.active += 1
+        self.peak = max(self.peak, self.active)
+        try:
+            await asyncio.sleep(self.delay)
+        finally:
+            self.active -= 1
+
+        class Message:
+            content = f"echo: {messages[-1]['content']}"
+
+        class Choice:
+            message = Message()
+
+        class Response:
+            choices = [Choice()]
+            usage = None
+
+        return Response()
+
+class SlowFirstAsyncGroq(FakeAsyncGroq):
+    """
+    The first `slow_calls` completions take `slow_delay`; the rest take `delay`
+    events records ("start" | "finish" | "cancelled", call number) in the order they happen
+    """
+
+    def __init__(self, delay, slow_delay, slow_calls=1):
+        super().__init__(delay)
+        self.fast_delay = delay
+        self.slow_delay = slow_delay
+        self.slow_calls = slow_calls
+        self.calls = 0
+        self.cancelled = 0
+        self.events = []
+        self.cancellation = threading.Event()
+
+    async def create(self, model, messages, max_tokens, temperature):
+        self.calls += 1
+        call = self.calls
+        self.delay = self.slow_delay if call <= self.slow_calls else self.fast_delay
+        self.events.append(("start", call))
+        try:
+            response = await super().create(model, messages, max_tokens, temperature)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            self.events.append(("cancelled", call))
+            self.cancellation.set()
+            raise
+        self.events.append(("finish", call))
+        return response
+
+def with_fake_client(delay, fake=None):
+    fake = fake or FakeAsyncGroq(delay)
+    original = async_llm_client.async_groq_client
+    async_llm_client.async_groq_client = fake
+    return fake, original
+
+def messages(text):
+    return [{"role": "user", "content": text}]
+
+def test_many_in_flight_on_one_thread():
+    """Hundreds of concurrent completions run without a thread per request"""
+    fake, original = with_fake_client(0.3)
+    threads_before = threading.active_count()
+    try:
+        requests = [dict(messages=messages(f"message {i}"), model="m", max_tokens=10, temperature=0.7)
+                    for i in range(300)]
+        start = time.perf_counter()
+        results = complete_many(requests, timeout=10)
+        elapsed = time.perf_counter() - start
+    finally:
+        async_llm_client.async_groq_client = original
+
+    print(f"300 completions in {elapsed:.2f}s, peak in flight {fake.peak}, "
+          f"threads {threads_before} -> {threading.active_count()}")
+    assert [content for content, _ in results] == [f"echo: message {i}" for i in range(300)]
+    assert fake.peak >= 200
+    assert threading.active_count() <= threads_before + 1
+    # In-flight requests are a gauge that drops back once they finish
+    assert async_llm_client.metrics.get_gauge("llm_async_in_flight") == 0
+    assert "# TYPE wellbot_llm_async_in_flight gauge" in async_llm_client.metrics.render_prometheus()
+
+def test_caller_owned_event_loops():
+    """acomplete_many also runs on a loop the caller owns, each loop with its own concurrency limit"""
+    fake, original = with_fake_client(0.01)
+    try:
+        requests = [dict(messages=messages(f"own {i}"), model="m", max_tokens=10, temperature=0.7) for i in range(5)]
+        for _ in range(2):
+            results = asyncio.run(async_llm_client.acomplete_many(requests))
+            assert [content for content, _ in results] == [f"echo: own {i}" for i in range(5)]
+        # The shared loop still works alongside them
+        assert complete_sync(messages("shared"), "m", 10, 0.7, timeout=2)[0] == "echo: shared"
+    finally:
+        async_llm_client.async_groq_client = original
+
+def test_sync_wrapper_and_timeout():
+    """The sync wrapper returns results and turns timeouts into a failed (None) result"""
+    fake, original = with_fake_client(0.05)
+    try:
+        content, _ = complete_sync(messages("hello"), "m", 10, 0.7, timeout=2)
+        assert content == "echo: hello"
+        fake.delay = 1.0
+        content, _ = complete_sync(messages("slow"), "m", 10, 0.7, timeout=0.1)
+        assert content is None
+    finally:
+        async_llm_client.async_groq_client = original
+
+def test_resubmit_cancels_previous_request():
+    """A newer request from the same session cancels the one it replaces"""
+    fake, original = with_fake_client(0.5)
+    outcome = {}
+
+    def first():
+        try:
+            outcome['first'] = complete_sync(messages("first"), "m", 10, 0.7, timeout=5, session_id="s1")
+        except RequestSuperseded:
+            outcome['first'] = "superseded"
+
+    try:
+        thread = threading.Thread(target=first)
+        thread.start()
+        time.sleep(0.1)
+        outcome['second'] = complete_sync(messages("second"), "m", 10, 0.7, timeout=5, session_id="s1")
+        thread.join(5)
+    finally:
+        async_llm_client.async_groq_client = original
+
+    assert outcome['first'] == "superseded"
+    assert outcome['second'][0] == "echo: second"
+
+def test_cancel_session():
+    """Cancelling a session that went away cancels its in-flight request"""
+    fake, original = with_fake_client(1.0)
+    try:
+        future = async_llm_client.submit(async_llm_client.acomplete(messages("bye"), "m", 10, 0.7, 5), "s2")
+        time.sleep(0.05)
+        assert async_llm_client.cancel_session("s2") is True
+        with pytest.raises(Exception):
+            future.result(2)
+        assert future.cancelled()
+    finally:
+        async_llm_client.async_groq_client = original
+
+def run_hedged(delay, timeout=5):
+    return async_llm_client.submit(
+        async_llm_client.ahedged_complete(messages("hedge"), "hedge-model", 10, 0.7, timeout, delay=delay)
+    ).result(timeout + 1)
+
+def test_hedge_beats_slow_request_and_cancels_loser():
+    """A slow first request is hedged after the delay; the winner is used and the loser cancelled"""
+    async_llm_client.metrics.reset()
+    fake, original = with_fake_client(0.05, SlowFirstAsyncGroq(0.05, 30.0))
+    budget = async_llm_client._hedge_budget
+    async_llm_client._hedge_budget = async_llm_client.HedgeBudget(rate=0.05, burst=1)
+    try:
+        start = time.perf_counter()
+        content, _ = run_hedged(delay=0.1, timeout=60)
+        elapsed = time.perf_counter() - start
+        # The loser is cancelled on the loop thread once the winner's result is back
+        assert fake.cancellation.wait(5)
+    finally:
+        async_llm_client.async_groq_client = original
+        async_llm_client._hedge_budget = budget
+
+    stats = async_llm_client.get_hedging_stats()
+    print(f"Hedged completion in {elapsed:.2f}s (slow request takes 30s), stats {stats}")
+    assert content == "echo: hedge"
+    # The hedge answered while the slow request was still running, and the slow one was then cancelled
+    assert fake.events == [("start", 1), ("start", 2), ("finish", 2), ("cancelled", 1)]
+    assert stats['fired'] == 1 and stats['won'] == 1
+
+def test_fast_requests_are_not_hedged():
+    async_llm_client.metrics.reset()
+    fake, original = with_fake_client(0.02, SlowFirstAsyncGroq(0.02, 0.02))
+    try:
+        for _ in range(5):
+            assert run_hedged(delay=0.2)[0] == "echo: hedge"
+    finally:
+        async_llm_client.async_groq_client = original
+    assert fake.calls == 5
+    assert async_llm_client.get_hedging_stats()['fired'] == 0
+
+def test_hedge_rate_is_capped():
+    """Once the hedge budget is spent, slow requests just wait"""
+    async_llm_client.metrics.reset()
+    fake, original = with_fake_client(0.3, SlowFirstAsyncGroq(0.3, 0.3, slow_calls=0))
+    budget = async_llm_client._hedge_budget
+    async_llm_client._hedge_budget = async_llm_client.HedgeBudget(rate=0.1, burst=1)
+    try:
+        requests = [async_llm_client.ahedged_complete(messages(f"m{i}"), "capped-model", 10, 0.7, 5, delay=0.05)
+                    for i in range(10)]
+
+        async def run_all():
+            return await asyncio.gather(*requests)
+
+        results = async_llm_client.submit(run_all()).result(5)
+    finally:
+        async_llm_client.async_groq_client = original
+        async_llm_client._hedge_budget = budget
+
+    stats = async_llm_client.get_hedging_stats()
+    print(f"10 slow requests with a 10% hedge cap: {stats}")
+    assert all(content is not None for content, _ in results)
+    assert stats['fired'] == 1
+    assert stats['skipped_by_rate_cap'] == 9
+
+if __name__ == "__main__":
+    test_many_in_flight_on_one_thread()
+    test_caller_owned_event_loops()
+    test_sync_wrapper_and_timeout()
+    test_resubmit_cancels_previous_request()
+    test_cancel_session()
+    test_hedge_beats_slow_request_and_cancels_loser()
+    test_fast_requests_are_not_hedged()
+    test_hedge_rate_is_capped()
+    print("\n🎉 Async LLM client tests passed")
@@ -0,0 +1,80 @@
+"""
+Test bounded conversation memory with rolling summaries
+"""
+
+from conversation_memory import ConversationMemory, extractive_summary, prior_turns
+from prompt_builder import count_tokens
+
+def make_history(turns):
+    return [{'user': f"Message {i}: I have been worrying about my exams and sleep.",
+             'bot': f"Reply {i}: Try a regular study schedule and a wind-down routine before bed.",
+             'timestamp': float(i)} for i in range(turns)]
+
+def local_memory(**kwargs):
+    return ConversationMemory(summarizer=extractive_summary, **kwargs)
+
+def test_short_history_is_verbatim():
+    """A short conversation is passed through unchanged"""
+    memory = local_memory()
+    messages = memory.messages(make_history(2))
+    assert [m['role'] for m in messages] == ['user', 'assistant', 'user', 'assistant']
+    assert memory.summary == ""
+
+def test_prompt_size_is_bounded():
+    """History tokens stay within the budget for conversations of any length"""
+    memory = local_memory(max_turns=4, token_budget=300)
+    sizes = []
+    for length in (5, 20, 80, 200):
+        history = make_history(length)
+        memory.messages(history)
+        memory.wait(5)
+        messages = memory.messages(history)
+        size = sum(count_tokens(m['content']) + 4 for m in messages)
+        sizes.append(size)
+        assert size <= 300, size
+    print(f"History tokens by conversation length: {sizes}")
+    assert memory.summary.startswith("The user said") or "Message" in memory.summary
+    assert messages[0]['role'] == 'system'
+
+def test_summary_is_incremental():
+    """Each background update only receives turns not yet summarized"""
+    seen = []
+
+    def summarizer(previous, turns, budget):
+        seen.append(len(turns))
+        return extractive_summary(previous, turns, budget)
+
+    memory = ConversationMemory(max_turns=2, token_budget=400, summarizer=summarizer)
+    history = make_history(3)
+    memory.messages(history)
+    memory.wait(5)
+    history += make_history(5)[3:]
+    memory.messages(history)
+    memory.wait(5)
+    print(f"Turns per summary update: {seen}")
+    assert seen == [1, 2]
+    assert memory.summarized_turns == 3
+
+def test_clear_chat_resets_summary():
+    """Clearing the chat history drops the summary"""
+    memory = local_memory(max_turns=1)
+    history = make_history(4)
+    memory.messages(history)
+    memory.wait(5)
+    assert memory.summary
+    memory.messages([{'user': "hello", 'bot': "hi", 'timestamp': 99.0}])
+    assert memory.summary == ""
+
+def test_prior_turns_excludes_current_message():
+    """The message being answered is not repeated as history"""
+    history = [{'user': "first"}, {'user': "second"}]
+    assert prior_turns(history, exclude_text="second") == [{'user': "first"}]
+    assert prior_turns(history, exclude_text="other") == history
+
+if __name__ == "__main__":
+    test_short_history_is_verbatim()
+    test_prompt_size_is_bounded()
+    test_summary_is_incremental()
+    test_clear_chat_resets_summary()
+    test_prior_turns_excludes_current_message()
+    print("\n🎉 Conversation memory tests passed")
@@ -0,0 +1,126 @@
+"""
+Test the offline knowledge base answer engine
+"""
+
+import time
+import pandas as pd
+import metrics
+from kb_answer_engine import (KBAnswerEngine, FALLBACK_INTRO, KB_FAST_PATH_CONFIDENCE, fallback_answer,
+                              fast_path_answer, get_answer_engine, get_short_circuit_stats,
+                              question_match_score, summarize_answer)
+
+def load_knowledge_base():
+    mentalhealth = pd.read_csv("AI_Mental_Health.csv")
+    knowledge_base = {}
+    for i in range(len(mentalhealth)):
+        question = str(mentalhealth.iloc[i]["Questions"]).lower()
+        answer = str(mentalhealth.iloc[i]["Answers"])
+        if question and answer and question != 'nan' and answer != 'nan':
+            knowledge_base[question] = answer
+    return knowledge_base
+
+def test_dataset_questions_are_answered_with_full_confidence():
+    """Every question in the dataset finds its own answer"""
+    knowledge_base = load_knowledge_base()
+    engine = KBAnswerEngine(knowledge_base)
+    misses = [question for question in knowledge_base
+              if engine.answer(question)['question'] != question]
+    print(f"{len(knowledge_base) - len(misses)}/{len(knowledge_base)} dataset questions matched themselves")
+    assert len(misses) <= 2
+    result = engine.answer("What does it mean to have a mental illness?")
+    assert result['confidence'] == 1.0
+    assert result['response'].startswith("Mental illnesses are health conditions")
+
+def test_paraphrase_and_off_topic_confidence():
+    engine = KBAnswerEngine(load_knowledge_base())
+    paraphrase = engine.answer("what does having a mental illness mean")
+    assert paraphrase['question'] == "what does it mean to have a mental illness?"
+    assert 0.5 < paraphrase['confidence'] < KB_FAST_PATH_CONFIDENCE
+
+    # Extra words on either side lower confidence
+    mixed = engine.answer("I want to die, what is depression?")
+    assert mixed is None or mixed['confidence'] < KB_FAST_PATH_CONFIDENCE
+    assert engine.answer("hello") is None
+
+def test_summaries_are_short_and_well_formed():
+    knowledge_base = load_knowledge_base()
+    for answer in knowledge_base.values():
+        summary = summarize_answer(answer)
+        assert summary
+        assert len(summary.split()) <= 180
+        assert summary.rstrip()[-1] in ".!?:" or "\n- " in summary
+
+    summary = summarize_answer("Grief can come up in many ways. This includes: \n Losing security \n Losing routine \n Losing safety \n Losing sleep")
+    assert summary == "Grief can come up in many ways. This includes:\n- Losing security\n- Losing routine\n- Losing safety"
+
+def test_fast_path_and_fallback():
+    knowledge_base = load_knowledge_base()
+    assert fast_path_answer(knowledge_base, "How can I manage grief?", 0)['question'] == "how can i manage grief?"
+    assert fast_path_answer(knowledge_base, "I've been feeling down about my grief lately", 0) is None
+
+    response, confidence = fallback_answer(knowledge_base, "How can I manage grief?")
+    assert response.startswith(FALLBACK_INTRO) and "grief" in response and confidence == 1.0
+    response, confidence = fallback_answer(knowledge_base, "my cat is cute")
+    assert response == FALLBACK_INTRO
+    assert fallback_answer({}, "anything") == (FALLBACK_INTRO, 0.0)
+
+def test_question_match_score():
+    question = "what does it mean to have a mental illness?"
+    assert question_match_score("What does it mean to have a mental illness", question) == 1.0
+    assert 0.9 < question_match_score("what does it mean to have mental illness?", question) < 1.0
+    assert question_match_score("how can i manage grief?", question) < 0.6
+    assert question_match_score("?!", question) == 0.0
+
+def test_short_circuit_risk_policy():
+    """Low risk uses the threshold, moderate+ never short-circuits, unscored needs an exact match"""
+    knowledge_base = load_knowledge_base()
+    metrics.reset()
+    near_exact = "what does it mean to have a mental illness today"
+    assert fast_path_answer(knowledge_base, near_exact, risk_score=2)['match_score'] >= KB_FAST_PATH_CONFIDENCE
+    assert fast_path_answer(knowledge_base, near_exact, risk_score=3) is not None
+    assert fast_path_answer(knowledge_base, near_exact, risk_score=4) is None
+    assert fast_path_answer(knowledge_base, near_exact, risk_score=None) is None
+    assert fast_path_answer(knowledge_base, "What does it mean to have a mental illness?", risk_score=None) is not None
+    assert fast_path_answer(knowledge_base, near_exact, risk_score=0, threshold=1.0) is None
+
+    stats = get_short_circuit_stats()
+    print(f"Short-circuit stats: {stats}")
+    assert stats['checked'] == 6 and stats['served'] == 3 and stats['blocked_by_risk'] == 1
+    assert stats['served_fraction'] == 0.5
+    assert stats['estimated_seconds_saved'] > 0
+
+def test_engine_is_reused_across_reruns():
+    """Streamlit rebuilds the knowledge base dict each rerun; the index is built once"""
+    assert get_answer_engine(load_knowledge_base()) is get_answer_engine(load_knowledge_base())
+
+if __name__ == "__main__":
+    test_dataset_questions_are_answered_with_full_confidence()
+    test_paraphrase_and_off_topic_confidence()
+    test_summaries_are_short_and_well_formed()
+    test_fast_path_and_fallback()
+    test_question_match_score()
+    test_short_circuit_risk_policy()
+    test_engine_is_reused_across_reruns()
+
+    knowledge_base = load_knowledge_base()
+    engine = get_answer_engine(knowledge_base)
+    queries = list(knowledge_base) + ["I feel anxious at work", "how do I support a friend", "trouble sleeping"]
+    start = time.perf_counter()
+    for _ in range(10):
+        for query in queries:
+            engine.answer(query)
+    elapsed = (time.perf_counter() - start) / (10 * len(queries))
+    print(f"Average local answer time: {elapsed * 1000:.3f}ms over {len(engine)} Q&A pairs")
+
+    # Share of a mixed workload (dataset FAQs, paraphrases, open-ended messages) served locally
+    metrics.reset()
+    workload = list(knowledge_base)[:30] + [question.rstrip("?") + " please" for question in list(knowledge_base)[30:50]] + [
+        "I've had a rough week and can't focus", "my partner and I keep arguing", "I feel anxious at work"] * 10
+    start = time.perf_counter()
+    for message in workload:
+        fast_path_answer(knowledge_base, message, risk_score=1)
+    elapsed = time.perf_counter() - start
+    stats = get_short_circuit_stats()
+    print(f"Short-circuit: {stats['served']}/{stats['checked']} messages ({stats['served_fraction']:.0%}) "
+          f"served locally in {elapsed * 1000 / len(workload):.3f}ms each")
+    print("🎉 KB answer engine tests passed")
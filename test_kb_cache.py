@@ -0,0 +1,64 @@
+"""
+Test the per-version index caches and their cost per lookup
+"""
+
+import time
+from kb_cache import KnowledgeBaseCache
+from kb_store import LiveKnowledgeBase
+
+class Snapshot(LiveKnowledgeBase):
+    """A live snapshot whose items() must not be walked on a lookup"""
+
+    answer_engine = object()
+
+    def items(self):
+        raise AssertionError("live snapshots are looked up by identity")
+
+def counting_cache(versions=2):
+    builds = []
+
+    def build(knowledge_base):
+        builds.append(dict.items(knowledge_base) if isinstance(knowledge_base, dict) else knowledge_base)
+        return object()
+
+    return KnowledgeBaseCache(build, versions), builds
+
+def test_plain_dicts_by_identity_then_content():
+    cache, builds = counting_cache()
+    knowledge_base = {"what is stress?": "A response to pressure."}
+    index = cache.get(knowledge_base)
+    assert cache.get(knowledge_base) is index
+    # An equal dict rebuilt by a rerun finds the same index
+    assert cache.get(dict(knowledge_base)) is index and len(builds) == 1
+    assert cache.get({"what is sleep?": "Rest."}) is not index and len(builds) == 2
+
+def test_live_snapshots_are_never_hashed():
+    cache, builds = counting_cache()
+    first, second = Snapshot({"a": "1"}), Snapshot({"a": "1"})
+    index = cache.get(first)
+    assert cache.get(first) is index
+    assert cache.get(second) is not index and len(builds) == 2
+
+def test_only_recent_versions_are_kept():
+    cache, builds = counting_cache(versions=2)
+    versions = [{f"question {i}": "answer"} for i in range(3)]
+    indexes = [cache.get(knowledge_base) for knowledge_base in versions]
+    # The oldest version was evicted and is rebuilt; the newest two are still cached
+    assert cache.get(versions[2]) is indexes[2] and cache.get(versions[1]) is indexes[1]
+    assert cache.get(versions[0]) is not indexes[0] and len(builds) == 4
+    assert len(cache._entries) == 2
+
+if __name__ == "__main__":
+    test_plain_dicts_by_identity_then_content()
+    test_live_snapshots_are_never_hashed()
+    test_only_recent_versions_are_kept()
+
+    knowledge_base = {f"question {i}": f"answer {i} " * 20 for i in range(40_000)}
+    cache, _ = counting_cache()
+    cache.get(knowledge_base)
+    for label, lookup in (("same dict (identity)", knowledge_base), ("equal rebuilt dict (content)", dict(knowledge_base))):
+        start = time.perf_counter()
+        for _ in range(100):
+            cache.get(lookup)
+        print(f"40k entries, {label}: {(time.perf_counter() - start) / 100 * 1e6:.1f}µs per lookup")
+    print("🎉 KB cache tests passed")
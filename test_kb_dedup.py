@@ -0,0 +1,136 @@
+"""
+Test MinHash/LSH near-duplicate collapse of knowledge base entries and benchmark it on a generated corpus
+"""
+
+import itertools
+import os
+import random
+import shutil
+import tempfile
+import time
+import numpy as np
+from kb_answer_engine import fast_path_answer, get_answer_engine
+from kb_dedup import (MinHasher, deduplicate, deduplicate_store, find_clusters, is_duplicate, load_aliases,
+                      lsh_candidates, shingles, similarity)
+from kb_store import KnowledgeBaseStore
+from test_kb_answer_engine import load_knowledge_base
+
+def test_signatures_estimate_jaccard():
+    hasher = MinHasher(num_permutations=256)
+    texts = ["How can I manage anxiety before an exam at school?",
+             "How can I manage my anxiety before exams at school?",
+             "What are the warning signs of mental illness?"]
+    signatures = hasher.signatures(texts)
+    for i, j in itertools.combinations(range(len(texts)), 2):
+        first, second = set(shingles(texts[i]).tolist()), set(shingles(texts[j]).tolist())
+        exact = len(first & second) / len(first | second)
+        assert abs(similarity(signatures, i, j) - exact) < 0.1
+    assert (hasher.signatures(texts) == MinHasher(num_permutations=256).signatures(texts)).all()
+    assert lsh_candidates(signatures) == {(0, 1)}
+
+def test_collapses_reworded_dataset_questions():
+    knowledge_base = load_knowledge_base()
+    result = deduplicate(knowledge_base)
+    assert result['clusters'] == [
+        ["how can i find a mental health professional right for my child or myself?",
+         "how can i find a mental health professional for myself or my child?"],
+        ["if i become involved in treatment what do i need to know?",
+         "if i become involved in treatment, what do i need to know?"],
+    ]
+    # Same template, different topic: not duplicates
+    assert "where can i find self-help materials for anxiety?" in result['knowledge_base']
+    assert "where can i find self-help materials for depression?" in result['knowledge_base']
+    assert result['aliases']["if i become involved in treatment, what do i need to know?"] == \
+        "if i become involved in treatment what do i need to know?"
+    stats = result['stats']
+    assert stats['clusters'] == 2 and stats['duplicates'] == 2 and stats['cluster_sizes'] == {2: 2}
+    assert stats['index_after']['entries'] == 95
+    assert stats['index_after']['postings'] < stats['index_before']['postings']
+
+def test_canonical_entry_and_answer_only_duplicates():
+    questions = ["How do I sleep better?", "How can I sleep better?", "How do I sleep better at night?",
+                 "What does grief feel like?", "Can you tell me what grief feels like?", "Is exercise good for mood?",
+                 "Where can I get help for an eating disorder?", "Is medication safe during pregnancy?"]
+    answers = ["Keep a regular bedtime.", "Keep a regular bedtime and avoid screens late at night.",
+               "Keep a regular bedtime.", "Grief is the response to loss, often of someone we love.",
+               "Grief is the response to loss, often of someone we love.", "Yes, regular exercise lifts mood.",
+               "Please talk to your doctor, who can advise you.", "Please talk to your doctor, who can advise you."]
+    clusters = find_clusters(questions, answers)
+    # The same answer to unrelated questions doesn't make them duplicates
+    assert [sorted(cluster) for cluster in clusters] == [[0, 1, 2], [3, 4]]
+    # Most central first, then the longest answer
+    assert clusters[0][0] == 0 and clusters[1][0] == 3
+    assert find_clusters(["", "?"], ["", ""]) == []
+    assert is_duplicate(0.3, 0.95) and not is_duplicate(0.0, 1.0)
+
+def test_store_deduplication_reaches_other_processes():
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "kb.csv")
+        shutil.copy("AI_Mental_Health.csv", path)
+        store, other = KnowledgeBaseStore(path), KnowledgeBaseStore(path)
+
+        stats = deduplicate_store(store, dry_run=True)
+        assert stats['duplicates'] == 2 and len(other.current()) == 97 and not load_aliases(path)
+
+        stats = deduplicate_store(store)
+        assert stats['index_after']['entries'] == 95 and len(other.current()) == 95
+        aliases = load_aliases(path)
+        assert set(aliases) == {"How can I find a mental health professional for myself or my child?",
+                                "If I become involved in treatment, what do I need to know?"}
+        for canonical in aliases.values():
+            assert store.get(canonical) is not None
+        assert deduplicate_store(store)['duplicates'] == 0 and len(load_aliases(path)) == 2
+
+        # A collapsed question still matches its canonical entry exactly, in running and new stores
+        alias = "How can I find a mental health professional for myself or my child?"
+        canonical = "how can i find a mental health professional right for my child or myself?"
+        for knowledge_base in (other.current(), KnowledgeBaseStore(path).current()):
+            assert alias.lower() not in knowledge_base
+            answer = fast_path_answer(knowledge_base, alias, risk_score=None)
+            assert answer['question'] == canonical and answer['match_score'] == 1.0
+            assert get_answer_engine(knowledge_base).answer(alias)['question'] == canonical
+
+if __name__ == "__main__":
+    test_signatures_estimate_jaccard()
+    test_collapses_reworded_dataset_questions()
+    test_canonical_entry_and_answer_only_duplicates()
+    test_store_deduplication_reaches_other_processes()
+
+    # Generated corpus: distinct topics, a third of them with a few reworded copies
+    rng = random.Random(7)
+    words = [f"topic{i}" for i in range(4000)]
+    questions, answers, topics = [], [], []
+    for topic in range(6000):
+        subject = " ".join(rng.sample(words, 3))
+        answer = f"Advice about {subject}: " + " ".join(rng.sample(words, 25)) + "."
+        copies = rng.choice((1, 1, 2, 3, 4))
+        for copy in range(copies):
+            prefix = ("How do I deal with", "How can I deal with", "How should I handle", "Tips for dealing with")[copy]
+            questions.append(f"{prefix} {subject}?")
+            answers.append(answer if copy % 2 == 0 else answer.replace("Advice", "Some advice"))
+            topics.append(topic)
+    knowledge_base = dict(zip(questions, answers))
+    start = time.perf_counter()
+    result = deduplicate(knowledge_base)
+    elapsed = time.perf_counter() - start
+    expected = len(knowledge_base) - len(set(topics))
+    stats = result['stats']
+    merged_across_topics = sum(len({topics[questions.index(q)] for q in cluster}) > 1 for cluster in result['clusters'])
+    print(f"{len(knowledge_base):,} entries: {stats['duplicates']:,} duplicates found ({expected:,} planted) "
+          f"in {stats['clusters']:,} clusters, {merged_across_topics} clusters mixing topics, {elapsed:.1f}s")
+    print(f"Cluster sizes {stats['cluster_sizes']}; index {stats['index_before']['postings']:,} -> "
+          f"{stats['index_after']['postings']:,} postings")
+
+    signatures = MinHasher().signatures(questions)
+    start = time.perf_counter()
+    candidates = lsh_candidates(signatures)
+    lsh_seconds = time.perf_counter() - start
+    sample = 200_000
+    start = time.perf_counter()
+    for _ in range(sample):
+        i, j = rng.randrange(len(questions)), rng.randrange(len(questions))
+        np.mean(signatures[i] == signatures[j])
+    all_pairs = len(questions) * (len(questions) - 1) // 2
+    print(f"LSH: {len(candidates):,} candidate pairs in {lsh_seconds:.2f}s; comparing all {all_pairs:,} pairs "
+          f"~{(time.perf_counter() - start) / sample * all_pairs:.0f}s")
+    print("🎉 Near-duplicate collapse tests passed")
@@ -0,0 +1,119 @@
+"""
+Test the trigram fuzzy index used for typo-tolerant knowledge base lookup
+"""
+
+import random
+import string
+import time
+from kb_fuzzy_index import TrigramIndex, edit_distance, get_fuzzy_index, trigrams
+from prompt_builder import rank_kb_passages
+from test_kb_answer_engine import load_knowledge_base
+
+def test_trigrams_and_edit_distance():
+    assert trigrams("Sad!") == {"  s", " sa", "sad", "ad "}
+    assert trigrams("?!") == set()
+    assert edit_distance("anxeity", "anxiety", 2) == 1
+    assert edit_distance("slep", "sleep", 1) == 1
+    assert edit_distance("therapist", "therapy", 2) == 3
+
+def test_similarity_search_matches_brute_force():
+    """Postings-based candidate generation finds exactly what a full scan finds"""
+    rng = random.Random(7)
+    texts = ["".join(rng.choices("abcdefgh", k=rng.randint(3, 9))) for _ in range(2000)]
+    index = TrigramIndex(texts)
+    for query in texts[:50] + ["abcabc", "hhhh", "zzz"]:
+        for threshold in (0.3, 0.6):
+            grams = trigrams(query)
+            expected = sorted(
+                (i for i, text in enumerate(texts)
+                 if len(grams & trigrams(text)) / len(grams | trigrams(text)) >= threshold),
+            )
+            found = sorted(doc_id for doc_id, _ in index.search(query, threshold, limit=len(texts)))
+            assert found == expected, (query, threshold)
+
+def test_ranking_and_limit():
+    index = TrigramIndex(["what is anxiety", "what is depression", "how to sleep better"])
+    results = index.search("wat is anxeity", threshold=0.2)
+    assert results[0][0] == 0
+    assert all(first[1] >= second[1] for first, second in zip(results, results[1:]))
+    assert len(index.search("what is", threshold=0.1, limit=1)) == 1
+    assert TrigramIndex().search("anything") == []
+
+def test_incremental_add():
+    index = TrigramIndex(["what is anxiety"])
+    assert index.search("lonely") == []
+    doc_id = index.add("how can i feel less lonely")
+    assert index.search("how can i fel less lonley")[0][0] == doc_id
+
+def test_adds_after_searches_match_a_fresh_index():
+    rng = random.Random(3)
+    texts = ["".join(rng.choices("abcdefgh", k=rng.randint(3, 9))) for _ in range(600)]
+    grown = TrigramIndex(texts[:100])
+    for i, text in enumerate(texts[100:]):
+        if i % 50 == 0:
+            grown.search(text)
+        grown.add(text)
+    fresh = TrigramIndex(texts)
+    for query in texts[::20] + ["abcabc"]:
+        assert grown.search(query, 0.3, limit=50) == fresh.search(query, 0.3, limit=50)
+
+def test_typo_correction_against_knowledge_base():
+    knowledge_base = load_knowledge_base()
+    index = get_fuzzy_index(knowledge_base)
+    assert index.correct_tokens(["anxeity", "grif", "lonley", "medicaton", "stres"]) == [
+        "anxiety", "grief", "lonely", "medication", "stress"]
+    # Real words that aren't in the knowledge base are left alone
+    assert index.correct_word("therapist") == "therapist"
+    assert index.correct_word("cat") == "cat"
+
+    with_typos = rank_kb_passages(knowledge_base, "how can I manage my grif and anxeity", limit=3)
+    correct = rank_kb_passages(knowledge_base, "how can I manage my grief and anxiety", limit=3)
+    assert with_typos == correct
+
+def random_words(count, rng):
+    return ["".join(rng.choices(string.ascii_lowercase, k=rng.randint(4, 12))) for _ in range(count)]
+
+if __name__ == "__main__":
+    test_trigrams_and_edit_distance()
+    test_similarity_search_matches_brute_force()
+    test_ranking_and_limit()
+    test_incremental_add()
+    test_adds_after_searches_match_a_fresh_index()
+    test_typo_correction_against_knowledge_base()
+
+    rng = random.Random(1)
+    knowledge_base = load_knowledge_base()
+    vocabulary = get_fuzzy_index(knowledge_base).vocabulary
+    typos = ["anxeity", "depresed", "medicaton", "lonley", "grif", "stres", "therapyst", "suport"]
+    for size in (1_000, 10_000, 100_000, 300_000):
+        words = list(set(vocabulary + random_words(size, rng)))
+        index = TrigramIndex(words)
+        index.search("warmup")
+        start = time.perf_counter()
+        for _ in range(20):
+            for typo in typos:
+                index.search(typo, 0.25, limit=8)
+        per_lookup = (time.perf_counter() - start) / (20 * len(typos))
+
+        # The substring loop the apps used before, over the same number of entries
+        start = time.perf_counter()
+        for typo in typos[:2]:
+            [word for word in words if typo in word]
+        per_scan = (time.perf_counter() - start) / 2
+        print(f"{len(words):>7} words: trigram lookup {per_lookup * 1000:.3f}ms, substring scan {per_scan * 1000:.3f}ms")
+
+    # Adds to a searched index touch only the new string's postings, whatever the index size
+    added = random_words(1000, rng)
+    start = time.perf_counter()
+    for word in added:
+        index.add(word)
+    per_add = (time.perf_counter() - start) / len(added)
+    print(f"{len(index):>7} words: add after searches {per_add * 1000:.3f}ms per word")
+
+    question_index = get_fuzzy_index(knowledge_base).question_index
+    start = time.perf_counter()
+    for _ in range(100):
+        question_index.search("how can i manage grif", 0.5)
+    print(f"Question similarity over {len(question_index)} questions: "
+          f"{(time.perf_counter() - start) * 10:.3f}ms per lookup")
+    print("🎉 Fuzzy index tests passed")
@@ -0,0 +1,125 @@
+"""
+Test chunked streaming ingestion of Q&A datasets and benchmark it on a large generated corpus
+"""
+
+import json
+import os
+import tempfile
+import time
+import pandas as pd
+from kb_fuzzy_index import TrigramIndex
+from kb_ingest import clean_chunk, ingest_knowledge_base, iter_chunks
+from test_kb_answer_engine import load_knowledge_base
+
+def write_csv(path, rows):
+    pd.DataFrame(rows, columns=["Question_ID", "Questions", "Answers"]).to_csv(path, index=False)
+
+def test_matches_row_by_row_loader():
+    """Same entries in the same order as the apps' old iloc loop"""
+    expected = load_knowledge_base()
+    for chunk_rows in (7, 1000):
+        knowledge_base, stats = ingest_knowledge_base("AI_Mental_Health.csv", chunk_rows=chunk_rows)
+        assert list(knowledge_base.items()) == list(expected.items())
+        assert stats['rows_read'] == 97 and stats['entries'] == len(expected)
+        assert stats['rows_per_second'] > 0 and stats['peak_rss_mb'] > 0
+
+def test_cleaning_and_cross_chunk_duplicates():
+    rows = [
+        (1, "What is Anxiety?", "first"),
+        (2, None, "no question"),
+        (3, "Empty answer", None),
+        (4, "nan", "literal nan"),
+        (5, "what is anxiety?", "second"),
+        (6, "What is grief?", "grief answer"),
+        (7, "WHAT IS ANXIETY?", "third"),
+    ]
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "kb.csv")
+        write_csv(path, rows)
+        for chunk_rows in (2, 3, 100):
+            knowledge_base, stats = ingest_knowledge_base(path, chunk_rows=chunk_rows)
+            assert knowledge_base == {"what is anxiety?": "third", "what is grief?": "grief answer"}
+            assert list(knowledge_base) == ["what is anxiety?", "what is grief?"]
+            assert stats['dropped'] == 5
+        cleaned = clean_chunk(next(iter_chunks(path, chunk_rows=100)))
+        assert list(cleaned.index) == ["what is anxiety?", "what is grief?"]
+
+def test_jsonl_with_custom_columns_and_incremental_index():
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "counsel.jsonl")
+        with open(path, "w", encoding="utf-8") as output:
+            for i in range(25):
+                output.write(json.dumps({"question": f"Question {i}", "answer": f"Answer {i}", "topic": "x"}) + "\n")
+            output.write("\n")
+        index = TrigramIndex()
+        seen = []
+
+        def add_to_index(questions, answers):
+            seen.append(len(questions))
+            for question in questions:
+                index.add(question)
+
+        knowledge_base, stats = ingest_knowledge_base(path, "question", "answer", chunk_rows=10,
+                                                      on_chunk=add_to_index)
+        assert len(knowledge_base) == 25 and knowledge_base["question 7"] == "Answer 7"
+        assert seen == [10, 10, 5] and stats['chunks'] == 3
+        assert index.texts[index.search("question 13", 0.9)[0][0]] == "question 13"
+
+def test_memory_ceiling():
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "kb.csv")
+        write_csv(path, [(i, f"question {i}", "answer " * 20) for i in range(3000)])
+        knowledge_base, stats = ingest_knowledge_base(path, chunk_rows=100_000, max_memory_mb=100_000)
+        assert len(knowledge_base) == 3000
+        # The first chunk is small; later chunks are sized from its bytes per row
+        assert stats['chunks'] >= 2
+        try:
+            ingest_knowledge_base(path, max_memory_mb=1)
+            assert False, "a 1MB ceiling should be exceeded"
+        except MemoryError:
+            pass
+    try:
+        ingest_knowledge_base("missing.csv")
+        assert False, "missing files should raise"
+    except FileNotFoundError:
+        pass
+
+if __name__ == "__main__":
+    test_matches_row_by_row_loader()
+    test_cleaning_and_cross_chunk_duplicates()
+    test_jsonl_with_custom_columns_and_incremental_index()
+    test_memory_ceiling()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "large.csv")
+        rows = 1_000_000
+        # Written in pieces so generating the file doesn't set the peak RSS
+        for first in range(0, rows, 100_000):
+            ids = range(first, first + 100_000)
+            pd.DataFrame({
+                "Question_ID": ids,
+                "Questions": [f"How do I cope with situation {i % 800_000}?" for i in ids],
+                "Answers": [f"Talk to someone you trust about situation {i}. Small steps help." for i in ids],
+            }).to_csv(path, index=False, mode="a", header=first == 0)
+        print(f"Generated {rows:,} rows ({os.path.getsize(path) / 1e6:.0f}MB)")
+
+        _, stats = ingest_knowledge_base(path, chunk_rows=100_000)
+        print(f"Streaming: {stats['rows_per_second']:,.0f} rows/s, {stats['entries']:,} entries, "
+              f"{stats['chunks']} chunks, peak RSS {stats['peak_rss_mb']:.0f}MB")
+
+        # The old loader: whole-file read_csv, then one .iloc lookup per row (timed on a sample)
+        start = time.perf_counter()
+        data = pd.read_csv(path)
+        read_seconds = time.perf_counter() - start
+        sample = 20_000
+        start = time.perf_counter()
+        knowledge_base = {}
+        for i in range(sample):
+            question = str(data.iloc[i]["Questions"]).lower()
+            answer = str(data.iloc[i]["Answers"])
+            if question and answer and question != 'nan' and answer != 'nan':
+                knowledge_base[question] = answer
+        per_row = (time.perf_counter() - start) / sample
+        print(f"read_csv + iloc loop: ~{rows / (read_seconds + per_row * rows):,.0f} rows/s "
+              f"(loop estimated from {sample:,} rows)")
+    print("🎉 Streaming ingestion tests passed")
@@ -0,0 +1,207 @@
+"""
+Test the memory-mapped knowledge base index against the in-memory engines and measure per-worker memory
+"""
+
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import pandas as pd
+import kb_mmap_index
+import kb_reranker
+from kb_answer_engine import KBAnswerEngine, fast_path_answer, get_answer_engine, index_terms
+from kb_mmap_index import MappedKnowledgeBase, MappedSource, compile_index
+from kb_passages import PassageIndex, rank_kb_sentences
+from kb_reranker import two_stage_search
+from kb_shards import ChainedKnowledgeBase, ShardedKnowledgeBase, get_sharded_knowledge_base
+from kb_store import KnowledgeBaseStore
+from test_kb_answer_engine import load_knowledge_base
+
+QUERIES = ["what are the warning signs of mental illness", "how do I find a therapist", "anxeity and panic attacks",
+           "can I recover from depression", "support for a family member"]
+
+def rounded(hits):
+    return [(hit['question'], hit['doc_id'], round(hit['score'], 4)) for hit in hits]
+
+def test_mapped_engine_matches_in_memory_engine():
+    knowledge_base = load_knowledge_base()
+    with tempfile.TemporaryDirectory() as directory:
+        compile_index(knowledge_base, os.path.join(directory, "v1"))
+        mapped = MappedKnowledgeBase(os.path.join(directory, "v1"))
+        assert len(mapped) == len(knowledge_base) and dict(mapped.items()) == knowledge_base
+        assert "not a question" not in mapped
+        engine, mapped_engine = KBAnswerEngine(knowledge_base), get_answer_engine(mapped)
+        assert mapped_engine is mapped.answer_engine
+        for query in QUERIES:
+            assert rounded(mapped_engine.search(query)) == rounded(engine.search(query))
+            assert round(mapped_engine.search(query)[0]['confidence'], 4) == round(engine.search(query)[0]['confidence'], 4)
+        assert mapped_engine.doc_id(engine.questions[5]) == 5 and mapped_engine.doc_id("missing") is None
+        assert mapped_engine.question_terms[5] == engine.question_terms[5]
+
+        passages, terms = PassageIndex(knowledge_base), index_terms("therapy and medication options")
+        expected, scores = passages.score(terms), mapped_engine.passages.score(terms)
+        assert {key: round(value, 4) for key, value in scores.items()} == \
+            {key: round(value, 4) for key, value in expected.items()}
+        assert mapped_engine.passages.select(5, scores, 2) == passages.select(5, expected, 2)
+
+        # The retrieval stack runs unchanged on the mapped view (with a budget no cold run can hit);
+        # the mapped engine always has its embeddings, so the dict's engine must have finished building them
+        assert get_answer_engine(knowledge_base).vectors.wait(30)
+        budget = kb_reranker.KB_RERANK_BUDGET_MS
+        kb_reranker.KB_RERANK_BUDGET_MS = 10_000
+        try:
+            for query in QUERIES:
+                assert rank_kb_sentences(mapped, query) == rank_kb_sentences(knowledge_base, query)
+                assert two_stage_search(mapped, query)['passages'] == two_stage_search(knowledge_base, query)['passages']
+        finally:
+            kb_reranker.KB_RERANK_BUDGET_MS = budget
+        question = engine.questions[0]
+        assert fast_path_answer(mapped, question)['question'] == fast_path_answer(knowledge_base, question)['question']
+
+def test_source_recompiles_after_store_changes():
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "kb.csv")
+        shutil.copy("AI_Mental_Health.csv", path)
+        source = MappedSource(path)
+        first = source.current()
+        assert len(first) == 97 and source.current() is first
+
+        KnowledgeBaseStore(path).add(500, "How do I cope with exam stress?", "Plan revision in short blocks.")
+        source._checked = 0.0
+        # The recompile runs in the background while the previous version is served
+        assert source.current() is first
+        assert source.wait(60)
+        second = source.current()
+        assert second is not first and len(second) == 98
+        assert second.answer_engine.search("exam stress revision")[0]['question'] == "how do i cope with exam stress?"
+        # A second worker maps the compiled version instead of compiling again
+        assert len(MappedSource(path).current()) == 98
+
+        store = KnowledgeBaseStore(path)
+        for question_id in list(store.records())[:3]:
+            store.delete(question_id)
+            source._checked = 0.0
+            source.current()
+            assert source.wait(60)
+        versions = [name for name in os.listdir(source.directory) if not name.startswith(".")]
+        assert len(versions) == kb_mmap_index.INDEX_VERSIONS_KEPT and len(source.current()) == 95
+
+def test_mapped_shards():
+    with tempfile.TemporaryDirectory() as directory:
+        general, students = os.path.join(directory, "general.csv"), os.path.join(directory, "students.csv")
+        shutil.copy("AI_Mental_Health.csv", general)
+        pd.DataFrame([(1, "How do I cope with exam stress?", "Plan revision in short blocks and take breaks."),
+                      (2, "What are some of the warning signs of mental illness?", "Students: talk to student services.")],
+                     columns=["Question_ID", "Questions", "Answers"]).to_csv(students, index=False)
+        sharded = ShardedKnowledgeBase()
+        sharded.add_shard("general", general, mode="mapped")
+        sharded.add_shard("students", students, mode="mapped")
+        assert sharded._shards["general"].store is None and sharded.shards()[1]['entries'] == 2
+
+        knowledge_base = sharded.current()
+        assert isinstance(knowledge_base, ChainedKnowledgeBase) and sharded.current() is knowledge_base
+        # Earlier shards win, as in the merged dict
+        question = "what are some of the warning signs of mental illness?"
+        assert knowledge_base[question] == load_knowledge_base()[question]
+        assert len(list(knowledge_base)) == 98 and len(set(knowledge_base)) == 98 and knowledge_base
+
+        engine = get_answer_engine(knowledge_base)
+        assert engine.search("exam stress revision")[0]['doc_id'] == ("students", 0)
+        assert engine.passages is not None and engine.vectors is not None
+        assert engine.passages.doc_ids["how do i cope with exam stress?"] == ("students", 0)
+        assert rank_kb_sentences(knowledge_base, "exam stress")[0][0] == "how do i cope with exam stress?"
+        assert two_stage_search(knowledge_base, "exam stress revision")['passages'][0][0] == "how do i cope with exam stress?"
+
+# RSS growth allowed per worker for the general shard of the test below: mapped, it stays in the
+# low tens of MB; built in memory (KB_GENERAL_SHARD_MODE=thread) the same shard takes about 100MB
+MAPPED_WORKER_RSS_GROWTH_MB = 40
+
+def write_topics(path, rows):
+    pd.DataFrame({
+        "Question_ID": range(rows),
+        "Questions": [f"How do I cope with stress about topic {i % 997} number {i}?" for i in range(rows)],
+        "Answers": [f"Talk to someone you trust about topic {i % 313}. Small steps help with stress." for i in range(rows)],
+    }).to_csv(path, index=False)
+
+def resident_kb():
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+
+def app_worker_rss_growth(path, sources_path, results):
+    """Spawned app worker: RSS growth (KB) from loading the general shard and answering a few queries"""
+    before = resident_kb()
+    sharded = get_sharded_knowledge_base([path], sources_path)
+    knowledge_base = sharded.current()
+    for query in ("coping with stress about topic 7", "talk to someone", "streess and anxeity"):
+        knowledge_base.answer_engine.search(query)
+        rank_kb_sentences(knowledge_base, query)
+    results.put((sharded.shards()[0]['mode'], resident_kb() - before))
+
+def test_app_workers_share_the_general_shard():
+    """Two app workers on the same compiled index each stay within a fixed RSS growth"""
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "kb.csv")
+        write_topics(path, 10_000)
+        MappedSource(path).current()
+        context = multiprocessing.get_context("spawn")
+        results = context.Queue()
+        workers = [context.Process(target=app_worker_rss_growth,
+                                   args=(path, os.path.join(directory, "kb_sources.json"), results))
+                   for _ in range(2)]
+        for worker in workers:
+            worker.start()
+        growth = [results.get(timeout=120) for _ in workers]
+        for worker in workers:
+            worker.join(30)
+        assert [mode for mode, _ in growth] == ["mapped", "mapped"]
+        assert all(kilobytes < MAPPED_WORKER_RSS_GROWTH_MB * 1024 for _, kilobytes in growth), growth
+
+WORKER = """
+import sys
+sys.path.insert(0, {root!r})
+from kb_answer_engine import get_answer_engine
+from kb_passages import rank_kb_sentences
+mode, path = sys.argv[1], sys.argv[2]
+if mode == "mapped":
+    from kb_mmap_index import get_mapped_knowledge_base
+    knowledge_base = get_mapped_knowledge_base(path)
+else:
+    from kb_store import KnowledgeBaseStore
+    knowledge_base = KnowledgeBaseStore(path).current()
+for query in ("coping with stress about topic 7", "talk to someone"):
+    get_answer_engine(knowledge_base).search(query)
+    rank_kb_sentences(knowledge_base, query)
+private = 0
+with open("/proc/self/smaps_rollup") as smaps:
+    for line in smaps:
+        if line.startswith(("Private_Clean:", "Private_Dirty:")):
+            private += int(line.split()[1])
+print(private)
+"""
+
+if __name__ == "__main__":
+    test_mapped_engine_matches_in_memory_engine()
+    test_source_recompiles_after_store_changes()
+    test_mapped_shards()
+    test_app_workers_share_the_general_shard()
+
+    with tempfile.TemporaryDirectory() as directory:
+        rows = 100_000
+        path = os.path.join(directory, "kb.csv")
+        write_topics(path, rows)
+        start = time.perf_counter()
+        MappedSource(path).current()
+        print(f"Compiled {rows:,} Q&A pairs in {time.perf_counter() - start:.1f}s")
+        script = WORKER.format(root=os.path.dirname(os.path.abspath(__file__)))
+        workers = 4
+        for mode in ("in-memory", "mapped"):
+            private = [int(subprocess.run([sys.executable, "-c", script, mode, path], capture_output=True,
+                                          text=True, check=True).stdout.split()[-1]) for _ in range(workers)]
+            print(f"{mode}: {sum(private) / len(private) / 1024:.0f}MB private memory per worker, "
+                  f"{sum(private) / 1024:.0f}MB for {workers} workers")
+    print("🎉 Mapped knowledge base index tests passed")
@@ -0,0 +1,97 @@
+"""
+Test sentence-level knowledge base passages and report prompt token savings
+"""
+
+import metrics
+from kb_answer_engine import index_terms
+from kb_passages import PassageIndex, get_passage_stats, rank_kb_sentences, sentence_spans
+from kb_reranker import rank_kb_context
+from model_router import choose_route
+from prompt_builder import build_messages
+from test_kb_answer_engine import load_knowledge_base
+
+ANSWER = ("Sleep problems are common. Try to keep a regular bedtime and avoid screens late at night.\n"
+          "Tips:\n"
+          "Limit caffeine after lunch. If worry keeps you awake, write it down before bed.")
+
+KNOWLEDGE_BASE = {
+    "how can i sleep better?": ANSWER,
+    "what is anxiety?": "Anxiety is a feeling of worry, nervousness, or unease. It is a normal reaction to stress.",
+}
+
+def test_sentence_spans_have_offsets():
+    spans = sentence_spans(ANSWER)
+    sentences = [ANSWER[start:end] for start, end in spans]
+    assert sentences == [
+        "Sleep problems are common.",
+        "Try to keep a regular bedtime and avoid screens late at night.",
+        "Tips:\nLimit caffeine after lunch.",
+        "If worry keeps you awake, write it down before bed.",
+    ]
+    assert sentence_spans("") == []
+    assert sentence_spans("One line without a full stop") == [(0, 28)]
+
+def test_passages_index_each_sentence():
+    index = PassageIndex(KNOWLEDGE_BASE)
+    assert len(index) == 6
+    assert [index.passages[i][0] for i in index.doc_passages[1]] == [1, 1]
+    doc_id, start, end = index.passages[index.doc_passages[0][1]]
+    assert KNOWLEDGE_BASE["how can i sleep better?"][start:end] == index.text(index.doc_passages[0][1])
+
+def test_selects_relevant_sentences_in_answer_order():
+    passages = rank_kb_sentences(KNOWLEDGE_BASE, "caffeine and worry keep me awake", limit=1)
+    assert passages == [("how can i sleep better?",
+                         "Tips:\nLimit caffeine after lunch. If worry keeps you awake, write it down before bed.")]
+    # No sentence shares a word with the message: the opening sentence stands in for the answer
+    index = PassageIndex(KNOWLEDGE_BASE)
+    assert index.select(1, index.score(["zebra"])) == "Anxiety is a feeling of worry, nervousness, or unease."
+
+def test_updates_match_a_fresh_index():
+    index = PassageIndex(KNOWLEDGE_BASE)
+    index.upsert(1, "what is anxiety?", "Anxiety is worry about what might happen. Caffeine can make it worse.")
+    index.upsert(2, "how do i calm down?", "Breathe slowly and count to four. Caffeine makes calm harder.")
+    index.remove(0)
+    changed = dict(KNOWLEDGE_BASE, **{"what is anxiety?": index.answers[1], "how do i calm down?": index.answers[2]})
+    fresh = PassageIndex(changed)
+    scores, fresh_scores = index.score(index_terms("caffeine")), fresh.score(index_terms("caffeine"))
+    for doc_id in (1, 2):
+        assert index.select(doc_id, scores) == fresh.select(doc_id, fresh_scores)
+    assert len(scores) == 2 and index.select(0, scores) == ""
+    assert index.doc_ids["how do i calm down?"] == 2
+
+def test_token_savings_are_reported():
+    metrics.reset()
+    knowledge_base = load_knowledge_base()
+    for question in list(knowledge_base)[:20]:
+        passages = rank_kb_sentences(knowledge_base, question)
+        assert passages and passages[0][0] == rank_kb_context(knowledge_base, question, limit=1)[0][0]
+    stats = get_passage_stats()
+    assert stats['requests'] == 20
+    assert stats['mean_sent_tokens'] < stats['mean_full_tokens']
+    assert 0 < stats['saved_fraction'] < 1
+
+if __name__ == "__main__":
+    test_sentence_spans_have_offsets()
+    test_passages_index_each_sentence()
+    test_selects_relevant_sentences_in_answer_order()
+    test_updates_match_a_fresh_index()
+    test_token_savings_are_reported()
+
+    knowledge_base = load_knowledge_base()
+    queries = ["how can I manage my grief and anxiety", "where can I find support for my teenager",
+               "is it normal to feel sad after a loss", "what are the side effects of antidepressants",
+               "how do I help a friend who is struggling"]
+    metrics.reset()
+    whole_tokens = sentence_tokens = 0
+    for query in queries:
+        route = choose_route(2, message_length=len(query))
+        whole_tokens += build_messages("You are a supportive assistant.", query,
+                                       rank_kb_context(knowledge_base, query), dict(route))[2]
+        sentence_tokens += build_messages("You are a supportive assistant.", query,
+                                          rank_kb_sentences(knowledge_base, query), dict(route))[2]
+    stats = get_passage_stats()
+    print(f"Retrieved context: {stats['mean_full_tokens']:.0f} tokens as whole answers, "
+          f"{stats['mean_sent_tokens']:.0f} as sentences ({stats['saved_fraction']:.0%} saved per request)")
+    print(f"Packed prompts: {whole_tokens / len(queries):.0f} tokens with whole answers, "
+          f"{sentence_tokens / len(queries):.0f} with sentences")
+    print("🎉 Sentence passage tests passed")
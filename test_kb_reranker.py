@@ -0,0 +1,139 @@
+"""
+Test two-stage knowledge base retrieval with a time-budgeted reranker
+"""
+
+import threading
+import time
+import kb_dense_retriever
+import metrics
+from kb_answer_engine import KBAnswerEngine, get_answer_engine
+from kb_reranker import (Reranker, get_two_stage_stats, phrase_overlap, proximity, rank_kb_context,
+                         two_stage_search)
+from kb_store import LiveKnowledgeBase
+from prompt_builder import rank_kb_passages
+from test_kb_answer_engine import load_knowledge_base
+
+KNOWLEDGE_BASE = {
+    "what helps with stress at work?": "Breaks, boundaries and talking to your manager can help with work stress.",
+    "how do i talk to my manager about stress?": "Plan what to say, be specific and suggest changes.",
+    "can exercise help with stress?": "Yes, regular exercise lowers stress hormones.",
+}
+
+class SlowReranker:
+    """Takes 5ms per candidate and prefers the last first-stage candidate"""
+
+    def __init__(self, knowledge_base, input_text):
+        pass
+
+    def score(self, candidate, top_score):
+        time.sleep(0.005)
+        return -candidate['score']
+
+def test_phrase_overlap_and_proximity():
+    assert phrase_overlap(["stress", "work"], ["stress", "work", "help"]) == 1.0
+    assert phrase_overlap(["stress", "work"], ["work", "stress"]) == 0.0
+    assert phrase_overlap(["stress"], ["stress"]) == 0.0
+    assert proximity(["stress", "work"], ["stress", "at", "work"]) == 2 / 3
+    assert proximity(["stress", "work"], ["work", "stress"]) == 1.0
+    assert proximity(["stress"], ["stress"]) == 1.0
+    assert proximity(["calm"], ["stress"]) == 0.0
+
+def test_reranker_prefers_phrase_matches():
+    result = two_stage_search(KNOWLEDGE_BASE, "stress at work", budget_ms=1000)
+    assert result['reranked']
+    assert result['passages'][0][0] == "what helps with stress at work?"
+    assert set(result['timings']) == {'candidates_ms', 'rerank_ms'}
+    assert all(value >= 0 for value in result['timings'].values())
+    assert rank_kb_context(KNOWLEDGE_BASE, "stress at work", limit=1) == result['passages'][:1]
+
+def test_deadline_falls_back_to_first_stage_order():
+    metrics.reset()
+    first_stage = [(c['question'], c['answer']) for c in get_answer_engine(KNOWLEDGE_BASE).search("stress", limit=20)]
+    slow = two_stage_search(KNOWLEDGE_BASE, "stress", budget_ms=2, reranker=SlowReranker)
+    assert not slow['reranked']
+    assert slow['passages'] == first_stage
+    # The slow reranker is abandoned early, so the request stays near the budget
+    assert slow['timings']['rerank_ms'] < 50
+
+    fast = two_stage_search(KNOWLEDGE_BASE, "stress", budget_ms=1000, reranker=SlowReranker)
+    assert fast['reranked']
+    assert fast['passages'] == first_stage[::-1]
+
+    stats = get_two_stage_stats()
+    assert stats['requests'] == 2 and stats['deadline_hits'] == 1
+    assert stats['rerank_max_ms'] >= stats['rerank_mean_ms'] > 0
+
+def test_empty_inputs():
+    assert two_stage_search({}, "stress")['passages'] == []
+    assert rank_kb_context(KNOWLEDGE_BASE, "the and of") == []
+    assert two_stage_search(KNOWLEDGE_BASE, "exercise")['reranked'] is False
+
+def test_embeddings_are_built_off_the_request_path():
+    built = threading.Event()
+    load = kb_dense_retriever.load_or_build_embeddings
+
+    def slow_load(*args):
+        built.wait(5)
+        return load(*args)
+
+    kb_dense_retriever.load_or_build_embeddings = slow_load
+    try:
+        engine = KBAnswerEngine(KNOWLEDGE_BASE, embeddings=True)
+        knowledge_base = LiveKnowledgeBase(KNOWLEDGE_BASE)
+        knowledge_base.answer_engine = engine
+        candidate = engine.search("stress at work")[0]
+        metrics.reset()
+        # Until the embeddings are built the reranker leaves the embedding term out instead of waiting
+        assert Reranker(knowledge_base, "stress at work")._similarity(candidate) == 0.0
+        assert metrics.snapshot()['counters']['kb_rerank_without_embeddings'] == 1
+        built.set()
+        assert engine.vectors.wait(5)
+    finally:
+        built.set()
+        kb_dense_retriever.load_or_build_embeddings = load
+
+    fingerprint = kb_dense_retriever.kb_fingerprint
+    kb_dense_retriever.kb_fingerprint = None
+    try:
+        assert Reranker(knowledge_base, "stress at work")._similarity(candidate) > 0
+        # A new entry is embedded on its own, without touching the rest
+        engine.upsert("is stress at work common?", "Very common.")
+        added = engine.search("is stress at work common?")[0]
+        assert Reranker(knowledge_base, "is stress at work common")._similarity(added) > 0.5
+        assert len(engine.vectors._base) == len(KNOWLEDGE_BASE)
+    finally:
+        kb_dense_retriever.kb_fingerprint = fingerprint
+
+def test_knowledge_base_questions_stay_on_top():
+    knowledge_base = load_knowledge_base()
+    questions = list(knowledge_base)
+    hits = sum(1 for question in questions
+               if rank_kb_context(knowledge_base, question, limit=1)[0][0] == question)
+    print(f"Two-stage top-1 self-retrieval: {hits}/{len(questions)}")
+    assert hits >= 0.9 * len(questions)
+
+if __name__ == "__main__":
+    test_phrase_overlap_and_proximity()
+    test_reranker_prefers_phrase_matches()
+    test_deadline_falls_back_to_first_stage_order()
+    test_empty_inputs()
+    test_embeddings_are_built_off_the_request_path()
+    test_knowledge_base_questions_stay_on_top()
+
+    knowledge_base = load_knowledge_base()
+    queries = ["how can I manage my grief and anxiety", "what is the difference between anxiety and stress",
+               "where can I find support for my teenager", "is it normal to feel sad after a loss"] * 50
+    get_answer_engine(knowledge_base).vectors.wait()
+    metrics.reset()
+    start = time.perf_counter()
+    for query in queries:
+        rank_kb_passages(knowledge_base, query)
+    keyword_ms = (time.perf_counter() - start) / len(queries) * 1000
+    for query in queries:
+        rank_kb_context(knowledge_base, query)
+    stats = get_two_stage_stats()
+    print(f"Keyword overlap ranking: {keyword_ms:.3f}ms per message")
+    print(f"Two-stage: candidates {stats['candidates_mean_ms']:.3f}ms (max {stats['candidates_max_ms']:.3f}), "
+          f"rerank {stats['rerank_mean_ms']:.3f}ms (max {stats['rerank_max_ms']:.3f}), "
+          f"{stats['deadline_hits']}/{stats['requests']} deadline hits")
+    print("🎉 Two-stage retrieval tests passed")
@@ -0,0 +1,174 @@
+"""
+Test the sharded knowledge base: per-source shards, parallel fan-out, merging and runtime changes
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import time
+import pandas as pd
+from kb_answer_engine import fast_path_answer, get_answer_engine, index_terms
+from kb_passages import rank_kb_sentences
+from kb_reranker import two_stage_search
+from kb_shards import ShardedKnowledgeBase, get_sharded_knowledge_base
+
+STUDENT_ROWS = [
+    (1, "How do I cope with exam stress?", "Plan revision in short blocks and take regular breaks."),
+    (2, "How can I stop procrastinating on coursework?", "Break assignments into small tasks with deadlines."),
+    (3, "I feel homesick at university, is that normal?", "Homesickness is common in the first term and usually eases."),
+]
+WORKPLACE_ROWS = [
+    (1, "How do I handle burnout at work?", "Talk to your manager about workload and protect time to recover."),
+    (2, "How can I set boundaries with my boss?", "Be clear about your working hours and what you can take on."),
+]
+
+def write_sources(directory):
+    general = os.path.join(directory, "general.csv")
+    shutil.copy("AI_Mental_Health.csv", general)
+    paths = {'general': general}
+    for name, rows in (("students", STUDENT_ROWS), ("workplace", WORKPLACE_ROWS)):
+        paths[name] = os.path.join(directory, f"{name}.csv")
+        pd.DataFrame(rows, columns=["Question_ID", "Questions", "Answers"]).to_csv(paths[name], index=False)
+    return paths
+
+def test_fan_out_merges_shards():
+    with tempfile.TemporaryDirectory() as directory:
+        paths = write_sources(directory)
+        sharded = ShardedKnowledgeBase()
+        sharded.add_shard("general", paths['general'], domain="general mental health")
+        sharded.add_shard("students", paths['students'], domain="student wellbeing")
+        sharded.add_shard("workplace", paths['workplace'], domain="workplace stress")
+        assert [shard['name'] for shard in sharded.shards()] == ["general", "students", "workplace"]
+        assert sharded.shards()[1]['domain'] == "student wellbeing" and sharded.shards()[1]['mode'] == "thread"
+
+        knowledge_base = sharded.current()
+        assert len(knowledge_base) == 97 + len(STUDENT_ROWS) + len(WORKPLACE_ROWS)
+        assert sharded.current() is knowledge_base
+        engine = get_answer_engine(knowledge_base)
+        hits = engine.search("exam stress revision")
+        assert hits[0]['shard'] == "students" and hits[0]['doc_id'] == ("students", 0)
+        assert engine.question_terms[hits[0]['doc_id']] == index_terms("How do I cope with exam stress?")
+        assert {hit['shard'] for hit in engine.search("stress at work and burnout", limit=10)} >= {"workplace", "general"}
+
+        # The rest of the retrieval stack runs unchanged on the merged view
+        assert two_stage_search(knowledge_base, "burnout at work")['passages'][0][0] == "how do i handle burnout at work?"
+        assert rank_kb_sentences(knowledge_base, "homesick at university")[0][0] == \
+            "i feel homesick at university, is that normal?"
+        assert fast_path_answer(knowledge_base, "How can I set boundaries with my boss?")['shard'] == "workplace"
+        # Only the student shard knows the word, so it corrects the typo
+        assert "procrastinating" not in engine.fuzzy.indexes[0]
+        assert engine.fuzzy.correct_text("procrastinatng") == "procrastinating"
+
+def test_shards_change_at_runtime():
+    with tempfile.TemporaryDirectory() as directory:
+        paths = write_sources(directory)
+        sharded = ShardedKnowledgeBase()
+        sharded.add_shard("general", paths['general'])
+        before = sharded.current()
+        assert not any(hit['shard'] == "students" for hit in sharded.search("exam stress", limit=10))
+
+        sharded.add_shard("students", paths['students'])
+        assert sharded.current() is not before
+        assert sharded.search("exam stress")[0]['shard'] == "students"
+        for change, error in ((lambda: sharded.add_shard("students", paths['students']), ValueError),
+                              (lambda: sharded.remove_shard("missing"), KeyError),
+                              (lambda: sharded.add_shard("missing", os.path.join(directory, "x.csv")), FileNotFoundError)):
+            try:
+                change()
+                assert False, "change should be rejected"
+            except error:
+                pass
+
+        # Updates to a shard's store show up in the merged view
+        sharded._shards["students"].store.add(9, "How do I deal with group project conflict?", "Agree roles early.")
+        assert sharded.search("group project conflict")[0]['question'] == "how do i deal with group project conflict?"
+
+        sharded.remove_shard("students")
+        assert "how do i cope with exam stress?" not in sharded.current()
+        assert [shard['name'] for shard in sharded.shards()] == ["general"]
+
+def test_sources_file():
+    with tempfile.TemporaryDirectory() as directory:
+        paths = write_sources(directory)
+        sources = os.path.join(directory, "kb_sources.json")
+        sharded = ShardedKnowledgeBase()
+        sharded.add_shard("general", paths['general'])
+        with open(sources, "w") as output:
+            json.dump([{"name": "students", "path": paths['students'], "domain": "student wellbeing"},
+                       {"name": "missing", "path": os.path.join(directory, "missing.csv")}], output)
+        sharded.sync_sources(sources)
+        assert [shard['name'] for shard in sharded.shards()] == ["general", "students"]
+
+        time.sleep(0.01)
+        with open(sources, "w") as output:
+            json.dump([{"name": "workplace", "path": paths['workplace']}], output)
+        sharded.sync_sources(sources)
+        assert [shard['name'] for shard in sharded.shards()] == ["general", "workplace"]
+
+        time.sleep(0.01)
+        with open(sources, "w") as output:
+            output.write("not json")
+        sharded.sync_sources(sources)
+        assert [shard['name'] for shard in sharded.shards()] == ["general", "workplace"]
+        os.remove(sources)
+        sharded.sync_sources(sources)
+        assert [shard['name'] for shard in sharded.shards()] == ["general"]
+
+        # The app entry point: the first existing default path becomes the general shard
+        assert get_sharded_knowledge_base(["missing.csv", "AI_Mental_Health.csv"], sources).shards()[0]['name'] == "general"
+
+def test_process_shards_match_thread_shards():
+    with tempfile.TemporaryDirectory() as directory:
+        paths = write_sources(directory)
+        threaded, processes = ShardedKnowledgeBase(), ShardedKnowledgeBase(timeout=60)
+        for name in ("general", "students"):
+            threaded.add_shard(name, paths[name], mode="thread")
+            processes.add_shard(name, paths[name], mode="process")
+        try:
+            for query in ("exam stress", "what are the warning signs of mental illness", "therapy options"):
+                expected = [(hit['question'], hit['doc_id']) for hit in threaded.search(query)]
+                assert [(hit['question'], hit['doc_id']) for hit in processes.search(query)] == expected
+        finally:
+            for name in ("general", "students"):
+                processes.remove_shard(name)
+
+if __name__ == "__main__":
+    test_fan_out_merges_shards()
+    test_shards_change_at_runtime()
+    test_sources_file()
+    test_process_shards_match_thread_shards()
+
+    with tempfile.TemporaryDirectory() as directory:
+        rows = 60_000
+        shard_count = 4
+        paths = []
+        for shard in range(shard_count):
+            path = os.path.join(directory, f"shard{shard}.csv")
+            pd.DataFrame({
+                "Question_ID": range(rows),
+                "Questions": [f"How do I cope with stress about topic {shard} {i % 997} number {i}?" for i in range(rows)],
+                "Answers": [f"Talk to someone you trust about topic {i % 313}. Small steps help with stress." for i in range(rows)],
+            }).to_csv(path, index=False)
+            paths.append(path)
+        queries = [f"coping with stress about topic {i}" for i in range(20)]
+        for mode in ("thread", "process"):
+            sharded = ShardedKnowledgeBase(timeout=120)
+            for shard, path in enumerate(paths):
+                sharded.add_shard(f"shard{shard}", path, mode=mode)
+            sharded.search(queries[0])
+            engines = list(sharded.current().answer_engine.engines.values())
+            start = time.perf_counter()
+            for query in queries:
+                for engine in engines:
+                    engine.search(query)
+            sequential = (time.perf_counter() - start) / len(queries)
+            start = time.perf_counter()
+            for query in queries:
+                sharded.search(query)
+            fanned_out = (time.perf_counter() - start) / len(queries)
+            print(f"{shard_count} shards x {rows:,} Q&A pairs ({mode} mode, {os.cpu_count()} CPUs): one after another {sequential * 1000:.0f}ms, "
+                  f"fanned out {fanned_out * 1000:.0f}ms per query")
+            for shard in range(shard_count):
+                sharded.remove_shard(f"shard{shard}")
+    print("🎉 Sharded knowledge base tests passed")
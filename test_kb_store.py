@@ -0,0 +1,212 @@
+"""
+Test incremental knowledge base updates through the delta log and compare their cost with a full rebuild
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import pandas as pd
+from kb_answer_engine import KBAnswerEngine, fast_path_answer, get_answer_engine
+from kb_passages import rank_kb_sentences
+from kb_store import KnowledgeBaseStore, delta_log_path
+from test_kb_answer_engine import load_knowledge_base
+
+def copy_dataset(directory):
+    path = os.path.join(directory, "kb.csv")
+    shutil.copy("AI_Mental_Health.csv", path)
+    return path
+
+def test_loads_like_the_apps():
+    with tempfile.TemporaryDirectory() as directory:
+        store = KnowledgeBaseStore(copy_dataset(directory))
+        assert list(store.current().items()) == list(load_knowledge_base().items())
+        assert store.get("1590140")[0] == "What does it mean to have a mental illness?"
+        assert not os.path.exists(delta_log_path(store.base_path))
+
+def test_updates_reach_other_stores_in_place():
+    with tempfile.TemporaryDirectory() as directory:
+        path = copy_dataset(directory)
+        writer, reader = KnowledgeBaseStore(path), KnowledgeBaseStore(path)
+        before = reader.current()
+        engine = reader.engine
+
+        writer.add(1, "How do I cope with exam stress?", "Plan your revision and take regular breaks.")
+        knowledge_base = reader.current()
+        assert knowledge_base["how do i cope with exam stress?"] == "Plan your revision and take regular breaks."
+        assert "how do i cope with exam stress?" not in before
+        # The same engine object, updated in place rather than rebuilt
+        assert reader.engine is engine and get_answer_engine(knowledge_base) is engine
+        assert fast_path_answer(knowledge_base, "How do I cope with exam stress?")['question'] == \
+            "how do i cope with exam stress?"
+
+        writer.update(1, answer="Breaks help.")
+        assert reader.current()["how do i cope with exam stress?"] == "Breaks help."
+        writer.update(1, question="How do I handle exam stress?")
+        knowledge_base = reader.current()
+        assert "how do i cope with exam stress?" not in knowledge_base
+        assert knowledge_base["how do i handle exam stress?"] == "Breaks help."
+        assert engine.search("cope with exam stress")[0]['question'] == "how do i handle exam stress?"
+
+        writer.delete("1590140")
+        knowledge_base = reader.current()
+        assert "what does it mean to have a mental illness?" not in knowledge_base
+        assert all(hit['question'] != "what does it mean to have a mental illness?"
+                   for hit in engine.search("what does it mean to have a mental illness"))
+        assert len(engine) == len(knowledge_base) == 97
+        assert reader.pending_deltas == 4
+
+def test_passages_and_embeddings_follow_each_delta():
+    with tempfile.TemporaryDirectory() as directory:
+        path = copy_dataset(directory)
+        writer, reader = KnowledgeBaseStore(path), KnowledgeBaseStore(path)
+        engine = reader.engine
+        passages, vectors = engine.passages, engine.vectors
+        assert vectors.wait(30)
+        base = vectors._base
+
+        writer.add(1, "How do I cope with exam stress?", "Plan your revision. Take regular breaks.")
+        writer.update("1590140", answer="It means a condition that affects how you think and feel.")
+        knowledge_base = reader.current()
+        assert rank_kb_sentences(knowledge_base, "exam stress breaks", limit=1) == [
+            ("how do i cope with exam stress?", "Plan your revision. Take regular breaks.")]
+        question = "what does it mean to have a mental illness?"
+        assert dict(rank_kb_sentences(knowledge_base, question))[question] == knowledge_base[question]
+        # Only the changed entries were split and embedded; the indexes are the ones loaded with the base
+        assert engine.passages is passages and engine.vectors is vectors and vectors._base is base
+        assert sorted(vectors._changed) == [engine.doc_id(question), engine.doc_id("how do i cope with exam stress?")]
+
+        doc_id = engine.doc_id("how do i cope with exam stress?")
+        writer.delete(1)
+        reader.refresh()
+        assert engine.passages.select(doc_id, {}) == "" and doc_id not in vectors._changed
+
+def publish_seconds(store, repeats=200):
+    """Fastest of several publishes of the store's current state"""
+    fastest = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        store._publish()
+        fastest = min(fastest, time.perf_counter() - start)
+    return fastest
+
+def test_publishing_copies_only_the_changes():
+    with tempfile.TemporaryDirectory() as directory:
+        small = KnowledgeBaseStore(copy_dataset(directory))
+        path = os.path.join(directory, "large.csv")
+        rows = 20_000
+        pd.DataFrame({
+            "Question_ID": range(rows),
+            "Questions": [f"How do I cope with situation {i}?" for i in range(rows)],
+            "Answers": [f"Talk to someone you trust about situation {i}." for i in range(rows)],
+        }).to_csv(path, index=False)
+        large = KnowledgeBaseStore(path)
+
+        for store in (small, large):
+            before = store.current()
+            store.add("new", "How do I cope with exam stress?", "Take regular breaks.")
+            store.delete(next(iter(store.records())))
+            after = store.current()
+            # The new snapshot shares the base with the old one and carries only the two changes
+            assert after._base is before._base and len(after._overlay) == 2
+            assert len(after) == len(before) == len(dict(after))
+        # A copy of the entries would make the large store's publish ~200x slower
+        assert publish_seconds(large) < 20 * publish_seconds(small) + 1e-5
+
+def test_invalid_changes_are_rejected():
+    with tempfile.TemporaryDirectory() as directory:
+        store = KnowledgeBaseStore(copy_dataset(directory))
+        for change, error in ((lambda: store.add("1590140", "q", "a"), ValueError),
+                              (lambda: store.update("missing", answer="a"), KeyError),
+                              (lambda: store.delete("missing"), KeyError),
+                              (lambda: store.add(5, "   ", "a"), ValueError)):
+            try:
+                change()
+                assert False, "change should be rejected"
+            except error:
+                pass
+        assert store.pending_deltas == 0
+
+def test_partial_lines_wait_for_the_writer():
+    with tempfile.TemporaryDirectory() as directory:
+        path = copy_dataset(directory)
+        store = KnowledgeBaseStore(path)
+        with open(delta_log_path(path), "w", encoding="utf-8") as log:
+            log.write('{"op": "upsert", "id": "9", "question": "Half written?", "answer": "Yes')
+        assert store.refresh() == 0
+        with open(delta_log_path(path), "a", encoding="utf-8") as log:
+            log.write('."}\n')
+        assert store.refresh() == 1 and store.current()["half written?"] == "Yes."
+
+def test_compaction_folds_deltas_into_the_base():
+    with tempfile.TemporaryDirectory() as directory:
+        path = copy_dataset(directory)
+        writer, reader = KnowledgeBaseStore(path), KnowledgeBaseStore(path)
+        writer.add(1, "What is burnout?", "Exhaustion from prolonged stress.")
+        writer.delete("1590140")
+        expected = dict(writer.current())
+        assert writer.compact() and not writer.compact()
+        assert not os.path.exists(delta_log_path(path))
+        assert writer.pending_deltas == 0
+        assert dict(reader.current()) == expected and reader.pending_deltas == 0
+        assert dict(KnowledgeBaseStore(path).current()) == expected
+        assert len(pd.read_csv(path)) == 97
+
+        writer.add(2, "What is resilience?", "The ability to adapt to stress.")
+        assert reader.current()["what is resilience?"] == "The ability to adapt to stress."
+
+def test_updates_from_another_process():
+    with tempfile.TemporaryDirectory() as directory:
+        path = copy_dataset(directory)
+        store = KnowledgeBaseStore(path)
+        subprocess.run([sys.executable, "-c",
+                        "import sys; from kb_store import KnowledgeBaseStore; "
+                        "KnowledgeBaseStore(sys.argv[1]).add(7, 'Can pets help loneliness?', 'Often, yes.')", path],
+                       check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+        assert store.current()["can pets help loneliness?"] == "Often, yes."
+
+if __name__ == "__main__":
+    test_loads_like_the_apps()
+    test_updates_reach_other_stores_in_place()
+    test_passages_and_embeddings_follow_each_delta()
+    test_publishing_copies_only_the_changes()
+    test_invalid_changes_are_rejected()
+    test_partial_lines_wait_for_the_writer()
+    test_compaction_folds_deltas_into_the_base()
+    test_updates_from_another_process()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "large.csv")
+        rows = 50_000
+        pd.DataFrame({
+            "Question_ID": range(rows),
+            "Questions": [f"How do I cope with situation {i} at work or home?" for i in range(rows)],
+            "Answers": [f"Talk to someone you trust about situation {i}. Small steps help." for i in range(rows)],
+        }).to_csv(path, index=False)
+        writer, reader = KnowledgeBaseStore(path), KnowledgeBaseStore(path)
+
+        start = time.perf_counter()
+        KBAnswerEngine(reader.current())
+        rebuild = time.perf_counter() - start
+
+        updates = 200
+        start = time.perf_counter()
+        for i in range(updates):
+            writer.update(i, answer=f"Updated answer {i}: breathe slowly and reach out.")
+            reader.refresh()
+        per_update = (time.perf_counter() - start) / updates
+        print(f"{rows:,} Q&A pairs: full engine rebuild {rebuild * 1000:.0f}ms, "
+              f"logged update + refresh in another store {per_update * 1000:.2f}ms")
+
+        reader.engine.vectors.wait()
+        writer.add("new", "How do I cope with a new situation at work?", "Ask for help early.")
+        start = time.perf_counter()
+        rank_kb_sentences(reader.current(), "new situation at work")
+        print(f"First message after an update: {(time.perf_counter() - start) * 1000:.1f}ms")
+
+        start = time.perf_counter()
+        writer.compact()
+        print(f"Compacting {updates} deltas: {(time.perf_counter() - start) * 1000:.0f}ms")
+    print("🎉 Knowledge base store tests passed")
@@ -0,0 +1,78 @@
+"""
+Test batched TF-IDF retrieval over the knowledge base
+"""
+
+import time
+import numpy as np
+from kb_tfidf import TfidfRetriever, get_tfidf_retriever
+from prompt_builder import rank_kb_passages
+from test_kb_answer_engine import load_knowledge_base
+
+KNOWLEDGE_BASE = {
+    "what is anxiety?": "Anxiety is a feeling of worry, nervousness, or unease.",
+    "how can i manage anxiety at work?": "Take short breaks, breathe slowly and talk to someone you trust.",
+    "what is depression?": "Depression is a mood disorder that causes a persistent feeling of sadness.",
+    "how much sleep do i need?": "Most adults need seven to nine hours of sleep each night.",
+}
+
+def test_search_ranks_by_tfidf():
+    retriever = TfidfRetriever(KNOWLEDGE_BASE)
+    results = retriever.search("managing anxiety at work", k=2)
+    assert results[0][0] == "how can i manage anxiety at work?"
+    assert results[0][2] > results[1][2] > 0
+    assert retriever.search("sleep", k=3)[0][0] == "how much sleep do i need?"
+    assert retriever.search("zebra") == []
+
+def test_batch_matches_single_queries():
+    """search_batch and one-at-a-time search return the same results"""
+    retriever = get_tfidf_retriever(load_knowledge_base())
+    queries = list(retriever.questions[:20]) + ["I feel anxious", "", "how do I sleep better"]
+    batch = retriever.search_batch(queries, k=3)
+    assert len(batch) == len(queries)
+    for query, results in zip(queries, batch):
+        single = retriever.search(query, k=3)
+        assert [question for question, _, _ in results] == [question for question, _, _ in single]
+        assert np.allclose([score for _, _, score in results], [score for _, _, score in single], atol=1e-5)
+    assert batch[queries.index("")] == []
+
+def test_dataset_questions_find_themselves():
+    retriever = get_tfidf_retriever(load_knowledge_base())
+    results = retriever.search_batch(retriever.questions, k=1)
+    hits = sum(1 for question, top in zip(retriever.questions, results) if top and top[0][0] == question)
+    print(f"TF-IDF top-1 self-retrieval: {hits}/{len(retriever)}")
+    # A few dataset questions are near-duplicates of each other
+    assert hits >= 0.85 * len(retriever)
+
+def test_scores_are_cosine_similarities():
+    retriever = TfidfRetriever(KNOWLEDGE_BASE)
+    scores = retriever.score_batch(["anxiety", "sleep at night"])
+    assert scores.shape == (2, len(KNOWLEDGE_BASE))
+    assert (scores >= 0).all() and (scores <= 1 + 1e-6).all()
+
+if __name__ == "__main__":
+    test_search_ranks_by_tfidf()
+    test_batch_matches_single_queries()
+    test_dataset_questions_find_themselves()
+    test_scores_are_cosine_similarities()
+
+    knowledge_base = load_knowledge_base()
+    retriever = get_tfidf_retriever(knowledge_base)
+    queries = (list(knowledge_base) + ["I feel anxious at work", "trouble sleeping", "how to support a friend"]) * 20
+
+    start = time.perf_counter()
+    for query in queries:
+        rank_kb_passages(knowledge_base, query, limit=5)
+    loop_qps = len(queries) / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for query in queries:
+        retriever.search(query, k=5)
+    single_qps = len(queries) / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    retriever.search_batch(queries, k=5)
+    batch_qps = len(queries) / (time.perf_counter() - start)
+
+    print(f"{len(queries)} queries over {len(retriever)} Q&A pairs: loop {loop_qps:,.0f} q/s, "
+          f"single {single_qps:,.0f} q/s, batch {batch_qps:,.0f} q/s ({batch_qps / loop_qps:.1f}x loop)")
+    print("🎉 TF-IDF retrieval tests passed")
@@ -0,0 +1,95 @@
+"""
+Test request coalescing in the shared LLM client
+"""
+
+import threading
+import time
+import llm_client
+import metrics
+
+MESSAGES = [
+    {"role": "system", "content": "You are WellBot."},
+    {"role": "user", "content": "How can I manage my anxiety?"}
+]
+
+def run_concurrently(count, target):
+    results = [None] * count
+    errors = [None] * count
+
+    def worker(i):
+        try:
+            results[i] = target()
+        except BaseException as e:
+            errors[i] = e
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    return results, errors
+
+def test_identical_requests_share_one_call():
+    """Concurrent identical prompts are sent upstream once and all get the result"""
+    metrics.reset()
+    calls = []
+    original = llm_client._complete
+
+    def fake_complete(messages, model, max_tokens, temperature, timeout=None, session_id=None):
+        calls.append(model)
+        time.sleep(0.2)
+        return "Try slow breathing.", None
+
+    llm_client._complete = fake_complete
+    try:
+        results, errors = run_concurrently(8, lambda: llm_client.call_groq_api(MESSAGES))
+    finally:
+        llm_client._complete = original
+
+    stats = llm_client.get_coalescing_stats()
+    print(f"Coalescing stats: {stats}")
+    assert errors == [None] * 8
+    assert results == ["Try slow breathing."] * 8
+    assert len(calls) == 1
+    assert stats['coalesced_requests'] == 7
+    assert stats['in_flight'] == 0
+
+def test_whitespace_is_normalized_but_parameters_are_not():
+    """Keys ignore whitespace differences but not model or parameters"""
+    spaced = [{"role": m["role"], "content": "  " + m["content"].replace(" ", "   ")} for m in MESSAGES]
+    key = llm_client.request_key(MESSAGES, "m", 100, 0.7)
+    assert llm_client.request_key(spaced, "m", 100, 0.7) == key
+    assert llm_client.request_key(MESSAGES, "m", 200, 0.7) != key
+    assert llm_client.request_key(MESSAGES, "other", 100, 0.7) != key
+
+def test_leader_cancellation_does_not_fail_followers():
+    """If the caller doing the upstream call is interrupted, a waiting caller retries"""
+    metrics.reset()
+    calls = []
+    original = llm_client._complete
+
+    def fake_complete(messages, model, max_tokens, temperature, timeout=None, session_id=None):
+        calls.append(model)
+        time.sleep(0.2)
+        if len(calls) == 1:
+            raise KeyboardInterrupt("session stopped")
+        return "second attempt", None
+
+    llm_client._complete = fake_complete
+    try:
+        results, errors = run_concurrently(2, lambda: llm_client.call_groq_api(MESSAGES))
+    finally:
+        llm_client._complete = original
+
+    print(f"Results: {results}, errors: {errors}")
+    assert sorted(map(str, results)) == ["None", "second attempt"]
+    assert sum(isinstance(e, KeyboardInterrupt) for e in errors) == 1
+    assert metrics.get_counter("llm_coalesced_retries") == 1
+    assert llm_client.get_coalescing_stats()['in_flight'] == 0
+
+if __name__ == "__main__":
+    test_identical_requests_share_one_call()
+    test_whitespace_is_normalized_but_parameters_are_not()
+    test_leader_cancellation_does_not_fail_followers()
+    print("\n" + metrics.render_prometheus())
+    print("🎉 LLM client tests passed")
@@ -0,0 +1,136 @@
+"""
+Test the per-message stage graph and the background alert queue
+"""
+
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import metrics
+from message_pipeline import StageGraph, enqueue_alert, wait_for_alerts
+
+def slow(value, seconds):
+    time.sleep(seconds)
+    return value
+
+def test_independent_stages_run_in_parallel():
+    """Wall time approaches the slowest path, not the sum of stages"""
+    pipeline = StageGraph()
+    pipeline.add("analysis", slow, (0.1, 2, "LOW", "NEUTRAL"), 0.2)
+    pipeline.add("retrieval", slow, ["passage"], 0.2)
+    pipeline.add("generation", lambda analysis, passages: f"{analysis[3]}:{passages[0]}",
+                 deps=("analysis", "retrieval"))
+    pipeline.start()
+
+    assert pipeline.result("generation", timeout=2) == "NEUTRAL:passage"
+    report = pipeline.report()
+    summed = sum(report['stage_seconds'].values())
+    print(f"Wall {report['wall_seconds']:.3f}s vs summed stages {summed:.3f}s")
+    assert report['wall_seconds'] < 0.35
+    assert summed >= 0.4
+
+def test_first_result_is_available_before_the_rest():
+    """A fast stage can be rendered while a slow dependent stage is still running"""
+    pipeline = StageGraph()
+    pipeline.add("analysis", slow, "analysis", 0.01)
+    pipeline.add("generation", lambda analysis: slow(analysis + " reply", 0.3), deps=("analysis",))
+    pipeline.start()
+
+    assert pipeline.result("analysis", timeout=1) == "analysis"
+    assert pipeline.elapsed() < 0.2
+    assert list(pipeline.as_completed(timeout=2)) == ["analysis", "generation"]
+
+def test_dependency_errors_propagate():
+    """A failing stage fails the stages that depend on it"""
+    def fail():
+        raise ValueError("analysis failed")
+
+    pipeline = StageGraph()
+    pipeline.add("analysis", fail)
+    pipeline.add("generation", lambda analysis: "unreachable", deps=("analysis",))
+    pipeline.start()
+
+    for name in ("analysis", "generation"):
+        try:
+            pipeline.result(name, timeout=1)
+            assert False, f"{name} should have failed"
+        except ValueError as e:
+            assert "analysis failed" in str(e)
+
+def test_unknown_dependency_is_rejected():
+    pipeline = StageGraph()
+    try:
+        pipeline.add("generation", lambda analysis: None, deps=("analysis",))
+        assert False, "unknown dependency should be rejected"
+    except ValueError:
+        pass
+
+def test_alerts_do_not_block_the_caller():
+    """SMTP-style sends run on the alert queue, in order"""
+    metrics.reset()
+    sent = []
+    lock = threading.Lock()
+
+    def send(user, risk_score):
+        time.sleep(0.1)
+        with lock:
+            sent.append((user, risk_score))
+        return risk_score < 9
+
+    start = time.perf_counter()
+    enqueue_alert(send, "alice", 5)
+    enqueue_alert(send, "bob", 9)
+    enqueue_alert(lambda: 1 / 0)
+    enqueued = time.perf_counter() - start
+    print(f"Enqueued 3 alerts in {enqueued * 1000:.2f}ms")
+    assert enqueued < 0.05
+
+    assert wait_for_alerts(timeout=2)
+    assert sent == [("alice", 5), ("bob", 9)]
+    assert metrics.get_counter("alerts_sent") == 1
+    assert metrics.get_counter("alerts_failed") == 2
+
+def test_queued_alerts_are_sent_before_exit():
+    """A process that exits right after queueing an alert still sends it"""
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "sent.txt")
+        script = ("import time\n"
+                  "from message_pipeline import enqueue_alert\n"
+                  "def send(path):\n"
+                  "    time.sleep(0.3)\n"
+                  "    open(path, 'w').write('sent')\n"
+                  f"enqueue_alert(send, {path!r})\n")
+        subprocess.run([sys.executable, "-c", script], check=True, timeout=30,
+                       cwd=os.path.dirname(os.path.abspath(__file__)))
+        with open(path) as sent:
+            assert sent.read() == "sent"
+
+if __name__ == "__main__":
+    test_independent_stages_run_in_parallel()
+    test_first_result_is_available_before_the_rest()
+    test_dependency_errors_propagate()
+    test_unknown_dependency_is_rejected()
+    test_alerts_do_not_block_the_caller()
+    test_queued_alerts_are_sent_before_exit()
+
+    # Sequential vs staged message handling with simulated stage latencies
+    analysis_s, retrieval_s, alert_s, generation_s = 0.05, 0.08, 0.3, 0.4
+    start = time.perf_counter()
+    slow(None, analysis_s); slow(None, retrieval_s); slow(None, alert_s); slow(None, generation_s)
+    sequential = time.perf_counter() - start
+
+    start = time.perf_counter()
+    pipeline = StageGraph()
+    pipeline.add("analysis", slow, None, analysis_s)
+    pipeline.add("retrieval", slow, None, retrieval_s)
+    pipeline.add("generation", lambda a, r: slow(None, generation_s), deps=("analysis", "retrieval"))
+    pipeline.start()
+    pipeline.result("analysis")
+    enqueue_alert(slow, None, alert_s)
+    pipeline.result("generation")
+    staged = time.perf_counter() - start
+    wait_for_alerts()
+    print(f"Sequential: {sequential:.3f}s, staged: {staged:.3f}s ({sequential / staged:.1f}x)")
+    print("🎉 Message pipeline tests passed")
@@ -0,0 +1,69 @@
+"""
+Test risk-aware model routing
+"""
+
+import json
+import os
+import tempfile
+import model_router
+from model_router import choose_route, record_latency, log_routing_outcome, FAST_MODEL, LARGE_MODEL
+
+def test_short_positive_message_uses_fast_model():
+    """'I'm feeling great today' does not need the 70B model"""
+    route = choose_route(risk_score=0, sentiment_label="POSITIVE", message_length=len("I'm feeling great today"))
+    print(f"Route: {route}")
+    assert route['model'] == FAST_MODEL
+    assert route['max_tokens'] < 800
+
+def test_elevated_and_unknown_risk_use_large_model():
+    """Moderate risk and unscored messages always get the large model"""
+    assert choose_route(risk_score=5, sentiment_label="NEGATIVE", message_length=20)['model'] == LARGE_MODEL
+    assert choose_route(risk_score=None, message_length=20)['model'] == LARGE_MODEL
+    assert choose_route(risk_score=1, sentiment_label="NEGATIVE", message_length=20)['model'] == LARGE_MODEL
+
+def test_latency_fallback():
+    """Only low-risk messages fall back to the fast model when the large model is over budget"""
+    model_router._trackers.clear()
+    for _ in range(model_router.LATENCY_MIN_SAMPLES):
+        record_latency(LARGE_MODEL, model_router.LATENCY_BUDGET_SECONDS[LARGE_MODEL] + 5)
+    try:
+        route = choose_route(risk_score=1, sentiment_label="NEGATIVE", message_length=200)
+        print(f"Fallback route: {route['model']} - {route['reason']}")
+        assert route['model'] == FAST_MODEL
+        assert route['fallback'] is True
+
+        for risk_score in (4, 9, None):
+            route = choose_route(risk_score=risk_score, sentiment_label="NEGATIVE", message_length=200)
+            assert route['model'] == LARGE_MODEL
+            assert route['fallback'] is False
+            assert route['timeout'] >= model_router.OVER_BUDGET_TIMEOUT_SECONDS
+    finally:
+        model_router._trackers.clear()
+
+def test_routing_log():
+    """Outcomes are appended to the routing log with cost estimates"""
+    class Usage:
+        prompt_tokens = 1000
+        completion_tokens = 500
+
+    original = model_router.ROUTING_LOG_FILE
+    with tempfile.TemporaryDirectory() as tmp:
+        model_router.ROUTING_LOG_FILE = os.path.join(tmp, "routing.log")
+        try:
+            route = choose_route(risk_score=0, sentiment_label="NEUTRAL", message_length=10)
+            log_routing_outcome(route, 0.42, Usage())
+            with open(model_router.ROUTING_LOG_FILE) as f:
+                record = json.loads(f.readline())
+        finally:
+            model_router.ROUTING_LOG_FILE = original
+
+    assert record['model'] == route['model']
+    assert record['latency'] == 0.42
+    assert record['cost_usd'] > 0
+
+if __name__ == "__main__":
+    test_short_positive_message_uses_fast_model()
+    test_elevated_and_unknown_risk_use_large_model()
+    test_latency_fallback()
+    test_routing_log()
+    print("\n🎉 Model routing tests passed")
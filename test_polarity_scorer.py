@@ -0,0 +1,82 @@
+"""
+Parity of the native polarity scorer with TextBlob, and its speed
+"""
+
+import time
+import pandas as pd
+from textblob import TextBlob
+from textblob.en import parser
+from polarity_scorer import find_tokens, find_words, find_words_many, get_polarity_scorer, load_lexicon, text_sentiment
+
+EDGE_CASES = [
+    "", "!!!", "I'm not happy :(", "This is not a good day!!!", "really not good", "I am very very happy :D",
+    "X D haha", "(!) sure, great plan", "I can't believe it's so terribly bad...", "not a good idea",
+    'He said "great". Mr. Smith was U.S. based, e.g. fine.', "Not bad at all!\n\nVery nice :-)",
+    "I don't feel good", "never been better", "extremely sad and very lonely", "“Quoted” happy ‘text’",
+    "tab\tgood\x0bfine", "line\r\n\r\nnice . great", "I feel worthless :'( and hopeless", "wow ;) that's cool",
+]
+
+def corpus():
+    knowledge_base = pd.read_csv("AI_Mental_Health.csv")
+    return (EDGE_CASES + list(pd.read_csv("risk_training.csv")['text'])
+            + list(knowledge_base['Questions'].dropna()) + list(knowledge_base['Answers'].dropna()))
+
+def test_matches_textblob_on_corpus():
+    mismatches = []
+    for text in corpus():
+        expected = TextBlob(text).sentiment
+        polarity, subjectivity = text_sentiment(text)
+        if abs(polarity - expected.polarity) > 1e-9 or abs(subjectivity - expected.subjectivity) > 1e-9:
+            mismatches.append((text, tuple(expected), (polarity, subjectivity)))
+    assert not mismatches, mismatches[:5]
+
+def test_tokenizer_matches_pattern():
+    for text in corpus()[::5]:
+        assert find_tokens(text) == parser.find_tokens(text)
+
+def test_batch_matches_one_at_a_time():
+    texts = corpus()
+    assert find_words_many(texts) == [find_words(text) for text in texts]
+    assert get_polarity_scorer().sentiments(texts) == [text_sentiment(text) for text in texts]
+    # Emoticons and paragraph breaks at message boundaries, and the batch marker inside a message
+    edges = [":", ")", "good :)", "\n", "\nbad", "fine\x00great", "", "(!"]
+    assert find_words_many(edges) == [find_words(text) for text in edges]
+    assert find_words_many(edges[:-3]) == [find_words(text) for text in edges[:-3]]
+    assert find_words_many([]) == []
+
+def test_lexicon_rules():
+    lexicon = load_lexicon()
+    assert lexicon["good"][3] is False and lexicon["very"][3] is True
+    # Adverbs derived from adjectives
+    assert lexicon["terribly"][3] is True and lexicon["terribly"][0] < 0
+    scorer = get_polarity_scorer()
+    assert scorer.sentiment("good")[0] > 0 > scorer.sentiment("not good")[0]
+    assert scorer.sentiment("very good")[0] > scorer.sentiment("good")[0]
+    assert scorer.sentiment("good!")[0] > scorer.sentiment("good")[0]
+    assert scorer.sentiment("the table") == (0.0, 0.0)
+
+if __name__ == "__main__":
+    start = time.perf_counter()
+    TextBlob("warm up").sentiment
+    textblob_first = time.perf_counter() - start
+    start = time.perf_counter()
+    get_polarity_scorer()
+    native_first = time.perf_counter() - start
+    test_matches_textblob_on_corpus()
+    test_tokenizer_matches_pattern()
+    test_batch_matches_one_at_a_time()
+    test_lexicon_rules()
+
+    texts = corpus()
+    for name, analyze in (("TextBlob(text).sentiment", lambda text: TextBlob(text).sentiment),
+                          ("native scorer", text_sentiment)):
+        start = time.perf_counter()
+        for text in texts:
+            analyze(text)
+        elapsed = time.perf_counter() - start
+        print(f"{name}: {elapsed / len(texts) * 1e6:.0f}µs per message over {len(texts)} messages")
+    start = time.perf_counter()
+    get_polarity_scorer().sentiments(texts)
+    print(f"native scorer, one batch: {(time.perf_counter() - start) / len(texts) * 1e6:.0f}µs per message")
+    print(f"First call (lexicon load): TextBlob {textblob_first * 1000:.0f}ms, native {native_first * 1000:.0f}ms")
+    print("🎉 Polarity scorer tests passed")
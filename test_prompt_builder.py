@@ -0,0 +1,58 @@
+"""
+Test token-budgeted prompt assembly
+"""
+
+from prompt_builder import count_tokens, rank_kb_passages, build_messages, prompt_budget
+from model_router import choose_route, FAST_MODEL
+
+KNOWLEDGE_BASE = {
+    "what is anxiety?": "Anxiety is a feeling of worry, nervousness, or unease. " * 5,
+    "how can i manage anxiety at work?": "Take short breaks, breathe slowly and talk to someone you trust.",
+    "what is depression?": "Depression is a mood disorder that causes a persistent feeling of sadness.",
+    "how much sleep do i need?": "Most adults need seven to nine hours of sleep each night.",
+}
+
+def test_count_tokens():
+    """Token counts grow with text and are zero for empty text"""
+    assert count_tokens("") == 0
+    short = count_tokens("I feel anxious")
+    long = count_tokens("I feel anxious " * 20)
+    print(f"Tokens: short={short}, long={long}")
+    assert 0 < short < long
+
+def test_ranking():
+    """Questions sharing more content words rank first; stop words alone don't match"""
+    ranked = rank_kb_passages(KNOWLEDGE_BASE, "How do I manage anxiety at work?")
+    assert ranked[0][0] == "how can i manage anxiety at work?"
+    assert all("sleep" not in question for question, _ in ranked)
+    assert rank_kb_passages(KNOWLEDGE_BASE, "how can i") == []
+
+def test_whole_passages_within_budget():
+    """Passages are never cut mid-sentence and the prompt stays within budget"""
+    route = choose_route(risk_score=0, sentiment_label="NEUTRAL", message_length=10)
+    route['max_tokens'] = 300
+    passages = rank_kb_passages(KNOWLEDGE_BASE, "anxiety") * 50
+    messages, context, prompt_tokens = build_messages("You are WellBot.", "anxiety", passages, route)
+
+    print(f"Prompt tokens: {prompt_tokens} (budget {prompt_budget(route['model'], route['max_tokens'])})")
+    assert prompt_tokens <= prompt_budget(route['model'], route['max_tokens'])
+    assert route['prompt_tokens'] == prompt_tokens
+    for passage in context.split("\n\n"):
+        assert passage.startswith("Q: ") and "\nA: " in passage
+        assert passage.rstrip().endswith((".", "?"))
+
+def test_default_context():
+    """Without matches the default context is used, or omitted when None"""
+    route = {'model': FAST_MODEL, 'max_tokens': 300}
+    messages, context, _ = build_messages("You are WellBot.", "hello", [], route)
+    assert context == ""
+    assert messages[0]['content'].endswith("Context: General mental health support")
+    messages, _, _ = build_messages("You are WellBot.", "hello", [], route, default_context=None)
+    assert messages[0]['content'] == "You are WellBot."
+
+if __name__ == "__main__":
+    test_count_tokens()
+    test_ranking()
+    test_whole_passages_within_budget()
+    test_default_context()
+    print("\n🎉 Prompt builder tests passed")
@@ -0,0 +1,119 @@
+"""
+Test the semantic response cache
+"""
+
+import logging
+import time
+import metrics
+import response_cache
+from response_cache import SemanticResponseCache, log_cache_stats
+
+def test_paraphrase_hit():
+    """A paraphrase of a cached low-risk question is served from the cache"""
+    cache = SemanticResponseCache(audit_rate=1.0)
+    cache.store("How can I manage my anxiety?", "Try slow breathing.", risk_score=1)
+
+    response = cache.lookup("how can i manage my anxiety", risk_score=1)
+    print(f"Paraphrase lookup: {response}")
+    assert response == "Try slow breathing."
+    assert cache.stats()['hits'] == 1
+    assert len(cache.audit_samples) == 1
+
+def test_unrelated_miss():
+    """Unrelated questions do not hit"""
+    cache = SemanticResponseCache()
+    cache.store("How can I manage my anxiety?", "Try slow breathing.", risk_score=1)
+    assert cache.lookup("What are the warning signs of depression?", risk_score=1) is None
+    assert cache.stats()['misses'] == 1
+
+def test_crisis_bypass():
+    """Moderate and higher risk messages never read from or write to the cache"""
+    cache = SemanticResponseCache()
+    assert cache.store("I want to end my life", "response", risk_score=8) is False
+    cache.store("I feel tired today", "Rest helps.", risk_score=1)
+    assert cache.lookup("I feel tired today", risk_score=6) is None
+    assert cache.stats()['bypassed'] == 1
+    assert cache.stats()['entries'] == 1
+
+def test_negation_guard():
+    """Negated paraphrases are not served the cached answer"""
+    cache = SemanticResponseCache(threshold=0.5)
+    cache.store("I feel good about my progress", "That's wonderful!", risk_score=0)
+    assert cache.lookup("I don't feel good about my progress", risk_score=0) is None
+
+def test_context_and_name_adaptation():
+    """Entries are partitioned by context and personalized per user"""
+    cache = SemanticResponseCache()
+    cache.store("How do I sleep better?", "Alice, keep a regular schedule.", risk_score=0,
+                context="NEUTRAL", user_name="Alice")
+    assert cache.lookup("How do I sleep better?", risk_score=0, context="POSITIVE") is None
+    response = cache.lookup("How do I sleep better", risk_score=0, context="NEUTRAL", user_name="Bob")
+    assert response == "Bob, keep a regular schedule."
+
+def test_name_substitution_is_whole_word():
+    """Only the user's name itself is generalized; short or ambiguous names aren't cached"""
+    cache = SemanticResponseCache()
+    cache.store("How do I sleep better?", "Ann, annual checkups and a routine help. Also, Ann, rest.", risk_score=0,
+                user_name="Ann")
+    response = cache.lookup("How do I sleep better", risk_score=0, user_name="Bob")
+    assert response == "Bob, annual checkups and a routine help. Also, Bob, rest."
+
+    assert cache.store("What helps with stress?", "Al, also try walking.", risk_score=0, user_name="Al") is False
+    assert cache.store("Is there hope for me?", "Hope, there is always hope.", risk_score=0, user_name="Hope") is False
+    assert cache.stats()['entries'] == 1
+
+def test_lru_eviction():
+    """The least recently used entry is evicted when the cache is full"""
+    cache = SemanticResponseCache(capacity=2)
+    cache.store("first question about stress", "a", risk_score=0)
+    time.sleep(0.01)
+    cache.store("second question about sleep", "b", risk_score=0)
+    time.sleep(0.01)
+    cache.lookup("first question about stress", risk_score=0)
+    time.sleep(0.01)
+    cache.store("third question about diet", "c", risk_score=0)
+    assert cache.stats()['evictions'] == 1
+    assert cache.lookup("second question about sleep", risk_score=0) is None
+    assert cache.lookup("first question about stress", risk_score=0) == "a"
+
+def test_stats_report(caplog):
+    """log_cache_stats reports hit rate, memory and each audit sample once; counters reach metrics"""
+    cache = response_cache.get_response_cache("test_report")
+    cache.audit_rate = 1.0
+    hits = metrics.get_counter("response_cache_hits")
+    cache.store("How can I manage my anxiety?", "Try slow breathing.", risk_score=1)
+    cache.lookup("how can i manage my anxiety", risk_score=1)
+    cache.lookup("I feel tired today", risk_score=1)
+    assert metrics.get_counter("response_cache_hits") == hits + 1
+    assert cache.recent_audit_samples(1)[0]['cached_query'] == "how can i manage my anxiety"
+
+    with caplog.at_level(logging.INFO):
+        stats = log_cache_stats("test_report")
+        log_cache_stats("test_report")
+    assert stats['hit_rate'] == 0.5 and stats['memory_bytes'] > 0
+    assert sum("hit rate 50.0%" in message for message in caplog.messages) == 2
+    assert sum("audit" in message for message in caplog.messages) == 1
+
+if __name__ == "__main__":
+    test_paraphrase_hit()
+    test_unrelated_miss()
+    test_crisis_bypass()
+    test_negation_guard()
+    test_context_and_name_adaptation()
+    test_name_substitution_is_whole_word()
+    test_lru_eviction()
+
+    # Lookup latency and hit rate using the dataset questions as traffic
+    import pandas as pd
+    questions = pd.read_csv("AI_Mental_Health.csv")["Questions"].dropna().astype(str).tolist()
+    cache = SemanticResponseCache()
+    for question in questions[:cache.capacity]:
+        cache.store(question, "cached answer", risk_score=0)
+    traffic = [q.lower().rstrip("?") for q in questions[:1000]]
+    start = time.perf_counter()
+    for question in traffic:
+        cache.lookup(question, risk_score=0)
+    elapsed = time.perf_counter() - start
+    print(f"\n⚡ {len(traffic)} lookups on {cache.stats()['entries']} entries: {elapsed / len(traffic) * 1000:.3f} ms avg")
+    print(f"📊 Stats: {cache.stats()}")
+    print("\n🎉 Response cache tests passed")
@@ -0,0 +1,161 @@
+"""
+Test the trained linear risk classifier and benchmark it against the keyword rules
+"""
+
+import os
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+import risk_classifier
+from risk_classifier import (RISK_TRAINING_PATH, SEED_MESSAGES, RiskClassifier, agreement, classify_risk,
+                             get_risk_classifier, label_messages, level_band, load_labels, message_features, model_path,
+                             sentiment_label)
+from risk_rules import get_rule_set
+
+def test_features_are_deterministic_and_sparse():
+    ids, counts, tokens = message_features("I feel hopeless, hopeless and worthless")
+    assert tokens == 6 and len(ids) == len(set(ids.tolist())) and counts.max() >= 2
+    again = message_features("I feel hopeless, hopeless and worthless")
+    assert ids.tolist() == again[0].tolist() and counts.tolist() == again[1].tolist()
+    assert message_features("")[2] == 0
+
+def test_levels_and_labels_match_the_rules():
+    rules = get_rule_set("simple")
+    assert [rules.crisis_level(risk) for risk in (0, 3, 4, 6, 7, 8, 10)] == \
+        ["LOW", "LOW", "MODERATE", "HIGH", "HIGH", "SEVERE", "SEVERE"]
+    # Each model reports levels with the thresholds of the rule set it was trained on
+    for name in ("simple", "standard"):
+        assert get_risk_classifier(model_path(name)).rules is get_rule_set(name)
+    assert [sentiment_label(polarity) for polarity in (-0.5, -0.1, 0.0, 0.1, 0.5)] == \
+        ["NEGATIVE", "NEUTRAL", "NEUTRAL", "NEUTRAL", "POSITIVE"]
+
+def test_learns_an_additive_keyword_rule():
+    """Each keyword adds 4 points up to the cap, which a linear model can represent"""
+    keywords = ["hopeless", "worthless", "overdose"]
+    fillers = ["today", "at school", "with my family", "after work", "again", "lately"]
+    texts = [f"I feel {first} {filler}" for first in keywords + ["fine", "tired"] for filler in fillers]
+    texts += [f"{first} and {second} {filler}" for first in keywords for second in keywords if first != second
+              for filler in fillers[:3]]
+    texts += [f"hopeless and worthless and I want an overdose {filler}" for filler in fillers]
+    risks = [min(sum(4 for keyword in keywords if keyword in text), 10) for text in texts]
+    polarities = [-0.5 if risk else 0.2 for risk in risks]
+    classifier = RiskClassifier.train(texts, polarities, risks, penalty=0.1)
+    assert classifier.analyze("I feel fine this morning")[2] == "LOW"
+    assert classifier.analyze("I feel hopeless this morning")[1] in (3, 4, 5)
+    assert classifier.analyze("worthless and overdose tonight")[1] in (7, 8, 9)
+    assert classifier.analyze("hopeless and worthless and I want an overdose tonight")[1] == 10
+
+def test_trained_weights_agree_on_the_seed_phrases():
+    classifier = get_risk_classifier()
+    assert classifier is not None and classifier.weights.shape == (risk_classifier.FEATURE_DIM, 2)
+    enabled = risk_classifier.RISK_CLASSIFIER
+    try:
+        risk_classifier.RISK_CLASSIFIER = True
+        results = {message: classify_risk(message) for message in SEED_MESSAGES}
+    finally:
+        risk_classifier.RISK_CLASSIFIER = enabled
+    assert results["Hello, how are you today?"][1:] == (0, "LOW", "NEUTRAL")
+    for message in ("I want to kill myself", "I want to cut myself", "I feel hopeless and worthless"):
+        assert results[message][2] == "SEVERE"
+    assert results["I am feeling sad and depressed"][2:] == ("MODERATE", "NEGATIVE")
+    assert all(-1 <= polarity <= 1 and 0 <= risk <= 10 for polarity, risk, _, _ in results.values())
+
+def test_unknown_text_scores_low():
+    """Without an intercept, words the model hasn't seen add no risk"""
+    for name in ("simple", "standard"):
+        classifier = get_risk_classifier(model_path(name))
+        for message in ("my exam went well", "xyzzy"):
+            assert classifier.analyze(message)[1] <= 1, (name, message)
+        # The hand labels raise first-person wording ("I ...") above what the rules give it
+        assert classifier.analyze("I passed my driving test")[2] == "LOW", name
+
+def test_hand_labels_override_the_rules():
+    labels = load_labels()
+    assert set(SEED_MESSAGES) <= set(labels['text'])
+    assert set(labels['crisis_level']) == {"LOW", "MODERATE", "HIGH", "SEVERE"}
+    rules = get_rule_set("simple")
+    assert [level_band(rules, level) for level in ("LOW", "MODERATE", "HIGH", "SEVERE")] == \
+        [(0, 3), (4, 5), (6, 7), (8, 10)]
+    labeled = pd.DataFrame({'text': ["This traffic is killing me", "I've written goodbye letters to my family",
+                                     "I feel sad"],
+                            'crisis_level': ["LOW", "SEVERE", "MODERATE"]})
+    frame = label_messages(["I feel sad", "I want to die"], rules, labeled, weight=2)
+    assert len(frame) == 7 and list(frame['source']).count("human") == 6
+    risks = dict(zip(frame['text'], frame['risk_score']))
+    assert risks["I want to die"] == rules.assess("I want to die")[1]
+    assert risks["I've written goodbye letters to my family"] == 8 and risks["I feel sad"] == 4
+    assert risks["This traffic is killing me"] <= 3
+
+def test_save_load_and_switch():
+    classifier = get_risk_classifier()
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "weights.npz")
+        classifier.save(path)
+        loaded = RiskClassifier.load(path)
+        assert loaded.analyze("I feel like cutting") == classifier.analyze("I feel like cutting")
+        assert get_risk_classifier(path) is not classifier and get_risk_classifier(path) is get_risk_classifier(path)
+        assert get_risk_classifier(os.path.join(directory, "missing.npz")) is None
+        corrupt = os.path.join(directory, "corrupt.npz")
+        with open(corrupt, "wb") as output:
+            output.write(b"not a weights file")
+        assert get_risk_classifier(corrupt) is None
+        assert get_risk_classifier(model_path("standard")) is not classifier
+    enabled = risk_classifier.RISK_CLASSIFIER
+    try:
+        risk_classifier.RISK_CLASSIFIER = False
+        assert classify_risk("I want to die") is None
+        risk_classifier.RISK_CLASSIFIER = True
+        assert classify_risk("I want to die") == classifier.analyze("I want to die")
+        assert classify_risk("I want to die", "no such rule set") is None
+    finally:
+        risk_classifier.RISK_CLASSIFIER = enabled
+
+def test_each_rule_set_keeps_its_scale_and_crisis_floor():
+    enabled = risk_classifier.RISK_CLASSIFIER
+    try:
+        risk_classifier.RISK_CLASSIFIER = True
+        for name in ("simple", "standard"):
+            rules = get_rule_set(name)
+            for message in ("Better off dead honestly", "Everyone would be better without me", "I want to kill myself",
+                            "I feel hopeless and worthless"):
+                result = classify_risk(message, name)
+                assert result[1] >= rules.assess(message)[1] and result[2] == rules.crisis_level(result[1]), message
+        # The standard rules score a crisis phrase 2 points, not 4
+        assert classify_risk("I want to kill myself", "standard")[1] < classify_risk("I want to kill myself")[1]
+    finally:
+        risk_classifier.RISK_CLASSIFIER = enabled
+
+if __name__ == "__main__":
+    test_features_are_deterministic_and_sparse()
+    test_levels_and_labels_match_the_rules()
+    test_learns_an_additive_keyword_rule()
+    test_trained_weights_agree_on_the_seed_phrases()
+    test_unknown_text_scores_low()
+    test_hand_labels_override_the_rules()
+    test_save_load_and_switch()
+    test_each_rule_set_keeps_its_scale_and_crisis_floor()
+
+    frame = label_messages(pd.read_csv(RISK_TRAINING_PATH)['text'], "simple")
+    split = int(len(frame) * 0.8)
+    held_out = RiskClassifier.train(frame['text'][:split], frame['polarity'][:split], frame['risk_score'][:split])
+    stats = agreement(held_out, frame[split:].reset_index(drop=True))
+    print(f"Held-out agreement with the keyword rules on {stats['messages']} messages: crisis level "
+          f"{stats['crisis_level']:.1%}, exact risk {stats['risk_score']:.1%}, sentiment label "
+          f"{stats['sentiment_label']:.1%}, polarity error {stats['polarity_error']:.3f}, "
+          f"{stats['missed_high_risk']}/{stats['high_risk']} HIGH+ messages scored lower")
+
+    classifier = RiskClassifier.load(model_path("simple"))
+    risk_classifier.RISK_CLASSIFIER = True
+    messages = list(frame['text'][:1000])
+    for name, analyze in (("keyword rules", get_rule_set("simple").assess), ("linear classifier", classifier.analyze),
+                          ("classify_risk (with crisis floor)", classify_risk)):
+        analyze(messages[0])
+        start = time.perf_counter()
+        for message in messages:
+            analyze(message)
+        elapsed = time.perf_counter() - start
+        print(f"{name}: {elapsed / len(messages) * 1e6:.0f}µs per message")
+    print(f"Weights: {np.count_nonzero(classifier.weights[:, 1])} non-zero of {len(classifier.weights)} hashed slots, "
+          f"{os.path.getsize(model_path('simple')) / 1e3:.0f}KB on disk")
+    print("🎉 Risk classifier tests passed")
@@ -0,0 +1,141 @@
+"""
+Test offline re-scoring of message archives: formats, resume from a checkpoint, the level diff
+"""
+
+import json
+import os
+import random
+import tempfile
+import time
+import pandas as pd
+import pytest
+from kb_ingest import peak_rss_bytes
+from risk_rescore import checkpoint_path, format_diff, iter_batches, rescore_archives
+from risk_scoring import analyze_many
+
+MESSAGES = list(pd.read_csv("risk_training.csv")['text'][:300])
+
+def write_archive(directory):
+    """A chat-history JSONL (with blank, malformed and bot-only lines) and a CSV of the same messages"""
+    jsonl_path = os.path.join(directory, "history.jsonl")
+    with open(jsonl_path, "w", encoding="utf-8") as output:
+        for i, message in enumerate(MESSAGES):
+            output.write(json.dumps({'user': message, 'bot': "I'm here for you", 'timestamp': i}) + "\n")
+            if i % 50 == 0:
+                output.write("\n{not json\n" + json.dumps({'bot': "hello"}) + "\n")
+    csv_path = os.path.join(directory, "messages.csv")
+    pd.DataFrame({'id': range(len(MESSAGES)), 'text': MESSAGES}).to_csv(csv_path, index=False)
+    return jsonl_path, csv_path
+
+def read_results(path):
+    with open(path, encoding="utf-8") as results:
+        return [json.loads(line) for line in results]
+
+def test_scores_jsonl_and_csv_like_analyze_many():
+    with tempfile.TemporaryDirectory() as directory:
+        jsonl_path, csv_path = write_archive(directory)
+        output = os.path.join(directory, "rescored.jsonl")
+        stats = rescore_archives([jsonl_path, csv_path], output, rules="standard", old_rules="simple",
+                                 batch_size=64, workers=1)
+        results = read_results(output)
+        assert stats['messages'] == len(results) == 2 * len(MESSAGES) and stats['skipped'] == 2 * 6
+        expected, old = analyze_many(MESSAGES, "standard"), analyze_many(MESSAGES, "simple")
+        for results_part in (results[:len(MESSAGES)], results[len(MESSAGES):]):
+            assert [row['risk_score'] for row in results_part] == expected['risk_score'].tolist()
+            assert [row['old_crisis_level'] for row in results_part] == old['crisis_level'].tolist()
+        assert results[-1]['id'] == str(len(MESSAGES) - 1) and results[-1]['source'] == csv_path
+        # Records count every non-blank line, messages or not
+        assert results[1]['record'] == 3 and results[0]['id'] is None
+
+def test_skipping_records_lines_up():
+    with tempfile.TemporaryDirectory() as directory:
+        for path in write_archive(directory):
+            everything = [item for batch in iter_batches(path, batch_size=7) for item in batch]
+            resumed = [item for batch in iter_batches(path, batch_size=7, skip=12) for item in batch]
+            assert resumed == everything[12:] and [item[0] for item in everything] == list(range(len(everything)))
+
+def test_resumes_after_an_interruption():
+    with tempfile.TemporaryDirectory() as directory:
+        paths = write_archive(directory)
+        complete = os.path.join(directory, "complete.jsonl")
+        rescore_archives(paths, complete, rules="standard", batch_size=40, workers=1)
+
+        output = os.path.join(directory, "interrupted.jsonl")
+        batches = []
+
+        def interrupt(stats):
+            batches.append(stats['records'])
+            if len(batches) == 5:
+                raise KeyboardInterrupt
+
+        with pytest.raises(KeyboardInterrupt):
+            rescore_archives(paths, output, rules="standard", batch_size=40, workers=1, on_batch=interrupt)
+        # A batch written after the last checkpoint, cut short
+        with open(output, "a", encoding="utf-8") as partial:
+            partial.write('{"source": "history.jsonl", "rec')
+        with pytest.raises(ValueError):
+            rescore_archives(paths, output, rules="simple", batch_size=40, workers=1, resume=True)
+        stats = rescore_archives(paths, output, rules="standard", batch_size=40, workers=1, resume=True)
+        assert stats['resumed_records'] == batches[-1] > 0
+        assert read_results(output) == read_results(complete)
+        assert rescore_archives(paths, output, rules="standard", batch_size=40, workers=1,
+                                resume=True)['records'] == stats['records']
+
+def test_pool_and_level_diff():
+    with tempfile.TemporaryDirectory() as directory:
+        jsonl_path, _ = write_archive(directory)
+        rules_path = os.path.join(directory, "lonely.json")
+        with open(rules_path, "w", encoding="utf-8") as rules_file:
+            json.dump({'base': "simple", 'keyword_groups': [{'name': "crisis", 'points': 4, 'phrases': ["lonely"]}],
+                       'crisis_levels': {'SEVERE': 8, 'HIGH': 6, 'MODERATE': 2}}, rules_file)
+        serial = os.path.join(directory, "serial.jsonl")
+        stats = rescore_archives(jsonl_path, serial, rules=rules_path, batch_size=50, workers=1, changes_only=True)
+        parallel = os.path.join(directory, "parallel.jsonl")
+        assert rescore_archives(jsonl_path, parallel, rules=rules_path, batch_size=50, workers=2,
+                                changes_only=True)['transitions'] == stats['transitions']
+        assert read_results(parallel) == read_results(serial)
+        changed = read_results(serial)
+        assert changed and all(row['crisis_level'] != row['old_crisis_level'] for row in changed)
+        assert stats['written'] == len(changed) == sum(count for (old, new), count in stats['transitions'].items()
+                                                       if old != new)
+        assert stats['rules'] == "lonely" and f"{len(changed):,} of {len(MESSAGES):,} messages" in format_diff(stats)
+        assert os.path.exists(checkpoint_path(serial))
+
+def test_archives_without_messages():
+    """Archives with no text records (or none at all) still produce a diff, also when resumed"""
+    with tempfile.TemporaryDirectory() as directory:
+        no_text, empty = os.path.join(directory, "no_text.jsonl"), os.path.join(directory, "empty.jsonl")
+        with open(no_text, "w", encoding="utf-8") as output:
+            output.write('{"id": 1}\n')
+        open(empty, "w").close()
+        for paths in ([no_text], [empty]):
+            output = os.path.join(directory, "out.jsonl")
+            for resume in (False, True):
+                stats = rescore_archives(paths, output, workers=1, resume=resume)
+                assert stats['messages'] == 0 and stats['transitions'] == {}
+                assert "0 of 0 messages changed level" in format_diff(stats)
+
+if __name__ == "__main__":
+    test_scores_jsonl_and_csv_like_analyze_many()
+    test_skipping_records_lines_up()
+    test_resumes_after_an_interruption()
+    test_pool_and_level_diff()
+    test_archives_without_messages()
+
+    rng = random.Random(5)
+    with tempfile.TemporaryDirectory() as directory:
+        archive = os.path.join(directory, "archive.jsonl")
+        with open(archive, "w", encoding="utf-8") as output:
+            for i in range(300_000):
+                message = f"{rng.choice(MESSAGES)} {rng.choice(MESSAGES)}"
+                output.write(json.dumps({'id': i, 'user': message, 'bot': "..."}) + "\n")
+        size = os.path.getsize(archive)
+        for workers in sorted({1, os.cpu_count() or 1}):
+            start = time.perf_counter()
+            stats = rescore_archives(archive, os.path.join(directory, f"rescored-{workers}.jsonl"), rules="standard",
+                                     workers=workers)
+            elapsed = time.perf_counter() - start
+            print(f"{workers} worker(s): {stats['messages']:,} messages ({size / 1e6:.0f}MB) in {elapsed:.1f}s, "
+                  f"{stats['messages'] / elapsed:,.0f} messages/s, peak RSS {peak_rss_bytes() / 1e6:.0f}MB")
+        print(format_diff(stats))
+    print("🎉 Risk rescore tests passed")
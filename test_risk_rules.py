@@ -0,0 +1,166 @@
+"""
+Test the shared risk rules against the per-app rules they replaced, and their reloads
+"""
+
+import json
+import os
+import tempfile
+import threading
+import time
+import pandas as pd
+import pytest
+import metrics
+from polarity_scorer import text_sentiment
+from risk_rules import RiskRulesFile, compile_rule_sets, get_rule_set, load_rules, read_rule_sets
+
+# The keyword lists and arithmetic the apps had before risk_rules.json
+SIMPLE_KEYWORDS = [
+    'suicide', 'kill myself', 'end my life', 'want to die', 'better off dead',
+    'no point living', 'can\'t go on', 'end it all', 'hurt myself', 'self harm',
+    'cutting', 'cut myself', 'want to cut', 'going to cut', 'overdose', 'jump off',
+    'hang myself', 'worthless', 'hopeless', 'can\'t take it anymore', 'can\'t take this anymore',
+    'nobody cares', 'everyone would be better without me', 'want to kill myself',
+    'going to kill myself', 'self-harm', 'self injury', 'harm myself', 'injure myself', 'bleeding'
+]
+STANDARD_KEYWORDS = [
+    'suicide', 'kill myself', 'end my life', 'want to die', 'better off dead',
+    'no point living', 'can\'t go on', 'end it all', 'hurt myself', 'self harm',
+    'cutting', 'overdose', 'jump off', 'hang myself', 'worthless', 'hopeless',
+    'can\'t take it anymore', 'nobody cares', 'everyone would be better without me'
+]
+
+def level_and_label(risk_score, polarity):
+    level = "SEVERE" if risk_score >= 8 else "HIGH" if risk_score >= 6 else "MODERATE" if risk_score >= 4 else "LOW"
+    label = "POSITIVE" if polarity > 0.1 else "NEGATIVE" if polarity < -0.1 else "NEUTRAL"
+    return level, label
+
+def legacy_simple(text):
+    polarity = text_sentiment(text)[0]
+    text_lower = text.lower()
+    risk_score = sum(1 for keyword in SIMPLE_KEYWORDS if keyword in text_lower) * 4
+    risk_score += 3 if polarity <= -0.5 else 2 if polarity <= -0.2 else 1 if polarity < 0 else 0
+    risk_score += sum(1 for word in ['depressed', 'depression', 'anxiety', 'anxious', 'panic', 'scared', 'suicidal',
+                                     'desperate', 'overwhelmed'] if word in text_lower)
+    risk_score = min(risk_score, 10)
+    return (polarity, risk_score, *level_and_label(risk_score, polarity))
+
+def legacy_standard(text):
+    polarity = text_sentiment(text.lower())[0]
+    risk_score = 3 if polarity < -0.5 else 2 if polarity < -0.2 else 1 if polarity < 0 else 0
+    risk_score += sum(1 for keyword in STANDARD_KEYWORDS if keyword in text.lower()) * 2
+    if any(word in text.lower() for word in ['depressed', 'anxiety', 'panic', 'scared']):
+        risk_score += 1
+    risk_score = min(risk_score, 10)
+    return (polarity, risk_score, *level_and_label(risk_score, polarity))
+
+def corpus():
+    return list(pd.read_csv("risk_training.csv")['text']) + [
+        "", "I CAN'T GO ON", "cutting cutting", "Self-Harm and self harm", "I'm scared, anxious and DEPRESSED",
+        "everyone would be better without me, I want to kill myself", "I feel great today!"]
+
+def write_rules(path, declarations):
+    with open(path, "w", encoding="utf-8") as rules_file:
+        json.dump({'rule_sets': declarations}, rules_file)
+    # A distinct mtime even on coarse-grained filesystems
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+
+SMALL_RULES = {
+    'small': {
+        'keyword_groups': [{'name': "crisis", 'points': 5, 'phrases': ["Hopeless", "hopeless", "cut"]},
+                           {'name': "distress", 'points': 2, 'count': "any", 'phrases': ["sad", "cut"]}],
+        'polarity_buckets': [{'at_most': -0.5, 'points': 1}],
+        'crisis_levels': {'HIGH': 6, 'MODERATE': 3},
+        'max_risk': 9,
+    },
+    'strict': {'base': "small", 'max_risk': 4},
+}
+
+def test_config_reproduces_the_app_rules():
+    simple, standard = get_rule_set("simple"), get_rule_set("standard")
+    for text in corpus():
+        assert simple.assess(text)[:4] == legacy_simple(text), text
+        assert standard.assess(text)[:4] == legacy_standard(text), text
+
+def test_compiled_phrase_and_weight_table():
+    rule_sets = compile_rule_sets(SMALL_RULES)
+    small = rule_sets['small']
+    # One table across groups; a phrase listed twice in an "each" group counts twice
+    assert small.phrases == ("hopeless", "cut", "sad") and small.phrase_points == [10, 5, 0]
+    assert small.once_groups == [(2, (1, 2))] and small.group_phrases['crisis'] == (0, 1)
+    # "sad" is also -0.5 polarity, which the at_most bucket includes
+    assert small.assess("so sad")[1:3] == (3, "MODERATE") and small.assess("a table")[1:3] == (0, "LOW")
+    assert small.assess("I cut myself, sad")[1:3] == (8, "HIGH")
+    assert small.assess("HOPELESS, I cut")[1] == 9
+    assert rule_sets['strict'].assess("HOPELESS, I cut")[1:3] == (4, "MODERATE")
+    assert rule_sets['strict'].to_dict()['keyword_groups'] == small.to_dict()['keyword_groups']
+    for broken in ({'polarity_buckets': [{'points': 1}]}, {'keyword_groups': [{'name': "x", 'count': "some",
+                                                                                 'phrases': []}]}):
+        with pytest.raises(ValueError):
+            compile_rule_sets({'broken': dict(SMALL_RULES['small'], **broken)})
+    with pytest.raises(ValueError):
+        compile_rule_sets({'loop': {'base': "loop"}})
+
+def test_rules_file_for_a_rescore():
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "standard.json")
+        with open(path, "w", encoding="utf-8") as rules_file:
+            json.dump({'base': "standard", 'max_risk': 5}, rules_file)
+        derived = load_rules(path)
+        assert derived.name == "standard" and derived.max_risk == 5
+        assert derived.phrases == get_rule_set("standard").phrases and get_rule_set("standard").max_risk == 10
+    assert load_rules("simple") is get_rule_set("simple") and load_rules(derived) is derived
+
+def test_reloads_swap_whole_rule_sets():
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "rules.json")
+        write_rules(path, SMALL_RULES)
+        rules_file = RiskRulesFile(path, check_seconds=0)
+        assert rules_file.get("small").assess("cut")[1] == 7 and rules_file.refresh() is False
+
+        # Readers running through a reload see the old rules or the new ones
+        seen, done = set(), threading.Event()
+
+        def read():
+            while not done.is_set():
+                seen.add(rules_file.get("small").assess("cut")[1])
+
+        reader = threading.Thread(target=read)
+        reader.start()
+        changed = json.loads(json.dumps(SMALL_RULES))
+        changed['small']['keyword_groups'][0]['points'] = 1
+        for _ in range(20):
+            write_rules(path, changed)
+            write_rules(path, SMALL_RULES)
+        done.set()
+        reader.join()
+        assert seen <= {3, 7}
+
+        write_rules(path, changed)
+        assert rules_file.get("small").assess("cut")[1] == 3 and sorted(rules_file.names()) == ["small", "strict"]
+        errors = metrics.get_counter("risk_rules_reload_errors")
+        with open(path, "w", encoding="utf-8") as broken:
+            broken.write('{"rule_sets": {"small": ')
+        os.utime(path, ns=(0, os.stat(path).st_mtime_ns + 2_000_000_000))
+        assert rules_file.refresh() is False and rules_file.get("small").assess("cut")[1] == 3
+        assert metrics.get_counter("risk_rules_reload_errors") == errors + 1
+
+if __name__ == "__main__":
+    test_config_reproduces_the_app_rules()
+    test_compiled_phrase_and_weight_table()
+    test_rules_file_for_a_rescore()
+    test_reloads_swap_whole_rule_sets()
+
+    texts = corpus()
+    for name, legacy, rule_set in (("simple", legacy_simple, get_rule_set("simple")),
+                                   ("standard", legacy_standard, get_rule_set("standard"))):
+        for label, analyze in (("per-app code", legacy), ("compiled rule set", rule_set.assess)):
+            start = time.perf_counter()
+            for text in texts:
+                analyze(text)
+            elapsed = time.perf_counter() - start
+            print(f"{name} rules, {label}: {elapsed / len(texts) * 1e6:.1f}µs per message")
+    start = time.perf_counter()
+    read_rule_sets()
+    print(f"Compiling risk_rules.json: {(time.perf_counter() - start) * 1000:.2f}ms")
+    print("🎉 Risk rules tests passed")
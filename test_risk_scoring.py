@@ -0,0 +1,83 @@
+"""
+Test batch sentiment and risk scoring against the apps' per-message analysis, and its throughput
+"""
+
+import contextlib
+import io
+import os
+import random
+import time
+import numpy as np
+import pandas as pd
+import risk_scoring
+from risk_rules import get_rule_set
+from risk_scoring import analyze_many
+
+with contextlib.redirect_stdout(io.StringIO()):
+    from Enhanced_Mental_Health_Chatbot import analyze_sentiment_and_risk as enhanced_analysis
+    from Simple_Authenticated_Chatbot import analyze_sentiment_and_risk as simple_analysis
+
+EXTRA_MESSAGES = ["", "I CAN'T GO ON", "Everyone would be better without me.", "I'm scared, anxious and overwhelmed",
+                  "cutting cutting cutting", "I feel great today!", "self-harm\nself harm"]
+
+def corpus():
+    return list(pd.read_csv("risk_training.csv")['text']) + EXTRA_MESSAGES
+
+def assert_matches(results, texts, analysis):
+    with contextlib.redirect_stdout(io.StringIO()):
+        expected = [analysis(text) for text in texts]
+    assert np.allclose(results['polarity'].to_numpy(), [row[0] for row in expected], atol=1e-12)
+    assert results['risk_score'].tolist() == [row[1] for row in expected]
+    assert results['crisis_level'].tolist() == [row[2] for row in expected]
+    assert results['sentiment_label'].tolist() == [row[3] for row in expected]
+
+def test_matches_each_apps_rules():
+    texts = corpus()
+    assert_matches(analyze_many(texts, get_rule_set("simple")), texts, simple_analysis)
+    assert_matches(analyze_many(texts, "standard"), texts, enhanced_analysis)
+
+def test_columns_and_alignment():
+    messages = pd.Series(["I want to die", None, float("nan"), "I want to die", "hello"], index=[10, 11, 12, 13, 14])
+    results = analyze_many(messages)
+    assert list(results.index) == [10, 11, 12, 13, 14]
+    assert list(results.columns) == ["polarity", "subjectivity", "risk_score", "crisis_level", "sentiment_label",
+                                     "crisis_keywords"]
+    assert results.loc[10, 'crisis_keywords'] == 1 and results.loc[10].equals(results.loc[13])
+    assert results.loc[11, 'risk_score'] == 0 and results.loc[12, 'crisis_level'] == "LOW"
+    assert len(analyze_many([])) == 0
+    # A message containing the batch separator still lines up
+    assert analyze_many(["hopeless\x00worthless", "fine"])['crisis_keywords'].tolist() == [2, 0]
+
+def test_process_pool_matches_serial():
+    texts = corpus()[:400]
+    parallel_min = risk_scoring.RISK_BATCH_PARALLEL_MIN
+    try:
+        risk_scoring.RISK_BATCH_PARALLEL_MIN = 100
+        parallel = analyze_many(texts, workers=2, chunk_size=150)
+    finally:
+        risk_scoring.RISK_BATCH_PARALLEL_MIN = parallel_min
+    assert parallel.equals(analyze_many(texts, workers=1))
+
+if __name__ == "__main__":
+    test_matches_each_apps_rules()
+    test_columns_and_alignment()
+    test_process_pool_matches_serial()
+
+    rng = random.Random(3)
+    base = corpus()
+    # An archive: mostly distinct messages, with the usual repeats
+    archive = [f"{rng.choice(base)} {rng.choice(base)}" if rng.random() < 0.8 else rng.choice(base)
+               for _ in range(60_000)]
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        for text in archive[:5000]:
+            simple_analysis(text)
+        one_by_one = (time.perf_counter() - start) / 5000
+    print(f"analyze_sentiment_and_risk one message at a time: {1 / one_by_one:,.0f} messages/s")
+    for workers in sorted({1, 2, os.cpu_count() or 1}):
+        risk_scoring.RISK_BATCH_PARALLEL_MIN = 1
+        start = time.perf_counter()
+        analyze_many(archive, workers=workers)
+        elapsed = time.perf_counter() - start
+        print(f"analyze_many, {workers} worker(s) on {os.cpu_count()} CPUs: {len(archive) / elapsed:,.0f} messages/s")
+    print("🎉 Batch risk scoring tests passed")
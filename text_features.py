@@ -0,0 +1,69 @@
+"""
+Shared text normalization and feature hashing helpers
+Used by the response cache and the knowledge base indexes
+"""
+
+import re
+import zlib
+import numpy as np
+
+# Words are lowercase letters/digits, keeping apostrophes so "can't" stays one token
+WORD_PATTERN = re.compile(r"[a-z0-9]+(?:'[a-z]+)?")
+
+NEGATION_WORDS = {
+    'not', 'no', 'never', 'nothing', 'nobody', 'none', 'cannot',
+    "can't", "don't", "doesn't", "didn't", "won't", "isn't", "aren't", "wasn't", "couldn't"
+}
+
+# Very common words that carry no topical signal when ranking knowledge base matches
+STOP_WORDS = {
+    'a', 'an', 'the', 'and', 'or', 'but', 'if', 'of', 'to', 'in', 'on', 'at', 'for', 'with', 'by',
+    'from', 'about', 'as', 'is', 'are', 'was', 'were', 'be', 'been', 'am', 'do', 'does', 'did',
+    'i', 'me', 'my', 'you', 'your', 'we', 'it', 'its', 'this', 'that', 'what', 'how', 'can',
+    'should', 'would', 'could', 'so', 'there', 'have', 'has', 'had', 'im', "i'm", 'just', 'really'
+}
+
+def tokenize(text):
+    """Split text into lowercase word tokens"""
+    return WORD_PATTERN.findall(str(text).lower().replace("’", "'"))
+
+def normalize_text(text):
+    """Lowercase, drop punctuation and collapse whitespace"""
+    return " ".join(tokenize(text))
+
+def content_tokens(text):
+    """Tokens with stop words removed"""
+    return [token for token in tokenize(text) if token not in STOP_WORDS]
+
+def negation_signature(tokens):
+    """Return the set of negation words in a token list (used to guard against 'I feel good' ~ 'I don't feel good')"""
+    return frozenset(token for token in tokens if token in NEGATION_WORDS)
+
+def hashed_features(text, ngram_chars=3):
+    """
+    Yield string features for hashing: word unigrams, word bigrams and
+    character trigrams of the normalized text
+    """
+    tokens = tokenize(text)
+    for token in tokens:
+        yield "w:" + token
+    for first, second in zip(tokens, tokens[1:]):
+        yield "b:" + first + " " + second
+    normalized = " " + " ".join(tokens) + " "
+    for i in range(len(normalized) - ngram_chars + 1):
+        yield "c:" + normalized[i:i + ngram_chars]
+
+def hash_vectorize(text, dim=1024):
+    """
+    Signed feature hashing into a fixed-size, L2-normalized float32 vector
+    Deterministic across processes (crc32, not Python's salted hash())
+    """
+    vector = np.zeros(dim, dtype=np.float32)
+    for feature in hashed_features(text):
+        h = zlib.crc32(feature.encode("utf-8"))
+        sign = 1.0 if h & 0x80000000 else -1.0
+        vector[h % dim] += sign
+    norm = np.linalg.norm(vector)
+    if norm > 0:
+        vector /= norm
+    return vector